@@ -1,12 +1,42 @@
 import sqlite3
 import logging
 import json
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, g, has_request_context
 from datetime import datetime, date, timedelta #timedelta es NUEVO
 import ble_utils
 import math # Para math.ceil en el cálculo de total_pages
 import pytz # Para manejo de zonas horarias
 from collections import defaultdict # NUEVO para manufacturer_analysis
+import live_devices
+import fingerprint
+import sketches
+import base64
+import sharding
+import storage
+import ingest_control
+import rules
+import sessions
+import read_pool
+import query_budget
+import snapshot
+import profiling
+import cooccurrence
+import proximity
+import maintenance
+import federation
+import os
+import sys
+import time
+import functools
+import hmac
+import contextvars
+import select
+import socket
+import threading
+import heapq
+import itertools
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # --- Configuración ---
 DATABASE_NAME = 'ble_data.db'
@@ -17,6 +47,141 @@ API_ENDPOINT_PATH = '/api/ble-data'
 TARGET_TIMEZONE_PYTZ = pytz.timezone('Atlantic/Canary')
 SQLITE_ANALYTICS_TIME_OFFSET = '+1 hours' 
 
+# --- Sharding por ESP ---
+# Patrón (fnmatch) de esp_device_id -> nombre de shard. Cada shard es un fichero SQLite con su propio
+# escritor; los ESPs sin patrón van al shard por defecto (DATABASE_NAME). Vacío = una sola base de datos.
+# Tras cambiar las rutas con datos existentes, ejecutar offline: python backend_server.py --rebalance-shards
+SHARD_ROUTES = {}   # Ejemplo: {'ESP_EdificioA_*': 'edificio_a', 'ESP_EdificioB_*': 'edificio_b'}
+SHARD_DATABASE_TEMPLATE = 'ble_data_{shard}.db'
+
+# Backend de almacenamiento: 'sqlite' (ficheros por shard) o 'memory' (motor columnar en memoria,
+# sin E/S de disco; para pruebas, benchmarks y despliegues efímeros: los datos se pierden al reiniciar)
+STORAGE_BACKEND = 'sqlite'
+
+# Búsqueda por nombre en el inventario con FTS5 (tokenizer trigram). Se desactiva si SQLite no lo soporta.
+DEVICE_NAME_FTS_ENABLED = True
+
+# Dispositivos "en rango": tiempo sin detección tras el cual se expulsan del estado en memoria
+LIVE_DEVICE_TTL_SEC = 300
+
+# --- Reglas de alerta evaluadas en la ingesta ---
+# Cada regla es un dict con 'type' (mac_appeared, mac_disappeared, rssi_above, rssi_below, esp_silent) y sus
+# parámetros: mac, esp_id, company_id, threshold, absent_after_sec / silent_after_sec. Se pueden añadir más
+# en caliente con POST /api/alert-rules (esas no se conservan al reiniciar).
+ALERT_RULES = [
+    {"type": "esp_silent", "esp_id": "*", "silent_after_sec": 120, "name": "ESP sin contacto"},
+]
+ALERT_WEBHOOK_URL = None        # e.g. 'http://localhost:9000/alerts'; None = solo la cola local (/api/alerts)
+ALERT_DEDUP_SEC = 300           # Una misma alerta (regla, MAC, ESP, estado) no se repite dentro de esta ventana
+ALERT_SWEEP_INTERVAL_SEC = 15   # Frecuencia de comprobación de MACs desaparecidas y ESPs en silencio
+ALERT_QUEUE_SIZE = 1000
+
+# --- Visitas (sesiones) por MAC ---
+SESSION_GAP_SEC = 300                 # Sin detectar una MAC durante más de esto, su visita se cierra
+SESSION_MAX_DURATION_SEC = 86400      # Las visitas más largas se parten (acota las consultas por instante)
+
+# --- Dispositivos que se ven juntos (índice de co-ocurrencia en memoria) ---
+COOCCURRENCE_WINDOW_SEC = 60          # Dos MACs vistas por el mismo ESP dentro de la misma ventana coinciden
+COOCCURRENCE_NEIGHBORS_PER_MAC = 32   # Compañeros guardados por MAC (top-K acotado)
+COOCCURRENCE_MAX_MACS = 50000         # MACs en el índice; se descartan las que llevan más tiempo sin coincidir
+COOCCURRENCE_REBUILD_SEC = 6 * 3600   # Histórico reciente con el que se reconstruye el índice al arrancar
+
+# --- RSSI suavizado y distancia estimada por (MAC, ESP) (filtro de Kalman en memoria) ---
+PROXIMITY_PROCESS_NOISE = 0.5         # dB²/s: deriva admitida del RSSI real (más alto = sigue antes el movimiento, suaviza menos)
+PROXIMITY_MEASUREMENT_NOISE = 16.0    # dB²: varianza del ruido de cada lectura (σ ≈ 4 dB)
+PROXIMITY_TTL_SEC = 600               # Pares sin detecciones durante más de esto se descartan; al volver, el filtro se reinicia
+PROXIMITY_MAX_TRACKS = 100000         # Pares (MAC, ESP) con estado; se descartan los que llevan más tiempo sin verse
+# Calibración por fabricante (company ID) del modelo log-distancia; los campos que falten toman el valor por
+# defecto (RSSI a 1 m -59 dBm, txPower - 41 dB como RSSI a 1 m, exponente 2.0). e.g.:
+# {0x004C: {"rssi_at_1m": -56, "path_loss_exponent": 2.2}, 0x0075: {"tx_power_offset_db": -45}}
+PROXIMITY_CALIBRATION = {}
+
+# Historial en lote (/api/device-histories): MACs por petición y filas por MAC y página
+HISTORY_BATCH_MAX_MACS = 200
+HISTORY_PAGE_MAX_LIMIT = 500
+
+# Sincronización incremental del inventario (/api/unique-devices?since=<cursor>): cambios por shard y respuesta
+DEVICE_SYNC_DEFAULT_LIMIT = 500
+DEVICE_SYNC_MAX_LIMIT = 2000
+
+# --- Lecturas ---
+READ_POOL_SIZE = 8                    # Conexiones de solo lectura reutilizables por shard
+OVERVIEW_SECTION_BUDGET_MS = 2000     # /api/overview: una sección que tarde más se devuelve como 'timeout'
+OVERVIEW_MAX_BUDGET_MS = 10000        # Máximo aceptado en el parámetro budget_ms
+
+# --- Réplica de lectura (snapshot) para analíticas ---
+# Con SNAPSHOT_ENABLED, los endpoints analíticos y del dashboard leen de una copia de cada shard
+# (<fichero><SNAPSHOT_DATABASE_SUFFIX>) que se refresca cada SNAPSHOT_INTERVAL_SEC copiando solo las filas
+# nuevas o cambiadas; así no compiten con la ingesta por los locks. Su antigüedad se devuelve en la cabecera
+# X-Snapshot-Staleness-Sec y en /api/snapshot-status. Solo con el backend 'sqlite'.
+SNAPSHOT_ENABLED = False
+SNAPSHOT_INTERVAL_SEC = 30
+SNAPSHOT_DATABASE_SUFFIX = '.snapshot'
+SNAPSHOT_REFRESH_MAX_ROWS = 50000     # Filas de scanned_devices copiadas por shard y refresco (acota el lock de lectura)
+
+# --- Perfilado bajo demanda y log de consultas lentas (endpoints /api/admin/*) ---
+ADMIN_TOKEN = None                # Valor exigido en la cabecera X-Admin-Token; None = endpoints de administración desactivados
+PROFILE_SAMPLE_RATE = 0.0         # Fracción de peticiones perfiladas con cProfile (0 = nunca); ajustable en /api/admin/profiling
+SLOW_QUERY_THRESHOLD_MS = 500     # Sentencias más lentas que esto se guardan con sus parámetros y EXPLAIN QUERY PLAN
+SLOW_QUERY_WINDOW_SEC = 3600      # Ventana del ranking de sentencias más costosas
+
+# Presupuesto de los endpoints analíticos: tiempo (ms) y pasos de la VM de SQLite (~10 por fila examinada).
+# Una consulta que lo supera se interrumpe y la petición responde 422 con una sugerencia (rango más corto,
+# granularidad más gruesa, sketches...). Peticiones idénticas simultáneas comparten una sola ejecución.
+QUERY_BUDGETS = {
+    'device_activity': {"time_ms": 5000, "max_steps": 200_000_000},
+    'peak_activity_hours': {"time_ms": 5000, "max_steps": 200_000_000},
+    'manufacturer_analysis': {"time_ms": 8000, "max_steps": 300_000_000},
+    'distinct_devices': {"time_ms": 8000, "max_steps": 300_000_000},
+    'rssi_trend': {"time_ms": 5000, "max_steps": 200_000_000},
+    'esp_rssi_distribution': {"time_ms": 5000, "max_steps": 200_000_000},
+    'rssi_percentiles': {"time_ms": 8000, "max_steps": 300_000_000},
+    'federation_summary': {"time_ms": 8000, "max_steps": 300_000_000},
+}
+RSSI_PERCENTILES_DEFAULT = (10, 50, 90)   # Percentiles de /api/rssi-percentiles si no se indican
+RSSI_PERCENTILES_MAX = 20
+
+# --- Control de carga de la ingesta (backpressure) ---
+INGEST_RATE_PER_ESP = 1.0             # Lotes/segundo sostenidos por deviceId (token bucket); por encima -> 429
+INGEST_BURST_PER_ESP = 5              # Ráfaga máxima de lotes por deviceId
+INGEST_MAX_IN_FLIGHT = 16             # Escrituras simultáneas (en curso o esperando el lock del shard); por encima -> 503
+INGEST_TARGET_WRITE_MS = 200          # Latencia de escritura objetivo; por encima se sugiere a los ESPs espaciar los envíos
+INGEST_MAX_SUGGESTED_INTERVAL_SEC = 300
+DELTA_MAX_REFS_PER_ESP = 1024         # Protocolo delta: referencias (0..N-1) que cada ESP puede tener definidas
+DELTA_MAX_ESPS = 1024                 # ESPs con estado delta en memoria; el resto debe reenviar sus lotes completos
+
+# --- Mantenimiento de la base de datos (solo backend 'sqlite') ---
+# Las tareas se ejecutan shard a shard en los periodos de calma de la ingesta (sin escrituras durante
+# MAINTENANCE_QUIET_SEC), como mucho cada interval_sec, y se interrumpen al agotar su budget_ms (mientras
+# tanto las escrituras de ese shard esperan). Historial y ejecución manual en /api/admin/maintenance.
+MAINTENANCE_ENABLED = True
+MAINTENANCE_TICK_SEC = 10
+MAINTENANCE_QUIET_SEC = 3
+MAINTENANCE_JOBS = {
+    'wal_checkpoint': {"interval_sec": 60, "budget_ms": 250},         # PASSIVE, solo con journal_mode=WAL
+    'optimize': {"interval_sec": 6 * 3600, "budget_ms": 2000},        # ANALYZE muestreado (analysis_limit)
+    'incremental_vacuum': {"interval_sec": 900, "budget_ms": 250},    # Solo con auto_vacuum=INCREMENTAL
+    'integrity_check': {"interval_sec": 3600, "budget_ms": 500},      # quick_check tabla a tabla, retomando donde se quedó
+}
+MAINTENANCE_ANALYSIS_LIMIT = 1000          # Filas examinadas por índice en ANALYZE (estadísticas aproximadas, coste acotado)
+MAINTENANCE_VACUUM_PAGES_PER_STEP = 128    # Páginas devueltas al sistema por paso; el lock del shard se suelta entre pasos
+# True: init_db pone los shards en journal_mode=WAL (las lecturas no bloquean los commits de la ingesta) y los
+# checkpoints pasan al mantenimiento; el auto-checkpoint de las escrituras queda como red de seguridad
+DATABASE_WAL_ENABLED = False
+WAL_AUTOCHECKPOINT_PAGES = 10000
+
+# --- Federación multi-sede (una instancia del backend por edificio) ---
+# Cada instancia publica en /api/federation/summary resúmenes mergeables de un rango de fechas (sketches HLL,
+# advertisements por hora, histograma de RSSI y dispositivos por fabricante), nunca filas. Una instancia con
+# FEDERATION_SITES hace de agregador: /api/federation/overview los pide en paralelo, los cachea y los une.
+FEDERATION_SITE_NAME = None           # Nombre de esta sede en sus resúmenes; None = nombre del host
+FEDERATION_TOKEN = None               # Si se define, /api/federation/summary exige la cabecera X-Federation-Token (el agregador la envía)
+FEDERATION_SITES = {}                 # Agregador: {'edificio_a': 'http://10.0.0.11:5000', 'local': None} (None = esta misma instancia)
+FEDERATION_CACHE_SEC = 60             # Antigüedad máxima de un resumen en caché antes de volver a pedirlo
+FEDERATION_TIMEOUT_SEC = 10
+FEDERATION_DEFAULT_DAYS = 7           # Rango por defecto: los últimos N días locales, hoy incluido
+FEDERATION_MANUFACTURERS_MAX = 100    # Fabricantes por resumen; el resto se agrupa en 'Otros'
+
 app = Flask(__name__)
 
 app.logger = logging.getLogger(__name__) 
@@ -35,18 +200,147 @@ app.logger.addHandler(stream_handler)
 app.logger.setLevel(logging.INFO)
 app.logger.propagate = False
 
+# --- Enrutado de ESPs a shards y ejecución en paralelo de consultas sobre todos ellos ---
+shard_router = sharding.ShardRouter(SHARD_ROUTES, SHARD_DATABASE_TEMPLATE)
+# --- Estado en memoria de dispositivos en rango (actualizado en la ingesta) ---
+live_device_store = live_devices.LiveDeviceStore(ttl_sec=LIVE_DEVICE_TTL_SEC)
+# --- Control de admisión de la ingesta: límites por ESP, cola de escrituras e intervalo sugerido ---
+ingest_controller = ingest_control.IngestController(
+    rate_per_esp=INGEST_RATE_PER_ESP, burst_per_esp=INGEST_BURST_PER_ESP, max_in_flight=INGEST_MAX_IN_FLIGHT,
+    target_write_ms=INGEST_TARGET_WRITE_MS, max_interval_sec=INGEST_MAX_SUGGESTED_INTERVAL_SEC
+)
+# --- Ventanas de secuencia por ESP: reenvíos idempotentes y recuento de lotes perdidos ---
+batch_sequence_tracker = ingest_control.BatchSequenceTracker()
+# --- Protocolo delta: conjuntos de campos por referencia de cada ESP ---
+delta_state_cache = ingest_control.DeltaStateCache(max_refs=DELTA_MAX_REFS_PER_ESP, max_esps=DELTA_MAX_ESPS)
+# --- Visitas abiertas por MAC (las cerradas se guardan en device_sessions) ---
+sessionizer = sessions.Sessionizer(gap_sec=SESSION_GAP_SEC, max_duration_sec=SESSION_MAX_DURATION_SEC)
+# --- Índice de co-ocurrencia por (ESP, ventana): compañeros de cada MAC ---
+cooccurrence_index = cooccurrence.CooccurrenceIndex(
+    window_sec=COOCCURRENCE_WINDOW_SEC, neighbors_per_mac=COOCCURRENCE_NEIGHBORS_PER_MAC, max_macs=COOCCURRENCE_MAX_MACS
+)
+# --- RSSI suavizado y distancia estimada por (MAC, ESP) ---
+proximity_tracker = proximity.ProximityTracker(
+    process_noise=PROXIMITY_PROCESS_NOISE, measurement_noise=PROXIMITY_MEASUREMENT_NOISE,
+    ttl_sec=PROXIMITY_TTL_SEC, max_tracks=PROXIMITY_MAX_TRACKS, calibration=PROXIMITY_CALIBRATION
+)
+# --- Motor de reglas de alerta (estado en memoria, alertas a cola local y webhook opcional) ---
+alert_engine = rules.RuleEngine(rules.AlertSink(
+    capacity=ALERT_QUEUE_SIZE, dedup_sec=ALERT_DEDUP_SEC, webhook_url=ALERT_WEBHOOK_URL
+))
+for alert_rule in ALERT_RULES:
+    alert_engine.add_rule(alert_rule)
+# --- Réplicas de lectura de los shards (solo si SNAPSHOT_ENABLED; se crean al arrancar) ---
+snapshot_replicator = snapshot.SnapshotReplicator(lambda replica: refresh_snapshot_replica(replica), SNAPSHOT_INTERVAL_SEC)
+# True mientras se atiende un endpoint que puede leer de la réplica
+snapshot_reads = contextvars.ContextVar('snapshot_reads', default=False)
+# --- Perfilado por muestreo de peticiones y registro de sentencias SQL lentas ---
+request_profiler = profiling.RequestProfiler(sample_rate=PROFILE_SAMPLE_RATE)
+slow_query_log = profiling.SlowQueryLog(threshold_ms=SLOW_QUERY_THRESHOLD_MS, window_sec=SLOW_QUERY_WINDOW_SEC)
+# --- Ejecuciones compartidas de consultas analíticas idénticas ---
+query_coalescer = query_budget.QueryCoalescer()
+# --- Secciones de /api/overview calculadas en paralelo (cada una con sus propias conexiones de lectura) ---
+overview_executor = ThreadPoolExecutor(max_workers=12, thread_name_prefix='overview')
+# --- Índice de huellas para agrupar MACs aleatorias rotativas en clusters (uno por shard) ---
+fingerprint_indexes = {shard: fingerprint.FingerprintIndex() for shard in shard_router.all_shards()}
+# --- Tareas de mantenimiento de SQLite en los periodos de calma de la ingesta (se registran más abajo) ---
+maintenance_scheduler = maintenance.MaintenanceScheduler(
+    lambda: shard_router.all_shards(), lambda: ingest_controller.idle_sec() >= MAINTENANCE_QUIET_SEC,
+    tick_sec=MAINTENANCE_TICK_SEC
+)
+# --- Agregador de la federación multi-sede (solo si FEDERATION_SITES) ---
+federation_aggregator = federation.FederationAggregator(
+    FEDERATION_SITES, cache_sec=FEDERATION_CACHE_SEC, timeout_sec=FEDERATION_TIMEOUT_SEC, token=FEDERATION_TOKEN,
+    local_fetch=lambda params: local_federation_summary(params)
+) if FEDERATION_SITES else None
 
 # --- Funciones de Base de Datos ---
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_NAME)
+def shard_database_path(shard=None):
+    return DATABASE_NAME if shard in (None, sharding.DEFAULT_SHARD) else shard_router.database_path(shard)
+
+def setup_connection(conn):
     conn.row_factory = sqlite3.Row
+    conn.create_function('hll_merge', 2, sketches.hll_merge_serialized, deterministic=True)
+    conn.create_function('histogram_merge', 2, sketches.histogram_merge_serialized, deterministic=True)
+    conn.create_function('ble_company_id', 1, ble_utils.extract_company_id, deterministic=True)
+
+def get_db_connection(shard=None):
+    conn = sqlite3.connect(shard_database_path(shard))
+    setup_connection(conn)
+    if DATABASE_WAL_ENABLED:
+        conn.execute(f"PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT_PAGES}")
     return conn
 
+# Pools de conexiones de solo lectura, por fichero (DATABASE_NAME puede cambiar antes de init_db)
+read_pools = {}
+read_pools_lock = threading.Lock()
+
+def get_read_pool(shard=None, use_snapshot=False):
+    database = shard_database_path(shard)
+    if use_snapshot and SNAPSHOT_ENABLED:
+        replica = snapshot_replicator.get(shard or sharding.DEFAULT_SHARD)
+        if replica is not None:
+            database = replica.replica_path
+    with read_pools_lock:
+        pool = read_pools.get(database)
+        if pool is None:
+            pool = read_pools[database] = read_pool.ReadConnectionPool(database, max_size=READ_POOL_SIZE, setup=setup_connection)
+        return pool
+
+def run_on_shard(shard, fn):
+    """
+    Ejecuta fn(conn) con una conexión de solo lectura del pool del shard indicado (o de su réplica),
+    aplicando el presupuesto de consulta activo en la petición (si lo hay). Cada sentencia se mide
+    para el log de consultas lentas.
+    """
+    budget = query_budget.current()
+    with get_read_pool(shard, snapshot_reads.get()).connection() as conn:
+        timer = profiling.StatementTimer(conn)
+        try:
+            if budget is None:
+                return fn(timer)
+            with query_budget.enforce(conn, budget):
+                return fn(timer)
+        finally:
+            record_statement_timings(conn, shard, timer.finish())
+
+def record_statement_timings(conn, shard, timings):
+    endpoint = request.path if has_request_context() else None
+    for sql, params, duration_sec in timings:
+        slow_query_log.record(sql, params, duration_sec, shard=shard, endpoint=endpoint,
+                              plan_fn=lambda sql=sql, params=params: profiling.explain_query_plan(conn, sql, params))
+
+def run_on_all_shards(fn, shards=None):
+    """Ejecuta fn(conn) en paralelo en todos los shards (o los indicados) y devuelve la lista de resultados."""
+    return run_per_shard(lambda shard, conn: fn(conn), shards)
+
+def run_per_shard(fn, shards=None):
+    """Como run_on_all_shards, pero fn(shard, conn) recibe también el shard (p.ej. para usar parámetros distintos en cada uno)."""
+    # Los hilos del pool de shards no heredan el contexto (presupuesto, réplica, petición): una copia por shard
+    shards = list(shards) if shards is not None else shard_router.all_shards()
+    contexts = {shard: contextvars.copy_context() for shard in shards}
+    return shard_router.map(lambda shard: contexts[shard].run(run_on_shard, shard, functools.partial(fn, shard)), shards)
+
+def query_all_shards(sql, params=(), shards=None):
+    """Ejecuta la misma consulta en todos los shards y concatena las filas."""
+    results = run_on_all_shards(lambda conn: conn.execute(sql, tuple(params)).fetchall(), shards)
+    return [row for rows in results for row in rows]
+
 def init_db():
+    for shard in shard_router.all_shards():
+        init_shard_db(shard)
+
+def init_shard_db(shard):
     conn = None
+    database = shard_database_path(shard)
     try:
-        conn = get_db_connection()
+        conn = get_db_connection(shard)
         cursor = conn.cursor()
+        if cursor.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+            # Fichero nuevo: el espacio de las filas borradas se puede devolver por pasos (tarea incremental_vacuum)
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if DATABASE_WAL_ENABLED:
+            cursor.execute('PRAGMA journal_mode = WAL')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS scanned_devices (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -59,7 +353,8 @@ def init_db():
                 service_data TEXT,
                 service_uuids TEXT,
                 tx_power INTEGER,
-                appearance INTEGER
+                appearance INTEGER,
+                company_id INTEGER
             )
         ''')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_mac_timestamp ON scanned_devices (ble_mac_address, timestamp DESC);')
@@ -76,19 +371,869 @@ def init_db():
         columns = [row['name'] for row in cursor.fetchall()]
         new_columns = {
             'manufacturer_data': 'TEXT', 'service_data': 'TEXT', 'service_uuids': 'TEXT',
-            'tx_power': 'INTEGER', 'appearance': 'INTEGER'
+            'tx_power': 'INTEGER', 'appearance': 'INTEGER', 'company_id': 'INTEGER'
         }
         for col_name, col_type in new_columns.items():
             if col_name not in columns:
                 app.logger.info(f"Añadiendo columna '{col_name}' a 'scanned_devices'.")
                 cursor.execute(f'ALTER TABLE scanned_devices ADD COLUMN {col_name} {col_type};')
+        if 'company_id' not in columns:
+            backfill_company_ids(conn)
+        # Company ID (entero) extraído en la ingesta: análisis de fabricantes con índices y JOINs
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_id ON scanned_devices (company_id);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_mac_timestamp_company ON scanned_devices (ble_mac_address, timestamp, company_id);')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS companies (
+                company_id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_companies_name ON companies (name);')
+        # Se regenera en cada arranque para reflejar cambios en ble_utils / company_identifiers.yaml
+        cursor.execute('DELETE FROM companies;')
+        cursor.executemany('INSERT INTO companies (company_id, name) VALUES (?, ?)', ble_utils.COMPANY_IDENTIFIERS.items())
+
+        # Clusters de huellas: agrupan las MACs aleatorias rotativas de un mismo dispositivo
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_clusters (
+                cluster_id INTEGER PRIMARY KEY,
+                address_type TEXT NOT NULL,
+                company_id INTEGER,
+                mac_count INTEGER NOT NULL DEFAULT 0,
+                first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_clusters_last_seen ON device_clusters (last_seen DESC);')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS mac_clusters (
+                ble_mac_address TEXT PRIMARY KEY,
+                cluster_id INTEGER NOT NULL,
+                address_type TEXT NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_mac_clusters_cluster ON mac_clusters (cluster_id);')
+
+        # Último contacto de cada ESP (lotes con o sin dispositivos), actualizado en cada ingesta
+        heartbeats_table_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'esp_heartbeats'"
+        ).fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS esp_heartbeats (
+                esp_device_id TEXT PRIMARY KEY,
+                first_contact DATETIME,
+                last_contact DATETIME,
+                last_batch_size INTEGER,
+                batches INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        ''')
+        if shard == sharding.DEFAULT_SHARD:
+            # Visitas cerradas por MAC. No pertenecen a un ESP concreto, así que solo viven en el shard por defecto
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS device_sessions (
+                    id INTEGER PRIMARY KEY,
+                    ble_mac_address TEXT NOT NULL,
+                    start_time DATETIME NOT NULL,
+                    end_time DATETIME NOT NULL,
+                    duration_sec INTEGER NOT NULL,
+                    esps TEXT NOT NULL,
+                    peak_rssi INTEGER,
+                    adv_count INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_start ON device_sessions (start_time);')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_mac_start ON device_sessions (ble_mac_address, start_time);')
+        if not heartbeats_table_exists:
+            # Los heartbeats anteriores no se guardaban: se parte de la primera y última detección de cada ESP
+            cursor.execute('''
+                INSERT OR IGNORE INTO esp_heartbeats (esp_device_id, first_contact, last_contact, batches)
+                SELECT esp_device_id, MIN(timestamp), MAX(timestamp), 0 FROM scanned_devices GROUP BY esp_device_id
+            ''')
+
+        # Sketches HyperLogLog de MACs distintas por (granularidad, bucket UTC, ESP).
+        # granularity: 'hour' ('YYYY-MM-DD HH:00:00'), 'day' ('YYYY-MM-DD 00:00:00') o 'all' (bucket '').
+        hll_table_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hll_sketches'"
+        ).fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS hll_sketches (
+                granularity TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                esp_device_id TEXT NOT NULL,
+                registers BLOB NOT NULL,
+                PRIMARY KEY (granularity, bucket_start, esp_device_id)
+            ) WITHOUT ROWID
+        ''')
+        if not hll_table_exists:
+            backfill_hll_sketches(conn)
+
+        # Histogramas de RSSI (percentiles exactos y mergeables) por (granularidad, bucket UTC, ESP), como los HLL
+        rssi_histograms_table_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rssi_histograms'"
+        ).fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rssi_histograms (
+                granularity TEXT NOT NULL,
+                bucket_start TEXT NOT NULL,
+                esp_device_id TEXT NOT NULL,
+                counts BLOB NOT NULL,
+                PRIMARY KEY (granularity, bucket_start, esp_device_id)
+            ) WITHOUT ROWID
+        ''')
+        if not rssi_histograms_table_exists:
+            backfill_rssi_histograms(conn)
+
+        # Inventario de dispositivos: resumen por MAC mantenido en la ingesta para filtrar y paginar con índices
+        inventory_table_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'device_inventory'"
+        ).fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_inventory (
+                device_id INTEGER PRIMARY KEY,
+                ble_mac_address TEXT NOT NULL UNIQUE,
+                first_seen DATETIME,
+                last_seen DATETIME,
+                adv_packets_count INTEGER NOT NULL DEFAULT 0,
+                best_name TEXT,
+                last_manufacturer_data TEXT,
+                company_id INTEGER,
+                last_rssi INTEGER,
+                max_rssi INTEGER,
+                change_seq INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        inventory_columns = [row['name'] for row in cursor.execute("PRAGMA table_info(device_inventory);").fetchall()]
+        inventory_rebuilt = not inventory_table_exists
+        if 'change_seq' not in inventory_columns:
+            app.logger.info("Añadiendo columna 'change_seq' a 'device_inventory'.")
+            cursor.execute('ALTER TABLE device_inventory ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0;')
+            inventory_rebuilt = True
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_last_seen ON device_inventory (last_seen, ble_mac_address);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_company_last_seen ON device_inventory (company_id, last_seen);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_name ON device_inventory (best_name COLLATE NOCASE);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_max_rssi ON device_inventory (max_rssi);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_adv_count ON device_inventory (adv_packets_count, ble_mac_address);')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_inventory_change_seq ON device_inventory (change_seq, ble_mac_address);')
+        # Época de la secuencia de cambios: se renueva al reconstruir el inventario (los cursores anteriores dejan de valer)
+        cursor.execute('CREATE TABLE IF NOT EXISTS inventory_sync (epoch TEXT NOT NULL)')
+        if inventory_rebuilt or cursor.execute("SELECT 1 FROM inventory_sync").fetchone() is None:
+            cursor.execute("DELETE FROM inventory_sync")
+            cursor.execute("INSERT INTO inventory_sync (epoch) VALUES (?)", (os.urandom(6).hex(),))
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_esps (
+                esp_device_id TEXT NOT NULL,
+                ble_mac_address TEXT NOT NULL,
+                last_seen DATETIME,
+                PRIMARY KEY (esp_device_id, ble_mac_address)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS device_service_uuids (
+                service_uuid TEXT NOT NULL,
+                ble_mac_address TEXT NOT NULL,
+                PRIMARY KEY (service_uuid, ble_mac_address)
+            ) WITHOUT ROWID
+        ''')
+        if not inventory_table_exists:
+            backfill_device_inventory(conn)
+        init_device_name_fts(conn)
         conn.commit()
-        app.logger.info(f"Base de datos '{DATABASE_NAME}' inicializada y tabla 'scanned_devices' asegurada/actualizada.")
+        app.logger.info(f"Base de datos '{database}' (shard '{shard}') inicializada y tabla 'scanned_devices' asegurada/actualizada.")
     except sqlite3.Error as e:
         app.logger.error(f"Error al inicializar/actualizar la base de datos: {e}")
     finally:
         if conn: conn.close()
 
+def backfill_company_ids(conn, chunk_size=50000):
+    """Rellena company_id en las filas existentes, por tramos de id para no bloquear la BD de golpe."""
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) as max_id FROM scanned_devices").fetchone()['max_id']
+    updated = 0
+    for start_id in range(0, max_id + 1, chunk_size):
+        cursor = conn.execute(
+            "UPDATE scanned_devices SET company_id = ble_company_id(manufacturer_data) "
+            "WHERE id > ? AND id <= ? AND manufacturer_data IS NOT NULL AND manufacturer_data != ''",
+            (start_id, start_id + chunk_size)
+        )
+        updated += cursor.rowcount
+        conn.commit()
+    if updated:
+        app.logger.info(f"Backfill de company_id completado: {updated} filas actualizadas.")
+
+def backfill_device_inventory(conn):
+    """Construye el inventario de dispositivos (y sus tablas de ESPs y Service UUIDs) desde el histórico."""
+    conn.execute('''
+        INSERT OR IGNORE INTO device_inventory (ble_mac_address, first_seen, last_seen, adv_packets_count, max_rssi)
+        SELECT ble_mac_address, MIN(timestamp), MAX(timestamp), COUNT(*), MAX(ble_rssi)
+        FROM scanned_devices
+        GROUP BY ble_mac_address
+    ''')
+    conn.execute('''
+        UPDATE device_inventory SET
+            best_name = (SELECT s.ble_device_name FROM scanned_devices s
+                         WHERE s.ble_mac_address = device_inventory.ble_mac_address
+                           AND s.ble_device_name IS NOT NULL AND s.ble_device_name != ''
+                         ORDER BY s.timestamp DESC, s.id DESC LIMIT 1),
+            last_manufacturer_data = (SELECT s.manufacturer_data FROM scanned_devices s
+                                      WHERE s.ble_mac_address = device_inventory.ble_mac_address
+                                      ORDER BY s.timestamp DESC, s.id DESC LIMIT 1),
+            last_rssi = (SELECT s.ble_rssi FROM scanned_devices s
+                         WHERE s.ble_mac_address = device_inventory.ble_mac_address AND s.ble_rssi IS NOT NULL
+                         ORDER BY s.timestamp DESC, s.id DESC LIMIT 1)
+    ''')
+    conn.execute("UPDATE device_inventory SET company_id = ble_company_id(last_manufacturer_data) WHERE last_manufacturer_data IS NOT NULL")
+    conn.execute('''
+        INSERT OR IGNORE INTO device_esps (esp_device_id, ble_mac_address, last_seen)
+        SELECT esp_device_id, ble_mac_address, MAX(timestamp) FROM scanned_devices GROUP BY esp_device_id, ble_mac_address
+    ''')
+    conn.execute('''
+        INSERT OR IGNORE INTO device_service_uuids (service_uuid, ble_mac_address)
+        SELECT DISTINCT lower(j.value), s.ble_mac_address
+        FROM scanned_devices s, json_each(s.service_uuids) j
+        WHERE s.service_uuids IS NOT NULL AND json_valid(s.service_uuids) AND json_type(s.service_uuids) = 'array'
+    ''')
+    total = conn.execute("SELECT COUNT(*) as total FROM device_inventory").fetchone()['total']
+    if total:
+        app.logger.info(f"Backfill del inventario de dispositivos completado: {total} MACs.")
+
+def init_device_name_fts(conn):
+    """Crea el índice FTS5 (trigram) de nombres del inventario y sus triggers de sincronización."""
+    global DEVICE_NAME_FTS_ENABLED
+    if not DEVICE_NAME_FTS_ENABLED:
+        return
+    try:
+        fts_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'device_names_fts'"
+        ).fetchone() is not None
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS device_names_fts USING fts5(
+                best_name, content='device_inventory', content_rowid='device_id', tokenize='trigram'
+            )
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_inventory_fts_insert AFTER INSERT ON device_inventory
+            WHEN new.best_name IS NOT NULL BEGIN
+                INSERT INTO device_names_fts (rowid, best_name) VALUES (new.device_id, new.best_name);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_inventory_fts_update AFTER UPDATE OF best_name ON device_inventory
+            WHEN old.best_name IS NOT new.best_name BEGIN
+                INSERT INTO device_names_fts (device_names_fts, rowid, best_name)
+                    SELECT 'delete', old.device_id, old.best_name WHERE old.best_name IS NOT NULL;
+                INSERT INTO device_names_fts (rowid, best_name)
+                    SELECT new.device_id, new.best_name WHERE new.best_name IS NOT NULL;
+            END
+        ''')
+        if not fts_exists:
+            conn.execute("INSERT INTO device_names_fts (device_names_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:
+        DEVICE_NAME_FTS_ENABLED = False
+        app.logger.warning(f"FTS5/trigram no disponible en este SQLite ({e}). La búsqueda por nombre usará LIKE sobre el inventario.")
+
+# Tablas resumen derivadas de scanned_devices: tras un rebalanceo se eliminan y init_db() las reconstruye
+DERIVED_SHARD_TABLES = ('device_names_fts', 'device_service_uuids', 'device_esps', 'device_inventory', 'inventory_sync', 'hll_sketches',
+                        'rssi_histograms')
+
+def rebalance_shards(extra_source_shards=()):
+    """
+    Rebalanceo offline (con el servidor parado): mueve las filas de cada ESP al shard que le asignan
+    las rutas actuales. extra_source_shards: shards que ya no aparecen en SHARD_ROUTES pero aún tienen datos.
+    Las asignaciones MAC-cluster se copian al shard destino y los resúmenes derivados de los shards
+    afectados se reconstruyen desde scanned_devices.
+    """
+    init_db()
+    columns = ('timestamp, esp_device_id, ble_mac_address, ble_device_name, ble_rssi, manufacturer_data, '
+               'service_data, service_uuids, tx_power, appearance, company_id')
+    touched_shards = set()
+    for source in list(dict.fromkeys(shard_router.all_shards() + list(extra_source_shards))):
+        conn = get_db_connection(source)
+        try:
+            esps = [row['esp_device_id'] for row in conn.execute("SELECT DISTINCT esp_device_id FROM scanned_devices")]
+            for esp_device_id in esps:
+                target = shard_router.shard_for_esp(esp_device_id)
+                if target == source:
+                    continue
+                target_database = shard_database_path(target)
+                conn.execute("ATTACH DATABASE ? AS target", (target_database,))
+                try:
+                    moved = conn.execute(
+                        f"INSERT INTO target.scanned_devices ({columns}) SELECT {columns} FROM main.scanned_devices WHERE esp_device_id = ?",
+                        (esp_device_id,)
+                    ).rowcount
+                    conn.execute('''
+                        INSERT OR IGNORE INTO target.mac_clusters
+                        SELECT * FROM main.mac_clusters
+                        WHERE ble_mac_address IN (SELECT DISTINCT ble_mac_address FROM main.scanned_devices WHERE esp_device_id = ?)
+                    ''', (esp_device_id,))
+                    conn.execute('''
+                        INSERT OR IGNORE INTO target.device_clusters
+                        SELECT * FROM main.device_clusters
+                        WHERE cluster_id IN (SELECT cluster_id FROM target.mac_clusters)
+                    ''')
+                    conn.execute("DELETE FROM main.scanned_devices WHERE esp_device_id = ?", (esp_device_id,))
+                    conn.commit()
+                finally:
+                    conn.execute("DETACH DATABASE target")
+                touched_shards.update((source, target))
+                app.logger.info(f"Rebalanceo: {moved} filas del ESP '{esp_device_id}' movidas de '{source}' a '{target}'.")
+        finally:
+            conn.close()
+
+    for shard in touched_shards:
+        conn = get_db_connection(shard)
+        try:
+            conn.execute('''
+                DELETE FROM mac_clusters WHERE NOT EXISTS (
+                    SELECT 1 FROM scanned_devices s WHERE s.ble_mac_address = mac_clusters.ble_mac_address
+                )
+            ''')
+            conn.execute("UPDATE device_clusters SET mac_count = (SELECT COUNT(*) FROM mac_clusters m WHERE m.cluster_id = device_clusters.cluster_id)")
+            conn.execute("DELETE FROM device_clusters WHERE mac_count = 0")
+            for table in DERIVED_SHARD_TABLES:
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.commit()
+        finally:
+            conn.close()
+    # Reconstruye inventario, FTS y sketches de los shards afectados
+    init_db()
+    return sorted(touched_shards)
+
+def store_inventory_batch(cursor, esp_device_id, inventory_rows):
+    """Actualiza el inventario, la relación MAC-ESP y los Service UUIDs de un lote. inventory_rows: (mac, name, rssi, mfg, company_id, uuids)."""
+    # Todas las MACs del lote comparten un número de cambio mayor que cualquiera ya confirmado en el shard
+    # (las escrituras de un shard van en serie bajo su writer_lock)
+    change_seq = cursor.execute("SELECT COALESCE(MAX(change_seq), 0) + 1 FROM device_inventory").fetchone()[0]
+    cursor.executemany('''
+        INSERT INTO device_inventory (
+            ble_mac_address, first_seen, last_seen, adv_packets_count, best_name,
+            last_manufacturer_data, company_id, last_rssi, max_rssi, change_seq
+        ) VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 1, NULLIF(?, ''), ?, ?, ?, ?, ?)
+        ON CONFLICT (ble_mac_address) DO UPDATE SET
+            change_seq = excluded.change_seq,
+            last_seen = excluded.last_seen,
+            adv_packets_count = adv_packets_count + 1,
+            best_name = COALESCE(excluded.best_name, best_name),
+            last_manufacturer_data = excluded.last_manufacturer_data,
+            company_id = excluded.company_id,
+            last_rssi = COALESCE(excluded.last_rssi, last_rssi),
+            max_rssi = MAX(COALESCE(max_rssi, excluded.max_rssi), COALESCE(excluded.max_rssi, max_rssi))
+    ''', [(mac, name, mfg, company_id, rssi, rssi, change_seq) for mac, name, rssi, mfg, company_id, _ in inventory_rows])
+    cursor.executemany('''
+        INSERT INTO device_esps (esp_device_id, ble_mac_address, last_seen) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (esp_device_id, ble_mac_address) DO UPDATE SET last_seen = excluded.last_seen
+    ''', [(esp_device_id, row[0]) for row in inventory_rows])
+    cursor.executemany(
+        "INSERT OR IGNORE INTO device_service_uuids (service_uuid, ble_mac_address) VALUES (?, ?)",
+        [(str(uuid).lower(), row[0]) for row in inventory_rows if row[5] for uuid in row[5]]
+    )
+
+def backfill_hll_sketches(conn):
+    """Construye los sketches HLL a partir del histórico existente (una sola pasada, memoria acotada)."""
+    rows = conn.execute('''
+        SELECT esp_device_id, strftime('%Y-%m-%d %H:00:00', timestamp) as hour_bucket, ble_mac_address
+        FROM scanned_devices
+        GROUP BY esp_device_id, hour_bucket, ble_mac_address
+        ORDER BY esp_device_id, hour_bucket
+    ''')
+    current = {'hour': (None, None), 'day': (None, None), 'all': (None, None)}
+    sketches_written = 0
+
+    def flush(granularity):
+        nonlocal sketches_written
+        key, sketch = current[granularity]
+        if key is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO hll_sketches (granularity, bucket_start, esp_device_id, registers) VALUES (?, ?, ?, ?)",
+                (granularity, key[1], key[0], sketch.to_bytes())
+            )
+            sketches_written += 1
+        current[granularity] = (None, None)
+
+    for row in rows:
+        esp_id, hour_bucket, mac = row['esp_device_id'], row['hour_bucket'], row['ble_mac_address']
+        keys = {'hour': (esp_id, hour_bucket), 'day': (esp_id, hour_bucket[:10] + ' 00:00:00'), 'all': (esp_id, '')}
+        for granularity, key in keys.items():
+            if current[granularity][0] != key:
+                flush(granularity)
+                current[granularity] = (key, sketches.HyperLogLog())
+            current[granularity][1].add(mac)
+    for granularity in current:
+        flush(granularity)
+    if sketches_written:
+        app.logger.info(f"Backfill de sketches HLL completado: {sketches_written} sketches generados a partir del histórico.")
+
+def store_hll_batch(cursor, esp_device_id, mac_addresses, now_utc=None):
+    """Une las MACs de un lote en los sketches (hora, día y total) del ESP mediante UPSERT con hll_merge."""
+    if not mac_addresses:
+        return
+    now_utc = now_utc or datetime.now(pytz.utc)
+    batch_sketch = sketches.HyperLogLog()
+    for mac in mac_addresses:
+        batch_sketch.add(mac)
+    blob = batch_sketch.to_bytes()
+    buckets = [
+        ('hour', now_utc.strftime('%Y-%m-%d %H:00:00')),
+        ('day', now_utc.strftime('%Y-%m-%d 00:00:00')),
+        ('all', ''),
+    ]
+    cursor.executemany('''
+        INSERT INTO hll_sketches (granularity, bucket_start, esp_device_id, registers) VALUES (?, ?, ?, ?)
+        ON CONFLICT (granularity, bucket_start, esp_device_id) DO UPDATE SET registers = hll_merge(registers, excluded.registers)
+    ''', [(granularity, bucket, esp_device_id, blob) for granularity, bucket in buckets])
+
+def backfill_rssi_histograms(conn):
+    """Construye los histogramas de RSSI (hora, día y total por ESP) a partir del histórico existente."""
+    rows = conn.execute('''
+        SELECT esp_device_id, strftime('%Y-%m-%d %H:00:00', timestamp) as hour_bucket, ble_rssi, COUNT(*) as count
+        FROM scanned_devices
+        WHERE ble_rssi IS NOT NULL
+        GROUP BY esp_device_id, hour_bucket, ble_rssi
+    ''')
+    histograms = defaultdict(sketches.ValueHistogram)
+    for row in rows:
+        esp_id, hour_bucket = row['esp_device_id'], row['hour_bucket']
+        for key in (('hour', hour_bucket, esp_id), ('day', hour_bucket[:10] + ' 00:00:00', esp_id), ('all', '', esp_id)):
+            histograms[key].add(row['ble_rssi'], row['count'])
+    conn.executemany(
+        "INSERT OR REPLACE INTO rssi_histograms (granularity, bucket_start, esp_device_id, counts) VALUES (?, ?, ?, ?)",
+        [key + (histogram.to_bytes(),) for key, histogram in histograms.items()]
+    )
+    if histograms:
+        app.logger.info(f"Backfill de histogramas de RSSI completado: {len(histograms)} histogramas generados a partir del histórico.")
+
+def store_rssi_histogram_batch(cursor, esp_device_id, rssi_values, now_utc=None):
+    """Suma los RSSI de un lote a los histogramas (hora, día y total) del ESP mediante UPSERT con histogram_merge."""
+    if not rssi_values:
+        return
+    now_utc = now_utc or datetime.now(pytz.utc)
+    batch_histogram = sketches.ValueHistogram()
+    for rssi in rssi_values:
+        batch_histogram.add(rssi)
+    blob = batch_histogram.to_bytes()
+    buckets = [
+        ('hour', now_utc.strftime('%Y-%m-%d %H:00:00')),
+        ('day', now_utc.strftime('%Y-%m-%d 00:00:00')),
+        ('all', ''),
+    ]
+    cursor.executemany('''
+        INSERT INTO rssi_histograms (granularity, bucket_start, esp_device_id, counts) VALUES (?, ?, ?, ?)
+        ON CONFLICT (granularity, bucket_start, esp_device_id) DO UPDATE SET counts = histogram_merge(counts, excluded.counts)
+    ''', [(granularity, bucket, esp_device_id, blob) for granularity, bucket in buckets])
+
+def parse_utc_timestamp_to_epoch(utc_timestamp_str):
+    """Convierte un timestamp UTC de SQLite ('YYYY-MM-DD HH:MM:SS[.ffffff]') a epoch (segundos)."""
+    try:
+        naive_dt = datetime.strptime(utc_timestamp_str, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        naive_dt = datetime.strptime(utc_timestamp_str, '%Y-%m-%d %H:%M:%S')
+    return pytz.utc.localize(naive_dt).timestamp()
+
+def rebuild_live_device_store():
+    """Reconstruye el estado en memoria de dispositivos en rango a partir de las filas recientes."""
+    try:
+        rows = storage_backend.recent_observations(storage.epoch_to_utc_string(time.time() - LIVE_DEVICE_TTL_SEC))
+        live_device_store.clear()
+        for row in rows:
+            live_device_store.update(
+                row['esp_device_id'], row['ble_mac_address'],
+                rssi=row['ble_rssi'], name=row['ble_device_name'], company_id=row['company_id'],
+                seen_at=parse_utc_timestamp_to_epoch(row['timestamp'])
+            )
+        app.logger.info(f"Estado de dispositivos en rango reconstruido: {len(live_device_store)} MACs a partir de {len(rows)} filas recientes.")
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos al reconstruir el estado de dispositivos en rango: {e}")
+
+def store_closed_sessions(closed_sessions):
+    """Guarda las visitas cerradas en la ingesta. Un fallo no invalida el lote, ya confirmado."""
+    if not closed_sessions:
+        return
+    try:
+        storage_backend.store_sessions(closed_sessions)
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos guardando {len(closed_sessions)} visitas cerradas: {e}")
+
+def rebuild_sessionizer():
+    """
+    Reabre las visitas en curso a partir de las filas de la última ventana SESSION_GAP_SEC. Las visitas
+    abiertas antes de esa ventana solo conservan la parte posterior (el estado abierto no se persiste).
+    """
+    try:
+        rows = storage_backend.recent_observations(storage.epoch_to_utc_string(time.time() - SESSION_GAP_SEC))
+        sessionizer.clear()
+        for row in rows:
+            # Las visitas que se cerrasen aquí ya se guardaron antes del reinicio: se descartan
+            sessionizer.observe_batch(row['esp_device_id'], [(row['ble_mac_address'], row['ble_rssi'])],
+                                      seen_at=parse_utc_timestamp_to_epoch(row['timestamp']))
+        app.logger.info(f"Visitas abiertas reconstruidas: {len(sessionizer)} MACs a partir de {len(rows)} filas recientes.")
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos al reconstruir las visitas abiertas: {e}")
+
+def rebuild_cooccurrence_index():
+    """Reconstruye el índice de co-ocurrencia con las filas de la última ventana COOCCURRENCE_REBUILD_SEC."""
+    try:
+        rows = storage_backend.recent_observations(storage.epoch_to_utc_string(time.time() - COOCCURRENCE_REBUILD_SEC))
+        cooccurrence_index.clear()
+        for row in rows:
+            cooccurrence_index.observe_batch(row['esp_device_id'], [(row['ble_mac_address'], row['ble_rssi'])],
+                                             seen_at=parse_utc_timestamp_to_epoch(row['timestamp']))
+        app.logger.info(f"Índice de co-ocurrencia reconstruido: {len(cooccurrence_index)} MACs a partir de {len(rows)} filas recientes.")
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos al reconstruir el índice de co-ocurrencia: {e}")
+
+def rebuild_proximity_tracker():
+    """Reconstruye el RSSI suavizado de cada (MAC, ESP) con las filas de la última ventana PROXIMITY_TTL_SEC."""
+    try:
+        rows = storage_backend.recent_observations(storage.epoch_to_utc_string(time.time() - PROXIMITY_TTL_SEC))
+        proximity_tracker.clear()
+        for row in rows:
+            proximity_tracker.observe_batch(row['esp_device_id'],
+                                            [(row['ble_mac_address'], row['ble_rssi'], row['tx_power'], row['company_id'])],
+                                            seen_at=parse_utc_timestamp_to_epoch(row['timestamp']))
+        app.logger.info(f"RSSI suavizado reconstruido: {len(proximity_tracker)} pares (MAC, ESP) a partir de {len(rows)} filas recientes.")
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos al reconstruir el RSSI suavizado: {e}")
+
+def seed_alert_engine():
+    """Carga en el motor de alertas el último contacto guardado de cada ESP."""
+    try:
+        heartbeats = storage_backend.esp_heartbeats()
+        alert_engine.seed_esp_contacts({
+            hb['esp_device_id']: parse_utc_timestamp_to_epoch(hb['last_contact_utc'])
+            for hb in heartbeats if hb['last_contact_utc']
+        })
+        app.logger.info(f"Motor de alertas iniciado con {len(alert_engine.rules())} reglas y {len(heartbeats)} ESPs conocidos.")
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos al cargar los heartbeats de los ESPs: {e}")
+
+# --- Réplica de lectura (snapshot) ---
+def init_snapshots():
+    """Crea (con la API de backup) la réplica de cada shard y arranca su refresco periódico."""
+    for shard in shard_router.all_shards():
+        source_path = shard_database_path(shard)
+        replica = snapshot.SnapshotReplica(shard, source_path, source_path + SNAPSHOT_DATABASE_SUFFIX)
+        try:
+            replica.create()
+        except (sqlite3.Error, OSError) as e:
+            app.logger.error(f"No se pudo crear la réplica de lectura del shard '{shard}': {e}. Se leerá del original.")
+            continue
+        snapshot_replicator.add(replica)
+        app.logger.info(f"Réplica de lectura del shard '{shard}' creada en '{replica.replica_path}' ({replica.last_refresh_ms} ms).")
+    snapshot_replicator.start()
+
+def fetch_rows(conn, sql, params=()):
+    """(columnas, filas como tuplas) de una consulta."""
+    cursor = conn.execute(sql, tuple(params))
+    return [column[0] for column in cursor.description], [tuple(row) for row in cursor.fetchall()]
+
+def upsert_rows(conn, table, key_columns, columns, rows):
+    """Inserta o actualiza filas por su clave. Con UPSERT (y no REPLACE) se disparan los triggers de UPDATE (FTS)."""
+    if not rows:
+        return 0
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns if column not in key_columns)
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT ({', '.join(key_columns)}) DO " + (f"UPDATE SET {updates}" if updates else "NOTHING"),
+        rows
+    )
+    return len(rows)
+
+def read_snapshot_changes(source, state):
+    """
+    Filas nuevas o cambiadas desde el último refresco: las detecciones y visitas nuevas (por id) y, de las
+    tablas resumen, solo las filas de las MACs, pares ESP-MAC y ESPs que aparecen en esas detecciones.
+    Se leen en una sola transacción de lectura: una foto coherente del original.
+    """
+    changes = []
+    scan_columns, scans = fetch_rows(source, "SELECT * FROM scanned_devices WHERE id > ? ORDER BY id LIMIT ?",
+                                     (state['scan_id'], SNAPSHOT_REFRESH_MAX_ROWS))
+    changes.append(('scanned_devices', ('id',), scan_columns, scans))
+    if scans:
+        row_index = {column: i for i, column in enumerate(scan_columns)}
+        macs = sorted({row[row_index['ble_mac_address']] for row in scans})
+        esps = sorted({row[row_index['esp_device_id']] for row in scans})
+        pairs = sorted({(row[row_index['esp_device_id']], row[row_index['ble_mac_address']]) for row in scans})
+        first_timestamp = min(row[row_index['timestamp']] for row in scans)
+        macs_json, esps_json = json.dumps(macs), json.dumps(esps)
+        changes.append(('device_inventory', ('device_id',)) + tuple(fetch_rows(
+            source, "SELECT * FROM device_inventory WHERE ble_mac_address IN (SELECT value FROM json_each(?))", (macs_json,))))
+        changes.append(('device_esps', ('esp_device_id', 'ble_mac_address')) + tuple(fetch_rows(
+            source, """SELECT * FROM device_esps WHERE (esp_device_id, ble_mac_address) IN
+                       (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))""", (json.dumps(pairs),))))
+        changes.append(('device_service_uuids', ('service_uuid', 'ble_mac_address')) + tuple(fetch_rows(
+            source, "SELECT * FROM device_service_uuids WHERE ble_mac_address IN (SELECT value FROM json_each(?))", (macs_json,))))
+        changes.append(('mac_clusters', ('ble_mac_address',)) + tuple(fetch_rows(
+            source, "SELECT * FROM mac_clusters WHERE ble_mac_address IN (SELECT value FROM json_each(?))", (macs_json,))))
+        # Cada lote actualiza last_seen de todos sus clusters, también de los que no reciben MACs nuevas
+        changes.append(('device_clusters', ('cluster_id',)) + tuple(fetch_rows(
+            source, "SELECT * FROM device_clusters WHERE last_seen >= ?", (first_timestamp,))))
+        # Sketches tocados: el total de cada ESP y sus buckets horarios/diarios desde la primera detección nueva
+        for sketch_table in ('hll_sketches', 'rssi_histograms'):
+            changes.append((sketch_table, ('granularity', 'bucket_start', 'esp_device_id')) + tuple(fetch_rows(source, f"""
+                SELECT * FROM {sketch_table} WHERE granularity = 'all' AND bucket_start = ''
+                    AND esp_device_id IN (SELECT value FROM json_each(?1))
+                UNION ALL
+                SELECT * FROM {sketch_table} WHERE granularity = 'hour' AND bucket_start >= ?2
+                    AND esp_device_id IN (SELECT value FROM json_each(?1))
+                UNION ALL
+                SELECT * FROM {sketch_table} WHERE granularity = 'day' AND bucket_start >= ?3
+                    AND esp_device_id IN (SELECT value FROM json_each(?1))
+            """, (esps_json, first_timestamp[:13] + ':00:00', first_timestamp[:10] + ' 00:00:00'))))
+    # Los heartbeats cambian también con lotes vacíos: la tabla es pequeña y se copia entera
+    changes.append(('esp_heartbeats', ('esp_device_id',)) + tuple(fetch_rows(source, "SELECT * FROM esp_heartbeats")))
+    if state.get('session_id') is not None:
+        changes.append(('device_sessions', ('id',)) + tuple(fetch_rows(
+            source, "SELECT * FROM device_sessions WHERE id > ? ORDER BY id", (state['session_id'],))))
+    return changes
+
+def refresh_snapshot_replica(replica):
+    """Pone al día la réplica de un shard con los cambios del original. Devuelve las filas copiadas."""
+    try:
+        target = replica.writer
+        if not replica.state:
+            has_sessions = target.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'device_sessions'").fetchone() is not None
+            replica.state = {
+                'scan_id': target.execute("SELECT COALESCE(MAX(id), 0) FROM scanned_devices").fetchone()[0],
+                'session_id': target.execute("SELECT COALESCE(MAX(id), 0) FROM device_sessions").fetchone()[0] if has_sessions else None,
+            }
+        with get_read_pool(replica.shard).connection() as source:
+            source.execute("BEGIN")
+            try:
+                changes = read_snapshot_changes(source, replica.state)
+            finally:
+                source.rollback()
+        copied = 0
+        with target:
+            for table, key_columns, columns, rows in changes:
+                copied += upsert_rows(target, table, key_columns, columns, rows)
+        for table, key_columns, columns, rows in changes:
+            if table == 'scanned_devices' and rows:
+                replica.state['scan_id'] = rows[-1][columns.index('id')]
+            elif table == 'device_sessions' and rows:
+                replica.state['session_id'] = rows[-1][columns.index('id')]
+        return copied
+    except sqlite3.Error as e:
+        app.logger.error(f"Error refrescando la réplica de lectura del shard '{replica.shard}': {e}")
+        raise
+
+def reads_from_snapshot(view):
+    """
+    Las consultas del endpoint leen de la réplica de lectura (si SNAPSHOT_ENABLED y está lista) y la
+    respuesta lleva su antigüedad en la cabecera X-Snapshot-Staleness-Sec. La vista puede volver al
+    original con snapshot_reads.set(False) (p.ej. en un modo que necesita los datos más recientes).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = snapshot_reads.set(True)
+        try:
+            response = app.make_response(view(*args, **kwargs))
+            from_snapshot = snapshot_reads.get()
+        finally:
+            snapshot_reads.reset(token)
+        staleness = snapshot_replicator.max_staleness_sec() if SNAPSHOT_ENABLED and from_snapshot else None
+        if staleness is not None:
+            response.headers['X-Snapshot-Staleness-Sec'] = f"{staleness:.1f}"
+        return response
+    return wrapper
+
+def store_cluster_assignments(cursor, touched_clusters, missed_assignments):
+    """
+    Registra los clusters vistos en un lote y las MACs nuevas asignadas a cada uno. missed_assignments son
+    las MACs que no estaban en la caché del índice (mac, cluster_id calculado, address_type, company_id):
+    si ya tienen fila en mac_clusters (reinicio o expulsión de la caché) conservan ese cluster aunque su
+    anuncio haya cambiado, y solo se crea un cluster para las MACs realmente nuevas. Devuelve los pares
+    (mac, cluster_id) asignados, para la caché.
+    """
+    missed_macs = list({mac for mac, _, _, _ in missed_assignments})
+    assigned = {}
+    for i in range(0, len(missed_macs), 500):
+        chunk = missed_macs[i:i + 500]
+        for row in cursor.execute(
+            f"SELECT ble_mac_address, cluster_id FROM mac_clusters WHERE ble_mac_address IN ({','.join('?' * len(chunk))})", chunk
+        ).fetchall():
+            assigned[row[0]] = row[1]
+    new_macs = []
+    for mac, cluster_id, address_type, company_id in missed_assignments:
+        existing_cluster_id = assigned.get(mac)
+        if existing_cluster_id is not None:
+            touched_clusters.setdefault(existing_cluster_id, (None, company_id))
+            continue
+        assigned[mac] = cluster_id
+        touched_clusters[cluster_id] = (address_type, company_id)
+        new_macs.append((mac, cluster_id, address_type))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO device_clusters (cluster_id, address_type, company_id) VALUES (?, ?, ?)",
+        [(cid, addr_type, company_id) for cid, (addr_type, company_id) in touched_clusters.items() if addr_type is not None]
+    )
+    for mac, cluster_id, address_type in new_macs:
+        cursor.execute(
+            "INSERT OR IGNORE INTO mac_clusters (ble_mac_address, cluster_id, address_type) VALUES (?, ?, ?)",
+            (mac, cluster_id, address_type)
+        )
+        if cursor.rowcount == 1:
+            cursor.execute("UPDATE device_clusters SET mac_count = mac_count + 1 WHERE cluster_id = ?", (cluster_id,))
+    cursor.executemany(
+        "UPDATE device_clusters SET last_seen = CURRENT_TIMESTAMP WHERE cluster_id = ?",
+        [(cid,) for cid in touched_clusters]
+    )
+    return assigned.items()
+
+# --- Mantenimiento de la base de datos (tareas de maintenance_scheduler) ---
+# Siguiente tabla de cada (tarea, shard) en las tareas que recorren las tablas por partes
+maintenance_positions = {}
+
+def check_maintenance_budget(budget):
+    """Comprobación entre pasos: el progress handler del presupuesto solo salta dentro de una sentencia."""
+    if budget.deadline is not None and time.monotonic() > budget.deadline:
+        budget.cancel(query_budget.REASON_TIME)
+    if budget.exceeded:
+        raise query_budget.QueryBudgetExceeded(budget)
+
+def run_table_by_table(job_name, shard, conn, budget, fn):
+    """
+    Aplica fn(tabla) a las tablas del shard empezando donde se quedó la ejecución anterior, hasta terminar
+    la vuelta o agotar el presupuesto. Una tabla que por sí sola no cabe en el presupuesto se salta (se indica
+    en el detalle) para que no bloquee la vuelta; se puede procesar con una ejecución manual con más budget_ms.
+    """
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+        "AND sql NOT LIKE 'CREATE VIRTUAL TABLE%' ORDER BY name"
+    )]
+    key = (job_name, shard)
+    position = maintenance_positions.get(key, 0)
+    if position >= len(tables):
+        position = 0
+    processed = []
+    try:
+        with query_budget.enforce(conn, budget):
+            for table in tables[position:]:
+                check_maintenance_budget(budget)
+                fn(table)
+                processed.append(table)
+                position += 1
+    except query_budget.QueryBudgetExceeded as e:
+        e.detail = {"tables": processed, "interrupted_table": tables[position]}
+        if not processed:
+            position += 1
+        raise
+    finally:
+        maintenance_positions[key] = position
+    return {"tables": processed, "pass_complete": position >= len(tables)}
+
+def maintenance_wal_checkpoint(shard, budget):
+    """Checkpoint PASSIVE: pasa al fichero las páginas del WAL que ya no necesita ningún lector, sin esperar a nadie."""
+    conn = get_db_connection(shard)
+    try:
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode != 'wal':
+            raise maintenance.JobSkipped(f"journal_mode is '{journal_mode}' (set DATABASE_WAL_ENABLED to use WAL)")
+        with query_budget.enforce(conn, budget):
+            busy, wal_pages, checkpointed_pages = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        return {"wal_pages": wal_pages, "checkpointed_pages": checkpointed_pages,
+                "pending_pages": max(0, wal_pages - checkpointed_pages)}
+    finally:
+        conn.close()
+
+def maintenance_optimize(shard, budget):
+    """
+    ANALYZE muestreado (analysis_limit filas por índice) tabla a tabla, para que el planificador siga eligiendo
+    bien los índices a medida que crecen las tablas. Cada tabla se analiza bajo el lock de escritura del shard.
+    """
+    conn = get_db_connection(shard)
+    try:
+        conn.execute(f"PRAGMA analysis_limit = {MAINTENANCE_ANALYSIS_LIMIT}")
+
+        def analyze(table):
+            with shard_router.writer_lock(shard):
+                conn.execute(f'ANALYZE "{table}"')
+
+        detail = run_table_by_table('optimize', shard, conn, budget, analyze)
+        return dict(detail, analysis_limit=MAINTENANCE_ANALYSIS_LIMIT)
+    finally:
+        conn.close()
+
+def maintenance_incremental_vacuum(shard, budget):
+    """
+    Devuelve al sistema las páginas libres del shard (p.ej. tras un rebalanceo) en pasos de
+    MAINTENANCE_VACUUM_PAGES_PER_STEP páginas, soltando el lock de escritura entre pasos.
+    """
+    conn = get_db_connection(shard)
+    try:
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            raise maintenance.JobSkipped(f"auto_vacuum is not INCREMENTAL ({free_pages} free pages); "
+                                         f"enable it offline with: python backend_server.py --enable-incremental-vacuum")
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        initial_free_pages = free_pages
+        steps = 0
+        try:
+            with query_budget.enforce(conn, budget):
+                while free_pages > 0:
+                    check_maintenance_budget(budget)
+                    with shard_router.writer_lock(shard):
+                        # incremental_vacuum libera una página por paso de la sentencia y execute() solo da el primero:
+                        # executescript la ejecuta hasta el final
+                        conn.executescript(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES_PER_STEP})")
+                    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                    steps += 1
+        except query_budget.QueryBudgetExceeded as e:
+            e.detail = {"freed_bytes": (initial_free_pages - free_pages) * page_size, "free_pages": free_pages, "steps": steps}
+            raise
+        return {"freed_bytes": (initial_free_pages - free_pages) * page_size, "free_pages": free_pages, "steps": steps}
+    finally:
+        conn.close()
+
+def maintenance_integrity_check(shard, budget):
+    """
+    PRAGMA quick_check tabla a tabla (cada tabla con sus índices). Sin WAL, una lectura larga impide los
+    commits: cada comprobación se hace bajo el lock de escritura del shard y la acota el presupuesto.
+    """
+    conn = get_db_connection(shard)
+    problems = []
+
+    def check(table):
+        with shard_router.writer_lock(shard):
+            messages = [row[0] for row in conn.execute(f'PRAGMA quick_check("{table}")').fetchall()]
+        if messages != ['ok']:
+            problems.append({"table": table, "messages": messages[:20]})
+
+    try:
+        detail = run_table_by_table('integrity_check', shard, conn, budget, check)
+    except query_budget.QueryBudgetExceeded as e:
+        e.detail["problems"] = problems
+        raise
+    finally:
+        conn.close()
+    if problems:
+        app.logger.error(f"quick_check ha encontrado problemas en el shard '{shard}': {problems}")
+        raise maintenance.JobFailed("quick_check found problems", dict(detail, problems=problems))
+    return detail
+
+MAINTENANCE_JOB_FUNCTIONS = {
+    'wal_checkpoint': maintenance_wal_checkpoint,
+    'optimize': maintenance_optimize,
+    'incremental_vacuum': maintenance_incremental_vacuum,
+    'integrity_check': maintenance_integrity_check,
+}
+for maintenance_job_name, maintenance_job in MAINTENANCE_JOBS.items():
+    # Primera ejecución como mucho a los 5 minutos de arrancar (los reinicios no retrasan indefinidamente las tareas largas)
+    maintenance_scheduler.add(maintenance_job_name, MAINTENANCE_JOB_FUNCTIONS[maintenance_job_name], maintenance_job["interval_sec"],
+                              maintenance_job["budget_ms"], initial_delay_sec=min(maintenance_job["interval_sec"], 300))
+
+def enable_incremental_vacuum():
+    """Offline (con el servidor parado): activa auto_vacuum=INCREMENTAL en los shards existentes (requiere un VACUUM completo)."""
+    for shard in shard_router.all_shards():
+        conn = get_db_connection(shard)
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                continue
+            started = time.monotonic()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            app.logger.info(f"auto_vacuum=INCREMENTAL activado en el shard '{shard}' ({time.monotonic() - started:.1f} s).")
+        finally:
+            conn.close()
+
 # --- Helper para validar y convertir fechas ---
 def validate_date_format(date_string):
     try:
@@ -96,6 +1241,181 @@ def validate_date_format(date_string):
     except (ValueError, TypeError):
         return None
 
+def is_exact_requested():
+    """True si la petición pide el cálculo exacto (exact=true) en lugar del estimado por sketches."""
+    return request.args.get('exact', 'false').strip().lower() in ('1', 'true', 'yes')
+
+def is_columnar_requested():
+    """True si la petición pide el formato columnar (format=columnar) en lugar de etiquetas y objetos por punto."""
+    return request.args.get('format', '').strip().lower() == 'columnar'
+
+def is_smoothing_requested():
+    """True si la petición pide además la serie de RSSI suavizada (smooth=true)."""
+    return request.args.get('smooth', 'false').strip().lower() in ('1', 'true', 'yes')
+
+def smooth_rssi_series(epochs, rssis):
+    """RSSI suavizado de una serie de un ESP con el mismo filtro (y parámetros) que el estado de la ingesta."""
+    return proximity.smooth_series(epochs, rssis, process_noise=PROXIMITY_PROCESS_NOISE,
+                                   measurement_noise=PROXIMITY_MEASUREMENT_NOISE, reset_after_sec=PROXIMITY_TTL_SEC)
+
+def client_disconnect_checker():
+    """
+    Función que indica si el cliente de la petición actual ha cerrado la conexión. Solo con el servidor
+    de Werkzeug, que expone el socket; con otros servidores WSGI devuelve None (no se vigila).
+    """
+    sock = request.environ.get('werkzeug.socket')
+    if sock is None:
+        return None
+    def is_disconnected():
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            # Legible pero sin datos: el cliente ha cerrado su extremo
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+    return is_disconnected
+
+def query_too_expensive_response(budget_name, budget, suggestion):
+    if budget.reason == query_budget.REASON_CANCELLED:
+        app.logger.info(f"Consulta '{budget_name}' cancelada: el cliente se desconectó tras {budget.elapsed_ms()} ms.")
+        return jsonify({"error": "Request cancelled"}), 499
+    app.logger.warning(f"Consulta '{budget_name}' interrumpida por presupuesto ({budget.reason}) tras {budget.elapsed_ms()} ms.")
+    return jsonify({
+        "error": "Query too expensive",
+        "reason": budget.reason,
+        "elapsed_ms": budget.elapsed_ms(),
+        "budget": {"time_ms": budget.time_ms, "max_steps": budget.max_steps},
+        "suggestion": suggestion,
+    }), 422
+
+def budgeted_query(budget_name, suggestion):
+    """
+    Aplica a un endpoint analítico su presupuesto de QUERY_BUDGETS (interrumpe la consulta en SQLite al
+    superarlo o si el cliente se desconecta) y agrupa las peticiones idénticas simultáneas en una sola ejecución.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            limits = QUERY_BUDGETS.get(budget_name, {})
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+
+            def execute():
+                response = app.make_response(view(*args, **kwargs))
+                return response.get_data(), response.status_code, list(response.headers)
+
+            try:
+                (body, status, headers), budget = query_coalescer.run(
+                    key, execute, lambda: query_budget.QueryBudget(**limits), client_disconnect_checker()
+                )
+            except query_budget.QueryBudgetExceeded as e:
+                budget = query_budget.QueryBudget(**limits)
+                budget.cancel(e.reason)
+            # Los endpoints capturan los errores de BD: el presupuesto indica si la consulta se interrumpió
+            if budget.exceeded:
+                return query_too_expensive_response(budget_name, budget, suggestion)
+            return app.response_class(body, status=status, headers=headers)
+        return wrapper
+    return decorator
+
+def negated_sqlite_offset(offset):
+    """'+1 hours' -> '-1 hours'. Permite pasar rangos de fechas locales a UTC en SQLite."""
+    offset = offset.strip()
+    if offset.startswith('+'): return '-' + offset[1:]
+    if offset.startswith('-'): return '+' + offset[1:]
+    return '-' + offset
+
+def local_date_range_to_utc(start_date_obj, end_date_obj):
+    """
+    Convierte [start_date, end_date] (días locales, inclusivo) en el intervalo UTC [inicio, fin).
+    Un extremo None deja el intervalo abierto por ese lado.
+    """
+    neg_offset = negated_sqlite_offset(SQLITE_ANALYTICS_TIME_OFFSET)
+    with sqlite3.connect(':memory:') as conn:
+        row = conn.execute(
+            "SELECT datetime(?, ?), datetime(?, '+1 day', ?)",
+            (start_date_obj.strftime('%Y-%m-%d') if start_date_obj else None, neg_offset,
+             end_date_obj.strftime('%Y-%m-%d') if end_date_obj else None, neg_offset)
+        ).fetchone()
+    return row[0], row[1]
+
+def fetch_hll_sketch_rows(start_utc=None, end_utc=None, esp_ids=None, hourly_only=False, table='hll_sketches'):
+    """
+    Devuelve filas (granularity, bucket_start, esp_device_id, registers) de todos los shards que cubren
+    [start_utc, end_utc) sin solaparse: sketches diarios para los días completos y horarios para los extremos.
+    Sin rango devuelve los sketches 'all' (histórico completo), o todos los horarios con hourly_only.
+    Al ser mergeables, la unión entre shards es exacta.
+    table='rssi_histograms' hace lo mismo con los histogramas de RSSI (columna counts).
+    """
+    return [row for rows in run_on_all_shards(lambda conn: _fetch_sketch_rows_shard(conn, table, start_utc, end_utc, esp_ids, hourly_only))
+            for row in rows]
+
+def _fetch_sketch_rows_shard(conn, table, start_utc, end_utc, esp_ids, hourly_only):
+    esp_filter_sql, esp_params = "", []
+    if esp_ids:
+        esp_filter_sql = f"AND esp_device_id IN ({','.join('?' for _ in esp_ids)})"
+        esp_params = list(esp_ids)
+
+    if start_utc is None and end_utc is None:
+        # Agrupando por hora hacen falta los sketches horarios: los 'all' no tienen hora
+        return conn.execute(
+            f"SELECT * FROM {table} WHERE granularity = ? {esp_filter_sql}", tuple(['hour' if hourly_only else 'all'] + esp_params)
+        ).fetchall()
+
+    select_sql = f"SELECT * FROM {table} WHERE granularity = ? AND bucket_start >= ? AND bucket_start < ? {esp_filter_sql}"
+    if hourly_only:
+        return conn.execute(select_sql, tuple(['hour', start_utc, end_utc] + esp_params)).fetchall()
+
+    start_dt = datetime.strptime(start_utc, '%Y-%m-%d %H:%M:%S')
+    end_dt = datetime.strptime(end_utc, '%Y-%m-%d %H:%M:%S')
+    first_full_day = start_dt.replace(hour=0, minute=0, second=0)
+    if first_full_day < start_dt: first_full_day += timedelta(days=1)
+    last_day_end = end_dt.replace(hour=0, minute=0, second=0)
+    fmt = '%Y-%m-%d %H:%M:%S'
+
+    if first_full_day >= last_day_end:
+        return conn.execute(select_sql, tuple(['hour', start_utc, end_utc] + esp_params)).fetchall()
+    rows = conn.execute(select_sql, tuple(['day', first_full_day.strftime(fmt), last_day_end.strftime(fmt)] + esp_params)).fetchall()
+    rows += conn.execute(select_sql, tuple(['hour', start_utc, first_full_day.strftime(fmt)] + esp_params)).fetchall()
+    rows += conn.execute(select_sql, tuple(['hour', last_day_end.strftime(fmt), end_utc] + esp_params)).fetchall()
+    return rows
+
+def analytics_offset_hours():
+    """Horas enteras de SQLITE_ANALYTICS_TIME_OFFSET (p.ej. '+1 hours' -> 1)."""
+    with sqlite3.connect(':memory:') as conn:
+        row = conn.execute(
+            "SELECT (julianday(datetime('2000-01-01 00:00:00', ?)) - julianday('2000-01-01 00:00:00')) * 24",
+            (SQLITE_ANALYTICS_TIME_OFFSET,)
+        ).fetchone()
+    return int(round(row[0]))
+
+def exact_distinct_counts(group_expr, where_sql='', params=()):
+    """
+    COUNT(DISTINCT ble_mac_address) agrupado por group_expr sobre todos los shards.
+    Con un único shard se resuelve en SQL; con varios se unen los conjuntos de MACs de cada grupo
+    para que una MAC vista en varios shards cuente una sola vez.
+    """
+    if not shard_router.is_sharded():
+        rows = query_all_shards(
+            f"SELECT {group_expr} as group_key, COUNT(DISTINCT ble_mac_address) as cnt FROM scanned_devices {where_sql} GROUP BY group_key",
+            params
+        )
+        return {row['group_key']: row['cnt'] for row in rows}
+    macs_by_group = defaultdict(set)
+    for row in query_all_shards(f"SELECT DISTINCT {group_expr} as group_key, ble_mac_address FROM scanned_devices {where_sql}", params):
+        macs_by_group[row['group_key']].add(row['ble_mac_address'])
+    return {key: len(macs) for key, macs in macs_by_group.items()}
+
+def merge_hll_rows(rows, key_func):
+    """Agrupa filas de sketches por key_func(row) y devuelve {clave: estimación de distintos}."""
+    return {key: sketch.estimate() for key, sketch in merge_hll_sketches(rows, key_func).items()}
+
+def merge_hll_sketches(rows, key_func):
+    """Como merge_hll_rows, pero devuelve los sketches unidos ({clave: HyperLogLog})."""
+    merged = defaultdict(sketches.HyperLogLog)
+    for row in rows:
+        merged[key_func(row)].merge_bytes(row['registers'])
+    return dict(merged)
+
 # --- Helper para convertir timestamp UTC string a local string ---
 def convert_utc_to_local_string(utc_timestamp_str, target_tz):
     if not utc_timestamp_str:
@@ -115,6 +1435,784 @@ def convert_utc_to_local_string(utc_timestamp_str, target_tz):
         return utc_timestamp_str 
 
 
+# --- Formato columnar de los gráficos (format=columnar) ---
+def utc_offset_sec(epoch, target_tz):
+    return int(datetime.fromtimestamp(epoch, target_tz).utcoffset().total_seconds())
+
+def timezone_offset_table(start_epoch, end_epoch, target_tz=None):
+    """
+    Offsets de la zona horaria en [start_epoch, end_epoch]: {zone, epoch, offset_sec}, listas paralelas en
+    las que desde epoch[i] la hora local es UTC + offset_sec[i]. El rango se recorre por días y cada cambio
+    (horario de verano) se localiza por bisección: el coste depende de los días, no de los puntos.
+    """
+    target_tz = target_tz or TARGET_TIMEZONE_PYTZ
+    start_epoch, end_epoch = int(start_epoch), int(end_epoch)
+    epochs, offsets = [start_epoch], [utc_offset_sec(start_epoch, target_tz)]
+    probe = start_epoch
+    while probe < end_epoch:
+        next_probe = min(probe + 86400, end_epoch)
+        next_offset = utc_offset_sec(next_probe, target_tz)
+        if next_offset != offsets[-1]:
+            lo, hi = probe, next_probe
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if utc_offset_sec(mid, target_tz) == offsets[-1]:
+                    lo = mid
+                else:
+                    hi = mid
+            epochs.append(hi)
+            offsets.append(next_offset)
+        probe = next_probe
+    return {"zone": target_tz.zone, "epoch": epochs, "offset_sec": offsets}
+
+def local_date_start_epoch(date_obj):
+    """Epoch UTC del inicio (00:00 local) de un día."""
+    return int(TARGET_TIMEZONE_PYTZ.localize(datetime(date_obj.year, date_obj.month, date_obj.day)).timestamp())
+
+
+# --- Helpers para cursores de paginación (keyset) ---
+def encode_page_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor_str):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor_str.encode('ascii')).decode('utf-8'))
+        return values if isinstance(values, list) else None
+    except (ValueError, UnicodeError):
+        return None
+
+def cursor_values_match(values, expected_types):
+    """True si cada valor del cursor es un escalar del tipo esperado (los valores acaban como parámetros SQL)."""
+    return len(values) == len(expected_types) and all(
+        isinstance(value, expected) and not isinstance(value, bool) for value, expected in zip(values, expected_types)
+    )
+
+def build_fts_phrase(text):
+    """Frase FTS5 literal (comillas escapadas) para buscar una subcadena con el tokenizer trigram."""
+    return '"' + text.replace('"', '""') + '"'
+
+def count_distinct_across_shards(sql, params=()):
+    """Número de valores distintos de la primera columna de sql en la unión de todos los shards."""
+    if not shard_router.is_sharded():
+        return query_all_shards(f"SELECT COUNT(*) as total FROM ({sql})", params)[0]['total']
+    return len({row[0] for row in query_all_shards(sql, params)})
+
+def merge_inventory_rows(rows, sort_by_param):
+    """Fusiona los resúmenes de inventario de una misma MAC procedentes de varios shards."""
+    merged = {}
+    for row in rows:
+        current = dict(row)
+        mac = current['ble_mac_address']
+        previous = merged.get(mac)
+        if previous is not None:
+            newer, older = (current, previous) if current['max_timestamp_utc'] > previous['max_timestamp_utc'] else (previous, current)
+            combined = dict(newer)
+            combined['adv_packets_count'] = newer['adv_packets_count'] + older['adv_packets_count']
+            if combined['best_ble_device_name'] == 'N/A':
+                combined['best_ble_device_name'] = older['best_ble_device_name']
+            current = combined
+        merged[mac] = current
+    python_sort_keys = {
+        'last_seen_timestamp': lambda r: r['max_timestamp_utc'],
+        'ble_mac_address': lambda r: r['ble_mac_address'],
+        'best_ble_device_name': lambda r: r['best_ble_device_name'],
+        'manufacturer_name': lambda r: r['company_name'] or '',
+        'adv_packets_count': lambda r: r['adv_packets_count'],
+    }
+    for row in merged.values():
+        row['sort_value'] = python_sort_keys[sort_by_param](row)
+    return merged
+
+# --- Backend de almacenamiento SQLite (un fichero por shard) ---
+class SQLiteStorage(storage.StorageBackend):
+    """storage.StorageBackend sobre scanned_devices y sus tablas resumen, repartidas en los shards."""
+
+    DEVICE_SORT_EXPRESSIONS = {
+        'last_seen_timestamp': 'i.last_seen',
+        'ble_mac_address': 'i.ble_mac_address',
+        'best_ble_device_name': "COALESCE(i.best_name, 'N/A')",
+        'manufacturer_name': "COALESCE(c.name, '')",
+        'adv_packets_count': 'i.adv_packets_count'
+    }
+
+    def init(self):
+        init_db()
+
+    def store_batch(self, esp_device_id, records):
+        shard = shard_router.shard_for_esp(esp_device_id)
+        fingerprint_index = fingerprint_indexes[shard]
+        touched_clusters = {}      # cluster_id -> (address_type, company_id)
+        missed_assignments = []    # (mac, cluster_id, address_type, company_id) no presentes en la caché del índice
+        for record in records:
+            cluster_id = fingerprint_index.get(record.ble_mac_address)
+            if cluster_id is None:
+                cluster_id, address_type = fingerprint.compute_cluster(
+                    record.ble_mac_address, record.manufacturer_data, record.service_uuids_list, record.appearance, record.tx_power
+                )
+                missed_assignments.append((record.ble_mac_address, cluster_id, address_type, record.company_id))
+            else:
+                touched_clusters.setdefault(cluster_id, (None, record.company_id))
+
+        with shard_router.writer_lock(shard):
+            conn = get_db_connection(shard)
+            try:
+                cursor = conn.cursor()
+                cursor.executemany("""
+                    INSERT INTO scanned_devices (
+                        esp_device_id, ble_mac_address, ble_device_name, ble_rssi,
+                        manufacturer_data, service_data, service_uuids, tx_power, appearance, company_id
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(
+                    esp_device_id, r.ble_mac_address, r.ble_device_name, r.ble_rssi,
+                    r.manufacturer_data, r.service_data, r.service_uuids, r.tx_power, r.appearance, r.company_id
+                ) for r in records])
+                cluster_assignments = store_cluster_assignments(cursor, touched_clusters, missed_assignments)
+                store_hll_batch(cursor, esp_device_id, {r.ble_mac_address for r in records})
+                store_rssi_histogram_batch(cursor, esp_device_id, [r.ble_rssi for r in records if r.ble_rssi is not None])
+                store_inventory_batch(cursor, esp_device_id, [
+                    (r.ble_mac_address, r.ble_device_name, r.ble_rssi, r.manufacturer_data, r.company_id, r.service_uuids_list)
+                    for r in records
+                ])
+                cursor.execute('''
+                    INSERT INTO esp_heartbeats (esp_device_id, first_contact, last_contact, last_batch_size, batches)
+                    VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, 1)
+                    ON CONFLICT(esp_device_id) DO UPDATE SET
+                        last_contact = excluded.last_contact,
+                        last_batch_size = excluded.last_batch_size,
+                        batches = batches + 1
+                ''', (esp_device_id, len(records)))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+        fingerprint_index.remember(cluster_assignments)
+
+    def recent_observations(self, since_utc):
+        rows = query_all_shards('''
+            SELECT timestamp, esp_device_id, ble_mac_address, ble_device_name, ble_rssi, tx_power, company_id
+            FROM scanned_devices
+            WHERE timestamp >= ?
+            ORDER BY timestamp ASC, id ASC
+        ''', (since_utc,))
+        rows.sort(key=lambda row: row['timestamp'])
+        return rows
+
+    def device_history(self, mac_address, limit):
+        history_query = """
+            SELECT 
+                id, 
+                timestamp as timestamp_utc, 
+                esp_device_id, ble_device_name, ble_rssi,
+                manufacturer_data, service_data, service_uuids,
+                tx_power, appearance
+            FROM scanned_devices
+            WHERE ble_mac_address = ?
+            ORDER BY timestamp DESC LIMIT ?; 
+        """
+        # Cada shard devuelve sus 'limit' más recientes; se fusionan y se recortan de nuevo
+        return sorted(query_all_shards(history_query, (mac_address, limit)),
+                      key=lambda row: row['timestamp_utc'], reverse=True)[:limit]
+
+    def device_history_batch(self, befores, limit):
+        branches, params = [], []
+        for mac_address, before in befores.items():
+            condition, branch_params = "ble_mac_address = ?", [mac_address]
+            if before is not None:
+                # 'timestamp <= ?' acota el rango sobre idx_mac_timestamp; la comparación de row values desempata
+                condition += " AND timestamp <= ? AND (timestamp, esp_device_id, id) < (?, ?, ?)"
+                branch_params += [before[0], *before]
+            branches.append(f"""
+                SELECT * FROM (
+                    SELECT id, timestamp as timestamp_utc, ble_mac_address, esp_device_id, ble_device_name, ble_rssi,
+                           manufacturer_data, service_data, service_uuids, tx_power, appearance
+                    FROM scanned_devices
+                    WHERE {condition}
+                    ORDER BY timestamp DESC, esp_device_id DESC, id DESC LIMIT ?
+                )""")
+            params += branch_params + [limit]
+        history = {mac_address: [] for mac_address in befores}
+        if not branches:
+            return history
+        # Una sola sentencia por shard con una búsqueda por índice para cada MAC
+        for row in query_all_shards(" UNION ALL ".join(branches), params):
+            row = dict(row)
+            history[row.pop('ble_mac_address')].append(row)
+        for mac_address, rows in history.items():
+            rows.sort(key=storage.history_order_key, reverse=True)
+            del rows[limit:]
+        return history
+
+    def _device_filter_sql(self, filters):
+        conditions, params = [], []
+        name = filters.get('name')
+        if name:
+            if DEVICE_NAME_FTS_ENABLED and len(name) >= 3:
+                conditions.append("i.device_id IN (SELECT rowid FROM device_names_fts WHERE device_names_fts MATCH ?)")
+                params.append(build_fts_phrase(name))
+            else:
+                # El tokenizer trigram necesita al menos 3 caracteres
+                conditions.append("i.best_name LIKE ? ESCAPE '\\'")
+                params.append('%' + name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if filters.get('name_prefix'):
+            # Rango sobre idx_inventory_name (COLLATE NOCASE) en lugar de LIKE para garantizar el uso del índice
+            conditions.append("i.best_name >= ? COLLATE NOCASE AND i.best_name < ? COLLATE NOCASE")
+            params += [filters['name_prefix'], filters['name_prefix'] + '\U0010FFFF']
+        if filters.get('company_id') is not None:
+            conditions.append("i.company_id = ?")
+            params.append(filters['company_id'])
+        if filters.get('esp_id'):
+            conditions.append("i.ble_mac_address IN (SELECT ble_mac_address FROM device_esps WHERE esp_device_id = ?)")
+            params.append(filters['esp_id'])
+        if filters.get('service_uuid'):
+            conditions.append("i.ble_mac_address IN (SELECT ble_mac_address FROM device_service_uuids WHERE service_uuid = ?)")
+            params.append(filters['service_uuid'])
+        if filters.get('min_rssi') is not None:
+            conditions.append("i.max_rssi >= ?")
+            params.append(filters['min_rssi'])
+        if filters.get('last_seen_from'):
+            conditions.append("i.last_seen >= ?")
+            params.append(filters['last_seen_from'])
+        if filters.get('last_seen_to'):
+            conditions.append("i.last_seen < ?")
+            params.append(filters['last_seen_to'])
+        return conditions, params
+
+    def count_devices(self, filters, exact):
+        if not filters and not exact:
+            return merge_hll_rows(fetch_hll_sketch_rows(), lambda row: 'total').get('total', 0), True
+        conditions, params = self._device_filter_sql(filters)
+        where_sql = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        return count_distinct_across_shards(f"SELECT i.ble_mac_address FROM device_inventory i {where_sql}", params), False
+
+    def list_devices(self, filters, sort_by, sort_order, limit, offset=0, after=None):
+        sort_expression = self.DEVICE_SORT_EXPRESSIONS[sort_by]
+        conditions, params = self._device_filter_sql(filters)
+        if after is not None:
+            comparator = '<' if sort_order == 'desc' else '>'
+            conditions.append(f"({sort_expression} {comparator} ? OR ({sort_expression} = ? AND i.ble_mac_address {comparator} ?))")
+            params += [after[0], after[0], after[1]]
+
+        select_sql = f"""
+            SELECT
+                i.ble_mac_address,
+                i.last_seen as max_timestamp_utc,
+                i.adv_packets_count,
+                COALESCE(i.best_name, 'N/A') as best_ble_device_name,
+                i.last_manufacturer_data,
+                c.name as company_name,
+                {sort_expression} as sort_value
+            FROM device_inventory i
+            LEFT JOIN companies c ON c.company_id = i.company_id
+        """
+        where_sql = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        order_sql = f"ORDER BY {sort_expression} {sort_order}, i.ble_mac_address {sort_order}"
+
+        if not shard_router.is_sharded():
+            query = f"{select_sql} {where_sql} {order_sql} LIMIT ? OFFSET ?"
+            app.logger.debug(f"Executing query for unique devices: {query} with params: {params + [limit, offset]}")
+            return [dict(row) for row in query_all_shards(query, params + [limit, offset])]
+
+        # Cada shard aporta sus primeras offset+limit filas; las MACs candidatas se completan con
+        # su resumen en todos los shards (una MAC puede verse en varios) y se reordenan ya fusionadas.
+        shard_rows = query_all_shards(f"{select_sql} {where_sql} {order_sql} LIMIT ?", params + [offset + limit])
+        candidate_macs = list({row['ble_mac_address'] for row in shard_rows})
+        merged_rows = []
+        if candidate_macs:
+            full_rows = query_all_shards(
+                f"{select_sql} WHERE i.ble_mac_address IN ({','.join('?' for _ in candidate_macs)})", candidate_macs
+            )
+            merged_rows = list(merge_inventory_rows(full_rows, sort_by).values())
+        merged_rows.sort(key=lambda row: (row['sort_value'], row['ble_mac_address']), reverse=(sort_order == 'desc'))
+        return merged_rows[offset:offset + limit]
+
+    def device_changes(self, since, limit):
+        summary_sql = """
+            SELECT
+                i.ble_mac_address,
+                i.last_seen as max_timestamp_utc,
+                i.adv_packets_count,
+                COALESCE(i.best_name, 'N/A') as best_ble_device_name,
+                i.last_manufacturer_data,
+                c.name as company_name,
+                i.change_seq as sort_value
+            FROM device_inventory i
+            LEFT JOIN companies c ON c.company_id = i.company_id
+        """
+
+        def read_shard_changes(shard, conn):
+            epoch = conn.execute("SELECT epoch FROM inventory_sync").fetchone()[0]
+            last_seq = conn.execute("SELECT COALESCE(MAX(change_seq), 0) FROM device_inventory").fetchone()[0]
+            position = (epoch, 0, '') if since is None else since.get(shard)
+            if position is None or position[0] != epoch or position[1] > last_seq:
+                return epoch, None
+            # Rango sobre idx_inventory_change_seq: se leen solo las filas cambiadas
+            rows = conn.execute(f"""
+                {summary_sql}
+                WHERE i.change_seq >= ? AND (i.change_seq, i.ble_mac_address) > (?, ?)
+                ORDER BY i.change_seq, i.ble_mac_address LIMIT ?
+            """, (position[1], position[1], position[2], limit)).fetchall()
+            return epoch, rows
+
+        shards = shard_router.all_shards()
+        results = dict(zip(shards, run_per_shard(read_shard_changes, shards)))
+        from_start = {shard: (epoch, 0, '') for shard, (epoch, _) in results.items()}
+        if (since is not None and set(since) != set(shards)) or any(rows is None for _, rows in results.values()):
+            return storage.DeviceChanges([], from_start, True, False)
+
+        cursor, changed = {}, []
+        for shard, (epoch, rows) in results.items():
+            cursor[shard] = (epoch, rows[-1]['sort_value'], rows[-1]['ble_mac_address']) if rows else (since or from_start)[shard]
+            changed += rows
+        has_more = any(len(rows) == limit for _, rows in results.values())
+        if not shard_router.is_sharded():
+            return storage.DeviceChanges([dict(row) for row in changed], cursor, False, has_more)
+
+        # Una MAC vista en varios shards: su resumen completo es la fusión de sus filas en todos ellos
+        changed_macs = sorted({row['ble_mac_address'] for row in changed})
+        merged_rows = []
+        if changed_macs:
+            full_rows = query_all_shards(
+                f"{summary_sql} WHERE i.ble_mac_address IN ({','.join('?' for _ in changed_macs)})", changed_macs
+            )
+            merged_rows = list(merge_inventory_rows(full_rows, 'ble_mac_address').values())
+        return storage.DeviceChanges(merged_rows, cursor, False, has_more)
+
+    def count_clusters(self, address_type=None):
+        where_sql = "WHERE address_type = ?" if address_type else ""
+        params = [address_type] if address_type else []
+        # Clusters sin MACs (huérfanos de versiones anteriores) no cuentan
+        cluster_where_sql = f"{where_sql} AND mac_count > 0" if where_sql else "WHERE mac_count > 0"
+        return (count_distinct_across_shards(f"SELECT cluster_id FROM device_clusters {cluster_where_sql}", params),
+                count_distinct_across_shards(f"SELECT ble_mac_address FROM mac_clusters {where_sql}", params))
+
+    def list_clusters(self, address_type, limit, offset):
+        where_sql = "WHERE mac_count > 0 AND address_type = ?" if address_type else "WHERE mac_count > 0"
+        params = [address_type] if address_type else []
+        select_sql = f'''
+            SELECT cluster_id, address_type, company_id, mac_count, first_seen, last_seen
+            FROM device_clusters {where_sql}
+            ORDER BY last_seen DESC, cluster_id DESC
+        '''
+        if not shard_router.is_sharded():
+            return [dict(row) for row in query_all_shards(select_sql + " LIMIT ? OFFSET ?", params + [limit, offset])]
+        # Un mismo cluster puede existir en varios shards: se fusionan fechas y MACs antes de paginar
+        merged = {}
+        for row in query_all_shards(select_sql + " LIMIT ?", params + [offset + limit]):
+            cluster = dict(row)
+            previous = merged.get(cluster['cluster_id'])
+            if previous is not None:
+                cluster['mac_count'] += previous['mac_count']
+                cluster['first_seen'] = min(cluster['first_seen'], previous['first_seen'])
+                cluster['last_seen'] = max(cluster['last_seen'], previous['last_seen'])
+            merged[cluster['cluster_id']] = cluster
+        return sorted(merged.values(), key=lambda c: (c['last_seen'], c['cluster_id']), reverse=True)[offset:offset + limit]
+
+    def get_cluster(self, cluster_id, mac_limit):
+        cluster_rows = query_all_shards("SELECT * FROM device_clusters WHERE cluster_id = ?", (cluster_id,))
+        if not cluster_rows:
+            return None
+        mac_rows = query_all_shards(
+            "SELECT ble_mac_address, address_type FROM mac_clusters WHERE cluster_id = ? ORDER BY ble_mac_address LIMIT ?",
+            (cluster_id, mac_limit)
+        )
+        macs = {row['ble_mac_address']: dict(row) for row in mac_rows}
+        result = dict(cluster_rows[0])
+        if len(cluster_rows) > 1:
+            result['mac_count'] = len(macs)
+        result['first_seen'] = min(row['first_seen'] for row in cluster_rows)
+        result['last_seen'] = max(row['last_seen'] for row in cluster_rows)
+        result['macs'] = [macs[mac] for mac in sorted(macs)][:mac_limit]
+        return result
+
+    def activity_counts(self, mac_address, time_format, start_utc=None, end_utc=None):
+        conditions, params = ["ble_mac_address = ?"], [time_format, mac_address]
+        if start_utc:
+            conditions.append("timestamp >= ?")
+            params.append(start_utc)
+        if end_utc:
+            conditions.append("timestamp < ?")
+            params.append(end_utc)
+        query = f"""
+            SELECT strftime(?, datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as time_group, COUNT(*) as count
+            FROM scanned_devices
+            WHERE {' AND '.join(conditions)}
+            GROUP BY time_group;
+        """
+        app.logger.debug(f"Ejecutando query para device-activity: {query} con params: {params}")
+        counts = defaultdict(int)
+        for row in query_all_shards(query, params):
+            counts[row['time_group']] += row['count']
+        return dict(counts)
+
+    def distinct_counts(self, group_by, start_utc=None, end_utc=None, esp_ids=None, exact=True):
+        if exact:
+            conditions, params = [], []
+            if start_utc:
+                conditions.append("timestamp >= ? AND timestamp < ?")
+                params += [start_utc, end_utc]
+            if esp_ids:
+                conditions.append(f"esp_device_id IN ({','.join('?' for _ in esp_ids)})")
+                params += esp_ids
+            where_sql = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+            group_expr = {
+                'none': "'total'",
+                'esp': "esp_device_id",
+                'hour_of_day': f"strftime('%H', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))",
+            }[group_by]
+            return exact_distinct_counts(group_expr, where_sql, params), False
+        return {key: sketch.estimate() for key, sketch in self.distinct_sketches(group_by, start_utc, end_utc, esp_ids).items()}, True
+
+    def distinct_sketches(self, group_by, start_utc=None, end_utc=None, esp_ids=None):
+        sketch_rows = fetch_hll_sketch_rows(start_utc, end_utc, esp_ids, hourly_only=(group_by == 'hour_of_day'))
+        if group_by == 'hour_of_day':
+            offset_hours = analytics_offset_hours()
+            key_func = lambda row: f"{(int(row['bucket_start'][11:13]) + offset_hours) % 24:02d}"
+        elif group_by == 'esp':
+            key_func = lambda row: row['esp_device_id']
+        else:
+            key_func = lambda row: 'total'
+        return merge_hll_sketches(sketch_rows, key_func)
+
+    def rssi_percentile_histograms(self, group_by, start_utc=None, end_utc=None, esp_ids=None, exact=False):
+        if exact:
+            conditions, params = ["ble_rssi IS NOT NULL"], []
+            if start_utc:
+                conditions.append("timestamp >= ? AND timestamp < ?")
+                params += [start_utc, end_utc]
+            if esp_ids:
+                conditions.append(f"esp_device_id IN ({','.join('?' for _ in esp_ids)})")
+                params += esp_ids
+            group_columns = {
+                'none': "'total' as esp_device_id, '' as hour_bucket",
+                'esp': "esp_device_id, '' as hour_bucket",
+                'hour': "'total' as esp_device_id, strftime('%Y-%m-%d %H:00:00', timestamp) as hour_bucket",
+                'esp_hour': "esp_device_id, strftime('%Y-%m-%d %H:00:00', timestamp) as hour_bucket",
+            }[group_by]
+            rows = query_all_shards(f"""
+                SELECT {group_columns}, ble_rssi, COUNT(*) as count
+                FROM scanned_devices
+                WHERE {' AND '.join(conditions)}
+                GROUP BY 1, 2, ble_rssi
+            """, params)
+            histograms = defaultdict(sketches.ValueHistogram)
+            for row in rows:
+                histograms[storage.percentile_group_key(group_by, row['esp_device_id'], row['hour_bucket'])].add(row['ble_rssi'], row['count'])
+            return dict(histograms)
+
+        sketch_rows = fetch_hll_sketch_rows(start_utc, end_utc, esp_ids, hourly_only=group_by in ('hour', 'esp_hour'),
+                                            table='rssi_histograms')
+        histograms = {}
+        for row in sketch_rows:
+            key = storage.percentile_group_key(group_by, row['esp_device_id'], row['bucket_start'])
+            if key in histograms:
+                histograms[key].merge_bytes(row['counts'])
+            else:
+                histograms[key] = sketches.ValueHistogram.from_bytes(row['counts'])
+        return histograms
+
+    def manufacturer_ranking(self, start_utc, end_utc, top_n):
+        date_filters_sql_parts, query_params = [], []
+        if start_utc:
+            date_filters_sql_parts.append("timestamp >= ?")
+            query_params.append(start_utc)
+        if end_utc:
+            date_filters_sql_parts.append("timestamp < ?")
+            query_params.append(end_utc)
+        date_filter_sql = ("AND " + " AND ".join(date_filters_sql_parts)) if date_filters_sql_parts else ""
+
+        if shard_router.is_sharded():
+            # Con shards, el último company_id de cada MAC se decide tras fusionar todos los shards
+            latest_by_mac = {}
+            for row in query_all_shards(f"""
+                SELECT ble_mac_address, company_id, MAX(timestamp) as last_ts
+                FROM scanned_devices
+                WHERE company_id IS NOT NULL {date_filter_sql}
+                GROUP BY ble_mac_address
+            """, query_params):
+                previous = latest_by_mac.get(row['ble_mac_address'])
+                if previous is None or row['last_ts'] > previous[1]:
+                    latest_by_mac[row['ble_mac_address']] = (row['company_id'], row['last_ts'])
+            company_counts = defaultdict(int)
+            for company_id, _ in latest_by_mac.values():
+                company_counts[company_id] += 1
+            return storage.rank_manufacturers(company_counts, top_n)
+
+        # Último company_id de cada MAC (columna "bare" de MAX() en SQLite), conteo por fabricante
+        # vía JOIN con la tabla companies y Top-N + "Otros" resuelto en SQL.
+        query = f"""
+            WITH latest_per_mac AS (
+                SELECT ble_mac_address, company_id, MAX(timestamp) as last_ts
+                FROM scanned_devices
+                WHERE company_id IS NOT NULL {date_filter_sql}
+                GROUP BY ble_mac_address
+            ),
+            counts AS (
+                SELECT COALESCE(c.name, 'Desconocido/Otro') as manufacturer_name, COUNT(*) as device_count
+                FROM latest_per_mac l
+                LEFT JOIN companies c ON c.company_id = l.company_id
+                GROUP BY manufacturer_name
+            ),
+            ranked AS (
+                SELECT manufacturer_name, device_count,
+                       ROW_NUMBER() OVER (ORDER BY device_count DESC, manufacturer_name ASC) as rn
+                FROM counts
+            )
+            SELECT CASE WHEN rn <= ? THEN manufacturer_name ELSE 'Otros' END as label,
+                   SUM(device_count) as device_count, MIN(rn) as position
+            FROM ranked
+            GROUP BY label
+            ORDER BY position ASC;
+        """
+        app.logger.debug(f"Ejecutando query para manufacturer_analysis: {query} con params: {query_params + [top_n]}")
+        return [(row['label'], row['device_count']) for row in query_all_shards(query, query_params + [top_n])]
+
+    def _rssi_points_query(self, columns, mac_address, start_utc, end_utc, esp_id, limit):
+        params = [mac_address]
+        sql_conditions = ["s.ble_mac_address = ?", "s.ble_rssi IS NOT NULL"]
+        if start_utc:
+            sql_conditions.append("s.timestamp >= ?")
+            params.append(start_utc)
+        if end_utc:
+            sql_conditions.append("s.timestamp < ?")
+            params.append(end_utc)
+        if esp_id:
+            sql_conditions.append("s.esp_device_id = ?")
+            params.append(esp_id)
+        query = f"""
+            SELECT {columns}
+            FROM scanned_devices s
+            WHERE {' AND '.join(sql_conditions)}
+            ORDER BY s.timestamp ASC, s.id ASC
+            LIMIT ?;
+        """
+        app.logger.debug(f"Executing query for device-rssi-trend: {query} with params: {params}")
+        return query, tuple(params + [limit])
+
+    def rssi_points(self, mac_address, start_utc=None, end_utc=None, esp_id=None, limit=1000):
+        query, params = self._rssi_points_query("s.timestamp as timestamp_utc, s.ble_rssi, s.esp_device_id",
+                                                mac_address, start_utc, end_utc, esp_id, limit)
+        # Con un ESP concreto basta con su shard; sin él se fusionan los puntos de todos
+        shards = [shard_router.shard_for_esp(esp_id)] if esp_id else None
+        return sorted(query_all_shards(query, params, shards), key=lambda row: row['timestamp_utc'])[:limit]
+
+    def rssi_series(self, mac_address, start_utc=None, end_utc=None, esp_id=None, limit=1000):
+        query, params = self._rssi_points_query("CAST(strftime('%s', s.timestamp) AS INTEGER), s.ble_rssi, s.esp_device_id",
+                                                mac_address, start_utc, end_utc, esp_id, limit)
+
+        def fetch(conn):
+            cursor = conn.execute(query, params)
+            cursor.row_factory = None   # Tuplas: sin un sqlite3.Row por punto
+            return cursor.fetchall()
+
+        shards = [shard_router.shard_for_esp(esp_id)] if esp_id else None
+        # Cada shard devuelve sus puntos ya ordenados: basta con intercalarlos
+        return storage.points_to_series(heapq.merge(*run_on_all_shards(fetch, shards)), limit)
+
+    def rssi_histogram(self, esp_id=None, start_utc=None, end_utc=None):
+        params, sql_conditions = [], ["ble_rssi IS NOT NULL"]
+        if esp_id:
+            sql_conditions.append("esp_device_id = ?")
+            params.append(esp_id)
+        if start_utc:
+            sql_conditions.append("timestamp >= ?")
+            params.append(start_utc)
+        if end_utc:
+            sql_conditions.append("timestamp < ?")
+            params.append(end_utc)
+        case_sql = "\n".join(
+            f"WHEN ble_rssi >= {threshold} THEN '{label}'" if threshold is not None else f"ELSE '{label}'"
+            for threshold, label in storage.RSSI_RANGES
+        )
+        query = f"""
+            SELECT CASE {case_sql} END as rssi_range, COUNT(*) as count
+            FROM scanned_devices
+            WHERE {' AND '.join(sql_conditions)}
+            GROUP BY rssi_range;
+        """
+        shards = [shard_router.shard_for_esp(esp_id)] if esp_id else None
+        counts = defaultdict(int)
+        for row in query_all_shards(query, params, shards):
+            counts[row['rssi_range']] += row['count']
+        return dict(counts)
+
+    def known_esps(self):
+        return sorted({row['esp_device_id'] for row in query_all_shards("SELECT DISTINCT esp_device_id FROM scanned_devices")})
+
+    def esp_heartbeats(self):
+        # Tras un rebalanceo un ESP puede tener filas en varios shards: se queda la de contacto más reciente
+        latest = {}
+        for row in query_all_shards("SELECT * FROM esp_heartbeats"):
+            current = latest.get(row['esp_device_id'])
+            if current is None or (row['last_contact'] or '') > (current['last_contact'] or ''):
+                latest[row['esp_device_id']] = dict(row)
+        return [{
+            "esp_device_id": esp_id,
+            "first_contact_utc": row['first_contact'],
+            "last_contact_utc": row['last_contact'],
+            "last_batch_size": row['last_batch_size'],
+            "batches": row['batches'],
+        } for esp_id, row in sorted(latest.items())]
+
+    def store_sessions(self, session_records):
+        shard = sharding.DEFAULT_SHARD
+        with shard_router.writer_lock(shard):
+            conn = get_db_connection(shard)
+            try:
+                conn.executemany('''
+                    INSERT INTO device_sessions (ble_mac_address, start_time, end_time, duration_sec, esps, peak_rssi, adv_count)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(
+                    r.ble_mac_address, storage.epoch_to_utc_string(r.start_epoch), storage.epoch_to_utc_string(r.end_epoch),
+                    int(round(r.end_epoch - r.start_epoch)), json.dumps(r.esps), r.peak_rssi, r.adv_count
+                ) for r in session_records])
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+
+    def _session_conditions(self, esp_id):
+        if esp_id:
+            return " AND EXISTS (SELECT 1 FROM json_each(esps) WHERE value = ?)", [esp_id]
+        return "", []
+
+    def sessions_overlapping(self, start_utc, end_utc, max_duration_sec, esp_id=None, limit=None):
+        esp_sql, esp_params = self._session_conditions(esp_id)
+        earliest_start = storage.epoch_to_utc_string(storage.utc_string_to_epoch(start_utc) - max_duration_sec)
+        query = f'''
+            SELECT ble_mac_address, start_time, end_time, duration_sec, esps, peak_rssi, adv_count
+            FROM device_sessions
+            WHERE start_time >= ? AND start_time <= ? AND end_time >= ?{esp_sql}
+            ORDER BY start_time ASC, id ASC
+            {'LIMIT ?' if limit is not None else ''}
+        '''
+        params = [earliest_start, end_utc, start_utc] + esp_params + ([limit] if limit is not None else [])
+        return [{
+            "ble_mac_address": row['ble_mac_address'],
+            "start_utc": row['start_time'],
+            "end_utc": row['end_time'],
+            "duration_sec": row['duration_sec'],
+            "esps": json.loads(row['esps']),
+            "peak_rssi": row['peak_rssi'],
+            "adv_count": row['adv_count'],
+        } for row in query_all_shards(query, params, [sharding.DEFAULT_SHARD])]
+
+    def dwell_histogram(self, start_utc=None, end_utc=None, esp_id=None):
+        conditions, params = ["1 = 1"], []
+        if start_utc:
+            conditions.append("start_time >= ?")
+            params.append(start_utc)
+        if end_utc:
+            conditions.append("start_time < ?")
+            params.append(end_utc)
+        esp_sql, esp_params = self._session_conditions(esp_id)
+        case_sql = "\n".join(
+            f"WHEN duration_sec < {upper} THEN '{label}'" if upper is not None else f"ELSE '{label}'"
+            for upper, label in storage.DWELL_BUCKETS
+        )
+        query = f'''
+            SELECT CASE {case_sql} END as bucket, COUNT(*) as sessions, SUM(duration_sec) as total_duration
+            FROM device_sessions
+            WHERE {' AND '.join(conditions)}{esp_sql}
+            GROUP BY bucket
+        '''
+        rows = query_all_shards(query, params + esp_params, [sharding.DEFAULT_SHARD])
+        total = sum(row['sessions'] for row in rows)
+        duration_sum = sum(row['total_duration'] for row in rows)
+        return {row['bucket']: row['sessions'] for row in rows}, total, (duration_sum / total if total else None)
+
+    def esps_for_mac(self, mac_address):
+        esps = query_all_shards("SELECT DISTINCT esp_device_id FROM scanned_devices WHERE ble_mac_address = ?", (mac_address,))
+        return sorted({row['esp_device_id'] for row in esps})
+
+
+def create_storage_backend(name):
+    if name == 'memory':
+        return storage.MemoryStorage(utc_offset_sec=analytics_offset_hours() * 3600)
+    if name != 'sqlite':
+        app.logger.warning(f"STORAGE_BACKEND '{name}' desconocido. Usando 'sqlite'.")
+    return SQLiteStorage()
+
+storage_backend = create_storage_backend(STORAGE_BACKEND)
+
+# --- Validación de los dispositivos de un lote ---
+def parse_device_fields(device_data, esp_device_id):
+    """
+    ScanRecord (sin RSSI) con los campos validados y normalizados de un dispositivo del lote, o None si
+    falta la MAC. En el protocolo delta se llama solo cuando cambian los campos de una referencia.
+    """
+    ble_mac_address = device_data.get('macAddress')
+    ble_device_name = device_data.get('deviceName') 
+
+    manufacturer_data = device_data.get('manufacturerData') 
+    service_data_raw = device_data.get('serviceData') 
+    service_uuids_raw = device_data.get('serviceUUIDs') 
+    tx_power_raw = device_data.get('txPower')
+    appearance_raw = device_data.get('appearance')
+
+    if not ble_mac_address:
+        app.logger.warning(f"Falta campo 'macAddress' en el objeto de dispositivo: {device_data} para ESP: {esp_device_id}")
+        return None
+
+    tx_power = None
+    if tx_power_raw is not None:
+        try:
+            tx_power = int(tx_power_raw)
+        except (ValueError, TypeError):
+            app.logger.warning(f"Valor de 'txPower' no es un entero válido: {tx_power_raw} para MAC {ble_mac_address}.")
+
+    appearance = None
+    if appearance_raw is not None:
+        try:
+            appearance = int(appearance_raw)
+        except (ValueError, TypeError):
+            app.logger.warning(f"Valor de 'appearance' no es un entero válido: {appearance_raw} para MAC {ble_mac_address}.")
+
+    service_data_json_str = None
+    if service_data_raw: 
+        if isinstance(service_data_raw, dict):
+            service_data_json_str = json.dumps(service_data_raw)
+        elif isinstance(service_data_raw, str): 
+             try:
+                json.loads(service_data_raw) 
+                service_data_json_str = service_data_raw
+             except json.JSONDecodeError:
+                app.logger.warning(f"service_data_raw no es un JSON string válido: {service_data_raw}")
+    
+    service_uuids_json_str = None
+    service_uuids_list = None
+    if service_uuids_raw: 
+        if isinstance(service_uuids_raw, list):
+            service_uuids_json_str = json.dumps(service_uuids_raw)
+            service_uuids_list = service_uuids_raw
+        elif isinstance(service_uuids_raw, str): 
+            try:
+                parsed_uuids = json.loads(service_uuids_raw) 
+                service_uuids_json_str = service_uuids_raw
+                if isinstance(parsed_uuids, list): service_uuids_list = parsed_uuids
+            except json.JSONDecodeError:
+                app.logger.warning(f"service_uuids_raw no es un JSON string válido: {service_uuids_raw}")
+
+    company_id = ble_utils.extract_company_id(manufacturer_data)
+
+    return storage.ScanRecord(
+        ble_mac_address, ble_device_name, None, manufacturer_data, service_data_json_str,
+        service_uuids_json_str, service_uuids_list, tx_power, appearance, company_id
+    )
+
+def parse_rssi(ble_rssi_raw, ble_mac_address, esp_device_id):
+    if ble_rssi_raw is None:
+        return None
+    try:
+        return int(ble_rssi_raw)
+    except (ValueError, TypeError):
+        app.logger.warning(f"Valor de 'rssi' no es un entero válido: {ble_rssi_raw} para MAC {ble_mac_address}. ESP: {esp_device_id}")
+        return None
+
 # --- Endpoint de la API para recibir datos del ESP32 ---
 @app.route(API_ENDPOINT_PATH, methods=['POST'])
 def receive_ble_data():
@@ -147,346 +2245,1037 @@ def receive_ble_data():
     elif not isinstance(devices_list, list):
         app.logger.warning("Campo 'devices' no es una lista.")
         return jsonify({"status": "error", "message": "'devices' field must be a list"}), 400
-        
-    devices_processed_count = 0
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
 
-        for device_data in devices_list:
-            if not isinstance(device_data, dict):
-                app.logger.warning(f"Elemento en 'devices' no es un diccionario: {device_data}")
-                continue
+    # Protocolo delta (opcional): stateId identifica la tabla de referencias ('ref') del ESP
+    state_id = data.get('stateId')
+    if state_id is not None and not isinstance(state_id, (str, int)):
+        return jsonify({"status": "error", "message": "'stateId' must be a string or integer"}), 400
 
-            ble_mac_address = device_data.get('macAddress')
-            ble_device_name = device_data.get('deviceName') 
-            ble_rssi_raw = device_data.get('rssi')
-            
-            manufacturer_data = device_data.get('manufacturerData') 
-            service_data_raw = device_data.get('serviceData') 
-            service_uuids_raw = device_data.get('serviceUUIDs') 
-            tx_power_raw = device_data.get('txPower')
-            appearance_raw = device_data.get('appearance')
-
-            if not ble_mac_address:
-                app.logger.warning(f"Falta campo 'macAddress' en el objeto de dispositivo: {device_data} para ESP: {esp_device_id}")
-                continue
-            
-            ble_rssi = None
-            if ble_rssi_raw is not None:
-                try:
-                    ble_rssi = int(ble_rssi_raw)
-                except (ValueError, TypeError):
-                    app.logger.warning(f"Valor de 'rssi' no es un entero válido: {ble_rssi_raw} para MAC {ble_mac_address}. ESP: {esp_device_id}")
+    # Intervalo de escaneo/envío configurado en el ESP (opcional): base del intervalo sugerido
+    configured_interval_sec = None
+    try:
+        if data.get('scanIntervalSec') is not None:
+            configured_interval_sec = max(1, int(data.get('scanIntervalSec')))
+    except (ValueError, TypeError):
+        app.logger.warning(f"Valor de 'scanIntervalSec' no es un entero válido: {data.get('scanIntervalSec')}. ESP: {esp_device_id}")
 
-            tx_power = None
-            if tx_power_raw is not None:
-                try:
-                    tx_power = int(tx_power_raw)
-                except (ValueError, TypeError):
-                    app.logger.warning(f"Valor de 'txPower' no es un entero válido: {tx_power_raw} para MAC {ble_mac_address}.")
+    # Número de secuencia del lote (opcional): un reenvío de un lote ya guardado se confirma sin reescribirlo
+    batch_seq = None
+    boot_id = data.get('bootId')
+    try:
+        if data.get('batchSeq') is not None:
+            batch_seq = int(data.get('batchSeq'))
+    except (ValueError, TypeError):
+        app.logger.warning(f"Valor de 'batchSeq' no es un entero válido: {data.get('batchSeq')}. ESP: {esp_device_id}")
+    if batch_seq is not None:
+        sequence_state = batch_sequence_tracker.begin(esp_device_id, boot_id, batch_seq)
+        if sequence_state == ingest_control.BATCH_DUPLICATE:
+            app.logger.info(f"Lote repetido de ESP {esp_device_id} (bootId {boot_id}, batchSeq {batch_seq}) ignorado.")
+            return jsonify({
+                "status": "duplicate",
+                "message": "Batch already received.",
+                "devices_processed": 0,
+                "suggested_interval_sec": ingest_controller.suggested_interval_sec(esp_device_id, configured_interval_sec)
+            }), 200
+        if sequence_state == ingest_control.BATCH_IN_PROGRESS:
+            app.logger.info(f"Lote de ESP {esp_device_id} (batchSeq {batch_seq}) ya en escritura en otra petición.")
+            response = jsonify({"status": "error", "message": "Batch is already being processed", "retry_after_sec": 1})
+            response.headers['Retry-After'] = '1'
+            return response, 409
+
+    decision, retry_after_sec = ingest_controller.try_acquire(esp_device_id)
+    if decision != ingest_control.ADMIT:
+        if batch_seq is not None:
+            batch_sequence_tracker.finish(esp_device_id, boot_id, batch_seq, committed=False)
+        rate_limited = decision == ingest_control.REJECT_RATE_LIMITED
+        app.logger.warning(f"Lote de ESP {esp_device_id} rechazado ({decision}). Retry-After: {retry_after_sec}s.")
+        response = jsonify({
+            "status": "error",
+            "message": "Too many batches from this device" if rate_limited else "Server overloaded, retry later",
+            "retry_after_sec": retry_after_sec,
+            "suggested_interval_sec": ingest_controller.suggested_interval_sec(esp_device_id, configured_interval_sec)
+        })
+        response.headers['Retry-After'] = str(retry_after_sec)
+        return response, 429 if rate_limited else 503
 
-            appearance = None
-            if appearance_raw is not None:
-                try:
-                    appearance = int(appearance_raw)
-                except (ValueError, TypeError):
-                    app.logger.warning(f"Valor de 'appearance' no es un entero válido: {appearance_raw} para MAC {ble_mac_address}.")
-
-            service_data_json_str = None
-            if service_data_raw: 
-                if isinstance(service_data_raw, dict):
-                    service_data_json_str = json.dumps(service_data_raw)
-                elif isinstance(service_data_raw, str): 
-                     try:
-                        json.loads(service_data_raw) 
-                        service_data_json_str = service_data_raw
-                     except json.JSONDecodeError:
-                        app.logger.warning(f"service_data_raw no es un JSON string válido: {service_data_raw}")
-            
-            service_uuids_json_str = None
-            if service_uuids_raw: 
-                if isinstance(service_uuids_raw, list):
-                    service_uuids_json_str = json.dumps(service_uuids_raw)
-                elif isinstance(service_uuids_raw, str): 
-                    try:
-                        json.loads(service_uuids_raw) 
-                        service_uuids_json_str = service_uuids_raw
-                    except json.JSONDecodeError:
-                        app.logger.warning(f"service_uuids_raw no es un JSON string válido: {service_uuids_raw}")
-
-            sql = """
-                INSERT INTO scanned_devices (
-                    esp_device_id, ble_mac_address, ble_device_name, ble_rssi,
-                    manufacturer_data, service_data, service_uuids, tx_power, appearance
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """
-            cursor.execute(sql, (
-                esp_device_id, ble_mac_address, ble_device_name, ble_rssi,
-                manufacturer_data, service_data_json_str, service_uuids_json_str,
-                tx_power, appearance
-            ))
-            devices_processed_count += 1
-        
-        conn.commit()
+    records = []
+    committed = False
+    write_started_at = time.monotonic()
+    try:
+        if state_id is not None:
+            # Protocolo delta: las entradas referencian conjuntos de campos ya enviados por este ESP
+            parsed_devices, unknown_refs = delta_state_cache.expand(
+                esp_device_id, state_id, devices_list, lambda fields: parse_device_fields(fields, esp_device_id)
+            )
+            if unknown_refs:
+                app.logger.warning(f"ESP {esp_device_id}: {len(unknown_refs)} referencias delta desconocidas (stateId {state_id}). Se pide el lote completo.")
+                return jsonify({
+                    "status": "resync_required",
+                    "message": "Unknown delta references. Resend the batch in full with a new stateId.",
+                    "unknown_refs": unknown_refs[:50],
+                    "suggested_interval_sec": ingest_controller.suggested_interval_sec(esp_device_id, configured_interval_sec)
+                }), 409
+        else:
+            parsed_devices = []
+            for device_data in devices_list:
+                if not isinstance(device_data, dict):
+                    app.logger.warning(f"Elemento en 'devices' no es un diccionario: {device_data}")
+                    continue
+                parsed_devices.append((parse_device_fields(device_data, esp_device_id), device_data.get('rssi')))
+
+        for record, ble_rssi_raw in parsed_devices:
+            if record is not None:
+                records.append(record._replace(ble_rssi=parse_rssi(ble_rssi_raw, record.ble_mac_address, esp_device_id)))
+
+        storage_backend.store_batch(esp_device_id, records)
+        committed = True
+        live_device_store.update_many(
+            esp_device_id, [(r.ble_mac_address, r.ble_rssi, r.ble_device_name, r.company_id) for r in records]
+        )
+        alert_engine.observe_batch(esp_device_id, [(r.ble_mac_address, r.ble_rssi, r.company_id) for r in records])
+        store_closed_sessions(sessionizer.observe_batch(esp_device_id, [(r.ble_mac_address, r.ble_rssi) for r in records]))
+        cooccurrence_index.observe_batch(esp_device_id, [(r.ble_mac_address, r.ble_rssi) for r in records])
+        proximity_tracker.observe_batch(
+            esp_device_id, [(r.ble_mac_address, r.ble_rssi, r.tx_power, r.company_id) for r in records]
+        )
         if devices_list:
-            app.logger.info(f"Datos de {devices_processed_count} dispositivos BLE almacenados correctamente para ESP: {esp_device_id}.")
+            app.logger.info(f"Datos de {len(records)} dispositivos BLE almacenados correctamente para ESP: {esp_device_id}.")
         else:
             app.logger.info(f"Recibido ping/heartbeat de ESP: {esp_device_id} (sin dispositivos BLE en payload).")
 
     except sqlite3.Error as e:
         app.logger.error(f"Error de base de datos al insertar datos: {e}")
-        if conn: conn.rollback()
         return jsonify({"status": "error", "message": "Database error occurred during insert"}), 500
     except Exception as e:
         app.logger.error(f"Error inesperado al procesar dispositivos: {e}", exc_info=True)
         return jsonify({"status": "error", "message": "An unexpected error occurred"}), 500
     finally:
-        if conn:
-            conn.close()
+        ingest_controller.release(time.monotonic() - write_started_at)
+        if batch_seq is not None:
+            lost_batches = batch_sequence_tracker.finish(esp_device_id, boot_id, batch_seq, committed)
+            if lost_batches > 0:
+                app.logger.warning(f"ESP {esp_device_id}: {lost_batches} lote(s) perdidos antes de batchSeq {batch_seq}.")
 
     return jsonify({
         "status": "success",
         "message": "Data received and processed.",
-        "devices_processed": devices_processed_count
+        "devices_processed": len(records),
+        "suggested_interval_sec": ingest_controller.suggested_interval_sec(esp_device_id, configured_interval_sec)
     }), 201
 
 
 # --- Endpoint para el Dashboard Principal ---
 @app.route('/dashboard')
+@reads_from_snapshot
 def dashboard():
     # ... (sin cambios aquí) ...
     app.logger.info("Solicitud GET recibida en /dashboard")
-    conn = None
     try:
-        conn = get_db_connection()
-        esp_device_counts_rows = conn.execute(
-            'SELECT esp_device_id, COUNT(DISTINCT ble_mac_address) as unique_device_count FROM scanned_devices GROUP BY esp_device_id ORDER BY esp_device_id'
-        ).fetchall()
-        esp_chart_labels = [row['esp_device_id'] for row in esp_device_counts_rows]
-        esp_chart_data = [row['unique_device_count'] for row in esp_device_counts_rows]
-
-        rssi_distribution_rows = conn.execute('''
-            SELECT
-                CASE
-                    WHEN ble_rssi >= -50 THEN '-50 a 0 dBm'
-                    WHEN ble_rssi >= -60 THEN '-60 a -51 dBm'
-                    WHEN ble_rssi >= -70 THEN '-70 a -61 dBm'
-                    WHEN ble_rssi >= -80 THEN '-80 a -71 dBm'
-                    WHEN ble_rssi >= -90 THEN '-90 a -81 dBm'
-                    ELSE '< -90 dBm'
-                END as rssi_range,
-                COUNT(*) as count
-            FROM scanned_devices WHERE ble_rssi IS NOT NULL
-            GROUP BY rssi_range
-            ORDER BY MIN(ble_rssi) DESC
-        ''').fetchall()
-        rssi_chart_labels = [row['rssi_range'] for row in rssi_distribution_rows]
-        rssi_chart_data = [row['count'] for row in rssi_distribution_rows]
-
+        esp_chart = build_esp_device_counts(is_exact_requested())
+        rssi_chart = build_rssi_ranges()
         return render_template('dashboard.html',
-                               esp_chart_labels=esp_chart_labels,
-                               esp_chart_data=esp_chart_data,
-                               rssi_chart_labels=rssi_chart_labels,
-                               rssi_chart_data=rssi_chart_data)
+                               esp_chart_labels=esp_chart["labels"],
+                               esp_chart_data=esp_chart["data"],
+                               rssi_chart_labels=rssi_chart["labels"],
+                               rssi_chart_data=rssi_chart["data"])
     except sqlite3.Error as e:
         app.logger.error(f"Error de base de datos al cargar datos para gráficas del dashboard: {e}")
         return render_template('dashboard.html', esp_chart_labels=[], esp_chart_data=[], rssi_chart_labels=[], rssi_chart_data=[]), 500
     except Exception as e:
         app.logger.error(f"Error inesperado al cargar el dashboard: {e}", exc_info=True)
         return render_template('dashboard.html', esp_chart_labels=[], esp_chart_data=[], rssi_chart_labels=[], rssi_chart_data=[]), 500
-    finally:
-        if conn: conn.close()
+
+def build_esp_device_counts(exact):
+    """Dispositivos distintos por ESP ({labels, data, approximate})."""
+    # Sin exact=true: estimación HLL (error relativo ~1.6 %) a partir de los sketches 'all' de cada ESP
+    counts_by_esp, approximate = storage_backend.distinct_counts('esp', exact=exact)
+    labels = sorted(counts_by_esp)
+    return {"labels": labels, "data": [counts_by_esp[esp_id] for esp_id in labels], "approximate": approximate}
+
+def build_rssi_ranges():
+    """Detecciones por rango de RSSI con datos, ordenados por intensidad ({labels, data})."""
+    rssi_counts = storage_backend.rssi_histogram()
+    labels = [label for _, label in storage.RSSI_RANGES if rssi_counts.get(label)]
+    return {"labels": labels, "data": [rssi_counts[label] for label in labels]}
+
+def format_device_row(dev_row_raw):
+    """Fila del inventario lista para la tabla de dispositivos únicos. Devuelve (dict, valor de ordenación)."""
+    dev_dict = dict(dev_row_raw)
+    sort_value = dev_dict.pop('sort_value')
+    dev_dict.pop('company_name', None)
+    utc_ts_str = dev_dict.pop('max_timestamp_utc')
+    dev_dict['last_seen_timestamp'] = convert_utc_to_local_string(utc_ts_str, TARGET_TIMEZONE_PYTZ)
+
+    manufacturer_name_str = "N/A"
+    if dev_dict.get('last_manufacturer_data'):
+        name, _, _ = ble_utils.parse_manufacturer_data(dev_dict['last_manufacturer_data'])
+        manufacturer_name_str = name if name != "Unknown CID" else f"Unknown ({dev_dict['last_manufacturer_data'][:4]})"
+    dev_dict['manufacturer_name'] = manufacturer_name_str
+    return dev_dict, sort_value
 
 # --- ENDPOINT API PARA LA TABLA DE DISPOSITIVOS ÚNICOS PAGINADA ---
+def decode_sync_cursor(cursor_str):
+    """{shard: (época, change_seq, mac)} de un cursor de sincronización, None si es '0' (desde el principio) o False si no es válido."""
+    if cursor_str in ('', '0'):
+        return None
+    values = decode_page_cursor(cursor_str)
+    if not values or len(values) != 2 or values[0] != 'sync' or not isinstance(values[1], list):
+        return False
+    positions = {}
+    for position in values[1]:
+        if not isinstance(position, list) or len(position) != 4:
+            return False
+        shard, epoch, change_seq, mac = position
+        if not (isinstance(shard, str) and isinstance(epoch, str) and isinstance(change_seq, int) and isinstance(mac, str)):
+            return False
+        positions[shard] = (epoch, change_seq, mac)
+    return positions
+
+def device_changes_response(since_param):
+    """
+    Modo since=<cursor> de /api/unique-devices: solo las MACs cuyo resumen cambió después del cursor y
+    el cursor nuevo. Con resync_required el cliente debe descartar su copia y seguir con el cursor
+    devuelto, que empieza desde el principio (igual que since=0).
+    """
+    since = decode_sync_cursor(since_param)
+    if since is False:
+        return jsonify({"error": "Invalid since cursor. Use since=0 to resync."}), 400
+    limit = request.args.get('limit', DEVICE_SYNC_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit or DEVICE_SYNC_DEFAULT_LIMIT, DEVICE_SYNC_MAX_LIMIT))
+    # La réplica se refresca por tramos y podría mostrar un cambio posterior sin uno anterior: se lee del original
+    snapshot_reads.set(False)
+    changes = storage_backend.device_changes(since, limit)
+    devices = [format_device_row(row)[0] for row in changes.devices]
+    cursor = encode_page_cursor(['sync', [[shard, *position] for shard, position in sorted(changes.cursor.items())]])
+    app.logger.info(f"Sincronización incremental: {len(devices)} dispositivos cambiados (resync: {changes.resync_required}, más: {changes.has_more}).")
+    return jsonify({"devices": devices, "cursor": cursor, "has_more": changes.has_more, "resync_required": changes.resync_required})
+
 @app.route('/api/unique-devices')
+@reads_from_snapshot
 def get_unique_devices_paginated():
-    # ... (sin cambios en esta función) ...
+    """
+    Dispositivos únicos desde el inventario (device_inventory), con filtros resueltos por índices:
+    name (subcadena, FTS5 trigram), name_prefix, company_id, esp_id, min_rssi, seen_within_sec,
+    startDate/endDate (última detección) y service_uuid.
+    Paginación por página (page) o por cursor (cursor / paging=cursor) estable ante inserciones.
+    Con since=<cursor> (since=0 la primera vez) devuelve solo los cambios: ver device_changes_response.
+    """
     app.logger.info("Solicitud GET recibida en /api/unique-devices")
     try:
+        since_param = request.args.get('since')
+        if since_param is not None:
+            return device_changes_response(since_param)
+
         page = request.args.get('page', 1, type=int)
         page_size_req = request.args.get('page_size', 20, type=int)
         sort_by_param = request.args.get('sort_by', 'last_seen_timestamp').strip()
         sort_order_param = request.args.get('sort_order', 'desc').strip().lower()
+        cursor_param = request.args.get('cursor')
+        use_cursor = bool(cursor_param) or request.args.get('paging') == 'cursor'
 
         if page < 1: page = 1
         valid_page_sizes = [20, 30, 40, 50, 60, 70, 80, 90, 100]
         page_size = page_size_req if page_size_req in valid_page_sizes else 20
         
-        valid_sort_columns_map = {
-            'last_seen_timestamp': 's_grouped.max_timestamp_utc', 
-            'ble_mac_address': 's_grouped.ble_mac_address',
-            'best_ble_device_name': 'best_ble_device_name_alias', 
-            'manufacturer_name': 'last_manufacturer_data',
-            'adv_packets_count': 's_grouped.adv_packets_count'
-        }
-
-        if sort_by_param not in valid_sort_columns_map:
+        if sort_by_param not in storage.DEVICE_SORT_COLUMNS:
             app.logger.warning(f"Parámetro sort_by inválido: {sort_by_param}. Usando 'last_seen_timestamp'.")
             sort_by_param = 'last_seen_timestamp'
-        
-        db_sort_column_expression = valid_sort_columns_map[sort_by_param]
 
         if sort_order_param not in ['asc', 'desc']:
             sort_order_param = 'desc'
 
-        offset = (page - 1) * page_size
-        conn = get_db_connection()
-        
-        total_devices_query = "SELECT COUNT(DISTINCT ble_mac_address) as total FROM scanned_devices;"
-        total_devices_result = conn.execute(total_devices_query).fetchone()
-        total_devices = total_devices_result['total'] if total_devices_result else 0
-        total_pages = math.ceil(total_devices / page_size) if page_size > 0 and total_devices > 0 else 1 if total_devices == 0 else math.ceil(total_devices / page_size)
+        # --- Filtros ---
+        filters = {}
+        name_filter = (request.args.get('name') or '').strip()
+        name_prefix = (request.args.get('name_prefix') or '').strip()
+        company_id_str = (request.args.get('company_id') or '').strip()
+        filter_esp_id = (request.args.get('esp_id') or '').strip()
+        service_uuid = (request.args.get('service_uuid') or '').strip().lower()
+        min_rssi = request.args.get('min_rssi', type=int)
+        seen_within_sec = request.args.get('seen_within_sec', type=int)
+        start_date_str = request.args.get('startDate')
+        end_date_str = request.args.get('endDate')
+
+        if name_filter: filters['name'] = name_filter
+        if name_prefix: filters['name_prefix'] = name_prefix
+        if company_id_str:
+            try:
+                filters['company_id'] = int(company_id_str, 0)
+            except ValueError:
+                return jsonify({"error": "Invalid company_id. Use decimal or 0xHHHH."}), 400
+        if filter_esp_id: filters['esp_id'] = filter_esp_id
+        if service_uuid: filters['service_uuid'] = service_uuid
+        if min_rssi is not None: filters['min_rssi'] = min_rssi
+        start_date_obj, end_date_obj = None, None
+        if start_date_str:
+            start_date_obj = validate_date_format(start_date_str)
+            if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
+        if end_date_str:
+            end_date_obj = validate_date_format(end_date_str)
+            if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
+        if start_date_obj or end_date_obj:
+            # Rango local de la última detección convertido a límites UTC
+            last_seen_from, last_seen_to = local_date_range_to_utc(start_date_obj, end_date_obj)
+            if last_seen_from: filters['last_seen_from'] = last_seen_from
+            if last_seen_to: filters['last_seen_to'] = last_seen_to
+        if seen_within_sec is not None:
+            if seen_within_sec <= 0:
+                return jsonify({"error": "seen_within_sec must be a positive integer"}), 400
+            seen_since = storage.epoch_to_utc_string(time.time() - seen_within_sec)
+            filters['last_seen_from'] = max(filters.get('last_seen_from', seen_since), seen_since)
+
+        total_devices, total_devices_approximate = storage_backend.count_devices(filters, is_exact_requested())
+        # Dispositivos estimados tras agrupar MACs aleatorias rotativas por huella
+        total_clusters, _ = storage_backend.count_clusters()
+        total_pages = math.ceil(total_devices / page_size) if total_devices > 0 else 1
         
-        if page > total_pages and total_pages > 0 :
-             page = total_pages 
-             offset = (page - 1) * page_size
+        after, offset = None, 0
+        if use_cursor:
+            if cursor_param:
+                cursor_values = decode_page_cursor(cursor_param)
+                sort_value_type = int if sort_by_param == 'adv_packets_count' else str
+                if (not cursor_values or len(cursor_values) != 4 or cursor_values[0] != sort_by_param or cursor_values[1] != sort_order_param
+                        or not cursor_values_match(cursor_values[2:], (sort_value_type, str))):
+                    return jsonify({"error": "Invalid cursor for the requested sort. Restart without cursor."}), 400
+                after = (cursor_values[2], cursor_values[3])
+        else:
+            if page > total_pages and total_pages > 0 and not total_devices_approximate:
+                 page = total_pages 
+            offset = (page - 1) * page_size
 
-        sub_query_grouped = """
-            SELECT 
-                ble_mac_address, 
-                MAX(timestamp) as max_timestamp_utc, 
-                COUNT(*) as adv_packets_count 
-            FROM scanned_devices
-            GROUP BY ble_mac_address
-        """
-        
-        query = f"""
-            SELECT
-                s_grouped.ble_mac_address,
-                s_grouped.max_timestamp_utc, 
-                s_grouped.adv_packets_count, 
-                COALESCE(
-                    (SELECT s_name.ble_device_name 
-                     FROM scanned_devices s_name
-                     WHERE s_name.ble_mac_address = s_grouped.ble_mac_address 
-                       AND s_name.ble_device_name IS NOT NULL AND s_name.ble_device_name != ''
-                     ORDER BY s_name.timestamp DESC, s_name.id DESC LIMIT 1), 'N/A'
-                ) as best_ble_device_name_alias,
-                (SELECT s_data.manufacturer_data
-                 FROM scanned_devices s_data
-                 WHERE s_data.ble_mac_address = s_grouped.ble_mac_address
-                 ORDER BY s_data.timestamp DESC, s_data.id DESC LIMIT 1
-                ) as last_manufacturer_data
-            FROM ({sub_query_grouped}) s_grouped
-            ORDER BY {db_sort_column_expression} {sort_order_param}, s_grouped.ble_mac_address {sort_order_param}
-            LIMIT ? OFFSET ?
-        """
-        
-        app.logger.debug(f"Executing query for unique devices: {query} with params: ({page_size}, {offset})")
-        raw_unique_devices = conn.execute(query, (page_size, offset)).fetchall()
+        raw_unique_devices = storage_backend.list_devices(filters, sort_by_param, sort_order_param, page_size, offset, after)
         
         unique_devices_processed = []
+        next_cursor = None
         for dev_row_raw in raw_unique_devices:
-            dev_dict = dict(dev_row_raw)
-            utc_ts_str = dev_dict.pop('max_timestamp_utc') 
-            dev_dict['last_seen_timestamp'] = convert_utc_to_local_string(utc_ts_str, TARGET_TIMEZONE_PYTZ)
-
-            manufacturer_name_str = "N/A"
-            if dev_dict.get('last_manufacturer_data'):
-                name, _, _ = ble_utils.parse_manufacturer_data(dev_dict['last_manufacturer_data'])
-                manufacturer_name_str = name if name != "Unknown CID" else f"Unknown ({dev_dict['last_manufacturer_data'][:4]})"
-            dev_dict['manufacturer_name'] = manufacturer_name_str
-            dev_dict['best_ble_device_name'] = dev_dict.pop('best_ble_device_name_alias', 'N/A')
+            dev_dict, sort_value = format_device_row(dev_row_raw)
             unique_devices_processed.append(dev_dict)
+            if use_cursor:
+                next_cursor = encode_page_cursor([sort_by_param, sort_order_param, sort_value, dev_dict['ble_mac_address']])
+        if len(raw_unique_devices) < page_size:
+            next_cursor = None
+
+        app.logger.info(f"Devolviendo {len(unique_devices_processed)} dispositivos únicos para la página {page} de {total_pages} (tamaño {page_size}). Total: {total_devices}.")
+        response = {
+            "devices": unique_devices_processed,
+            "total_devices": total_devices, "total_devices_approximate": total_devices_approximate,
+            "total_clusters": total_clusters, "current_page": page, "page_size": page_size,
+            "total_pages": total_pages, "sort_by": sort_by_param, "sort_order": sort_order_param
+        }
+        if use_cursor:
+            response["next_cursor"] = next_cursor
+        return jsonify(response)
+
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos en /api/unique-devices: {e}", exc_info=True)
+        return jsonify({"error": "Database error occurred"}), 500
+    except Exception as e:
+        app.logger.error(f"Error inesperado en /api/unique-devices: {e}", exc_info=True)
+        return jsonify({"error": "Unexpected server error"}), 500
+
+
+# --- RESUMEN DEL DASHBOARD EN UNA SOLA PETICIÓN ---
+OVERVIEW_DEFAULT_PEAK_DAYS = 7
+
+def run_overview_section(fn, budget, use_snapshot):
+    """Ejecuta una sección del resumen con su presupuesto y devuelve (resultado, segundos empleados)."""
+    started = time.perf_counter()
+    token = snapshot_reads.set(use_snapshot)
+    try:
+        with query_budget.activate(budget):
+            return fn(), time.perf_counter() - started
+    finally:
+        snapshot_reads.reset(token)
+
+@app.route('/api/overview')
+@reads_from_snapshot
+def dashboard_overview():
+    """
+    Datos del dashboard en una sola petición. Las secciones son consultas de lectura independientes y se
+    calculan en paralelo, cada una con conexiones del pool de solo lectura. Parámetros opcionales:
+    startDate/endDate (horas pico, por defecto los últimos 7 días, y fabricantes, por defecto todo el histórico),
+    topN, page_size, exact y budget_ms. Cada sección lleva status ('ok', 'timeout' o 'error') y elapsed_ms;
+    una sección que supera el presupuesto se interrumpe, se devuelve sin datos y no retrasa al resto (partial=true).
+    """
+    app.logger.info("Solicitud GET para /api/overview")
+    start_date_str = request.args.get('startDate')
+    end_date_str = request.args.get('endDate')
+    start_date_obj = end_date_obj = None
+    if start_date_str:
+        start_date_obj = validate_date_format(start_date_str)
+        if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
+    if end_date_str:
+        end_date_obj = validate_date_format(end_date_str)
+        if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
+    if start_date_obj and end_date_obj and start_date_obj > end_date_obj:
+        return jsonify({"error": "startDate cannot be after endDate."}), 400
+
+    top_n = request.args.get('topN', 7, type=int)
+    if top_n is None or top_n <= 0: top_n = 7
+    page_size = request.args.get('page_size', 20, type=int)
+    if page_size is None or not 1 <= page_size <= 100: page_size = 20
+    budget_ms = request.args.get('budget_ms', OVERVIEW_SECTION_BUDGET_MS, type=int)
+    if budget_ms is None or budget_ms <= 0: budget_ms = OVERVIEW_SECTION_BUDGET_MS
+    budget_ms = min(budget_ms, OVERVIEW_MAX_BUDGET_MS)
+    exact = is_exact_requested()
+
+    today = datetime.now(TARGET_TIMEZONE_PYTZ).date()
+    peak_end = end_date_obj or today
+    peak_start = start_date_obj or peak_end - timedelta(days=OVERVIEW_DEFAULT_PEAK_DAYS - 1)
+    peak_start_utc, peak_end_utc = local_date_range_to_utc(peak_start, peak_end)
+    range_start_utc, range_end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+
+    def unique_devices():
+        total_devices, approximate = storage_backend.count_devices({}, exact)
+        total_clusters, _ = storage_backend.count_clusters()
+        return {"total_devices": total_devices, "total_devices_approximate": approximate, "total_clusters": total_clusters}
+
+    def recent_devices():
+        rows = storage_backend.list_devices({}, 'last_seen_timestamp', 'desc', page_size)
+        return {"devices": [format_device_row(row)[0] for row in rows], "page_size": page_size,
+                "sort_by": 'last_seen_timestamp', "sort_order": 'desc'}
+
+    sections = {
+        "esp_device_counts": lambda: build_esp_device_counts(exact),
+        "rssi_ranges": build_rssi_ranges,
+        "unique_devices": unique_devices,
+        "recent_devices": recent_devices,
+        "peak_hours": lambda: dict(build_peak_hours(peak_start_utc, peak_end_utc, exact),
+                                   startDate=peak_start.isoformat(), endDate=peak_end.isoformat()),
+        "manufacturers": lambda: build_manufacturer_ranking(range_start_utc, range_end_utc, top_n),
+        "known_esps": lambda: {"esps": storage_backend.known_esps()},
+    }
+
+    started = time.perf_counter()
+    budgets = {name: query_budget.QueryBudget(time_ms=budget_ms) for name in sections}
+    use_snapshot = snapshot_reads.get()
+    futures = {name: overview_executor.submit(run_overview_section, fn, budgets[name], use_snapshot)
+               for name, fn in sections.items()}
+    wait(futures.values(), timeout=budget_ms / 1000.0)
+
+    payload = {}
+    for name, future in futures.items():
+        if not future.done():
+            # Si aún no había empezado no llega a ejecutarse; si está en SQLite, la consulta se interrumpe
+            future.cancel()
+            budgets[name].cancel()
+            app.logger.warning(f"/api/overview: la sección '{name}' superó el presupuesto de {budget_ms} ms.")
+            payload[name] = {"status": "timeout", "elapsed_ms": budget_ms, "data": None}
+            continue
+        try:
+            data, elapsed = future.result()
+            payload[name] = {"status": "ok", "elapsed_ms": round(elapsed * 1000, 1), "data": data}
+        except query_budget.QueryBudgetExceeded:
+            payload[name] = {"status": "timeout", "elapsed_ms": budgets[name].elapsed_ms(), "data": None}
+        except sqlite3.Error as e:
+            app.logger.error(f"Error de BD en la sección '{name}' de /api/overview: {e}")
+            payload[name] = {"status": "error", "elapsed_ms": None, "data": None, "error": "Database error occurred"}
+        except Exception as e:
+            app.logger.error(f"Error inesperado en la sección '{name}' de /api/overview: {e}", exc_info=True)
+            payload[name] = {"status": "error", "elapsed_ms": None, "data": None, "error": "Unexpected server error"}
+
+    return jsonify({
+        "sections": payload,
+        "partial": any(section["status"] != "ok" for section in payload.values()),
+        "budget_ms": budget_ms,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+
+
+# --- ENDPOINT API PARA DISPOSITIVOS EN RANGO (estado en memoria) ---
+@app.route('/api/live-devices')
+def get_live_devices():
+    app.logger.info("Solicitud GET recibida en /api/live-devices")
+    filter_esp_id = request.args.get('esp_id') or None
+    company_id_str = request.args.get('company_id')
+    min_rssi = request.args.get('min_rssi', type=int)
+    window_sec = request.args.get('window_sec', type=int)
+    limit = request.args.get('limit', 500, type=int)
+
+    company_id = None
+    if company_id_str:
+        try:
+            company_id = int(company_id_str, 0) # Acepta decimal o '0x004C'
+        except ValueError:
+            return jsonify({"error": "Invalid company_id. Use decimal or 0xHHHH."}), 400
+    if window_sec is not None and window_sec <= 0:
+        return jsonify({"error": "window_sec must be a positive integer"}), 400
+    if limit <= 0: limit = 500
+
+    devices = live_device_store.query(
+        esp_id=filter_esp_id, company_id=company_id, min_rssi=min_rssi,
+        window_sec=window_sec, limit=limit
+    )
+    for dev in devices:
+        dev['last_seen_timestamp'] = datetime.fromtimestamp(dev['last_seen_epoch'], TARGET_TIMEZONE_PYTZ).strftime('%Y-%m-%d %H:%M:%S')
+        cid = dev['company_id']
+        dev['manufacturer_name'] = ble_utils.COMPANY_IDENTIFIERS.get(cid, f"Unknown (0x{cid:04X})") if cid is not None else "N/A"
+
+    return jsonify({
+        "devices": devices,
+        "count": len(devices),
+        "ttl_sec": live_device_store.ttl_sec,
+        "window_sec": window_sec if window_sec is not None else live_device_store.ttl_sec
+    })
+
+
+# --- ENDPOINT API PARA DISPOSITIVOS QUE SE VEN JUNTOS (índice de co-ocurrencia en memoria) ---
+@app.route('/api/companions/<mac_address>')
+def get_device_companions(mac_address):
+    """
+    MACs que suelen verse junto a mac_address (mismo ESP, misma ventana de COOCCURRENCE_WINDOW_SEC):
+    móvil + reloj + auriculares, etiquetas de un mismo activo... score es el índice de Jaccard entre las
+    ventanas de ambas MACs. Parámetros: limit y min_shared (ventanas compartidas mínimas).
+    """
+    app.logger.info(f"Solicitud GET recibida en /api/companions/{mac_address}")
+    limit = request.args.get('limit', 10, type=int)
+    min_shared = request.args.get('min_shared', 2, type=int)
+    limit = max(1, min(limit, COOCCURRENCE_NEIGHBORS_PER_MAC))
+    # Cierra las ventanas ya terminadas de ESPs que no han vuelto a enviar
+    cooccurrence_index.flush()
+    windows, companions = cooccurrence_index.companions(mac_address, limit=limit, min_shared=max(1, min_shared))
+    for companion in companions:
+        companion['last_seen_together'] = datetime.fromtimestamp(
+            companion.pop('last_seen_together_epoch'), TARGET_TIMEZONE_PYTZ).strftime('%Y-%m-%d %H:%M:%S')
+    return jsonify({
+        "mac": mac_address,
+        "windows": windows,
+        "window_sec": cooccurrence_index.window_sec,
+        "companions": companions,
+    })
+
+@app.route('/api/cooccurrence-status')
+def get_cooccurrence_status():
+    """Tamaño del índice de co-ocurrencia: MACs, entradas de vecinos, ventanas cerradas y recortadas."""
+    return jsonify(cooccurrence_index.stats())
+
+
+# --- ENDPOINTS API PARA RSSI SUAVIZADO Y DISTANCIA ESTIMADA (estado por (MAC, ESP) en memoria) ---
+def format_proximity_entry(entry):
+    entry['last_seen'] = datetime.fromtimestamp(entry.pop('last_seen_epoch'), TARGET_TIMEZONE_PYTZ).strftime('%Y-%m-%d %H:%M:%S')
+    return entry
+
+@app.route('/api/proximity/<mac_address>')
+def get_device_proximity(mac_address):
+    """
+    RSSI suavizado y distancia estimada de mac_address en cada ESP que la ha visto en los últimos
+    PROXIMITY_TTL_SEC, del más cercano al más lejano. distance_range_m es la distancia con el RSSI
+    suavizado ± rssi_std; calibration indica de dónde sale el RSSI a 1 m (tx_power, company o default).
+    """
+    app.logger.info(f"Solicitud GET recibida en /api/proximity/{mac_address}")
+    esps = [format_proximity_entry(entry) for entry in proximity_tracker.device(mac_address)]
+    return jsonify({
+        "mac": mac_address,
+        "nearest_esp": esps[0]["esp_id"] if esps else None,
+        "esps": esps,
+        "ttl_sec": proximity_tracker.ttl_sec,
+    })
+
+@app.route('/api/esp-proximity/<esp_id>')
+def get_esp_proximity(esp_id):
+    """MACs vistas por esp_id ordenadas por distancia estimada. Parámetros: max_distance_m y limit."""
+    app.logger.info(f"Solicitud GET recibida en /api/esp-proximity/{esp_id}")
+    max_distance_m = request.args.get('max_distance_m', type=float)
+    limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+    tracked, devices = proximity_tracker.near_esp(esp_id, max_distance_m=max_distance_m, limit=limit)
+    return jsonify({
+        "esp_id": esp_id,
+        "tracked": tracked,
+        "devices": [format_proximity_entry(entry) for entry in devices],
+        "ttl_sec": proximity_tracker.ttl_sec,
+    })
+
+@app.route('/api/proximity-status')
+def get_proximity_status():
+    """Tamaño del estado de suavizado: pares (MAC, ESP), actualizaciones, lecturas recortadas y descartes."""
+    return jsonify(proximity_tracker.stats())
+
+
+# --- ENDPOINT API PARA EL ESTADO DE CARGA DE LA INGESTA ---
+@app.route('/api/ingest-status')
+def get_ingest_status():
+    app.logger.info("Solicitud GET recibida en /api/ingest-status")
+    status = ingest_controller.stats()
+    status["batch_sequences"] = batch_sequence_tracker.stats()
+    status["delta_protocol"] = delta_state_cache.stats()
+    return jsonify(status)
+
+
+# --- ADMINISTRACIÓN: PERFILADO DE PETICIONES Y CONSULTAS LENTAS ---
+def admin_required(view):
+    """Exige la cabecera X-Admin-Token igual a ADMIN_TOKEN (sin ADMIN_TOKEN los endpoints están desactivados)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "Admin token required"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.before_request
+def start_request_profile():
+    if request_profiler.should_sample():
+        g.request_profile = request_profiler.start()
+        g.request_profile_started = time.perf_counter()
+
+@app.after_request
+def finish_request_profile(response):
+    # after_request se ejecuta con la respuesta ya serializada: el perfil incluye la vista y el JSON
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        report = request_profiler.finish(profile, request.method, request.full_path.rstrip('?'), response.status_code,
+                                         time.perf_counter() - g.pop('request_profile_started'))
+        response.headers['X-Profile-Id'] = str(report["id"])
+    return response
+
+@app.teardown_request
+def discard_request_profile(exc):
+    # Petición terminada con una excepción sin respuesta: el perfil no se guarda pero sí se desactiva
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        profile.disable()
+
+@app.route('/api/admin/profiling', methods=['GET', 'POST'])
+@admin_required
+def admin_profiling():
+    """GET: configuración e informes guardados. POST: {sample_rate, slow_query_ms} para cambiarla en caliente."""
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        try:
+            if 'sample_rate' in body:
+                sample_rate = float(body['sample_rate'])
+                if not 0.0 <= sample_rate <= 1.0:
+                    raise ValueError
+                request_profiler.sample_rate = sample_rate
+            if 'slow_query_ms' in body:
+                slow_query_ms = float(body['slow_query_ms'])
+                if slow_query_ms < 0:
+                    raise ValueError
+                slow_query_log.threshold_ms = slow_query_ms
+        except (TypeError, ValueError):
+            return jsonify({"error": "sample_rate must be between 0 and 1 and slow_query_ms must be >= 0"}), 400
+        app.logger.info(f"Perfilado: sample_rate={request_profiler.sample_rate}, umbral de consultas lentas={slow_query_log.threshold_ms} ms.")
+    return jsonify({
+        "sample_rate": request_profiler.sample_rate,
+        "slow_query_ms": slow_query_log.threshold_ms,
+        "profiles": request_profiler.reports(),
+    })
+
+@app.route('/api/admin/profiles/<int:profile_id>')
+@admin_required
+def admin_profile_report(profile_id):
+    """Informe de una petición perfilada: texto (por defecto) o fichero .prof con format=pstats."""
+    report = request_profiler.report(profile_id)
+    if report is None:
+        return jsonify({"error": "Profile not found"}), 404
+    if request.args.get('format') == 'pstats':
+        return app.response_class(
+            profiling.RequestProfiler.pstats_bytes(report), mimetype='application/octet-stream',
+            headers={"Content-Disposition": f"attachment; filename=profile_{profile_id}.prof"}
+        )
+    header = f"{report['method']} {report['path']} -> {report['status']} en {report['duration_ms']} ms\n\n"
+    return app.response_class(header + report["text"], mimetype='text/plain')
+
+@app.route('/api/admin/slow-queries')
+@admin_required
+def admin_slow_queries():
+    """Sentencias que superaron el umbral (más recientes primero) con parámetros y plan de ejecución."""
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify({"threshold_ms": slow_query_log.threshold_ms, "queries": slow_query_log.entries(max(1, limit or 50))})
+
+@app.route('/api/admin/maintenance', methods=['GET', 'POST'])
+@admin_required
+def admin_maintenance():
+    """GET: estado de las tareas e historial (filtros job y limit). POST: {job, budget_ms} ejecuta una tarea ahora en todos los shards."""
+    if not isinstance(storage_backend, SQLiteStorage):
+        return jsonify({"error": "Database maintenance is only available with the sqlite storage backend"}), 400
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        job = body.get('job')
+        if job not in maintenance_scheduler.job_names():
+            return jsonify({"error": f"job must be one of: {', '.join(maintenance_scheduler.job_names())}"}), 400
+        budget_ms = body.get('budget_ms')
+        if budget_ms is not None and (isinstance(budget_ms, bool) or not isinstance(budget_ms, (int, float)) or budget_ms <= 0):
+            return jsonify({"error": "budget_ms must be a positive number"}), 400
+        app.logger.info(f"Mantenimiento: ejecución manual de '{job}' (presupuesto {budget_ms or 'por defecto'} ms).")
+        return jsonify({"job": job, "runs": maintenance_scheduler.run_job(job, budget_ms)})
+    limit = request.args.get('limit', 50, type=int)
+    status = maintenance_scheduler.stats()
+    status["enabled"] = MAINTENANCE_ENABLED
+    status["quiet_sec"] = MAINTENANCE_QUIET_SEC
+    status["history"] = maintenance_scheduler.history(request.args.get('job'), max(1, limit or 50))
+    return jsonify(status)
+
+@app.route('/api/admin/top-queries')
+@admin_required
+def admin_top_queries():
+    """Las n sentencias con más tiempo total acumulado en la ventana móvil (SLOW_QUERY_WINDOW_SEC)."""
+    n = request.args.get('n', 10, type=int)
+    return jsonify({"window_sec": slow_query_log.window_sec, "queries": slow_query_log.top(max(1, min(n or 10, 100)))})
+
+# --- RÉPLICA DE LECTURA: ESTADO DE LAS RÉPLICAS ---
+@app.route('/api/snapshot-status')
+def get_snapshot_status():
+    """Estado de las réplicas de lectura: antigüedad, duración del último refresco, filas copiadas y errores."""
+    return jsonify(dict(snapshot_replicator.stats(), enabled=SNAPSHOT_ENABLED))
+
+# --- ENDPOINTS API PARA ALERTAS Y ESTADO DE LOS ESPs ---
+@app.route('/api/alerts')
+def get_alerts():
+    app.logger.info("Solicitud GET recibida en /api/alerts")
+    try:
+        since_id = int(request.args.get('since_id', 0))
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "Invalid since_id or limit parameter"}), 400
+    if limit <= 0:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    limit = min(limit, ALERT_QUEUE_SIZE)
+    return jsonify({"alerts": alert_engine.sink.recent(since_id, limit), "sink": alert_engine.sink.stats()})
+
+
+@app.route('/api/alert-rules', methods=['GET', 'POST'])
+def alert_rules():
+    if request.method == 'GET':
+        app.logger.info("Solicitud GET recibida en /api/alert-rules")
+        return jsonify(alert_engine.rules())
+    app.logger.info("Solicitud POST recibida en /api/alert-rules")
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON object body required"}), 400
+    try:
+        rule = alert_engine.add_rule(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    app.logger.info(f"Regla de alerta añadida: {rule}")
+    return jsonify(rule), 201
 
-        conn.close()
 
-        app.logger.info(f"Devolviendo {len(unique_devices_processed)} dispositivos únicos para la página {page} de {total_pages} (tamaño {page_size}). Total: {total_devices}.")
+@app.route('/api/alert-rules/<int:rule_id>', methods=['DELETE'])
+def delete_alert_rule(rule_id):
+    app.logger.info(f"Solicitud DELETE recibida en /api/alert-rules/{rule_id}")
+    if not alert_engine.remove_rule(rule_id):
+        return jsonify({"error": "Rule not found"}), 404
+    return jsonify({"status": "deleted", "id": rule_id})
+
+
+@app.route('/api/esp-status')
+def get_esp_status():
+    app.logger.info("Solicitud GET recibida en /api/esp-status")
+    try:
+        heartbeats = storage_backend.esp_heartbeats()
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en /api/esp-status: {e}")
+        return jsonify({"error": "Database error"}), 500
+    contacts = alert_engine.esp_contacts()
+    for heartbeat in heartbeats:
+        since_contact, silent = contacts.get(heartbeat['esp_device_id'], (None, False))
+        heartbeat['seconds_since_contact'] = round(since_contact, 1) if since_contact is not None else None
+        heartbeat['silent'] = silent
+        heartbeat['last_contact_local'] = convert_utc_to_local_string(heartbeat['last_contact_utc'], TARGET_TIMEZONE_PYTZ) if heartbeat['last_contact_utc'] else None
+    return jsonify(heartbeats)
+
+
+# --- ENDPOINTS API PARA CLUSTERS DE MACs ALEATORIAS ---
+@app.route('/api/device-clusters')
+@reads_from_snapshot
+def get_device_clusters():
+    app.logger.info("Solicitud GET recibida en /api/device-clusters")
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', 20, type=int)
+    address_type = request.args.get('address_type')
+
+    if page < 1: page = 1
+    if page_size not in [20, 30, 40, 50, 60, 70, 80, 90, 100]: page_size = 20
+    valid_address_types = [fingerprint.ADDRESS_TYPE_PUBLIC, fingerprint.ADDRESS_TYPE_RANDOM_STATIC,
+                           fingerprint.ADDRESS_TYPE_RANDOM_RESOLVABLE, fingerprint.ADDRESS_TYPE_RANDOM_NON_RESOLVABLE]
+    if address_type and address_type not in valid_address_types:
+        return jsonify({"error": f"Invalid address_type. Use one of: {', '.join(valid_address_types)}"}), 400
+
+    try:
+        total_clusters, total_macs = storage_backend.count_clusters(address_type or None)
+        total_pages = max(1, math.ceil(total_clusters / page_size))
+        if page > total_pages: page = total_pages
+        offset = (page - 1) * page_size
+        rows = storage_backend.list_clusters(address_type or None, page_size, offset)
+
+        clusters = []
+        for cluster in rows:
+            cluster['first_seen'] = convert_utc_to_local_string(cluster['first_seen'], TARGET_TIMEZONE_PYTZ)
+            cluster['last_seen'] = convert_utc_to_local_string(cluster['last_seen'], TARGET_TIMEZONE_PYTZ)
+            cid = cluster['company_id']
+            cluster['manufacturer_name'] = ble_utils.COMPANY_IDENTIFIERS.get(cid, f"Unknown (0x{cid:04X})") if cid is not None else "N/A"
+            clusters.append(cluster)
+
         return jsonify({
-            "devices": unique_devices_processed,
-            "total_devices": total_devices, "current_page": page, "page_size": page_size,
-            "total_pages": total_pages, "sort_by": sort_by_param, "sort_order": sort_order_param
+            "clusters": clusters, "total_clusters": total_clusters, "total_macs": total_macs,
+            "current_page": page, "page_size": page_size, "total_pages": total_pages
         })
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en /api/device-clusters: {e}", exc_info=True)
+        return jsonify({"error": "Database error occurred"}), 500
 
+@app.route('/api/device-clusters/<int:cluster_id>')
+@reads_from_snapshot
+def get_device_cluster_macs(cluster_id):
+    app.logger.info(f"Solicitud GET recibida en /api/device-clusters/{cluster_id}")
+    limit = request.args.get('limit', 100, type=int)
+    if limit <= 0 or limit > 1000: limit = 100
+    try:
+        result = storage_backend.get_cluster(cluster_id, limit)
+        if result is None:
+            return jsonify({"error": "Cluster not found"}), 404
+        result['first_seen'] = convert_utc_to_local_string(result['first_seen'], TARGET_TIMEZONE_PYTZ)
+        result['last_seen'] = convert_utc_to_local_string(result['last_seen'], TARGET_TIMEZONE_PYTZ)
+        return jsonify(result)
     except sqlite3.Error as e:
-        app.logger.error(f"Error de base de datos en /api/unique-devices: {e}", exc_info=True)
+        app.logger.error(f"Error de BD en /api/device-clusters/{cluster_id}: {e}", exc_info=True)
         return jsonify({"error": "Database error occurred"}), 500
-    except Exception as e:
-        app.logger.error(f"Error inesperado en /api/unique-devices: {e}", exc_info=True)
-        return jsonify({"error": "Unexpected server error"}), 500
+
+
+# --- Decodificación de filas del historial ---
+# Las filas de un mismo dispositivo repiten los mismos valores crudos, así que el resultado se cachea
+# por valor. Los objetos devueltos se comparten entre filas: no deben modificarse.
+@functools.lru_cache(maxsize=4096)
+def resolve_manufacturer_data(manufacturer_data):
+    return ble_utils.parse_manufacturer_data(manufacturer_data)
+
+@functools.lru_cache(maxsize=4096)
+def resolve_service_uuids(service_uuids_json):
+    try:
+        service_uuids_list = json.loads(service_uuids_json)
+    except json.JSONDecodeError:
+        app.logger.warning(f"Error decodificando service_uuids JSON de la BD: {service_uuids_json}")
+        return [{"uuid": service_uuids_json, "name": "Error parsing UUID JSON list"}]
+    if not isinstance(service_uuids_list, list):
+        return [{"uuid": str(service_uuids_list), "name": "Invalid format in DB (not a list)"}]
+    return [{"uuid": uuid_str, "name": ble_utils.SERVICE_UUIDS_NAMES.get(uuid_str.lower(), "Unknown Service")}
+            for uuid_str in service_uuids_list]
+
+@functools.lru_cache(maxsize=4096)
+def resolve_service_data(service_data_json):
+    try:
+        service_data_obj = json.loads(service_data_json)
+    except json.JSONDecodeError:
+        app.logger.warning(f"Error decodificando service_data JSON de la BD: {service_data_json}")
+        return {"error": f"Could not parse Service Data JSON: {service_data_json}"}
+    if not isinstance(service_data_obj, dict):
+        return {"error": "Service Data in DB not a valid JSON object"}
+    resolved = {}
+    for uuid_key, data_value in service_data_obj.items():
+        service_name = ble_utils.SERVICE_UUIDS_NAMES.get(uuid_key.lower(), uuid_key)
+        resolved[f"{service_name} ({uuid_key})"] = data_value
+    return resolved
+
+def decode_history_row(row_raw):
+    log_dict = dict(row_raw)
+    utc_ts_str = log_dict.pop('timestamp_utc')
+    log_dict['formatted_timestamp'] = convert_utc_to_local_string(utc_ts_str, TARGET_TIMEZONE_PYTZ)
+
+    company_name, specific_data, company_id_hex = "N/A", "N/A", "N/A"
+    if log_dict.get('manufacturer_data'):
+        company_name, specific_data, company_id_hex = resolve_manufacturer_data(log_dict['manufacturer_data'])
+    log_dict['manufacturer_company'] = company_name
+    log_dict['manufacturer_specific_data'] = specific_data
+    log_dict['manufacturer_company_id'] = company_id_hex
+
+    log_dict['service_uuids_resolved'] = resolve_service_uuids(log_dict['service_uuids']) if log_dict.get('service_uuids') else []
+    log_dict['service_data_resolved'] = resolve_service_data(log_dict['service_data']) if log_dict.get('service_data') else {}
+    return log_dict
 
 
 # --- Endpoint API para obtener el historial de un dispositivo específico ---
 @app.route('/api/device-history/<mac_address>')
 def device_history(mac_address):
-    # ... (sin cambios en esta función) ...
     app.logger.info(f"Solicitud GET para historial del dispositivo MAC: {mac_address}")
-    conn = None
     try:
-        conn = get_db_connection()
-        history_query = """
-            SELECT 
-                id, 
-                timestamp as timestamp_utc, 
-                esp_device_id, ble_device_name, ble_rssi,
-                manufacturer_data, service_data, service_uuids,
-                tx_power, appearance
-            FROM scanned_devices
-            WHERE ble_mac_address = ?
-            ORDER BY timestamp DESC LIMIT 20; 
-        """
-        device_logs_raw = conn.execute(history_query, (mac_address,)).fetchall()
-        
-        logs_list_processed = []
-        for row_raw in device_logs_raw:
-            log_dict = dict(row_raw)
-            utc_ts_str = log_dict.pop('timestamp_utc')
-            log_dict['formatted_timestamp'] = convert_utc_to_local_string(utc_ts_str, TARGET_TIMEZONE_PYTZ)
-            
-            company_name, specific_data, company_id_hex = "N/A", "N/A", "N/A"
-            if log_dict.get('manufacturer_data'):
-                company_name, specific_data, company_id_hex = ble_utils.parse_manufacturer_data(log_dict['manufacturer_data'])
-            log_dict['manufacturer_company'] = company_name
-            log_dict['manufacturer_specific_data'] = specific_data
-            log_dict['manufacturer_company_id'] = company_id_hex
-
-            log_dict['service_uuids_resolved'] = []
-            if log_dict.get('service_uuids'):
-                try:
-                    service_uuids_list = json.loads(log_dict['service_uuids'])
-                    if isinstance(service_uuids_list, list):
-                        for uuid_str in service_uuids_list:
-                            name = ble_utils.SERVICE_UUIDS_NAMES.get(uuid_str.lower(), "Unknown Service")
-                            log_dict['service_uuids_resolved'].append({"uuid": uuid_str, "name": name})
-                    else: 
-                        log_dict['service_uuids_resolved'].append({"uuid": str(service_uuids_list), "name": "Invalid format in DB (not a list)"})
-                except json.JSONDecodeError:
-                    app.logger.warning(f"Error decodificando service_uuids JSON de la BD para MAC {mac_address}, ID {log_dict['id']}: {log_dict['service_uuids']}")
-                    log_dict['service_uuids_resolved'] = [{"uuid": log_dict['service_uuids'], "name": "Error parsing UUID JSON list"}]
-            
-            log_dict['service_data_resolved'] = {}
-            if log_dict.get('service_data'):
-                try:
-                    service_data_obj = json.loads(log_dict['service_data'])
-                    if isinstance(service_data_obj, dict):
-                        for uuid_key, data_value in service_data_obj.items():
-                            service_name = ble_utils.SERVICE_UUIDS_NAMES.get(uuid_key.lower(), uuid_key) 
-                            resolved_key = f"{service_name} ({uuid_key})" 
-                            log_dict['service_data_resolved'][resolved_key] = data_value
-                    else: 
-                         log_dict['service_data_resolved'] = {"error": "Service Data in DB not a valid JSON object"}
-                except json.JSONDecodeError:
-                    app.logger.warning(f"Error decodificando service_data JSON de la BD para MAC {mac_address}, ID {log_dict['id']}: {log_dict['service_data']}")
-                    log_dict['service_data_resolved'] = {"error": f"Could not parse Service Data JSON: {log_dict['service_data']}"}
-            
-            logs_list_processed.append(log_dict)
-            
-        return jsonify(logs_list_processed)
+        return jsonify([decode_history_row(row_raw) for row_raw in storage_backend.device_history(mac_address, 20)])
     except sqlite3.Error as e:
         app.logger.error(f"Error de base de datos obteniendo historial para {mac_address}: {e}")
         return jsonify({"error": "Database error while fetching history"}), 500
     except Exception as e:
         app.logger.error(f"Error inesperado obteniendo historial para {mac_address}: {e}", exc_info=True)
         return jsonify({"error": "Unexpected server error while fetching history"}), 500
-    finally:
-        if conn: conn.close()
+
+
+# --- Endpoint API para el historial (y análisis opcionales) de varias MACs en una sola petición ---
+@app.route('/api/device-histories', methods=['POST'])
+def device_histories():
+    """
+    Cuerpo JSON: macs (lista) y/o cursors ({mac: next_cursor de la página anterior}), limit (filas por
+    MAC), include (subconjunto de 'esps', 'activity', 'rssi_trend') y, para estos, granularity,
+    startDate, endDate, esp_id y format con el mismo significado que en sus endpoints individuales.
+    """
+    app.logger.info("Solicitud POST recibida en /api/device-histories")
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON object body required"}), 400
+
+    cursors = data.get('cursors') or {}
+    macs = data.get('macs') or []
+    if not isinstance(cursors, dict) or not isinstance(macs, list):
+        return jsonify({"error": "'macs' must be a list and 'cursors' an object"}), 400
+    befores = {}
+    for mac_address in macs + list(cursors):
+        if not isinstance(mac_address, str) or len(mac_address) != 17:
+            return jsonify({"error": f"Invalid MAC address format: {mac_address}"}), 400
+        befores[mac_address] = None
+    for mac_address, cursor_str in cursors.items():
+        if cursor_str is None:
+            continue
+        cursor_values = decode_page_cursor(cursor_str) if isinstance(cursor_str, str) else None
+        # (timestamp_utc, esp_device_id, id) de storage.history_order_key
+        if not cursor_values or not cursor_values_match(cursor_values, (str, str, int)):
+            return jsonify({"error": f"Invalid cursor for {mac_address}"}), 400
+        befores[mac_address] = tuple(cursor_values)
+    if not befores:
+        return jsonify({"error": "At least one MAC address is required"}), 400
+    if len(befores) > HISTORY_BATCH_MAX_MACS:
+        return jsonify({"error": f"At most {HISTORY_BATCH_MAX_MACS} MAC addresses per request"}), 400
+
+    try:
+        limit = int(data.get('limit', 20))
+    except (ValueError, TypeError):
+        return jsonify({"error": "Invalid 'limit' parameter"}), 400
+    limit = max(1, min(limit, HISTORY_PAGE_MAX_LIMIT))
+
+    include = data.get('include') or []
+    if not isinstance(include, list) or not all(isinstance(item, str) for item in include):
+        return jsonify({"error": "'include' accepts only 'esps', 'activity' and 'rssi_trend'"}), 400
+    include = set(include)
+    if not include <= {'esps', 'activity', 'rssi_trend'}:
+        return jsonify({"error": "'include' accepts only 'esps', 'activity' and 'rssi_trend'"}), 400
+    granularity = data.get('granularity', 'hourly')
+    if 'activity' in include and granularity not in ACTIVITY_TIME_FORMATS:
+        return jsonify({"error": "Invalid granularity parameter"}), 400
+    start_date_obj = validate_date_format(data['startDate']) if data.get('startDate') else None
+    end_date_obj = validate_date_format(data['endDate']) if data.get('endDate') else None
+    if (data.get('startDate') and not start_date_obj) or (data.get('endDate') and not end_date_obj):
+        return jsonify({"error": "Invalid date format. Use YYYY-MM-DD."}), 400
+    if start_date_obj and end_date_obj and start_date_obj > end_date_obj:
+        return jsonify({"error": "startDate cannot be after endDate."}), 400
+    if 'activity' in include and granularity == 'daily_date' and (not start_date_obj or not end_date_obj):
+        return jsonify({"error": "startDate and endDate are required for daily_date granularity."}), 400
+    columnar = str(data.get('format') or '').strip().lower() == 'columnar'
+
+    try:
+        # Se pide una fila de más por MAC para saber si queda otra página
+        history_by_mac = storage_backend.device_history_batch(befores, limit + 1)
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        devices = {}
+        for mac_address, rows in history_by_mac.items():
+            page = rows[:limit]
+            device = {
+                "history": [decode_history_row(row_raw) for row_raw in page],
+                "next_cursor": encode_page_cursor(list(storage.history_order_key(page[-1]))) if len(rows) > limit else None
+            }
+            if 'esps' in include:
+                device['esps'] = storage_backend.esps_for_mac(mac_address)
+            if 'activity' in include:
+                build_activity = build_activity_columnar if columnar else build_activity_series
+                device['activity'] = build_activity(mac_address, granularity, start_date_obj, end_date_obj)
+            if 'rssi_trend' in include:
+                build_trend = build_rssi_trend_columnar if columnar else build_rssi_trend
+                device['rssi_trend'] = build_trend(mac_address, start_utc, end_utc, data.get('esp_id') or None)
+            devices[mac_address] = device
+        return jsonify({"devices": devices, "limit": limit})
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de base de datos en /api/device-histories: {e}")
+        return jsonify({"error": "Database error while fetching history"}), 500
+    except Exception as e:
+        app.logger.error(f"Error inesperado en /api/device-histories: {e}", exc_info=True)
+        return jsonify({"error": "Unexpected server error while fetching history"}), 500
 
 
 # --- ENDPOINTS PARA ANÁLISIS AVANZADO ---
+# Formato strftime (sobre la hora local) que define cada grupo de /api/device-activity
+ACTIVITY_TIME_FORMATS = {
+    'hourly': '%H', 'daily_week': '%w', 'weekly': '%Y-W%W', 'monthly': '%Y-%m', 'daily_date': '%Y-%m-%d'
+}
+
+def build_activity_series(mac_address, granularity, start_date_obj, end_date_obj):
+    """{labels, data} de actividad de una MAC. Los parámetros llegan ya validados."""
+    start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+    counts_by_group = storage_backend.activity_counts(mac_address, ACTIVITY_TIME_FORMATS[granularity], start_utc, end_utc)
+    results_raw = [{'time_group': group, 'count': counts_by_group[group]} for group in sorted(counts_by_group)]
+    
+    labels = []
+    data_counts = []
+
+    if granularity == 'daily_week':
+        sqlite_day_to_name_map = {'0': 'Domingo', '1': 'Lunes', '2': 'Martes', '3': 'Miércoles', '4': 'Jueves', '5': 'Viernes', '6': 'Sábado'}
+        ordered_day_names = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+        activity_by_day = {name: 0 for name in ordered_day_names}
+        for row in results_raw:
+            sqlite_day_index = row['time_group'] 
+            day_name_from_db = sqlite_day_to_name_map.get(sqlite_day_index)
+            if day_name_from_db in activity_by_day:
+                activity_by_day[day_name_from_db] = row['count']
+        labels = ordered_day_names
+        data_counts = [activity_by_day[name] for name in ordered_day_names]
+    elif granularity == 'hourly':
+        hourly_counts = {f"{h:02d}":0 for h in range(24)}
+        for row in results_raw:
+            hourly_counts[row['time_group']] = row['count']
+        for hour_str in sorted(hourly_counts.keys()):
+            labels.append(f"{hour_str}:00")
+            data_counts.append(hourly_counts[hour_str])
+    elif granularity == 'daily_date':
+        activity_by_date = {row['time_group']: row['count'] for row in results_raw}
+        current_date = start_date_obj
+        while current_date <= end_date_obj:
+            date_str = current_date.strftime('%Y-%m-%d')
+            labels.append(date_str)
+            data_counts.append(activity_by_date.get(date_str, 0))
+            current_date += timedelta(days=1)
+    else: # weekly, monthly
+        for row in results_raw:
+            labels.append(row['time_group'])
+            data_counts.append(row['count'])
+    
+    if not results_raw and granularity not in ['hourly', 'daily_week', 'daily_date']:
+        app.logger.info(f"No se encontraron datos de actividad para MAC {mac_address} con los filtros aplicados ({granularity}).")
+    
+    return {"labels": labels, "data": data_counts}
+
+
+def build_activity_columnar(mac_address, granularity, start_date_obj, end_date_obj):
+    """
+    build_activity_series en formato columnar. hourly y daily_week: 'bucket' con la hora (0-23) o el día
+    ISO (1 = lunes ... 7 = domingo); daily_date, weekly y monthly: 't' con el epoch UTC del inicio local de
+    cada día, semana o mes, y la tabla de offsets de la zona horaria.
+    """
+    start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+    counts_by_group = storage_backend.activity_counts(mac_address, ACTIVITY_TIME_FORMATS[granularity], start_utc, end_utc)
+    result = {"format": "columnar", "granularity": granularity}
+    if granularity == 'hourly':
+        result["bucket"] = list(range(24))
+        result["count"] = [counts_by_group.get(f"{hour:02d}", 0) for hour in range(24)]
+        return result
+    if granularity == 'daily_week':
+        # strftime('%w') de SQLite: 0 = domingo
+        result["bucket"] = list(range(1, 8))
+        result["count"] = [counts_by_group.get(str(day % 7), 0) for day in range(1, 8)]
+        return result
+    if granularity == 'daily_date':
+        days = [start_date_obj + timedelta(days=offset) for offset in range((end_date_obj - start_date_obj).days + 1)]
+        counts = [counts_by_group.get(day.isoformat(), 0) for day in days]
+    else:
+        groups = sorted(counts_by_group)
+        group_format = '%Y-W%W-%w' if granularity == 'weekly' else '%Y-%m-%d'
+        suffix = '-1' if granularity == 'weekly' else '-01'   # Lunes de la semana o día 1 del mes
+        days = [datetime.strptime(group + suffix, group_format).date() for group in groups]
+        counts = [counts_by_group[group] for group in groups]
+    result["t"] = [local_date_start_epoch(day) for day in days]
+    result["count"] = counts
+    now = time.time()
+    result["tz"] = timezone_offset_table(result["t"][0] if days else now, result["t"][-1] if days else now)
+    return result
+
+
 @app.route('/api/device-activity/<mac_address>')
+@reads_from_snapshot
+@budgeted_query('device_activity', "Narrow startDate/endDate or use a coarser granularity (weekly, monthly).")
 def device_activity_analysis(mac_address):
     # ... (sin cambios en esta función) ...
     app.logger.info(f"Solicitud GET para análisis de actividad del dispositivo MAC: {mac_address}")
@@ -495,126 +3284,57 @@ def device_activity_analysis(mac_address):
     start_date_str = request.args.get('startDate')
     end_date_str = request.args.get('endDate')
 
-    valid_granularities = ['hourly', 'daily_week', 'weekly', 'monthly', 'daily_date']
-    if granularity not in valid_granularities:
+    if granularity not in ACTIVITY_TIME_FORMATS:
         return jsonify({"error": "Invalid granularity parameter"}), 400
     if not mac_address or len(mac_address) != 17: 
          return jsonify({"error": "Invalid MAC address format"}), 400
 
-    params = [mac_address]
-    date_filters = []
     start_date_obj = None
     end_date_obj = None
 
     if start_date_str:
         start_date_obj = validate_date_format(start_date_str)
         if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
-        date_filters.append(f"date(datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) >= date(?)")
-        params.append(start_date_obj.strftime('%Y-%m-%d'))
 
     if end_date_str:
         end_date_obj = validate_date_format(end_date_str)
         if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
-        date_filters.append(f"date(datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) <= date(?)")
-        params.append(end_date_obj.strftime('%Y-%m-%d'))
     
     if granularity == 'daily_date' and (not start_date_obj or not end_date_obj):
         return jsonify({"error": "startDate and endDate are required for daily_date granularity."}), 400
     if start_date_obj and end_date_obj and start_date_obj > end_date_obj:
         return jsonify({"error": "startDate cannot be after endDate."}), 400
 
-    date_filter_sql = ""
-    if date_filters: date_filter_sql = "AND " + " AND ".join(date_filters)
-
-    group_by_sql = ""
-    select_label_sql = ""
-    order_by_sql = ""
-
-    if granularity == 'hourly':
-        select_label_sql = f"strftime('%H', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as time_group"
-        group_by_sql = f"strftime('%H', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))"
-        order_by_sql = "time_group ASC"
-    elif granularity == 'daily_week':
-        select_label_sql = f"strftime('%w', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as time_group"
-        group_by_sql = f"strftime('%w', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))"
-        order_by_sql = "time_group ASC" 
-    elif granularity == 'weekly':
-        select_label_sql = f"strftime('%Y-W%W', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as time_group"
-        group_by_sql = f"strftime('%Y-W%W', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))"
-        order_by_sql = "time_group ASC"
-    elif granularity == 'monthly':
-        select_label_sql = f"strftime('%Y-%m', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as time_group"
-        group_by_sql = f"strftime('%Y-%m', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))"
-        order_by_sql = "time_group ASC"
-    elif granularity == 'daily_date':
-        select_label_sql = f"strftime('%Y-%m-%d', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as time_group"
-        group_by_sql = f"strftime('%Y-%m-%d', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))"
-        order_by_sql = "time_group ASC"
-
-    query = f"""
-        SELECT {select_label_sql}, COUNT(*) as count
-        FROM scanned_devices
-        WHERE ble_mac_address = ? {date_filter_sql}
-        GROUP BY {group_by_sql}
-        ORDER BY {order_by_sql};
-    """
-    
-    conn = None
     try:
-        conn = get_db_connection()
-        app.logger.debug(f"Ejecutando query para device-activity ({granularity}): {query} con params: {params}")
-        results_raw = conn.execute(query, tuple(params)).fetchall()
-        
-        labels = []
-        data_counts = []
-
-        if granularity == 'daily_week':
-            sqlite_day_to_name_map = {'0': 'Domingo', '1': 'Lunes', '2': 'Martes', '3': 'Miércoles', '4': 'Jueves', '5': 'Viernes', '6': 'Sábado'}
-            ordered_day_names = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-            activity_by_day = {name: 0 for name in ordered_day_names}
-            for row in results_raw:
-                sqlite_day_index = row['time_group'] 
-                day_name_from_db = sqlite_day_to_name_map.get(sqlite_day_index)
-                if day_name_from_db in activity_by_day:
-                    activity_by_day[day_name_from_db] = row['count']
-            labels = ordered_day_names
-            data_counts = [activity_by_day[name] for name in ordered_day_names]
-        elif granularity == 'hourly':
-            hourly_counts = {f"{h:02d}":0 for h in range(24)}
-            for row in results_raw:
-                hourly_counts[row['time_group']] = row['count']
-            for hour_str in sorted(hourly_counts.keys()):
-                labels.append(f"{hour_str}:00")
-                data_counts.append(hourly_counts[hour_str])
-        elif granularity == 'daily_date':
-            activity_by_date = {row['time_group']: row['count'] for row in results_raw}
-            current_date = start_date_obj
-            while current_date <= end_date_obj:
-                date_str = current_date.strftime('%Y-%m-%d')
-                labels.append(date_str)
-                data_counts.append(activity_by_date.get(date_str, 0))
-                current_date += timedelta(days=1)
-        else: # weekly, monthly
-            for row in results_raw:
-                labels.append(row['time_group'])
-                data_counts.append(row['count'])
-        
-        if not results_raw and granularity not in ['hourly', 'daily_week', 'daily_date']:
-            app.logger.info(f"No se encontraron datos de actividad para MAC {mac_address} con los filtros aplicados ({granularity}).")
-        
-        return jsonify({"labels": labels, "data": data_counts})
-
+        if is_columnar_requested():
+            return jsonify(build_activity_columnar(mac_address, granularity, start_date_obj, end_date_obj))
+        return jsonify(build_activity_series(mac_address, granularity, start_date_obj, end_date_obj))
     except sqlite3.Error as e:
         app.logger.error(f"Error de BD en device_activity_analysis para {mac_address}: {e}")
         return jsonify({"error": "Database error occurred"}), 500
     except Exception as e:
         app.logger.error(f"Error inesperado en device_activity_analysis para {mac_address}: {e}", exc_info=True)
         return jsonify({"error": "Unexpected server error"}), 500
-    finally:
-        if conn: conn.close()
 
 
+def build_peak_hours(start_utc, end_utc, exact):
+    """Dispositivos distintos por hora del día (local) en el rango ({labels, data, approximate, relative_std_error})."""
+    hourly_counts = {f"{h:02d}": 0 for h in range(24)}
+    counts, approximate = storage_backend.distinct_counts('hour_of_day', start_utc, end_utc, exact=exact)
+    hourly_counts.update(counts)
+    hours = sorted(hourly_counts)
+    return {"labels": [f"{hour_str}:00" for hour_str in hours], "data": [hourly_counts[hour_str] for hour_str in hours],
+            "approximate": approximate,
+            "relative_std_error": round(sketches.HLL_RELATIVE_STD_ERROR, 4) if approximate else 0.0}
+
+def build_manufacturer_ranking(start_utc, end_utc, top_n):
+    """Fabricantes con más dispositivos distintos ({labels, data})."""
+    results = storage_backend.manufacturer_ranking(start_utc, end_utc, top_n)
+    return {"labels": [label for label, _ in results], "data": [count for _, count in results]}
+
 @app.route('/api/peak-activity-hours')
+@reads_from_snapshot
+@budgeted_query('peak_activity_hours', "Narrow startDate/endDate, or drop exact=true to use the HLL sketches.")
 def peak_activity_hours_analysis():
     # ... (sin cambios en esta función) ...
     app.logger.info("Solicitud GET para análisis de horas pico de actividad.")
@@ -633,35 +3353,15 @@ def peak_activity_hours_analysis():
 
     if start_date_obj > end_date_obj: return jsonify({"error": "startDate cannot be after endDate."}), 400
 
-    params = [start_date_obj.strftime('%Y-%m-%d'), end_date_obj.strftime('%Y-%m-%d')]
-    
-    query = f"""
-        SELECT 
-            strftime('%H', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) as hour_of_day,
-            COUNT(DISTINCT ble_mac_address) as unique_device_count
-        FROM scanned_devices
-        WHERE date(datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) BETWEEN date(?) AND date(?)
-        GROUP BY strftime('%H', datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}'))
-        ORDER BY hour_of_day ASC; 
-    """ 
-
-    conn = None
     try:
-        conn = get_db_connection()
-        app.logger.debug(f"Ejecutando query para peak-activity-hours: {query} con params: {params}")
-        results = conn.execute(query, tuple(params)).fetchall()
-
-        hourly_counts = {f"{h:02d}":0 for h in range(24)}
-        for row in results:
-            hourly_counts[row['hour_of_day']] = row['unique_device_count']
-            
-        labels = [f"{hour_str}:00" for hour_str in sorted(hourly_counts.keys())]
-        data_counts = [hourly_counts[hour_str] for hour_str in sorted(hourly_counts.keys())]
-        
-        if not any(dc > 0 for dc in data_counts):
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        result = build_peak_hours(start_utc, end_utc, is_exact_requested())
+        if not any(dc > 0 for dc in result["data"]):
             app.logger.info(f"No se encontraron datos de actividad pico para el rango {start_date_str} a {end_date_str}.")
-        
-        return jsonify({"labels": labels, "data": data_counts})
+        if is_columnar_requested():
+            return jsonify({"format": "columnar", "bucket": list(range(24)), "count": result["data"],
+                            "approximate": result["approximate"], "relative_std_error": result["relative_std_error"]})
+        return jsonify(result)
 
     except sqlite3.Error as e:
         app.logger.error(f"Error de base de datos en peak_activity_hours_analysis: {e}")
@@ -669,11 +3369,11 @@ def peak_activity_hours_analysis():
     except Exception as e:
         app.logger.error(f"Error inesperado en peak_activity_hours_analysis: {e}", exc_info=True)
         return jsonify({"error": "Unexpected server error"}), 500
-    finally:
-        if conn: conn.close()
 
 
 @app.route('/api/manufacturer-analysis')
+@reads_from_snapshot
+@budgeted_query('manufacturer_analysis', "Narrow startDate/endDate, e.g. to a single week.")
 def manufacturer_analysis():
     # ... (sin cambios en esta función) ...
     app.logger.info("Solicitud GET para análisis de fabricantes.")
@@ -688,79 +3388,22 @@ def manufacturer_analysis():
         top_n = 7
         app.logger.warning(f"Valor de topN inválido '{top_n_str}', usando default {top_n}.")
 
-    date_filters_sql_parts = []
-    query_params = []
-
+    start_date_obj, end_date_obj = None, None
     if start_date_str:
         start_date_obj = validate_date_format(start_date_str)
         if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
-        date_filters_sql_parts.append(f"date(datetime(s_data.timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) >= date(?)")
-        query_params.append(start_date_obj.strftime('%Y-%m-%d'))
 
     if end_date_str:
         end_date_obj = validate_date_format(end_date_str)
         if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
-        date_filters_sql_parts.append(f"date(datetime(s_data.timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) <= date(?)")
-        query_params.append(end_date_obj.strftime('%Y-%m-%d'))
-    
-    date_filter_subquery_sql = ""
-    if date_filters_sql_parts:
-        date_filter_subquery_sql = "AND " + " AND ".join(date_filters_sql_parts)
-
-    query_latest_mfg_per_mac = f"""
-        SELECT
-            s_outer.ble_mac_address,
-            (SELECT s_data.manufacturer_data
-             FROM scanned_devices s_data
-             WHERE s_data.ble_mac_address = s_outer.ble_mac_address
-               AND s_data.manufacturer_data IS NOT NULL AND s_data.manufacturer_data != ''
-               {date_filter_subquery_sql} 
-             ORDER BY s_data.timestamp DESC, s_data.id DESC LIMIT 1
-            ) as last_manufacturer_data
-        FROM scanned_devices s_outer
-        WHERE 1=1 {'AND ' + ' AND '.join(d.replace('s_data.timestamp', 's_outer.timestamp') for d in date_filters_sql_parts) if date_filters_sql_parts else ''}
-        GROUP BY s_outer.ble_mac_address
-        HAVING last_manufacturer_data IS NOT NULL;
-    """
-    final_query_params = query_params + query_params if date_filters_sql_parts else []
 
-    conn = None
     try:
-        conn = get_db_connection()
-        app.logger.debug(f"Ejecutando query para manufacturer_analysis (fase 1 - datos crudos): {query_latest_mfg_per_mac} con params: {final_query_params}")
-        
-        raw_data_for_parsing = conn.execute(query_latest_mfg_per_mac, tuple(final_query_params)).fetchall()
-
-        manufacturer_counts = defaultdict(int)
-        for row in raw_data_for_parsing:
-            mfg_hex = row['last_manufacturer_data']
-            name, _, _ = ble_utils.parse_manufacturer_data(mfg_hex)
-            
-            if name == "Unknown CID" or "N/A" in name:
-                display_name = "Desconocido/Otro"
-            else:
-                display_name = name
-            manufacturer_counts[display_name] += 1
-        
-        sorted_manufacturers = sorted(manufacturer_counts.items(), key=lambda item: item[1], reverse=True)
-        
-        labels = []
-        data_counts = []
-        
-        if not sorted_manufacturers:
+        # Rango local convertido a límites UTC sobre 'timestamp' para poder usar los índices
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        result = build_manufacturer_ranking(start_utc, end_utc, top_n)
+        if not result["labels"]:
             app.logger.info("No se encontraron datos de fabricantes para los filtros aplicados.")
-        else:
-            for i, (name, count) in enumerate(sorted_manufacturers):
-                if i < top_n:
-                    labels.append(name)
-                    data_counts.append(count)
-                elif i == top_n: 
-                    labels.append("Otros")
-                    data_counts.append(count)
-                else: 
-                    data_counts[-1] += count
-        
-        return jsonify({"labels": labels, "data": data_counts})
+        return jsonify(result)
 
     except sqlite3.Error as e:
         app.logger.error(f"Error de BD en manufacturer_analysis: {e}", exc_info=True)
@@ -768,46 +3411,326 @@ def manufacturer_analysis():
     except Exception as e:
         app.logger.error(f"Error inesperado en manufacturer_analysis: {e}", exc_info=True)
         return jsonify({"error": "Unexpected server error"}), 500
-    finally:
-        if conn: conn.close()
+
+
+@app.route('/api/distinct-devices')
+@reads_from_snapshot
+@budgeted_query('distinct_devices', "Narrow startDate/endDate, or drop exact=true to use the HLL sketches.")
+def distinct_devices_analysis():
+    """
+    Dispositivos distintos para cualquier rango de fechas, conjunto de ESPs y agrupación
+    ('none', 'esp' o 'hour_of_day'), uniendo sketches HLL. Con exact=true se calcula con COUNT(DISTINCT).
+    """
+    app.logger.info("Solicitud GET para análisis de dispositivos distintos.")
+    start_date_str = request.args.get('startDate')
+    end_date_str = request.args.get('endDate')
+    group_by = request.args.get('group_by', 'none')
+    esp_ids = [e.strip() for e in request.args.get('esp_ids', '').split(',') if e.strip()]
+    exact = is_exact_requested()
+
+    if group_by not in ['none', 'esp', 'hour_of_day']:
+        return jsonify({"error": "Invalid group_by. Use 'none', 'esp' or 'hour_of_day'."}), 400
+    if bool(start_date_str) != bool(end_date_str):
+        return jsonify({"error": "startDate and endDate must be provided together."}), 400
+    start_date_obj, end_date_obj = None, None
+    if start_date_str:
+        start_date_obj = validate_date_format(start_date_str)
+        if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
+        end_date_obj = validate_date_format(end_date_str)
+        if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
+        if start_date_obj > end_date_obj: return jsonify({"error": "startDate cannot be after endDate."}), 400
+    if group_by == 'hour_of_day' and not start_date_obj:
+        return jsonify({"error": "startDate and endDate are required for hour_of_day grouping."}), 400
+
+    try:
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        counts, approximate = storage_backend.distinct_counts(group_by, start_utc, end_utc, esp_ids, exact)
+
+        if group_by == 'hour_of_day':
+            labels = [f"{h:02d}:00" for h in range(24)]
+            data_counts = [counts.get(f"{h:02d}", 0) for h in range(24)]
+        elif group_by == 'esp':
+            labels = sorted(counts)
+            data_counts = [counts[k] for k in labels]
+        else:
+            labels = ['total']
+            data_counts = [counts.get('total', 0)]
+
+        return jsonify({
+            "labels": labels, "data": data_counts, "approximate": approximate,
+            "relative_std_error": round(sketches.HLL_RELATIVE_STD_ERROR, 4) if approximate else 0.0
+        })
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en distinct_devices_analysis: {e}", exc_info=True)
+        return jsonify({"error": "Database error occurred"}), 500
+    except Exception as e:
+        app.logger.error(f"Error inesperado en distinct_devices_analysis: {e}", exc_info=True)
+        return jsonify({"error": "Unexpected server error"}), 500
+
+
+# --- ENDPOINTS DE VISITAS (SESIONES) ---
+OCCUPANCY_MAX_BUCKETS = 2000
+
+def parse_local_date_range_args(required):
+    """(start_date, end_date, error_response) a partir de startDate/endDate (días locales)."""
+    start_date_str = request.args.get('startDate')
+    end_date_str = request.args.get('endDate')
+    if bool(start_date_str) != bool(end_date_str) or (required and not start_date_str):
+        message = "startDate and endDate are required." if required else "startDate and endDate must be provided together."
+        return None, None, (jsonify({"error": message}), 400)
+    if not start_date_str:
+        return None, None, None
+    start_date_obj = validate_date_format(start_date_str)
+    end_date_obj = validate_date_format(end_date_str)
+    if not start_date_obj or not end_date_obj:
+        return None, None, (jsonify({"error": "Invalid date format. Use YYYY-MM-DD."}), 400)
+    if start_date_obj > end_date_obj:
+        return None, None, (jsonify({"error": "startDate cannot be after endDate."}), 400)
+    return start_date_obj, end_date_obj, None
+
+def sessions_in_range(start_utc, end_utc, esp_id=None, limit=None):
+    """
+    Visitas guardadas y abiertas que se solapan con [start_utc, end_utc], por inicio ascendente. En las
+    abiertas ('open': true) end_utc es la última detección, pero la visita sigue en curso.
+    """
+    stored = storage_backend.sessions_overlapping(start_utc, end_utc, SESSION_MAX_DURATION_SEC, esp_id, limit)
+    for row in stored:
+        row['open'] = False
+    open_rows = []
+    for record in sessionizer.open_sessions(storage.utc_string_to_epoch(start_utc), storage.utc_string_to_epoch(end_utc) + 1, esp_id):
+        row = storage.session_record_to_dict(record)
+        row['open'] = True
+        open_rows.append(row)
+    merged = sorted(stored + open_rows, key=lambda row: row['start_utc'])
+    return merged[:limit] if limit is not None else merged
+
+
+@app.route('/api/dwell-time')
+def dwell_time_distribution():
+    """Distribución de la duración de las visitas cerradas que empiezan en el rango de fechas."""
+    app.logger.info("Solicitud GET para /api/dwell-time")
+    start_date_obj, end_date_obj, error = parse_local_date_range_args(required=False)
+    if error:
+        return error
+    try:
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        counts, total, avg_sec = storage_backend.dwell_histogram(start_utc, end_utc, request.args.get('esp_id') or None)
+        labels = [label for _, label in storage.DWELL_BUCKETS]
+        if is_columnar_requested():
+            upper_sec = [upper for upper, _ in storage.DWELL_BUCKETS]
+            return jsonify({
+                "format": "columnar",
+                "lower_sec": [0] + upper_sec[:-1],
+                "upper_sec": upper_sec,
+                "count": [counts.get(label, 0) for label in labels],
+                "total_sessions": total,
+                "avg_dwell_sec": round(avg_sec, 1) if avg_sec is not None else None,
+                "session_gap_sec": SESSION_GAP_SEC
+            })
+        return jsonify({
+            "labels": labels,
+            "data": [counts.get(label, 0) for label in labels],
+            "total_sessions": total,
+            "avg_dwell_sec": round(avg_sec, 1) if avg_sec is not None else None,
+            "session_gap_sec": SESSION_GAP_SEC
+        })
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en /api/dwell-time: {e}", exc_info=True)
+        return jsonify({"error": "Database error occurred"}), 500
+
+
+@app.route('/api/occupancy')
+def occupancy_over_time():
+    """Dispositivos con una visita en curso dentro de cada intervalo de step_min minutos."""
+    app.logger.info("Solicitud GET para /api/occupancy")
+    start_date_obj, end_date_obj, error = parse_local_date_range_args(required=True)
+    if error:
+        return error
+    try:
+        step_sec = int(request.args.get('step_min', 15)) * 60
+    except ValueError:
+        return jsonify({"error": "Invalid step_min parameter"}), 400
+    if step_sec <= 0:
+        return jsonify({"error": "step_min must be positive"}), 400
+    try:
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        range_start, range_end = storage.utc_string_to_epoch(start_utc), storage.utc_string_to_epoch(end_utc)
+        bucket_count = math.ceil((range_end - range_start) / step_sec)
+        if bucket_count > OCCUPANCY_MAX_BUCKETS:
+            return jsonify({"error": f"Too many intervals ({bucket_count}). Increase step_min or shorten the range."}), 400
+
+        # Barrido con diferencias: cada visita suma 1 en su primer intervalo y resta 1 tras el último
+        deltas = [0] * (bucket_count + 1)
+        session_rows = sessions_in_range(start_utc, storage.epoch_to_utc_string(range_end - 1), request.args.get('esp_id') or None)
+        now = time.time()
+        for row in session_rows:
+            session_end = now if row['open'] else storage.utc_string_to_epoch(row['end_utc'])
+            first = max(0, int((storage.utc_string_to_epoch(row['start_utc']) - range_start) // step_sec))
+            last = min(bucket_count - 1, int((session_end - range_start) // step_sec))
+            if first <= last:
+                deltas[first] += 1
+                deltas[last + 1] -= 1
+        data_counts = list(itertools.accumulate(deltas[:bucket_count]))
+        if is_columnar_requested():
+            return jsonify({"format": "columnar", "t": list(range(range_start, range_start + bucket_count * step_sec, step_sec)),
+                            "count": data_counts, "step_min": step_sec // 60, "sessions": len(session_rows),
+                            "tz": timezone_offset_table(range_start, range_end)})
+        labels = [convert_utc_to_local_string(storage.epoch_to_utc_string(range_start + bucket * step_sec), TARGET_TIMEZONE_PYTZ)
+                  for bucket in range(bucket_count)]
+        return jsonify({"labels": labels, "data": data_counts, "step_min": step_sec // 60, "sessions": len(session_rows)})
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en /api/occupancy: {e}", exc_info=True)
+        return jsonify({"error": "Database error occurred"}), 500
+
+
+@app.route('/api/devices-present')
+def devices_present_at():
+    """Dispositivos con una visita que cubre el instante 'at' (hora local 'YYYY-MM-DD HH:MM[:SS]'; por defecto, ahora)."""
+    app.logger.info("Solicitud GET para /api/devices-present")
+    at_str = request.args.get('at')
+    if at_str:
+        at_local = None
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'):
+            try:
+                at_local = datetime.strptime(at_str, fmt)
+                break
+            except ValueError:
+                continue
+        if at_local is None:
+            return jsonify({"error": "Invalid 'at' format. Use YYYY-MM-DD HH:MM[:SS]."}), 400
+        at_utc = TARGET_TIMEZONE_PYTZ.localize(at_local).astimezone(pytz.utc).strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        at_utc = storage.epoch_to_utc_string(time.time())
+    try:
+        limit = max(1, min(int(request.args.get('limit', 500)), 5000))
+    except ValueError:
+        return jsonify({"error": "Invalid limit parameter"}), 400
+    try:
+        present = sessions_in_range(at_utc, at_utc, request.args.get('esp_id') or None)
+        for row in present:
+            row['start_local'] = convert_utc_to_local_string(row['start_utc'], TARGET_TIMEZONE_PYTZ)
+            row['end_local'] = convert_utc_to_local_string(row['end_utc'], TARGET_TIMEZONE_PYTZ)
+        return jsonify({
+            "at_local": convert_utc_to_local_string(at_utc, TARGET_TIMEZONE_PYTZ),
+            "count": len(present),
+            "devices": present[:limit]
+        })
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en /api/devices-present: {e}", exc_info=True)
+        return jsonify({"error": "Database error occurred"}), 500
 
 
 # --- NUEVOS ENDPOINTS PARA ANÁLISIS RSSI ---
 @app.route('/api/all-known-esps')
+@reads_from_snapshot
 def get_all_known_esps():
     app.logger.info("Solicitud GET para /api/all-known-esps")
-    conn = None
     try:
-        conn = get_db_connection()
-        esps = conn.execute("SELECT DISTINCT esp_device_id FROM scanned_devices ORDER BY esp_device_id ASC").fetchall()
-        return jsonify([row['esp_device_id'] for row in esps])
+        return jsonify(storage_backend.known_esps())
     except sqlite3.Error as e:
         app.logger.error(f"Error de BD en /api/all-known-esps: {e}")
         return jsonify({"error": "Database error"}), 500
-    finally:
-        if conn: conn.close()
 
 @app.route('/api/esps-for-mac/<mac_address>')
+@reads_from_snapshot
 def get_esps_for_mac(mac_address):
     app.logger.info(f"Solicitud GET para /api/esps-for-mac/{mac_address}")
     if not mac_address or len(mac_address) != 17:
         return jsonify({"error": "Invalid MAC address format"}), 400
-    conn = None
     try:
-        conn = get_db_connection()
-        esps = conn.execute(
-            "SELECT DISTINCT esp_device_id FROM scanned_devices WHERE ble_mac_address = ? ORDER BY esp_device_id ASC",
-            (mac_address,)
-        ).fetchall()
-        return jsonify([row['esp_device_id'] for row in esps])
+        return jsonify(storage_backend.esps_for_mac(mac_address))
     except sqlite3.Error as e:
         app.logger.error(f"Error de BD en /api/esps-for-mac/{mac_address}: {e}")
         return jsonify({"error": "Database error"}), 500
-    finally:
-        if conn: conn.close()
+
+
+def build_rssi_trend(mac_address, start_utc, end_utc, esp_id, smooth=False):
+    """
+    Series de RSSI por ESP de una MAC ({datasets, min_rssi, max_rssi}). Con smooth, cada ESP tiene además un
+    dataset 'smoothed' con el RSSI filtrado (smooth_rssi_series).
+    """
+    # Limitado a 1000 puntos para rendimiento del gráfico
+    results_raw = storage_backend.rssi_points(mac_address, start_utc, end_utc, esp_id, limit=1000)
+
+    datasets_by_esp = defaultdict(lambda: {"data": [], "esp_id": None, "label": None})
+    min_rssi_overall = 0
+    max_rssi_overall = -120
+
+    if not results_raw:
+        app.logger.info(f"No RSSI data found for MAC {mac_address} with current filters.")
+        return {"datasets": [], "min_rssi": -100, "max_rssi": 0}
+
+
+    epochs_by_esp = defaultdict(list)
+    for row in results_raw:
+        row_esp_id = row['esp_device_id']
+        if smooth:
+            epochs_by_esp[row_esp_id].append(parse_utc_timestamp_to_epoch(row['timestamp_utc']))
+        timestamp_local_str = convert_utc_to_local_string(row['timestamp_utc'], TARGET_TIMEZONE_PYTZ)
+        rssi_val = row['ble_rssi']
+
+        datasets_by_esp[row_esp_id]["esp_id"] = row_esp_id
+        datasets_by_esp[row_esp_id]["label"] = f"RSSI @ {row_esp_id}"
+        datasets_by_esp[row_esp_id]["data"].append({"x": timestamp_local_str, "y": rssi_val})
+        
+        if rssi_val is not None:
+            if rssi_val < min_rssi_overall: min_rssi_overall = rssi_val
+            if rssi_val > max_rssi_overall: max_rssi_overall = rssi_val
+
+    min_rssi_overall, max_rssi_overall = rssi_axis_bounds(min_rssi_overall, max_rssi_overall)
+    final_datasets = list(datasets_by_esp.values())
+    if smooth:
+        for dataset in list(final_datasets):
+            points = dataset["data"]
+            smoothed = smooth_rssi_series(epochs_by_esp[dataset["esp_id"]], [point["y"] for point in points])
+            final_datasets.append({
+                "data": [{"x": point["x"], "y": value} for point, value in zip(points, smoothed)],
+                "esp_id": dataset["esp_id"],
+                "label": f"RSSI suavizado @ {dataset['esp_id']}",
+                "smoothed": True,
+            })
+    return {"datasets": final_datasets, "min_rssi": min_rssi_overall, "max_rssi": max_rssi_overall}
+
+
+def rssi_axis_bounds(min_rssi, max_rssi):
+    """Límites del eje Y de los gráficos de RSSI a partir del mínimo (<= 0) y el máximo (>= -120) de los puntos."""
+    # Si no se encontraron valores RSSI válidos, establecer rangos por defecto
+    if min_rssi == 0 and max_rssi == -120:
+        return -100, 0
+    # Ajustar un poco para que los puntos no queden justo en el borde
+    min_rssi = math.floor(min_rssi / 10.0) * 10 - 5
+    max_rssi = math.ceil(max_rssi / 10.0) * 10 + 5
+    if min_rssi > -30: min_rssi = -30 # Cota inferior razonable
+    if max_rssi < -70: max_rssi = -70 # Cota superior razonable
+    return min_rssi, max_rssi
+
+
+def build_rssi_trend_columnar(mac_address, start_utc, end_utc, esp_id, smooth=False):
+    """
+    build_rssi_trend en formato columnar: por ESP, listas paralelas 't' (epoch UTC entero) y 'rssi' tal como
+    salen del storage (y 'rssi_smoothed' con smooth), más la tabla de offsets de la zona horaria para que el
+    navegador formatee las horas.
+    """
+    series_by_esp = storage_backend.rssi_series(mac_address, start_utc, end_utc, esp_id, limit=1000)
+    if not series_by_esp:
+        app.logger.info(f"No RSSI data found for MAC {mac_address} with current filters.")
+    series = [{"esp_id": series_esp_id, "label": f"RSSI @ {series_esp_id}", "t": epochs, "rssi": rssis}
+              for series_esp_id, (epochs, rssis) in series_by_esp.items()]
+    if smooth:
+        for item in series:
+            item["rssi_smoothed"] = smooth_rssi_series(item["t"], item["rssi"])
+    min_rssi, max_rssi = rssi_axis_bounds(min([0] + [min(item["rssi"]) for item in series]),
+                                          max([-120] + [max(item["rssi"]) for item in series]))
+    now = time.time()
+    first_epoch = min((item["t"][0] for item in series), default=now)
+    last_epoch = max((item["t"][-1] for item in series), default=now)
+    return {"format": "columnar", "series": series, "min_rssi": min_rssi, "max_rssi": max_rssi,
+            "tz": timezone_offset_table(first_epoch, last_epoch)}
 
 
 @app.route('/api/device-rssi-trend/<mac_address>')
+@reads_from_snapshot
+@budgeted_query('rssi_trend', "Narrow startDate/endDate or filter by esp_id.")
 def device_rssi_trend(mac_address):
     app.logger.info(f"Solicitud GET para /api/device-rssi-trend/{mac_address}")
     if not mac_address or len(mac_address) != 17:
@@ -817,90 +3740,35 @@ def device_rssi_trend(mac_address):
     end_date_str = request.args.get('endDate')
     filter_esp_id = request.args.get('esp_id') # Puede estar vacío o no presente
 
-    params = [mac_address]
-    sql_conditions = ["s.ble_mac_address = ?", "s.ble_rssi IS NOT NULL"]
-
     start_date_obj, end_date_obj = None, None
     if start_date_str:
         start_date_obj = validate_date_format(start_date_str)
         if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
-        sql_conditions.append(f"date(datetime(s.timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) >= date(?)")
-        params.append(start_date_obj.strftime('%Y-%m-%d'))
 
     if end_date_str:
         end_date_obj = validate_date_format(end_date_str)
         if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
-        sql_conditions.append(f"date(datetime(s.timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) <= date(?)")
-        params.append(end_date_obj.strftime('%Y-%m-%d'))
     
     if start_date_obj and end_date_obj and start_date_obj > end_date_obj:
         return jsonify({"error": "startDate cannot be after endDate."}), 400
 
-    if filter_esp_id:
-        sql_conditions.append("s.esp_device_id = ?")
-        params.append(filter_esp_id)
-
-    query = f"""
-        SELECT s.timestamp as timestamp_utc, s.ble_rssi, s.esp_device_id
-        FROM scanned_devices s
-        WHERE {' AND '.join(sql_conditions)}
-        ORDER BY s.timestamp ASC
-        LIMIT 1000;
-    """ # Limitado a 1000 puntos para rendimiento del gráfico
-
-    conn = None
     try:
-        conn = get_db_connection()
-        app.logger.debug(f"Executing query for device-rssi-trend: {query} with params: {params}")
-        results_raw = conn.execute(query, tuple(params)).fetchall()
-
-        datasets_by_esp = defaultdict(lambda: {"data": [], "esp_id": None, "label": None})
-        min_rssi_overall = 0
-        max_rssi_overall = -120
-
-        if not results_raw:
-            app.logger.info(f"No RSSI data found for MAC {mac_address} with current filters.")
-            return jsonify({"datasets": [], "min_rssi": -100, "max_rssi": 0})
-
-
-        for row in results_raw:
-            esp_id = row['esp_device_id']
-            timestamp_local_str = convert_utc_to_local_string(row['timestamp_utc'], TARGET_TIMEZONE_PYTZ)
-            rssi_val = row['ble_rssi']
-
-            datasets_by_esp[esp_id]["esp_id"] = esp_id
-            datasets_by_esp[esp_id]["label"] = f"RSSI @ {esp_id}"
-            datasets_by_esp[esp_id]["data"].append({"x": timestamp_local_str, "y": rssi_val})
-            
-            if rssi_val is not None:
-                if rssi_val < min_rssi_overall: min_rssi_overall = rssi_val
-                if rssi_val > max_rssi_overall: max_rssi_overall = rssi_val
-        
-        # Si no se encontraron valores RSSI válidos, establecer rangos por defecto
-        if min_rssi_overall == 0 and max_rssi_overall == -120:
-            min_rssi_overall = -100 # Default min if no data
-            max_rssi_overall = 0    # Default max if no data
-        else: # Ajustar un poco para que los puntos no queden justo en el borde
-            min_rssi_overall = math.floor(min_rssi_overall / 10.0) * 10 - 5
-            max_rssi_overall = math.ceil(max_rssi_overall / 10.0) * 10 + 5
-            if min_rssi_overall > -30: min_rssi_overall = -30 # Cota inferior razonable
-            if max_rssi_overall < -70: max_rssi_overall = -70 # Cota superior razonable
-
-
-        final_datasets = list(datasets_by_esp.values())
-        return jsonify({"datasets": final_datasets, "min_rssi": min_rssi_overall, "max_rssi": max_rssi_overall})
-
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        if is_columnar_requested():
+            return jsonify(build_rssi_trend_columnar(mac_address, start_utc, end_utc, filter_esp_id or None,
+                                                     smooth=is_smoothing_requested()))
+        return jsonify(build_rssi_trend(mac_address, start_utc, end_utc, filter_esp_id or None, smooth=is_smoothing_requested()))
     except sqlite3.Error as e:
         app.logger.error(f"Error de BD en device_rssi_trend para {mac_address}: {e}", exc_info=True)
         return jsonify({"error": "Database error"}), 500
     except Exception as e:
         app.logger.error(f"Error inesperado en device_rssi_trend para {mac_address}: {e}", exc_info=True)
         return jsonify({"error": "Unexpected server error"}), 500
-    finally:
-        if conn: conn.close()
 
 
 @app.route('/api/esp-rssi-distribution/<esp_id>')
+@reads_from_snapshot
+@budgeted_query('esp_rssi_distribution', "Narrow startDate/endDate.")
 def esp_rssi_distribution_advanced(esp_id):
     app.logger.info(f"Solicitud GET para /api/esp-rssi-distribution/{esp_id}")
     if not esp_id: # El ESP ID es parte de la URL, Flask debería dar 404 si no está, pero validamos.
@@ -909,56 +3777,39 @@ def esp_rssi_distribution_advanced(esp_id):
     start_date_str = request.args.get('startDate')
     end_date_str = request.args.get('endDate')
 
-    params = [esp_id]
-    sql_conditions = ["esp_device_id = ?", "ble_rssi IS NOT NULL"]
-
     start_date_obj, end_date_obj = None, None
     if start_date_str:
         start_date_obj = validate_date_format(start_date_str)
         if not start_date_obj: return jsonify({"error": "Invalid startDate format. Use YYYY-MM-DD."}), 400
-        sql_conditions.append(f"date(datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) >= date(?)")
-        params.append(start_date_obj.strftime('%Y-%m-%d'))
 
     if end_date_str:
         end_date_obj = validate_date_format(end_date_str)
         if not end_date_obj: return jsonify({"error": "Invalid endDate format. Use YYYY-MM-DD."}), 400
-        sql_conditions.append(f"date(datetime(timestamp, '{SQLITE_ANALYTICS_TIME_OFFSET}')) <= date(?)")
-        params.append(end_date_obj.strftime('%Y-%m-%d'))
 
     if start_date_obj and end_date_obj and start_date_obj > end_date_obj:
         return jsonify({"error": "startDate cannot be after endDate."}), 400
 
-    query = f"""
-        SELECT
-            CASE
-                WHEN ble_rssi >= -50 THEN '-50 a 0 dBm'
-                WHEN ble_rssi >= -60 THEN '-60 a -51 dBm'
-                WHEN ble_rssi >= -70 THEN '-70 a -61 dBm'
-                WHEN ble_rssi >= -80 THEN '-80 a -71 dBm'
-                WHEN ble_rssi >= -90 THEN '-90 a -81 dBm'
-                ELSE '< -90 dBm'
-            END as rssi_range,
-            COUNT(*) as count,
-            MIN(ble_rssi) as min_rssi_in_range -- Para ordenar correctamente los rangos
-        FROM scanned_devices
-        WHERE {' AND '.join(sql_conditions)}
-        GROUP BY rssi_range
-        ORDER BY min_rssi_in_range DESC;
-    """
-    conn = None
     try:
-        conn = get_db_connection()
-        app.logger.debug(f"Executing query for esp-rssi-distribution: {query} with params: {params}")
-        results_raw = conn.execute(query, tuple(params)).fetchall()
-
-        if not results_raw:
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        counts_by_range = storage_backend.rssi_histogram(esp_id, start_utc, end_utc)
+
+        if is_columnar_requested():
+            # Rangos por su límite inferior y superior en dBm (inclusivos); el inferior del último es null
+            lower_dbm = [threshold for threshold, _ in storage.RSSI_RANGES]
+            return jsonify({
+                "format": "columnar",
+                "lower_dbm": lower_dbm,
+                "upper_dbm": [0] + [threshold - 1 for threshold in lower_dbm[:-1]],
+                "count": [counts_by_range.get(label, 0) for _, label in storage.RSSI_RANGES]
+            })
+
+        if not counts_by_range:
             app.logger.info(f"No RSSI distribution data found for ESP {esp_id} with current filters.")
             # Devolver estructura vacía esperada por Chart.js pie/bar
             return jsonify({"labels": [], "data": []})
 
         # Asegurar el orden correcto de las etiquetas si algunos rangos no tienen datos
-        all_possible_ranges = ['-50 a 0 dBm', '-60 a -51 dBm', '-70 a -61 dBm', '-80 a -71 dBm', '-90 a -81 dBm', '< -90 dBm']
-        counts_by_range = {row['rssi_range']: row['count'] for row in results_raw}
+        all_possible_ranges = [label for _, label in storage.RSSI_RANGES]
         
         labels = all_possible_ranges
         data_counts = [counts_by_range.get(r, 0) for r in all_possible_ranges]
@@ -971,8 +3822,201 @@ def esp_rssi_distribution_advanced(esp_id):
     except Exception as e:
         app.logger.error(f"Error inesperado en esp_rssi_distribution para {esp_id}: {e}", exc_info=True)
         return jsonify({"error": "Unexpected server error"}), 500
-    finally:
-        if conn: conn.close()
+
+
+@app.route('/api/rssi-percentiles')
+@reads_from_snapshot
+@budgeted_query('rssi_percentiles', "Narrow startDate/endDate, group by esp instead of hour, or drop exact=true.")
+def rssi_percentiles_analysis():
+    """
+    Percentiles de RSSI (p.ej. p10/p50/p90) para cualquier rango de fechas y conjunto de ESPs, agrupados por
+    'none', 'esp', 'hour' o 'esp_hour', uniendo los histogramas guardados por (ESP, hora/día). Con exact=true
+    se calculan recorriendo las detecciones (mismo resultado: los histogramas son exactos).
+    """
+    app.logger.info("Solicitud GET para /api/rssi-percentiles")
+    group_by = request.args.get('group_by', 'esp')
+    if group_by not in storage.PERCENTILE_GROUPINGS:
+        return jsonify({"error": "Invalid group_by. Use 'none', 'esp', 'hour' or 'esp_hour'."}), 400
+    hourly = group_by in ('hour', 'esp_hour')
+    start_date_obj, end_date_obj, error = parse_local_date_range_args(required=hourly)
+    if error:
+        return error
+    esp_ids = [e.strip() for e in request.args.get('esp_ids', '').split(',') if e.strip()]
+    try:
+        percents = [float(p) for p in request.args.get('percentiles', ','.join(map(str, RSSI_PERCENTILES_DEFAULT))).split(',') if p.strip()]
+    except ValueError:
+        return jsonify({"error": "Invalid percentiles parameter. Use a comma-separated list such as 10,50,90."}), 400
+    if not percents or len(percents) > RSSI_PERCENTILES_MAX or not all(0 <= p <= 100 for p in percents):
+        return jsonify({"error": f"Between 1 and {RSSI_PERCENTILES_MAX} percentiles between 0 and 100 are required."}), 400
+    exact = is_exact_requested()
+
+    try:
+        start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+        histograms = storage_backend.rssi_percentile_histograms(group_by, start_utc, end_utc, esp_ids, exact)
+        groups = []
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            group = {}
+            if group_by in ('esp', 'esp_hour'):
+                group["esp_id"] = key[0] if group_by == 'esp_hour' else key
+            if hourly:
+                group["t"] = storage.utc_string_to_epoch(key[1] if group_by == 'esp_hour' else key)
+            mean = histogram.mean()
+            group.update({"count": histogram.total(), "mean": round(mean, 1) if mean is not None else None,
+                          "values": histogram.percentiles(percents)})
+            groups.append(group)
+        result = {"percentiles": percents, "group_by": group_by, "exact": exact, "groups": groups}
+        if hourly:
+            result["tz"] = timezone_offset_table(storage.utc_string_to_epoch(start_utc), storage.utc_string_to_epoch(end_utc))
+        return jsonify(result)
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en /api/rssi-percentiles: {e}", exc_info=True)
+        return jsonify({"error": "Database error"}), 500
+    except Exception as e:
+        app.logger.error(f"Error inesperado en /api/rssi-percentiles: {e}", exc_info=True)
+        return jsonify({"error": "Unexpected server error"}), 500
+
+
+# --- FEDERACIÓN MULTI-SEDE: RESÚMENES MERGEABLES Y VISTA AGREGADA ---
+def federation_date_range(params):
+    """(start_date, end_date) de startDate/endDate; por defecto los últimos FEDERATION_DEFAULT_DAYS días locales. ValueError si no son válidos."""
+    start_date_str, end_date_str = params.get('startDate'), params.get('endDate')
+    if bool(start_date_str) != bool(end_date_str):
+        raise ValueError("startDate and endDate must be provided together.")
+    if not start_date_str:
+        end_date_obj = datetime.now(TARGET_TIMEZONE_PYTZ).date()
+        return end_date_obj - timedelta(days=FEDERATION_DEFAULT_DAYS - 1), end_date_obj
+    start_date_obj, end_date_obj = validate_date_format(start_date_str), validate_date_format(end_date_str)
+    if not start_date_obj or not end_date_obj:
+        raise ValueError("Invalid date format. Use YYYY-MM-DD.")
+    if start_date_obj > end_date_obj:
+        raise ValueError("startDate cannot be after endDate.")
+    return start_date_obj, end_date_obj
+
+def build_federation_summary(start_date_obj, end_date_obj):
+    """
+    Resumen mergeable de esta instancia entre dos días locales: sketches HLL de las MACs vistas por hora del
+    día local, advertisements por hora e histograma de RSSI (de los histogramas por ESP y hora) y dispositivos
+    por fabricante. Unos pocos KB, independientemente del número de filas.
+    """
+    start_utc, end_utc = local_date_range_to_utc(start_date_obj, end_date_obj)
+    by_hour = storage_backend.distinct_sketches('hour_of_day', start_utc, end_utc)
+    # Toda MAC del rango está en el sketch de alguna hora: su unión es el total, sin otra consulta
+    unique = sketches.HyperLogLog()
+    for sketch in by_hour.values():
+        unique.merge(sketch)
+    offset_hours = analytics_offset_hours()
+    advertisements_by_hour = [0] * 24
+    rssi = sketches.ValueHistogram()
+    for hour_bucket, histogram in storage_backend.rssi_percentile_histograms('hour', start_utc, end_utc).items():
+        advertisements_by_hour[(int(hour_bucket[11:13]) + offset_hours) % 24] += histogram.total()
+        rssi.merge(histogram)
+    return {
+        "version": federation.SUMMARY_VERSION,
+        "site": FEDERATION_SITE_NAME or socket.gethostname(),
+        "timezone": TARGET_TIMEZONE_PYTZ.zone,
+        "startDate": start_date_obj.isoformat(),
+        "endDate": end_date_obj.isoformat(),
+        "generated_at": time.time(),
+        "unique_devices_estimate": unique.estimate(),
+        "unique_devices": federation.encode_blob(unique.to_bytes()),
+        "unique_devices_by_hour": {hour: federation.encode_blob(sketch.to_bytes()) for hour, sketch in sorted(by_hour.items())},
+        "advertisements_by_hour": advertisements_by_hour,
+        "rssi_histogram": federation.encode_blob(rssi.to_bytes()),
+        "manufacturers": storage_backend.manufacturer_ranking(start_utc, end_utc, FEDERATION_MANUFACTURERS_MAX),
+    }
+
+def local_federation_summary(params):
+    """Resumen de esta instancia para su propio agregador (sede con URL None), sin pasar por HTTP."""
+    try:
+        return build_federation_summary(*federation_date_range(params))
+    except sqlite3.Error as e:
+        raise federation.FederationError(f"Database error: {e}") from e
+
+def federation_token_required(view):
+    """Con FEDERATION_TOKEN definido exige la cabecera X-Federation-Token (va antes que la agrupación de peticiones idénticas)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get(federation.TOKEN_HEADER, '')
+        if FEDERATION_TOKEN and not hmac.compare_digest(token.encode(), FEDERATION_TOKEN.encode()):
+            return jsonify({"error": "Federation token required"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route(federation.SUMMARY_PATH)
+@federation_token_required
+@reads_from_snapshot
+@budgeted_query('federation_summary', "Narrow startDate/endDate.")
+def federation_summary():
+    """Resumen mergeable de esta sede (ver build_federation_summary) para startDate/endDate."""
+    app.logger.info(f"Solicitud GET para {federation.SUMMARY_PATH} con args: {request.args}")
+    try:
+        start_date_obj, end_date_obj = federation_date_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return jsonify(build_federation_summary(start_date_obj, end_date_obj))
+    except sqlite3.Error as e:
+        app.logger.error(f"Error de BD en {federation.SUMMARY_PATH}: {e}")
+        return jsonify({"error": "Database error"}), 500
+    except Exception as e:
+        app.logger.error(f"Error inesperado en {federation.SUMMARY_PATH}: {e}", exc_info=True)
+        return jsonify({"error": "Unexpected server error"}), 500
+
+@app.route('/api/federation/overview')
+def federation_overview():
+    """
+    Vista agregada de las sedes de FEDERATION_SITES: dispositivos distintos (unión de sketches), horas pico,
+    fabricantes y percentiles de RSSI. Las sedes que no responden aportan su último resumen del mismo rango
+    (staleness_sec); sin ninguno, quedan fuera y partial=true.
+    """
+    app.logger.info(f"Solicitud GET para /api/federation/overview con args: {request.args}")
+    if federation_aggregator is None:
+        return jsonify({"error": "Federation aggregator not configured (FEDERATION_SITES is empty)"}), 404
+    try:
+        start_date_obj, end_date_obj = federation_date_range(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    top_n = request.args.get('topN', 7, type=int)
+    if top_n is None or top_n <= 0: top_n = 7
+
+    # Rango explícito: todas las sedes resumen los mismos días y la caché no depende de "hoy"
+    results = federation_aggregator.collect({"startDate": start_date_obj.isoformat(), "endDate": end_date_obj.isoformat()})
+    sites = [{
+        "site": result["site"],
+        "ok": result["ok"],
+        "error": result["error"],
+        "from_cache": result["from_cache"],
+        "staleness_sec": result["staleness_sec"],
+        "timezone": result["summary"]["timezone"] if result["summary"] else None,
+        "unique_devices": result["summary"]["unique_devices_estimate"] if result["summary"] else None,
+    } for result in results]
+    available = [result for result in results if result["summary"] is not None]
+    for result in results:
+        if not result["ok"]:
+            app.logger.warning(f"Federación: la sede '{result['site']}' no ha respondido ({result['error']}); "
+                               f"{'se usa su último resumen' if result['summary'] else 'queda fuera de la vista'}.")
+    if not available:
+        return jsonify({"error": "No site summaries available", "sites": sites}), 502
+    try:
+        merged = federation.merge_summaries([result["summary"] for result in available], top_n=top_n)
+    except (KeyError, TypeError, ValueError, IndexError, zlib.error) as e:
+        app.logger.error(f"Federación: resumen con formato inválido: {e}")
+        return jsonify({"error": "Invalid site summary", "sites": sites}), 502
+    max_staleness = max(result["staleness_sec"] for result in available)
+    response = jsonify(dict(
+        merged, startDate=start_date_obj.isoformat(), endDate=end_date_obj.isoformat(), sites=sites,
+        sites_included=len(available), partial=len(available) < len(results), max_staleness_sec=max_staleness,
+    ))
+    response.headers['X-Federation-Max-Staleness-Sec'] = str(max_staleness)
+    return response
+
+@app.route('/api/federation/status')
+def federation_status():
+    """Estado del agregador: caché y último resultado de cada sede."""
+    if federation_aggregator is None:
+        return jsonify({"error": "Federation aggregator not configured (FEDERATION_SITES is empty)"}), 404
+    return jsonify(federation_aggregator.stats())
 
 
 # --- Ejecución del Servidor ---
@@ -980,5 +4024,29 @@ if __name__ == '__main__':
     app.logger.info("Iniciando servidor backend BLE...")
     app.logger.info(f"Zona horaria para visualización: {TARGET_TIMEZONE_PYTZ.zone}")
     app.logger.info(f"Offset para analíticas SQL (¡REVISAR DST!): {SQLITE_ANALYTICS_TIME_OFFSET}")
-    init_db() 
+    if '--rebalance-shards' in sys.argv:
+        # Uso: python backend_server.py --rebalance-shards [shard_retirado ...]
+        extra_shards = sys.argv[sys.argv.index('--rebalance-shards') + 1:]
+        touched = rebalance_shards(extra_shards)
+        app.logger.info(f"Rebalanceo de shards completado. Shards afectados: {touched or 'ninguno'}")
+        sys.exit(0)
+    if '--enable-incremental-vacuum' in sys.argv:
+        # Uso: python backend_server.py --enable-incremental-vacuum (reescribe cada shard con VACUUM)
+        init_db()
+        enable_incremental_vacuum()
+        sys.exit(0)
+    storage_backend.init()
+    rebuild_live_device_store()
+    rebuild_sessionizer()
+    rebuild_cooccurrence_index()
+    rebuild_proximity_tracker()
+    seed_alert_engine()
+    # Con debug=True el recargador ejecuta este bloque también en el proceso vigilante: los hilos de
+    # alertas (barrido y webhook) solo se arrancan en el proceso que atiende las peticiones
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        alert_engine.start(ALERT_SWEEP_INTERVAL_SEC)
+        if SNAPSHOT_ENABLED and isinstance(storage_backend, SQLiteStorage):
+            init_snapshots()
+        if MAINTENANCE_ENABLED and isinstance(storage_backend, SQLiteStorage):
+            maintenance_scheduler.start()
     app.run(host=SERVER_HOST, port=SERVER_PORT, debug=True)
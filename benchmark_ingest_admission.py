@@ -0,0 +1,193 @@
+"""
+Prueba de carga del control de admisión de la ingesta: uno o varios deviceId envían lotes a un ritmo fijo
+por encima de lo que la base de datos puede escribir, sin esperar respuesta ni respetar Retry-After (p.ej. un
+firmware que reintenta en bucle o un deviceId clonado), mientras otros ESPs envían a su ritmo normal.
+Se ejecuta con los límites desactivados y activados y se comparan la latencia p50/p99 de POST /api/ble-data,
+la proporción de 429/503, los Retry-After y el suggested_interval_sec, y la p99 por tramos de tiempo: sin
+límites la cola de escrituras crece mientras dure la sobrecarga y la latencia con ella; con los límites la
+latencia de los lotes admitidos se mantiene acotada.
+
+Uso: python benchmark_ingest_admission.py [--duration 20] [--hot-esps 2] [--hot-rate 60] [--normal-esps 6]
+
+Usa una base de datos temporal y un servidor Werkzeug en este mismo proceso; no toca ble_data.db.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import make_server
+
+import backend_server
+import ingest_control
+
+WINDOWS = 5   # Tramos de la duración de cada fase en los que se mide la p99
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+
+def post_batch(base_url, esp, macs, rnd, batch_size, scan_interval_sec=None):
+    """(estado HTTP, latencia ms, Retry-After, suggested_interval_sec) de un lote."""
+    payload = {"deviceId": esp, "devices": [
+        {"macAddress": rnd.choice(macs), "rssi": rnd.randrange(-100, -30), "manufacturerData": "4C000215aabb"}
+        for _ in range(batch_size)
+    ]}
+    if scan_interval_sec:
+        payload["scanIntervalSec"] = scan_interval_sec
+    request = urllib.request.Request(base_url + backend_server.API_ENDPOINT_PATH, data=json.dumps(payload).encode(),
+                                     headers={"Content-Type": "application/json"})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            status, headers, body = response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        status, headers, body = e.code, e.headers, e.read()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    retry_after = int(headers['Retry-After']) if headers.get('Retry-After') else None
+    try:
+        suggested = json.loads(body).get('suggested_interval_sec')
+    except ValueError:
+        suggested = None
+    return status, elapsed_ms, retry_after, suggested
+
+
+def run_phase(base_url, args, macs):
+    """Resultados [(clase, inicio relativo s, estado, latencia ms, Retry-After, sugerido)] de una fase."""
+    started_at = time.monotonic()
+    stop_at = started_at + args.duration
+    results = []
+    lock = threading.Lock()
+
+    def record(kind, sent_at, outcome):
+        with lock:
+            results.append((kind, sent_at - started_at) + outcome)
+
+    def hot_sender(esp, sent_at, seed):
+        record('hot', sent_at, post_batch(base_url, esp, macs, random.Random(seed), args.batch_size))
+
+    def hot_dispatcher(index):
+        # Carga abierta: un lote cada 1/hot_rate s pase lo que pase con los anteriores (sin respetar Retry-After)
+        rnd = random.Random(index)
+        esp = f"ESP_HOT_{index:02d}"
+        next_at, senders = started_at, []
+        while next_at < stop_at:
+            time.sleep(max(0.0, next_at - time.monotonic()))
+            sender = threading.Thread(target=hot_sender, args=(esp, next_at, rnd.random()))
+            sender.start()
+            senders.append(sender)
+            next_at += 1.0 / args.hot_rate
+        for sender in senders:
+            sender.join()
+
+    def normal_worker(worker):
+        # Firmware que se comporta: envía cada intervalo y respeta Retry-After y el intervalo sugerido
+        rnd = random.Random(1000 + worker)
+        esp = f"ESP_NORMAL_{worker:02d}"
+        time.sleep(rnd.random() * args.normal_interval)
+        while time.monotonic() < stop_at:
+            sent_at = time.monotonic()
+            outcome = post_batch(base_url, esp, macs, rnd, args.batch_size, args.normal_interval)
+            record('normal', sent_at, outcome)
+            _, _, retry_after, suggested = outcome
+            time.sleep(max(args.normal_interval, retry_after or 0, suggested or 0))
+
+    threads = [threading.Thread(target=hot_dispatcher, args=(i,)) for i in range(args.hot_esps)]
+    threads += [threading.Thread(target=normal_worker, args=(i,)) for i in range(args.normal_esps)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(label, results, duration):
+    """Imprime, por clase de ESP, latencias, rechazos, Retry-After, intervalo sugerido y la p99 por tramos."""
+    for kind in ('hot', 'normal'):
+        rows = [row for row in results if row[0] == kind]
+        if not rows:
+            continue
+        latencies = [row[3] for row in rows]
+        admitted = [row[3] for row in rows if row[2] == 201]
+        statuses = {}
+        for row in rows:
+            statuses[row[2]] = statuses.get(row[2], 0) + 1
+        rejected = [row for row in rows if row[2] in (429, 503)]
+        retry_afters = [row[4] for row in rejected if row[4] is not None]
+        suggested = [row[5] for row in rows if row[5] is not None]
+        windows = []
+        for i in range(WINDOWS):
+            window = [row[3] for row in rows if row[2] == 201 and i * duration / WINDOWS <= row[1] < (i + 1) * duration / WINDOWS]
+            windows.append(f"{percentile(window, 0.99):.0f}" if window else '-')
+        print(f"{label:<8}{kind:<8}{len(rows):>8}{len(admitted) / duration:>9.1f}"
+              f"{statistics.median(latencies):>9.1f}{percentile(latencies, 0.99):>10.1f}"
+              f"{statistics.median(admitted) if admitted else 0:>10.1f}{percentile(admitted, 0.99) or 0:>10.1f}"
+              f"{100.0 * statuses.get(429, 0) / len(rows):>7.1f}%{100.0 * statuses.get(503, 0) / len(rows):>7.1f}%"
+              f"{statistics.median(retry_afters) if retry_afters else 0:>8.0f}{max(retry_afters, default=0):>8}"
+              f"{statistics.median(suggested) if suggested else 0:>8.0f}{max(suggested, default=0):>8}"
+              f"   {' / '.join(windows)}   {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--hot-esps', type=int, default=2, help='deviceIds sobrecargados')
+    parser.add_argument('--hot-rate', type=float, default=60, help='Lotes/segundo enviados por cada deviceId sobrecargado')
+    parser.add_argument('--normal-esps', type=int, default=6)
+    parser.add_argument('--normal-interval', type=float, default=1.0, help='Segundos entre lotes de los ESPs normales')
+    parser.add_argument('--batch-size', type=int, default=20)
+    parser.add_argument('--rate-per-esp', type=float, default=backend_server.INGEST_RATE_PER_ESP)
+    parser.add_argument('--burst-per-esp', type=int, default=backend_server.INGEST_BURST_PER_ESP)
+    parser.add_argument('--max-in-flight', type=int, default=backend_server.INGEST_MAX_IN_FLIGHT)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ble_bench_')
+    backend_server.DATABASE_NAME = os.path.join(workdir, 'ble_data.db')
+    backend_server.app.logger.setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    macs = [f"AA:BB:CC:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}" for i in range(5000)]
+
+    backend_server.storage_backend.init()
+    server = make_server('127.0.0.1', 0, backend_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    phases = []
+    for limiting in (False, True):
+        if limiting:
+            controller = ingest_control.IngestController(
+                rate_per_esp=args.rate_per_esp, burst_per_esp=args.burst_per_esp, max_in_flight=args.max_in_flight,
+                target_write_ms=backend_server.INGEST_TARGET_WRITE_MS, max_interval_sec=backend_server.INGEST_MAX_SUGGESTED_INTERVAL_SEC
+            )
+        else:
+            # Sin límites: todo lote entra en la cola de escrituras
+            controller = ingest_control.IngestController(
+                rate_per_esp=1e9, burst_per_esp=1e9, max_in_flight=10 ** 9,
+                target_write_ms=backend_server.INGEST_TARGET_WRITE_MS, max_interval_sec=backend_server.INGEST_MAX_SUGGESTED_INTERVAL_SEC
+            )
+        backend_server.ingest_controller = controller
+        phases.append(('on' if limiting else 'off', run_phase(base_url, args, macs), controller.stats()))
+    server.shutdown()
+
+    print(f"\nDuración por fase: {args.duration} s, deviceIds sobrecargados: {args.hot_esps} a {args.hot_rate} lotes/s, "
+          f"ESPs normales: {args.normal_esps} (cada {args.normal_interval} s), lotes de {args.batch_size} dispositivos")
+    print(f"Límites: {args.rate_per_esp} lotes/s por ESP, ráfaga {args.burst_per_esp}, {args.max_in_flight} escrituras en curso")
+    print(f"{'límites':<8}{'ESPs':<8}{'lotes':>8}{'adm/s':>9}{'p50 ms':>9}{'p99 ms':>10}{'p50 adm':>10}{'p99 adm':>10}"
+          f"{'429':>8}{'503':>8}{'RA p50':>8}{'RA max':>8}{'sug p50':>8}{'sug max':>8}   p99 adm por tramo (ms)   estados")
+    for label, results, _ in phases:
+        summarize(label, results, args.duration)
+    for label, _, stats in phases:
+        print(f"Control de admisión ({label}): {json.dumps(stats)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark de la réplica de lectura: latencia de la ingesta (POST /api/ble-data) mientras varios clientes
+cargan el dashboard con consultas analíticas pesadas, con SNAPSHOT_ENABLED desactivado y activado.
+
+Uso: python benchmark_snapshot.py [--rows 300000] [--duration 20] [--ingest-clients 8] [--dashboard-clients 4]
+
+Usa una base de datos temporal y un servidor Werkzeug en este mismo proceso; no toca ble_data.db.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from werkzeug.serving import make_server
+
+import backend_server
+import ingest_control
+
+DASHBOARD_URLS = [
+    '/api/manufacturer-analysis?topN=7&startDate=2000-01-01&endDate=2100-01-01',
+    '/api/peak-activity-hours?startDate=2000-01-01&endDate=2100-01-01&exact=true',
+    '/api/distinct-devices?group_by=esp&exact=true',
+    '/api/device-activity/{mac}?granularity=daily_week',
+    '/api/unique-devices?page_size=100&sort_by=adv_packets_count',
+    '/api/overview?exact=true',
+]
+
+
+def seed_database(rows, esps, macs):
+    """Detecciones históricas insertadas directamente (más rápido que pasar por la API)."""
+    conn = sqlite3.connect(backend_server.DATABASE_NAME)
+    rnd = random.Random(7)
+    start = time.time() - 30 * 86400
+    conn.executemany(
+        "INSERT INTO scanned_devices (timestamp, esp_device_id, ble_mac_address, ble_rssi, manufacturer_data, company_id) "
+        "VALUES (datetime(?, 'unixepoch'), ?, ?, ?, ?, ?)",
+        ((start + i * 30 * 86400 / rows, rnd.choice(esps), rnd.choice(macs), rnd.randrange(-100, -30),
+          '4C000215aabb', 0x004C) for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+
+def run_phase(base_url, duration, ingest_clients, dashboard_clients, macs):
+    stop_at = time.monotonic() + duration
+    ingest_latencies, dashboard_latencies = [], []
+    statuses = {}
+    lock = threading.Lock()
+
+    def ingest_worker(worker):
+        rnd = random.Random(worker)
+        esp = f"ESP_BENCH_{worker:02d}"
+        while time.monotonic() < stop_at:
+            body = json.dumps({"deviceId": esp, "devices": [
+                {"macAddress": rnd.choice(macs), "rssi": rnd.randrange(-100, -30), "manufacturerData": "4C000215aabb"}
+                for _ in range(20)
+            ]}).encode()
+            request = urllib.request.Request(base_url + backend_server.API_ENDPOINT_PATH, data=body,
+                                             headers={"Content-Type": "application/json"})
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with lock:
+                ingest_latencies.append(elapsed_ms)
+                statuses[status] = statuses.get(status, 0) + 1
+            time.sleep(0.2)
+
+    def dashboard_worker(worker):
+        rnd = random.Random(1000 + worker)
+        while time.monotonic() < stop_at:
+            url = rnd.choice(DASHBOARD_URLS).format(mac=rnd.choice(macs))
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + url, timeout=60) as response:
+                    response.read()
+            except urllib.error.HTTPError:
+                pass
+            with lock:
+                dashboard_latencies.append((time.perf_counter() - started) * 1000)
+
+    threads = [threading.Thread(target=ingest_worker, args=(i,)) for i in range(ingest_clients)]
+    threads += [threading.Thread(target=dashboard_worker, args=(i,)) for i in range(dashboard_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ingest_latencies, dashboard_latencies, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--ingest-clients', type=int, default=8)
+    parser.add_argument('--dashboard-clients', type=int, default=4)
+    parser.add_argument('--snapshot-interval', type=float, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ble_bench_')
+    backend_server.DATABASE_NAME = os.path.join(workdir, 'ble_data.db')
+    # Sin límites de admisión: se mide la latencia de escritura, no el rechazo
+    backend_server.ingest_controller = ingest_control.IngestController(rate_per_esp=1000, burst_per_esp=1000, max_in_flight=1000)
+    backend_server.app.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    macs = [f"AA:BB:CC:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}" for i in range(5000)]
+
+    backend_server.storage_backend.init()
+    seed_database(args.rows, [f"ESP_HIST_{i}" for i in range(6)], macs)
+    server = make_server('127.0.0.1', 0, backend_server.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = []
+    for snapshot_enabled in (False, True):
+        backend_server.SNAPSHOT_ENABLED = snapshot_enabled
+        if snapshot_enabled:
+            backend_server.snapshot_replicator.interval_sec = args.snapshot_interval
+            backend_server.init_snapshots()
+        ingest, dashboard, statuses = run_phase(base_url, args.duration, args.ingest_clients, args.dashboard_clients, macs)
+        results.append((snapshot_enabled, ingest, dashboard, statuses))
+    server.shutdown()
+
+    print(f"\nFilas históricas: {args.rows}, duración por fase: {args.duration} s, "
+          f"clientes de ingesta: {args.ingest_clients}, clientes del dashboard: {args.dashboard_clients}")
+    print(f"{'snapshot':<10}{'lotes':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'consultas':>11}{'p50 consulta ms':>17}  estados")
+    for snapshot_enabled, ingest, dashboard, statuses in results:
+        print(f"{'on' if snapshot_enabled else 'off':<10}{len(ingest):>8}{statistics.median(ingest):>10.1f}"
+              f"{percentile(ingest, 0.95):>10.1f}{percentile(ingest, 0.99):>10.1f}{max(ingest):>10.1f}"
+              f"{len(dashboard):>11}{statistics.median(dashboard) if dashboard else 0:>17.1f}  {statuses}")
+    print(f"Réplicas: {json.dumps(backend_server.snapshot_replicator.stats()['replicas'], ensure_ascii=False)}")
+
+
+if __name__ == '__main__':
+    main()
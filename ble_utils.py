@@ -224,6 +224,18 @@ def parse_manufacturer_data(hex_string):
     except Exception:
         return "N/A (General Error)", hex_string, "N/A"
 
+def extract_company_id(hex_string):
+    """
+    Extrae el Company ID (entero de 16 bits, little-endian) del manufacturer_data hexadecimal.
+    Devuelve None si el dato no es válido. Ejemplo: "4C000215..." -> 76 (0x004C)
+    """
+    if not hex_string or not isinstance(hex_string, str) or len(hex_string) < 4:
+        return None
+    try:
+        return int(hex_string[2:4] + hex_string[0:2], 16)
+    except ValueError:
+        return None
+
 def get_service_uuid_name(uuid_str):
     """Retorna el nombre conocido de un Service UUID, o el mismo UUID si no se conoce."""
     return SERVICE_UUIDS_NAMES.get(uuid_str.lower(), uuid_str)
@@ -0,0 +1,198 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+import sketches
+
+# Duración de cada ventana: dos MACs vistas por el mismo ESP en la misma ventana "coinciden"
+DEFAULT_WINDOW_SEC = 60
+# Compañeros guardados por MAC (lista top-K acotada)
+DEFAULT_NEIGHBORS_PER_MAC = 32
+# MACs con lista de compañeros; por encima se descartan las que llevan más tiempo sin verse
+DEFAULT_MAX_MACS = 50000
+# MACs por ventana que se cruzan entre sí (las de RSSI más fuerte): acota el coste cuadrático de cada ventana
+DEFAULT_MAX_WINDOW_DEVICES = 64
+# Cada cuánto se dividen entre dos todos los recuentos: las coincidencias antiguas pierden peso
+DEFAULT_HALF_LIFE_SEC = 7 * 86400
+# Contadores por fila del sketch de pares (4 filas de 2^19 contadores de 32 bits: 8 MiB)
+DEFAULT_SKETCH_WIDTH = 1 << 19
+
+
+class _MacStats:
+    __slots__ = ('windows', 'neighbors', 'floor')
+
+    def __init__(self):
+        self.windows = 0
+        self.neighbors = {}   # mac -> [ventanas compartidas estimadas, última ventana compartida]
+        self.floor = 0        # Cota inferior del menor recuento de la lista llena (evita recorrerla en cada par)
+
+
+class CooccurrenceIndex:
+    """
+    Índice de coincidencias ("vistos juntos") mantenido en la ingesta. Las detecciones de cada ESP se
+    agrupan en ventanas de window_sec y, al cerrarse una ventana, cada par de MACs de su conjunto suma
+    una ventana compartida en un sketch Count-Min de pares (memoria fija). Cada MAC guarda solo sus
+    neighbors_per_mac compañeros de mayor recuento: un par entra en la lista cuando su estimación supera
+    a la del último de ella, así que el ruido de una sola coincidencia no desplaza a los habituales.
+    """
+
+    def __init__(self, window_sec=DEFAULT_WINDOW_SEC, neighbors_per_mac=DEFAULT_NEIGHBORS_PER_MAC,
+                 max_macs=DEFAULT_MAX_MACS, max_window_devices=DEFAULT_MAX_WINDOW_DEVICES,
+                 half_life_sec=DEFAULT_HALF_LIFE_SEC, sketch_width=DEFAULT_SKETCH_WIDTH):
+        self.window_sec = window_sec
+        self.neighbors_per_mac = neighbors_per_mac
+        self.max_macs = max_macs
+        self.max_window_devices = max_window_devices
+        self.half_life_sec = half_life_sec
+        self._sketch_width = sketch_width
+        self._lock = threading.Lock()
+        self._pairs = sketches.CountMinSketch(width=sketch_width)
+        self._open = {}              # esp_id -> (inicio de la ventana, {mac: mejor RSSI})
+        self._macs = OrderedDict()   # mac -> _MacStats, de la vista hace más tiempo a la más reciente
+        self._next_decay = None
+        self._windows_closed = 0
+        self._windows_truncated = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._macs)
+
+    def observe_batch(self, esp_id, observations, seen_at=None):
+        """observations: iterable de tuplas (mac, rssi) vistas por esp_id en seen_at."""
+        seen_at = seen_at if seen_at is not None else time.time()
+        window_start = seen_at - seen_at % self.window_sec
+        with self._lock:
+            self._close_windows_locked(window_start)
+            current = self._open.get(esp_id)
+            if current is None or current[0] < window_start:
+                current = self._open[esp_id] = (window_start, {})
+            elif current[0] > window_start:
+                # Detección de una ventana ya cerrada (p.ej. fuera de orden durante la reconstrucción): se ignora
+                return
+            devices = current[1]
+            for mac, rssi in observations:
+                rssi = rssi if rssi is not None else -128
+                if rssi > devices.get(mac, -129):
+                    devices[mac] = rssi
+
+    def _close_windows_locked(self, now_window_start):
+        for esp_id, (window_start, devices) in list(self._open.items()):
+            if window_start < now_window_start:
+                del self._open[esp_id]
+                self._add_window_locked(window_start, devices)
+
+    def _add_window_locked(self, window_start, devices):
+        if self._next_decay is None:
+            self._next_decay = window_start + self.half_life_sec
+        elif window_start >= self._next_decay:
+            self._decay_locked()
+            self._next_decay = window_start + self.half_life_sec
+        self._windows_closed += 1
+        macs = list(devices)
+        if len(macs) > self.max_window_devices:
+            self._windows_truncated += 1
+            macs = heapq.nlargest(self.max_window_devices, macs, key=devices.get)
+        macs.sort()
+        stats_by_mac = []
+        for mac in macs:
+            stats = self._macs.get(mac)
+            if stats is None:
+                stats = self._macs[mac] = _MacStats()
+            else:
+                self._macs.move_to_end(mac)
+            stats.windows += 1
+            stats_by_mac.append(stats)
+        for i, mac in enumerate(macs):
+            for j in range(i + 1, len(macs)):
+                other = macs[j]
+                shared = self._pairs.add(mac + '|' + other)
+                self._offer_locked(stats_by_mac[i], other, shared, window_start)
+                self._offer_locked(stats_by_mac[j], mac, shared, window_start)
+        while len(self._macs) > self.max_macs:
+            self._macs.popitem(last=False)
+            self._evictions += 1
+
+    def _offer_locked(self, stats, mac, shared, window_start):
+        neighbors = stats.neighbors
+        entry = neighbors.get(mac)
+        if entry is not None:
+            entry[0] = shared
+            entry[1] = window_start
+            return
+        if len(neighbors) < self.neighbors_per_mac:
+            neighbors[mac] = [shared, window_start]
+            return
+        if shared <= stats.floor:
+            return
+        weakest = min(neighbors, key=lambda other: neighbors[other][0])
+        weakest_shared = neighbors[weakest][0]
+        if shared <= weakest_shared:
+            stats.floor = weakest_shared
+            return
+        del neighbors[weakest]
+        neighbors[mac] = [shared, window_start]
+        stats.floor = min(entry[0] for entry in neighbors.values())
+
+    def _decay_locked(self):
+        self._pairs.halve()
+        for stats in self._macs.values():
+            stats.windows //= 2
+            stats.floor //= 2
+            for entry in stats.neighbors.values():
+                entry[0] //= 2
+
+    def flush(self, now=None):
+        """Cierra las ventanas anteriores a la actual (p.ej. de ESPs que han dejado de enviar)."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._close_windows_locked(now - now % self.window_sec)
+
+    def companions(self, mac, limit=10, min_shared=1):
+        """
+        (ventanas de la MAC, compañeros): dicts con mac, shared_windows (estimación del sketch, nunca por
+        debajo del valor real), score (Jaccard entre las ventanas de ambas MACs) y last_seen_together_epoch,
+        por score descendente. Solo cuentan las ventanas ya cerradas. (0, []) si la MAC no está en el índice.
+        """
+        with self._lock:
+            stats = self._macs.get(mac)
+            if stats is None:
+                return 0, []
+            result = []
+            for other, (shared, last_window) in stats.neighbors.items():
+                if shared < min_shared:
+                    continue
+                other_stats = self._macs.get(other)
+                other_windows = other_stats.windows if other_stats is not None else shared
+                # La estimación del par puede superar ligeramente las ventanas de alguna de las MACs
+                shared = min(shared, stats.windows, other_windows)
+                result.append({
+                    "mac": other,
+                    "shared_windows": shared,
+                    "score": round(shared / max(1, stats.windows + other_windows - shared), 4),
+                    "last_seen_together_epoch": last_window,
+                })
+            result.sort(key=lambda item: (-item["score"], -item["shared_windows"], item["mac"]))
+            return stats.windows, result[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "macs": len(self._macs),
+                "neighbor_entries": sum(len(stats.neighbors) for stats in self._macs.values()),
+                "open_windows": len(self._open),
+                "windows_closed": self._windows_closed,
+                "windows_truncated": self._windows_truncated,
+                "evicted_macs": self._evictions,
+                "pair_increments": self._pairs.total,
+                "window_sec": self.window_sec,
+                "neighbors_per_mac": self.neighbors_per_mac,
+                "max_macs": self.max_macs,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._open.clear()
+            self._macs.clear()
+            self._pairs = sketches.CountMinSketch(width=self._sketch_width)
+            self._next_decay = None
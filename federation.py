@@ -0,0 +1,240 @@
+import base64
+import json
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import sketches
+
+# Versión del formato de /api/federation/summary: el agregador descarta los resúmenes de otra versión
+SUMMARY_VERSION = 1
+SUMMARY_PATH = '/api/federation/summary'
+TOKEN_HEADER = 'X-Federation-Token'
+HOUR_KEYS = frozenset(f"{hour:02d}" for hour in range(24))
+
+
+class FederationError(Exception):
+    """Una sede no ha devuelto un resumen válido."""
+
+
+def encode_blob(blob):
+    return base64.b64encode(blob).decode('ascii')
+
+
+def decode_blob(text):
+    return base64.b64decode(text)
+
+
+def validate_summary(summary):
+    """
+    Decodifica y comprueba cada sketch de un resumen (tamaño de los HyperLogLog y del histograma de RSSI,
+    24 horas de advertisements, pares de fabricantes). FederationError si algo no cuadra: un resumen así no
+    debe cachearse como válido ni llegar a merge_summaries.
+    """
+    try:
+        sketches.HyperLogLog.from_bytes(decode_blob(summary["unique_devices"]))
+        by_hour = summary["unique_devices_by_hour"]
+        if not isinstance(by_hour, dict):
+            raise ValueError("unique_devices_by_hour must be an object")
+        for hour, blob in by_hour.items():
+            if hour not in HOUR_KEYS:
+                raise ValueError(f"Invalid hour key '{hour}'")
+            sketches.HyperLogLog.from_bytes(decode_blob(blob))
+        advertisements = summary["advertisements_by_hour"]
+        if not isinstance(advertisements, list) or len(advertisements) != 24 or \
+                not all(isinstance(count, int) and not isinstance(count, bool) and count >= 0 for count in advertisements):
+            raise ValueError("advertisements_by_hour must be 24 non-negative integers")
+        sketches.ValueHistogram().merge(sketches.ValueHistogram.from_bytes(decode_blob(summary["rssi_histogram"])))
+        for label, count in summary["manufacturers"]:
+            if not isinstance(label, str) or not isinstance(count, int) or isinstance(count, bool):
+                raise ValueError("manufacturers must be [label, count] pairs")
+    except (KeyError, TypeError, ValueError, IndexError, zlib.error) as e:
+        raise FederationError(f"Invalid summary: {e}") from e
+
+
+class _SiteState:
+    __slots__ = ('name', 'url', 'summaries', 'last_success_at', 'last_attempt_at', 'last_error', 'failures',
+                 'last_fetch_ms', 'fetches', 'fetch_lock')
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.summaries = OrderedDict()   # clave del rango -> (epoch de la descarga, resumen), la más reciente al final
+        self.last_success_at = None
+        self.last_attempt_at = None
+        self.last_error = None
+        self.failures = 0                # Fallos consecutivos
+        self.last_fetch_ms = None
+        self.fetches = 0
+        self.fetch_lock = threading.Lock()   # Una descarga a la vez por sede; las peticiones simultáneas la esperan
+
+
+class FederationAggregator:
+    """
+    Vista agregada de varias instancias del backend (una por sede). Pide en paralelo a cada sede su resumen
+    (SUMMARY_PATH) y lo guarda cache_sec por rango de fechas; si una sede no responde se sigue usando su
+    último resumen de ese rango, con su antigüedad (staleness_sec). sites: {nombre: URL base}; una URL None
+    es esta misma instancia y se resuelve con local_fetch(params) sin pasar por HTTP. Solo viajan resúmenes
+    mergeables, nunca filas: ver merge_summaries.
+    """
+
+    def __init__(self, sites, cache_sec=60, timeout_sec=10, token=None, local_fetch=None, max_cached_ranges=32):
+        self.cache_sec = cache_sec
+        self.timeout_sec = timeout_sec
+        self.token = token
+        self.local_fetch = local_fetch
+        self.max_cached_ranges = max_cached_ranges
+        self._sites = {name: _SiteState(name, url.rstrip('/') if url else None) for name, url in sites.items()}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, min(16, len(self._sites))), thread_name_prefix='federation')
+
+    def site_names(self):
+        return list(self._sites)
+
+    def collect(self, params, now=None):
+        """
+        Resumen de cada sede para params ({startDate, endDate}), descargando en paralelo los que faltan o han
+        caducado. Lista de dicts con site, ok, error, from_cache, fetched_at, staleness_sec y summary (None si
+        la sede nunca ha respondido para este rango).
+        """
+        key = tuple(sorted(params.items()))
+        futures = [self._executor.submit(self._site_summary, site, params, key) for site in self._sites.values()]
+        results = [future.result() for future in futures]
+        now = now if now is not None else time.time()
+        for result in results:
+            fetched_at = result["fetched_at"]
+            result["staleness_sec"] = round(max(0.0, now - fetched_at), 1) if fetched_at is not None else None
+        return results
+
+    def _site_summary(self, site, params, key):
+        cached = self._cached(site, key)
+        if cached is not None and time.time() - cached[0] < self.cache_sec:
+            return self._result(site, cached, ok=True, from_cache=True)
+        with site.fetch_lock:
+            # Otra petición puede haberlo descargado mientras se esperaba el lock
+            cached = self._cached(site, key)
+            if cached is not None and time.time() - cached[0] < self.cache_sec:
+                return self._result(site, cached, ok=True, from_cache=True)
+            started = time.time()
+            try:
+                summary = self._fetch(site, params)
+            except (FederationError, OSError, ValueError) as e:
+                with self._lock:
+                    site.last_attempt_at = started
+                    site.last_error = str(e)
+                    site.failures += 1
+                    site.fetches += 1
+                return self._result(site, cached, ok=False, from_cache=cached is not None, error=str(e))
+            entry = (started, summary)
+            with self._lock:
+                site.summaries[key] = entry
+                site.summaries.move_to_end(key)
+                while len(site.summaries) > self.max_cached_ranges:
+                    site.summaries.popitem(last=False)
+                site.last_attempt_at = site.last_success_at = started
+                site.last_error = None
+                site.failures = 0
+                site.fetches += 1
+                site.last_fetch_ms = round((time.time() - started) * 1000, 1)
+            return self._result(site, entry, ok=True, from_cache=False)
+
+    def _cached(self, site, key):
+        with self._lock:
+            return site.summaries.get(key)
+
+    @staticmethod
+    def _result(site, entry, ok, from_cache, error=None):
+        return {
+            "site": site.name,
+            "ok": ok,
+            "error": error,
+            "from_cache": from_cache,
+            "fetched_at": entry[0] if entry is not None else None,
+            "summary": entry[1] if entry is not None else None,
+        }
+
+    def _fetch(self, site, params):
+        if site.url is None:
+            if self.local_fetch is None:
+                raise FederationError("No local summary function configured")
+            summary = self.local_fetch(params)
+        else:
+            url = f"{site.url}{SUMMARY_PATH}?{urllib.parse.urlencode(params)}"
+            headers = {'Accept': 'application/json'}
+            if self.token:
+                headers[TOKEN_HEADER] = self.token
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=self.timeout_sec) as response:
+                    summary = json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                raise FederationError(f"HTTP {e.code} from {site.url}") from e
+        if not isinstance(summary, dict) or summary.get("version") != SUMMARY_VERSION:
+            raise FederationError(f"Unsupported summary version from site '{site.name}'")
+        validate_summary(summary)
+        return summary
+
+    def stats(self, now=None):
+        now = now if now is not None else time.time()
+        with self._lock:
+            return {
+                "cache_sec": self.cache_sec,
+                "sites": [{
+                    "site": site.name,
+                    "url": site.url,
+                    "cached_ranges": len(site.summaries),
+                    "fetches": site.fetches,
+                    "consecutive_failures": site.failures,
+                    "last_error": site.last_error,
+                    "last_fetch_ms": site.last_fetch_ms,
+                    "last_success_at": site.last_success_at,
+                    "since_last_success_sec": round(now - site.last_success_at, 1) if site.last_success_at is not None else None,
+                } for site in self._sites.values()],
+            }
+
+
+def merge_summaries(summaries, top_n=7, percents=(10, 50, 90)):
+    """
+    Une los resúmenes de varias sedes. Dispositivos distintos (total y por hora del día local de cada sede):
+    unión de los HyperLogLog, así que un dispositivo visto en varias sedes cuenta una vez. Advertisements por
+    hora e histograma de RSSI: suma. Fabricantes: suma de los dispositivos de cada sede (un dispositivo visto
+    en dos sedes cuenta en ambas), Top-N más 'Otros'.
+    """
+    unique = sketches.HyperLogLog()
+    by_hour = defaultdict(sketches.HyperLogLog)
+    advertisements_by_hour = [0] * 24
+    rssi = sketches.ValueHistogram()
+    manufacturers = defaultdict(int)
+    for summary in summaries:
+        unique.merge_bytes(decode_blob(summary["unique_devices"]))
+        for hour, blob in summary["unique_devices_by_hour"].items():
+            by_hour[hour].merge_bytes(decode_blob(blob))
+        for hour, count in enumerate(summary["advertisements_by_hour"]):
+            advertisements_by_hour[hour] += count
+        rssi.merge_bytes(decode_blob(summary["rssi_histogram"]))
+        for label, count in summary["manufacturers"]:
+            manufacturers[label] += count
+    # 'Otros' de cada sede (fabricantes fuera de su Top) se suma al 'Otros' agregado
+    others = manufacturers.pop('Otros', 0)
+    ranked = sorted(manufacturers.items(), key=lambda item: (-item[1], item[0]))
+    others += sum(count for _, count in ranked[top_n:])
+    ranked = ranked[:top_n]
+    if others:
+        ranked.append(('Otros', others))
+    hours = [f"{hour:02d}" for hour in range(24)]
+    return {
+        "unique_devices": unique.estimate(),
+        "peak_hours": {
+            "labels": [f"{hour}:00" for hour in hours],
+            "data": [by_hour[hour].estimate() if hour in by_hour else 0 for hour in hours],
+            "advertisements": advertisements_by_hour,
+        },
+        "manufacturers": {"labels": [label for label, _ in ranked], "data": [count for _, count in ranked]},
+        "rssi_percentiles": dict(zip((f"p{percent:g}" for percent in percents), rssi.percentiles(list(percents)))),
+        "advertisements": rssi.total(),
+        "relative_std_error": round(sketches.HLL_RELATIVE_STD_ERROR, 4),
+    }
@@ -0,0 +1,101 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Bytes del payload de fabricante (tras el Company ID) que se consideran estables.
+# En Apple Continuity, por ejemplo, los dos primeros bytes son tipo y longitud del mensaje.
+MFG_PAYLOAD_PREFIX_BYTES = 2
+
+# Máscara de 52 bits: los cluster_id caben en un Number de JavaScript sin perder precisión.
+CLUSTER_ID_MASK = (1 << 52) - 1
+
+ADDRESS_TYPE_PUBLIC = 'public'
+ADDRESS_TYPE_RANDOM_STATIC = 'random_static'
+ADDRESS_TYPE_RANDOM_RESOLVABLE = 'random_resolvable'
+ADDRESS_TYPE_RANDOM_NON_RESOLVABLE = 'random_non_resolvable'
+
+
+def classify_address(mac_address):
+    """
+    Clasifica una MAC BLE a partir de sus bits más significativos.
+    El firmware no envía el tipo de dirección, así que es una heurística:
+    - 11xxxxxx: aleatoria estática.
+    - 01xxxxxx: aleatoria privada resoluble (RPA, rota cada pocos minutos).
+    - bit U/L (0x02) activo: aleatoria no resoluble.
+    - resto: pública (OUI asignado por el IEEE).
+    """
+    try:
+        first_octet = int(mac_address[0:2], 16)
+    except (ValueError, TypeError):
+        return ADDRESS_TYPE_PUBLIC
+    top_bits = first_octet >> 6
+    if top_bits == 0b11:
+        return ADDRESS_TYPE_RANDOM_STATIC
+    if top_bits == 0b01:
+        return ADDRESS_TYPE_RANDOM_RESOLVABLE
+    if first_octet & 0x02:
+        return ADDRESS_TYPE_RANDOM_NON_RESOLVABLE
+    return ADDRESS_TYPE_PUBLIC
+
+
+def _hash_to_cluster_id(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & CLUSTER_ID_MASK
+
+
+def compute_cluster(mac_address, manufacturer_data, service_uuids, appearance, tx_power):
+    """
+    Calcula (cluster_id, address_type) para una advertisement.
+    Las direcciones públicas y estáticas son identidades estables: su cluster es la propia MAC.
+    Las rotativas se agrupan por un hash de las partes estables del anuncio; si no hay
+    ninguna parte estable se usa la MAC para no fusionar dispositivos sin relación.
+    """
+    address_type = classify_address(mac_address)
+    mac_key = mac_address.upper()
+    if address_type in (ADDRESS_TYPE_PUBLIC, ADDRESS_TYPE_RANDOM_STATIC):
+        return _hash_to_cluster_id(f"mac|{mac_key}"), address_type
+
+    mfg_part = ''
+    if manufacturer_data and isinstance(manufacturer_data, str) and len(manufacturer_data) >= 4:
+        mfg_part = manufacturer_data[:4 + 2 * MFG_PAYLOAD_PREFIX_BYTES].upper()
+    uuids_part = ''
+    if service_uuids:
+        uuids_part = ','.join(sorted({str(u).lower() for u in service_uuids}))
+    appearance_part = '' if appearance is None else str(appearance)
+    tx_part = '' if tx_power is None else str(tx_power)
+
+    if not (mfg_part or uuids_part or appearance_part):
+        return _hash_to_cluster_id(f"mac|{mac_key}"), address_type
+    return _hash_to_cluster_id(f"fp|{mfg_part}|{uuids_part}|{appearance_part}|{tx_part}"), address_type
+
+
+class FingerprintIndex:
+    """
+    Caché acotada (LRU) MAC -> cluster_id. Evita recalcular el hash y reescribir la
+    asignación en la BD para MACs ya vistas; la tabla mac_clusters es la fuente de verdad.
+    """
+
+    def __init__(self, max_macs=100000):
+        self.max_macs = max_macs
+        self._lock = threading.Lock()
+        self._mac_to_cluster = OrderedDict()
+
+    def get(self, mac_address):
+        with self._lock:
+            cluster_id = self._mac_to_cluster.get(mac_address)
+            if cluster_id is not None:
+                self._mac_to_cluster.move_to_end(mac_address)
+            return cluster_id
+
+    def remember(self, assignments):
+        """assignments: iterable de (mac, cluster_id). Llamar solo tras confirmar la transacción."""
+        with self._lock:
+            for mac_address, cluster_id in assignments:
+                self._mac_to_cluster[mac_address] = cluster_id
+                self._mac_to_cluster.move_to_end(mac_address)
+            while len(self._mac_to_cluster) > self.max_macs:
+                self._mac_to_cluster.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._mac_to_cluster.clear()
@@ -0,0 +1,336 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+ADMIT = 'admit'
+REJECT_RATE_LIMITED = 'rate_limited'   # HTTP 429: el ESP envía más rápido de lo permitido
+REJECT_OVERLOADED = 'overloaded'       # HTTP 503: demasiadas escrituras en curso
+
+# Peso de cada nueva muestra en las medias móviles exponenciales (latencia e intervalo entre envíos)
+EWMA_ALPHA = 0.2
+
+
+class TokenBucket:
+    """Cubo de tokens de un ESP: 'rate' lotes/segundo sostenidos con ráfagas de hasta 'burst'."""
+    __slots__ = ('tokens', 'updated_at', 'last_arrival', 'interval_ewma')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated_at = now
+        self.last_arrival = None
+        self.interval_ewma = None
+
+
+class IngestController:
+    """
+    Control de admisión de la ingesta. Mantiene un cubo de tokens por deviceId, el número de
+    escrituras en curso (incluidas las que esperan el lock del shard) y la latencia media de escritura.
+    Con esa carga decide si admitir un lote, cuánto debe esperar el ESP (Retry-After) y qué
+    intervalo de envío sugerirle para que la cola no siga creciendo.
+    """
+
+    def __init__(self, rate_per_esp=1.0, burst_per_esp=5, max_in_flight=16, target_write_ms=200,
+                 default_interval_sec=10, max_interval_sec=300):
+        self.rate_per_esp = rate_per_esp
+        self.burst_per_esp = burst_per_esp
+        self.max_in_flight = max_in_flight
+        self.target_write_sec = target_write_ms / 1000.0
+        self.default_interval_sec = default_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._in_flight = 0
+        self._write_latency_ewma = 0.0
+        self._last_write_at = None     # Fin de la última escritura (monotonic)
+        self._admitted = 0
+        self._rejected = {REJECT_RATE_LIMITED: 0, REJECT_OVERLOADED: 0}
+
+    def try_acquire(self, esp_device_id, now=None):
+        """
+        Devuelve (decisión, retry_after_sec). Si la decisión es ADMIT el llamante debe invocar
+        release() al terminar la escritura, haya ido bien o no.
+        """
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(esp_device_id)
+            if bucket is None:
+                bucket = self._buckets[esp_device_id] = TokenBucket(self.burst_per_esp, now)
+            bucket.tokens = min(self.burst_per_esp, bucket.tokens + (now - bucket.updated_at) * self.rate_per_esp)
+            bucket.updated_at = now
+
+            if bucket.tokens < 1.0:
+                self._rejected[REJECT_RATE_LIMITED] += 1
+                return REJECT_RATE_LIMITED, max(1, math.ceil((1.0 - bucket.tokens) / self.rate_per_esp))
+            if self._in_flight >= self.max_in_flight:
+                self._rejected[REJECT_OVERLOADED] += 1
+                return REJECT_OVERLOADED, self._drain_time_locked()
+            bucket.tokens -= 1.0
+            # Intervalo real entre lotes admitidos (los reintentos rechazados no cuentan)
+            if bucket.last_arrival is not None:
+                gap = now - bucket.last_arrival
+                bucket.interval_ewma = gap if bucket.interval_ewma is None else (1 - EWMA_ALPHA) * bucket.interval_ewma + EWMA_ALPHA * gap
+            bucket.last_arrival = now
+            self._in_flight += 1
+            self._admitted += 1
+            return ADMIT, 0
+
+    def release(self, write_duration_sec):
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+            self._write_latency_ewma = (1 - EWMA_ALPHA) * self._write_latency_ewma + EWMA_ALPHA * write_duration_sec
+            self._last_write_at = time.monotonic()
+
+    def idle_sec(self, now=None):
+        """Segundos sin escrituras de la ingesta: 0 si hay alguna en curso, infinito si aún no ha habido ninguna."""
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            if self._in_flight:
+                return 0.0
+            return now - self._last_write_at if self._last_write_at is not None else math.inf
+
+    def _drain_time_locked(self):
+        """Segundos estimados para vaciar la cola actual de escrituras."""
+        drain = self._in_flight * max(self._write_latency_ewma, self.target_write_sec)
+        return min(self.max_interval_sec, max(1, math.ceil(drain)))
+
+    def _load_factor_locked(self):
+        """>1 cuando la cola o la latencia superan los objetivos configurados."""
+        return max(self._in_flight / self.max_in_flight, self._write_latency_ewma / self.target_write_sec)
+
+    def suggested_interval_sec(self, esp_device_id, configured_interval_sec=None):
+        """
+        Intervalo de envío sugerido al ESP: el que tiene configurado (o, si no lo informa, el
+        observado) mientras la carga es normal, ampliado proporcionalmente a la carga cuando la
+        cola o la latencia superan el objetivo. Partir del configurado evita que la sugerencia se
+        realimente: al bajar la carga el ESP vuelve a su intervalo original.
+        """
+        with self._lock:
+            bucket = self._buckets.get(esp_device_id)
+            if configured_interval_sec:
+                interval = configured_interval_sec
+            elif bucket is not None and bucket.interval_ewma:
+                interval = bucket.interval_ewma
+            else:
+                interval = self.default_interval_sec
+            load = self._load_factor_locked()
+            if load > 1.0:
+                interval *= load
+            return min(self.max_interval_sec, max(1, math.ceil(interval)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "write_latency_ms": round(self._write_latency_ewma * 1000, 1),
+                "target_write_ms": round(self.target_write_sec * 1000, 1),
+                "load_factor": round(self._load_factor_locked(), 3),
+                "admitted": self._admitted,
+                "rejected_rate_limited": self._rejected[REJECT_RATE_LIMITED],
+                "rejected_overloaded": self._rejected[REJECT_OVERLOADED],
+                "tracked_esps": len(self._buckets),
+            }
+
+
+# --- Detección de lotes repetidos por número de secuencia ---
+BATCH_NEW = 'new'
+BATCH_DUPLICATE = 'duplicate'
+BATCH_IN_PROGRESS = 'in_progress'   # El mismo lote se está escribiendo en otra petición
+
+SEQUENCE_WINDOW_SIZE = 64
+
+
+class SequenceWindow:
+    """
+    Ventana anti-repetición de un ESP (como la de IPsec): la secuencia más alta confirmada y un
+    bitmap de las SEQUENCE_WINDOW_SIZE anteriores. Comprobar y marcar un lote es O(1) y la memoria
+    por ESP es constante. Un lote más antiguo que la ventana se trata como repetido.
+    """
+    __slots__ = ('boot_id', 'first_seq', 'highest_seq', 'seen_mask', 'pending',
+                 'received', 'duplicates', 'missing')
+
+    def __init__(self, boot_id):
+        self.boot_id = boot_id
+        self.first_seq = None
+        self.highest_seq = None
+        self.seen_mask = 0           # bit i -> se confirmó highest_seq - i
+        self.pending = set()         # Secuencias admitidas cuya escritura no ha terminado
+        self.received = 0
+        self.duplicates = 0
+        self.missing = 0             # Lotes saltados: huecos en la secuencia aún sin rellenar
+
+    def classify(self, seq):
+        if seq in self.pending:
+            return BATCH_IN_PROGRESS
+        if self.highest_seq is None or seq > self.highest_seq:
+            return BATCH_NEW
+        offset = self.highest_seq - seq
+        if offset >= SEQUENCE_WINDOW_SIZE or self.seen_mask >> offset & 1:
+            return BATCH_DUPLICATE
+        return BATCH_NEW
+
+    def mark_seen(self, seq):
+        self.received += 1
+        if self.highest_seq is None:
+            # Los lotes anteriores al primero recibido (p.ej. antes de arrancar el servidor) no cuentan como perdidos
+            self.first_seq = self.highest_seq = seq
+            self.seen_mask = 1
+        elif seq > self.highest_seq:
+            shift = seq - self.highest_seq
+            self.missing += shift - 1
+            self.seen_mask = (self.seen_mask << shift | 1) & ((1 << SEQUENCE_WINDOW_SIZE) - 1)
+            self.highest_seq = seq
+        else:
+            # Llegada tardía dentro de la ventana: rellena un hueco contado antes como pérdida
+            self.seen_mask |= 1 << (self.highest_seq - seq)
+            if seq > self.first_seq:
+                self.missing -= 1
+            else:
+                self.first_seq = seq
+
+
+class BatchSequenceTracker:
+    """
+    Reconoce reenvíos de lotes ya guardados (mismo deviceId, bootId y batchSeq), típicos cuando
+    el ESP agota el timeout HTTP después de que el servidor haya confirmado la escritura.
+    Un bootId nuevo (reinicio del ESP) reinicia su ventana; los contadores acumulados se conservan.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def begin(self, esp_device_id, boot_id, seq):
+        """
+        Devuelve BATCH_NEW (el llamante debe invocar finish() al terminar), BATCH_DUPLICATE o
+        BATCH_IN_PROGRESS.
+        """
+        with self._lock:
+            window = self._windows.get(esp_device_id)
+            if window is None or window.boot_id != boot_id:
+                previous, window = window, SequenceWindow(boot_id)
+                if previous is not None:
+                    window.received, window.duplicates, window.missing = previous.received, previous.duplicates, previous.missing
+                self._windows[esp_device_id] = window
+            decision = window.classify(seq)
+            if decision == BATCH_NEW:
+                window.pending.add(seq)
+            elif decision == BATCH_DUPLICATE:
+                window.duplicates += 1
+            return decision
+
+    def finish(self, esp_device_id, boot_id, seq, committed):
+        """Marca el lote como visto si se guardó; si falló, un reenvío posterior se aceptará."""
+        with self._lock:
+            window = self._windows.get(esp_device_id)
+            if window is None or window.boot_id != boot_id:
+                return 0
+            window.pending.discard(seq)
+            if not committed:
+                return 0
+            missing_before = window.missing
+            window.mark_seen(seq)
+            return window.missing - missing_before
+
+    def stats(self):
+        with self._lock:
+            return {
+                esp_device_id: {
+                    "boot_id": window.boot_id,
+                    "highest_seq": window.highest_seq,
+                    "received": window.received,
+                    "duplicates": window.duplicates,
+                    "missing": window.missing,
+                }
+                for esp_device_id, window in self._windows.items()
+            }
+
+
+DELTA_MAX_REFS_PER_ESP = 1024
+DELTA_MAX_ESPS = 1024
+# Campos de un dispositivo que el protocolo delta guarda por referencia (macAddress y rssi no: la MAC
+# identifica el conjunto y el RSSI llega en cada entrada)
+DELTA_FIELDS = ('deviceName', 'manufacturerData', 'serviceData', 'serviceUUIDs', 'txPower', 'appearance')
+
+
+class _DeltaState:
+    __slots__ = ('state_id', 'slots')
+
+    def __init__(self, state_id):
+        self.state_id = state_id
+        self.slots = {}   # ref -> (campos en formato completo, valor procesado por parse_fields)
+
+
+class DeltaStateCache:
+    """
+    Estado del protocolo delta por ESP. Cada entrada del lote lleva 'ref' (entero entre 0 y max_refs - 1)
+    y su RSSI; con 'macAddress' (re)define el conjunto de campos de esa referencia y, sin él, reutiliza el
+    guardado aplicando encima los campos que traiga (null borra). Los campos se procesan una sola vez por
+    cambio: las entradas que solo traen RSSI reutilizan el resultado de parse_fields.
+    stateId identifica la tabla de referencias del ESP: uno distinto (reinicio, resincronización) empieza
+    una tabla vacía. Se guardan como mucho max_esps estados (se descarta el usado hace más tiempo); un
+    ESP que pierde su estado recibe las referencias desconocidas y debe reenviar el lote completo.
+    """
+
+    def __init__(self, max_refs=DELTA_MAX_REFS_PER_ESP, max_esps=DELTA_MAX_ESPS):
+        self.max_refs = max_refs
+        self.max_esps = max_esps
+        self._lock = threading.Lock()
+        self._states = OrderedDict()   # esp_id -> _DeltaState, del usado hace más tiempo al más reciente
+        self._entries = 0
+        self._reused = 0
+        self._resyncs = 0
+
+    def expand(self, esp_device_id, state_id, entries, parse_fields):
+        """
+        Reconstruye las entradas del lote. Devuelve ([(valor de parse_fields, rssi sin procesar)], refs
+        desconocidas o inválidas). Si hay refs desconocidas el lote no debe guardarse; las definiciones que
+        sí traía quedan aplicadas (reenviar el lote completo es idempotente).
+        """
+        expanded, unknown = [], []
+        with self._lock:
+            state = self._states.get(esp_device_id)
+            if state is None or state.state_id != state_id:
+                state = self._states[esp_device_id] = _DeltaState(state_id)
+            self._states.move_to_end(esp_device_id)
+            while len(self._states) > self.max_esps:
+                self._states.popitem(last=False)
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    continue
+                ref = entry.get('ref')
+                if not isinstance(ref, int) or isinstance(ref, bool) or not 0 <= ref < self.max_refs:
+                    unknown.append(ref)
+                    continue
+                changes = {key: entry[key] for key in DELTA_FIELDS if key in entry}
+                if 'macAddress' in entry:
+                    fields = {key: value for key, value in changes.items() if value is not None}
+                    fields['macAddress'] = entry['macAddress']
+                    slot = state.slots[ref] = (fields, parse_fields(fields))
+                else:
+                    slot = state.slots.get(ref)
+                    if slot is None:
+                        unknown.append(ref)
+                        continue
+                    if changes:
+                        fields = {key: value for key, value in dict(slot[0], **changes).items() if value is not None}
+                        slot = state.slots[ref] = (fields, parse_fields(fields))
+                    else:
+                        self._reused += 1
+                self._entries += 1
+                expanded.append((slot[1], entry.get('rssi')))
+            if unknown:
+                self._resyncs += 1
+        return expanded, unknown
+
+    def stats(self):
+        with self._lock:
+            return {
+                "esps": len(self._states),
+                "refs": sum(len(state.slots) for state in self._states.values()),
+                "entries": self._entries,
+                "reused_entries": self._reused,
+                "resyncs": self._resyncs,
+                "max_refs_per_esp": self.max_refs,
+            }
@@ -0,0 +1,181 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Tiempo (segundos) tras el cual un dispositivo deja de considerarse "en rango".
+DEFAULT_LIVE_TTL_SEC = 300
+
+
+class LiveDeviceRecord:
+    """Estado compacto de una MAC vista recientemente."""
+    __slots__ = ('mac', 'name', 'company_id', 'last_rssi', 'last_esp', 'last_seen', 'esp_last_seen', 'esp_last_rssi')
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.name = None
+        self.company_id = None
+        self.last_rssi = None
+        self.last_esp = None
+        self.last_seen = 0.0
+        self.esp_last_seen = {}
+        self.esp_last_rssi = {}
+
+    def to_dict(self):
+        return {
+            "ble_mac_address": self.mac,
+            "ble_device_name": self.name,
+            "company_id": self.company_id,
+            "last_rssi": self.last_rssi,
+            "last_esp_id": self.last_esp,
+            "last_seen_epoch": round(self.last_seen, 3),
+            "esp_last_seen_epoch": {esp: round(ts, 3) for esp, ts in self.esp_last_seen.items()},
+            "esp_last_rssi": dict(self.esp_last_rssi),
+        }
+
+
+class LiveDeviceStore:
+    """
+    Conjunto "caliente" de dispositivos en rango, actualizado desde la ingesta.
+    Mantiene los registros ordenados por última detección (global y por ESP) para que
+    la expiración y las consultas por ventana temporal recorran solo los elementos afectados.
+    """
+
+    def __init__(self, ttl_sec=DEFAULT_LIVE_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._records = OrderedDict()     # mac -> LiveDeviceRecord, de más antiguo a más reciente
+        self._by_esp = {}                 # esp_id -> OrderedDict(mac -> last_seen)
+        self._by_company = {}             # company_id -> OrderedDict(mac -> None), de más antiguo a más reciente
+
+    def __len__(self):
+        return len(self._records)
+
+    def update(self, esp_id, mac, rssi=None, name=None, company_id=None, seen_at=None):
+        seen_at = seen_at if seen_at is not None else time.time()
+        with self._lock:
+            self._update_locked(esp_id, mac, rssi, name, company_id, seen_at)
+            self._evict_locked(seen_at - self.ttl_sec)
+
+    def update_many(self, esp_id, observations, seen_at=None):
+        """observations: iterable de tuplas (mac, rssi, name, company_id)."""
+        seen_at = seen_at if seen_at is not None else time.time()
+        with self._lock:
+            for mac, rssi, name, company_id in observations:
+                self._update_locked(esp_id, mac, rssi, name, company_id, seen_at)
+            self._evict_locked(seen_at - self.ttl_sec)
+
+    def _update_locked(self, esp_id, mac, rssi, name, company_id, seen_at):
+        record = self._records.get(mac)
+        if record is None:
+            record = LiveDeviceRecord(mac)
+            self._records[mac] = record
+        elif seen_at >= record.last_seen:
+            self._records.move_to_end(mac)
+        else:
+            # Observación antigua (p.ej. durante la reconstrucción): no altera el orden.
+            return
+
+        record.last_seen = seen_at
+        record.last_esp = esp_id
+        if rssi is not None:
+            record.last_rssi = rssi
+            record.esp_last_rssi[esp_id] = rssi
+        if name:
+            record.name = name
+        if company_id is not None and company_id != record.company_id:
+            if record.company_id is not None:
+                self._discard_company_locked(record.company_id, mac)
+            record.company_id = company_id
+        if record.company_id is not None:
+            company_index = self._by_company.get(record.company_id)
+            if company_index is None:
+                company_index = self._by_company[record.company_id] = OrderedDict()
+            company_index[mac] = None
+            company_index.move_to_end(mac)
+        record.esp_last_seen[esp_id] = seen_at
+
+        esp_index = self._by_esp.get(esp_id)
+        if esp_index is None:
+            esp_index = self._by_esp[esp_id] = OrderedDict()
+        esp_index[mac] = seen_at
+        esp_index.move_to_end(mac)
+
+    def _discard_company_locked(self, company_id, mac):
+        macs = self._by_company.get(company_id)
+        if macs is not None:
+            macs.pop(mac, None)
+            if not macs:
+                del self._by_company[company_id]
+
+    def _evict_locked(self, cutoff):
+        for esp_id in list(self._by_esp):
+            esp_index = self._by_esp[esp_id]
+            while esp_index:
+                mac, ts = next(iter(esp_index.items()))
+                if ts >= cutoff:
+                    break
+                esp_index.popitem(last=False)
+                record = self._records.get(mac)
+                if record is not None and record.esp_last_seen.get(esp_id) == ts:
+                    del record.esp_last_seen[esp_id]
+                    record.esp_last_rssi.pop(esp_id, None)
+            if not esp_index:
+                del self._by_esp[esp_id]
+
+        while self._records:
+            mac, record = next(iter(self._records.items()))
+            if record.last_seen >= cutoff:
+                break
+            self._records.popitem(last=False)
+            if record.company_id is not None:
+                self._discard_company_locked(record.company_id, mac)
+
+    def evict_expired(self, now=None):
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._evict_locked(now - self.ttl_sec)
+
+    def query(self, esp_id=None, company_id=None, min_rssi=None, window_sec=None, limit=None, now=None):
+        """
+        Devuelve los dispositivos en rango, del más reciente al más antiguo.
+        Se recorre el índice más selectivo (ESP, fabricante o el orden global) y la
+        iteración se corta al salir de la ventana temporal o al alcanzar el límite.
+        """
+        now = now if now is not None else time.time()
+        window_sec = self.ttl_sec if window_sec is None else min(window_sec, self.ttl_sec)
+        cutoff = now - window_sec
+        results = []
+        with self._lock:
+            self._evict_locked(now - self.ttl_sec)
+
+            if esp_id is not None:
+                esp_index = self._by_esp.get(esp_id, {})
+                candidates = ((self._records.get(mac), ts) for mac, ts in reversed(esp_index.items()))
+            elif company_id is not None:
+                # Mismo orden que el global: se recorre desde el más reciente y se corta en la ventana
+                records = (self._records[mac] for mac in reversed(self._by_company.get(company_id, {})))
+                candidates = ((r, r.last_seen) for r in records)
+            else:
+                candidates = ((r, r.last_seen) for r in reversed(self._records.values()))
+
+            for record, ts in candidates:
+                if record is None:
+                    continue
+                if ts < cutoff:
+                    break
+                if company_id is not None and record.company_id != company_id:
+                    continue
+                # Con esp_id, el RSSI que cuenta es el último visto por ese ESP
+                rssi = record.esp_last_rssi.get(esp_id) if esp_id is not None else record.last_rssi
+                if min_rssi is not None and (rssi is None or rssi < min_rssi):
+                    continue
+                results.append(record.to_dict())
+                if limit is not None and len(results) >= limit:
+                    break
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._by_esp.clear()
+            self._by_company.clear()
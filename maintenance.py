@@ -0,0 +1,185 @@
+import itertools
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import query_budget
+
+STATUS_OK = 'ok'
+STATUS_SKIPPED = 'skipped'                   # La tarea no aplica (p.ej. checkpoint sin WAL)
+STATUS_BUDGET_EXCEEDED = 'budget_exceeded'   # Interrumpida al agotar su presupuesto; se retoma en la siguiente ejecución
+STATUS_FAILED = 'failed'                     # Terminó, pero encontró problemas (p.ej. integrity_check)
+STATUS_ERROR = 'error'
+
+
+class JobSkipped(Exception):
+    """La tarea no aplica a este objetivo; el mensaje explica por qué."""
+
+
+class JobFailed(Exception):
+    """La tarea terminó y encontró problemas; detail se guarda en el historial."""
+
+    def __init__(self, message, detail=None):
+        super().__init__(message)
+        self.detail = detail
+
+
+class MaintenanceJob:
+    __slots__ = ('name', 'fn', 'interval_sec', 'budget_ms', 'next_run_at', 'runs', 'deferrals', 'last_status', 'last_run_at',
+                 'pending_targets')
+
+    def __init__(self, name, fn, interval_sec, budget_ms, next_run_at):
+        self.name = name
+        self.fn = fn
+        self.interval_sec = interval_sec
+        self.budget_ms = budget_ms
+        self.next_run_at = next_run_at
+        self.runs = 0
+        self.deferrals = 0
+        self.last_status = None
+        self.last_run_at = None
+        self.pending_targets = None   # Objetivos que faltaban cuando se aplazó la última ejecución
+
+
+class MaintenanceScheduler:
+    """
+    Tareas periódicas de mantenimiento (checkpoints, ANALYZE, vacuum incremental...) ejecutadas en un hilo
+    solo en los periodos de calma de la ingesta: cada tick_sec se comprueba is_quiet() y se ejecuta la tarea
+    vencida más atrasada sobre cada objetivo de targets() (los shards). fn(objetivo, presupuesto) recibe un
+    QueryBudget con el budget_ms de la tarea y devuelve un dict con el detalle; si la ingesta se reanuda
+    entre dos objetivos, los que faltan se retoman en el siguiente periodo de calma. Las ejecuciones (una por
+    objetivo) se guardan en un historial de 'capacity' entradas.
+    """
+
+    def __init__(self, targets, is_quiet, tick_sec=10, capacity=500):
+        self.targets = targets
+        self.is_quiet = is_quiet
+        self.tick_sec = tick_sec
+        self._jobs = {}
+        self._history = deque(maxlen=capacity)
+        self._history_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._run_lock = threading.Lock()   # Una tarea a la vez (hilo periódico o ejecución manual)
+        self._thread = None
+
+    def add(self, name, fn, interval_sec, budget_ms, initial_delay_sec=None):
+        delay = initial_delay_sec if initial_delay_sec is not None else interval_sec
+        self._jobs[name] = MaintenanceJob(name, fn, interval_sec, budget_ms, time.monotonic() + delay)
+
+    def job_names(self):
+        return list(self._jobs)
+
+    def run_pending(self, now=None):
+        """Ejecuta la tarea vencida más atrasada si la ingesta está en calma. Devuelve sus entradas del historial."""
+        now = now if now is not None else time.monotonic()
+        due = [job for job in self._jobs.values() if job.next_run_at <= now]
+        if not due:
+            return []
+        job = min(due, key=lambda job: job.next_run_at)
+        if not self.is_quiet():
+            job.deferrals += 1
+            return []
+        return self._run(job, require_quiet=True)
+
+    def run_job(self, name, budget_ms=None):
+        """
+        Ejecución manual (endpoint de administración): no espera a la calma, pero respeta el presupuesto
+        de la tarea o el indicado en budget_ms (p.ej. para comprobar una tabla que no cabe en el habitual).
+        """
+        job = self._jobs.get(name)
+        if job is None:
+            raise KeyError(name)
+        return self._run(job, require_quiet=False, budget_ms=budget_ms)
+
+    def _run(self, job, require_quiet, budget_ms=None):
+        entries = []
+        with self._run_lock:
+            targets = job.pending_targets if require_quiet and job.pending_targets else list(self.targets())
+            for i, target in enumerate(targets):
+                if require_quiet and entries and not self.is_quiet():
+                    # La ingesta se ha reanudado: los objetivos restantes esperan al siguiente periodo de calma
+                    job.deferrals += 1
+                    job.pending_targets = targets[i:]
+                    return entries
+                entries.append(self._run_target(job, target, budget_ms or job.budget_ms))
+            job.pending_targets = None
+            job.runs += 1
+            job.last_run_at = time.time()
+            job.last_status = self._worst_status(entries)
+            job.next_run_at = time.monotonic() + job.interval_sec
+        return entries
+
+    def _run_target(self, job, target, budget_ms):
+        started_at = time.time()
+        budget = query_budget.QueryBudget(time_ms=budget_ms)
+        detail = None
+        try:
+            detail = job.fn(target, budget)
+            status = STATUS_OK
+        except JobSkipped as e:
+            status, detail = STATUS_SKIPPED, {"reason": str(e)}
+        except JobFailed as e:
+            status, detail = STATUS_FAILED, dict(e.detail or {}, message=str(e))
+        except query_budget.QueryBudgetExceeded as e:
+            # La tarea puede adjuntar en e.detail lo que llegó a hacer antes de la interrupción
+            status, detail = STATUS_BUDGET_EXCEEDED, dict(getattr(e, 'detail', None) or {}, reason=e.reason)
+        except (sqlite3.Error, OSError) as e:
+            status, detail = STATUS_ERROR, {"error": str(e)}
+        except Exception as e:
+            # Cualquier otro fallo de una tarea queda en el historial: no debe terminar el hilo de mantenimiento
+            status, detail = STATUS_ERROR, {"error": f"{type(e).__name__}: {e}"}
+        entry = {
+            "id": next(self._ids),
+            "job": job.name,
+            "target": target,
+            "started_at": started_at,
+            "duration_ms": round((time.time() - started_at) * 1000, 1),
+            "status": status,
+            "detail": detail,
+        }
+        with self._history_lock:
+            self._history.append(entry)
+        return entry
+
+    @staticmethod
+    def _worst_status(entries):
+        order = (STATUS_ERROR, STATUS_FAILED, STATUS_BUDGET_EXCEEDED, STATUS_OK, STATUS_SKIPPED)
+        statuses = {entry["status"] for entry in entries}
+        return next((status for status in order if status in statuses), None)
+
+    def history(self, job=None, limit=None):
+        """Ejecuciones guardadas, de la más reciente a la más antigua."""
+        with self._history_lock:
+            entries = [entry for entry in reversed(self._history) if job is None or entry["job"] == job]
+        return entries[:limit] if limit else entries
+
+    def start(self):
+        """Arranca el hilo que revisa las tareas vencidas cada tick_sec."""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.tick_sec)
+                self.run_pending()
+
+        self._thread = threading.Thread(target=loop, name='db-maintenance', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "tick_sec": self.tick_sec,
+            "quiet": self.is_quiet(),
+            "jobs": [{
+                "job": job.name,
+                "interval_sec": job.interval_sec,
+                "budget_ms": job.budget_ms,
+                "runs": job.runs,
+                "deferrals": job.deferrals,
+                "last_status": job.last_status,
+                "last_run_at": job.last_run_at,
+                "next_run_in_sec": round(max(0.0, job.next_run_at - now), 1),
+            } for job in self._jobs.values()],
+        }
@@ -0,0 +1,210 @@
+import cProfile
+import io
+import itertools
+import marshal
+import pstats
+import random
+import threading
+import time
+from collections import deque
+
+# Longitud máxima de cada parámetro guardado en el log de consultas lentas
+MAX_PARAM_REPR = 200
+
+
+class RequestProfiler:
+    """
+    Perfilado con cProfile de una muestra de peticiones (sample_rate entre 0 y 1, ajustable en caliente;
+    0 = desactivado, sin coste). Guarda los últimos 'capacity' informes: resumen en texto ordenado por
+    tiempo acumulado y las estadísticas completas, descargables en formato pstats.
+    cProfile solo ve el hilo de la petición: el trabajo en los hilos de shards aparece como espera.
+    """
+
+    def __init__(self, sample_rate=0.0, capacity=50, top_functions=40):
+        self.sample_rate = sample_rate
+        self.top_functions = top_functions
+        self._lock = threading.Lock()
+        self._reports = deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+
+    def should_sample(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, method, path, status_code, duration_sec):
+        profile.disable()
+        text = io.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(self.top_functions)
+        report = {
+            "id": next(self._ids),
+            "method": method,
+            "path": path,
+            "status": status_code,
+            "duration_ms": round(duration_sec * 1000, 1),
+            "captured_at": time.time(),
+            "text": text.getvalue(),
+            "stats": stats.stats,
+        }
+        with self._lock:
+            self._reports.append(report)
+        return report
+
+    def reports(self):
+        """Resumen de los informes guardados, del más reciente al más antiguo."""
+        with self._lock:
+            return [{key: value for key, value in report.items() if key not in ('text', 'stats')}
+                    for report in reversed(self._reports)]
+
+    def report(self, report_id):
+        with self._lock:
+            return next((report for report in self._reports if report["id"] == report_id), None)
+
+    @staticmethod
+    def pstats_bytes(report):
+        """Contenido de un fichero .prof (el mismo formato que pstats.Stats.dump_stats)."""
+        return marshal.dumps(report["stats"])
+
+
+class StatementTimer:
+    """
+    Envuelve una conexión SQLite y mide cada sentencia desde su execute() hasta el siguiente execute()
+    o hasta finish(): incluye la lectura de las filas, que es donde SQLite hace el trabajo.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._current = None
+        self._timings = []
+
+    def _close_current(self):
+        if self._current is not None:
+            sql, params, started = self._current
+            self._timings.append((sql, params, time.perf_counter() - started))
+            self._current = None
+
+    def execute(self, sql, params=()):
+        self._close_current()
+        self._current = (sql, params, time.perf_counter())
+        return self._conn.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        self._close_current()
+        self._current = (sql, (), time.perf_counter())
+        return self._conn.executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def finish(self):
+        """Lista de (sql, params, segundos) de las sentencias ejecutadas."""
+        self._close_current()
+        return self._timings
+
+
+def normalize_sql(sql):
+    return " ".join(sql.split())
+
+
+def format_params(params):
+    if isinstance(params, dict):
+        return {key: format_param(value) for key, value in params.items()}
+    return [format_param(value) for value in params]
+
+
+def format_param(value):
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str) and len(value) > MAX_PARAM_REPR:
+        return value[:MAX_PARAM_REPR] + '…'
+    return value
+
+
+class SlowQueryLog:
+    """
+    Registro de sentencias lentas (SQL, parámetros, duración y EXPLAIN QUERY PLAN de las que superan
+    threshold_ms) y ranking móvil de las más costosas: todas las sentencias se agregan por SQL en
+    buckets de bucket_sec y el top-N suma los buckets de la última window_sec.
+    """
+
+    def __init__(self, threshold_ms=500, capacity=200, window_sec=3600, bucket_sec=60):
+        self.threshold_ms = threshold_ms
+        self.window_sec = window_sec
+        self.bucket_sec = bucket_sec
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=capacity)
+        self._buckets = deque()   # (inicio del bucket, {sql normalizada: [ejecuciones, total_ms, max_ms]})
+        self._ids = itertools.count(1)
+
+    def record(self, sql, params, duration_sec, shard=None, endpoint=None, plan_fn=None, now=None):
+        now = now if now is not None else time.time()
+        duration_ms = duration_sec * 1000
+        normalized = normalize_sql(sql)
+        with self._lock:
+            bucket_start = now - now % self.bucket_sec
+            if not self._buckets or self._buckets[-1][0] != bucket_start:
+                self._buckets.append((bucket_start, {}))
+                while self._buckets and self._buckets[0][0] <= now - self.window_sec - self.bucket_sec:
+                    self._buckets.popleft()
+            aggregate = self._buckets[-1][1].setdefault(normalized, [0, 0.0, 0.0])
+            aggregate[0] += 1
+            aggregate[1] += duration_ms
+            aggregate[2] = max(aggregate[2], duration_ms)
+        if duration_ms < self.threshold_ms:
+            return None
+        # El plan se obtiene fuera del lock: es otra consulta (barata) sobre la misma conexión
+        try:
+            plan = plan_fn() if plan_fn is not None else None
+        except Exception as e:
+            plan = [f"(no disponible: {e})"]
+        entry = {
+            "id": next(self._ids),
+            "recorded_at": now,
+            "duration_ms": round(duration_ms, 1),
+            "shard": shard,
+            "endpoint": endpoint,
+            "sql": normalized,
+            "params": format_params(params),
+            "plan": plan,
+        }
+        with self._lock:
+            self._entries.append(entry)
+        return entry
+
+    def entries(self, limit=None):
+        with self._lock:
+            entries = list(reversed(self._entries))
+        return entries[:limit] if limit else entries
+
+    def top(self, n=10, now=None):
+        """Las n sentencias con más tiempo total en la ventana móvil."""
+        now = now if now is not None else time.time()
+        totals = {}
+        with self._lock:
+            for bucket_start, aggregates in self._buckets:
+                if bucket_start <= now - self.window_sec - self.bucket_sec:
+                    continue
+                for sql, (count, total_ms, max_ms) in aggregates.items():
+                    merged = totals.setdefault(sql, [0, 0.0, 0.0])
+                    merged[0] += count
+                    merged[1] += total_ms
+                    merged[2] = max(merged[2], max_ms)
+        ranked = sorted(totals.items(), key=lambda item: item[1][1], reverse=True)[:n]
+        return [{"sql": sql, "executions": count, "total_ms": round(total_ms, 1),
+                 "mean_ms": round(total_ms / count, 2), "max_ms": round(max_ms, 1)}
+                for sql, (count, total_ms, max_ms) in ranked]
+
+
+def explain_query_plan(conn, sql, params=()):
+    """EXPLAIN QUERY PLAN como líneas sangradas según la jerarquía de pasos."""
+    depth = {0: -1}
+    lines = []
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+        node_id, parent_id, detail = row[0], row[1], row[3]
+        depth[node_id] = depth.get(parent_id, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
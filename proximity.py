@@ -0,0 +1,251 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Filtro de Kalman 1-D sobre el RSSI de cada par (MAC, ESP), con modelo de paseo aleatorio
+DEFAULT_PROCESS_NOISE = 0.5          # dB² por segundo: cuánto puede variar el RSSI real (movimiento) entre detecciones
+DEFAULT_MEASUREMENT_NOISE = 16.0     # dB² (σ ≈ 4 dB: desvanecimiento y multitrayecto habituales en interiores)
+DEFAULT_INNOVATION_GATE = 3.0        # Desviaciones (σ de la innovación) por encima de las cuales una lectura se recorta
+# Pares sin detecciones durante más de esto se descartan; si vuelven, el filtro arranca de nuevo
+DEFAULT_TTL_SEC = 600
+# Pares (MAC, ESP) con estado; por encima se descartan los que llevan más tiempo sin verse
+DEFAULT_MAX_TRACKS = 100000
+
+# Modelo log-distancia: d = 10 ** ((RSSI a 1 m - RSSI) / (10 * n))
+DEFAULT_RSSI_AT_1M = -59             # dBm a 1 m si el dispositivo no anuncia txPower
+DEFAULT_TX_POWER_OFFSET_DB = -41     # txPower (potencia a 0 m) + esto = RSSI esperado a 1 m
+DEFAULT_PATH_LOSS_EXPONENT = 2.0     # 2 en espacio libre; 2.5-4 en interiores con obstáculos
+CALIBRATION_KEYS = ('rssi_at_1m', 'tx_power_offset_db', 'path_loss_exponent')
+# txPower fuera de este rango (p.ej. 127 = "no disponible" en algunas pilas) no se usa
+TX_POWER_RANGE = (-100, 20)
+
+CALIBRATION_TX_POWER = 'tx_power'
+CALIBRATION_COMPANY = 'company'
+CALIBRATION_DEFAULT = 'default'
+
+
+def kalman_step(estimate, variance, rssi, dt, process_noise, measurement_noise, gate):
+    """Una actualización del filtro: predicción con dt segundos de deriva y corrección con la lectura rssi."""
+    predicted = variance + process_noise * dt
+    innovation_var = predicted + measurement_noise
+    innovation = rssi - estimate
+    # Recorte de la innovación (Huber): un reflejo aislado no arrastra la estimación; un cambio real sí, en
+    # pocas lecturas, porque la varianza predicha crece mientras se sigue recortando
+    limit = gate * math.sqrt(innovation_var)
+    if innovation > limit:
+        innovation = limit
+    elif innovation < -limit:
+        innovation = -limit
+    gain = predicted / innovation_var
+    return estimate + gain * innovation, (1.0 - gain) * predicted
+
+
+def smooth_series(epochs, rssis, process_noise=DEFAULT_PROCESS_NOISE, measurement_noise=DEFAULT_MEASUREMENT_NOISE,
+                  gate=DEFAULT_INNOVATION_GATE, reset_after_sec=DEFAULT_TTL_SEC):
+    """
+    El mismo filtro aplicado a una serie ya guardada (epochs y rssis paralelos, en orden cronológico de un
+    mismo ESP): lista de RSSI suavizados, con None donde la lectura es None.
+    """
+    smoothed = []
+    estimate = variance = last_epoch = None
+    for epoch, rssi in zip(epochs, rssis):
+        if rssi is None:
+            smoothed.append(None)
+            continue
+        if estimate is None or epoch - last_epoch > reset_after_sec:
+            estimate, variance = float(rssi), measurement_noise
+        else:
+            estimate, variance = kalman_step(estimate, variance, rssi, max(0.0, epoch - last_epoch),
+                                             process_noise, measurement_noise, gate)
+        last_epoch = epoch
+        smoothed.append(round(estimate, 1))
+    return smoothed
+
+
+def estimate_distance(rssi, rssi_at_1m, path_loss_exponent):
+    """Distancia en metros según el modelo log-distancia."""
+    return 10 ** ((rssi_at_1m - rssi) / (10.0 * path_loss_exponent))
+
+
+def validate_calibration(calibration):
+    """Valida {company_id: {rssi_at_1m, tx_power_offset_db, path_loss_exponent}}. Lanza ValueError si no es válida."""
+    for company_id, entry in calibration.items():
+        if not isinstance(company_id, int):
+            raise ValueError(f"Calibration key {company_id!r} must be an integer company ID")
+        unknown = set(entry) - set(CALIBRATION_KEYS)
+        if unknown:
+            raise ValueError(f"Unknown calibration fields for company 0x{company_id:04X}: {', '.join(sorted(unknown))}")
+        if entry.get('path_loss_exponent', DEFAULT_PATH_LOSS_EXPONENT) <= 0:
+            raise ValueError(f"'path_loss_exponent' for company 0x{company_id:04X} must be positive")
+
+
+class _Track:
+    __slots__ = ('estimate', 'variance', 'last_rssi', 'last_seen', 'samples', 'tx_power', 'company_id')
+
+    def __init__(self, rssi, variance, seen_at):
+        self.estimate = float(rssi)
+        self.variance = variance
+        self.last_rssi = rssi
+        self.last_seen = seen_at
+        self.samples = 1
+        self.tx_power = None
+        self.company_id = None
+
+
+class ProximityTracker:
+    """
+    RSSI suavizado y distancia estimada por par (MAC, ESP), actualizados en la ingesta. Cada detección es un
+    paso de un filtro de Kalman 1-D (coste constante); la distancia se calcula solo al consultar, con el
+    modelo log-distancia y la referencia a 1 m tomada de txPower (si el dispositivo lo anuncia) o de la
+    calibración de su fabricante (calibration: {company_id: {rssi_at_1m, tx_power_offset_db,
+    path_loss_exponent}}). Los pares se guardan en orden de última detección: los caducados (ttl_sec) y los
+    que exceden max_tracks se descartan desde el más antiguo.
+    """
+
+    def __init__(self, process_noise=DEFAULT_PROCESS_NOISE, measurement_noise=DEFAULT_MEASUREMENT_NOISE,
+                 gate=DEFAULT_INNOVATION_GATE, ttl_sec=DEFAULT_TTL_SEC, max_tracks=DEFAULT_MAX_TRACKS, calibration=None):
+        calibration = calibration or {}
+        validate_calibration(calibration)
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.gate = gate
+        self.ttl_sec = ttl_sec
+        self.max_tracks = max_tracks
+        self._default_calibration = (DEFAULT_RSSI_AT_1M, DEFAULT_TX_POWER_OFFSET_DB, DEFAULT_PATH_LOSS_EXPONENT)
+        self._calibration = {
+            company_id: tuple(entry.get(key, default) for key, default in zip(CALIBRATION_KEYS, self._default_calibration))
+            for company_id, entry in calibration.items()
+        }
+        self._lock = threading.Lock()
+        self._tracks = OrderedDict()   # (mac, esp_id) -> _Track, del visto hace más tiempo al más reciente
+        self._tracks_by_esp = {}       # esp_id -> pares con estado (para las consultas por MAC)
+        self._updates = 0
+        self._clipped = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def observe_batch(self, esp_id, observations, seen_at=None):
+        """observations: iterable de tuplas (mac, rssi, tx_power, company_id) vistas por esp_id en seen_at."""
+        seen_at = seen_at if seen_at is not None else time.time()
+        q, r, gate = self.process_noise, self.measurement_noise, self.gate
+        with self._lock:
+            tracks = self._tracks
+            for mac, rssi, tx_power, company_id in observations:
+                if rssi is None:
+                    continue
+                key = (mac, esp_id)
+                track = tracks.get(key)
+                if track is None:
+                    track = tracks[key] = _Track(rssi, r, seen_at)
+                    self._tracks_by_esp[esp_id] = self._tracks_by_esp.get(esp_id, 0) + 1
+                elif seen_at - track.last_seen > self.ttl_sec:
+                    track.__init__(rssi, r, seen_at)
+                    tracks.move_to_end(key)
+                else:
+                    dt = max(0.0, seen_at - track.last_seen)
+                    if abs(rssi - track.estimate) > gate * math.sqrt(track.variance + q * dt + r):
+                        self._clipped += 1
+                    track.estimate, track.variance = kalman_step(track.estimate, track.variance, rssi, dt, q, r, gate)
+                    track.last_rssi = rssi
+                    track.last_seen = max(seen_at, track.last_seen)
+                    track.samples += 1
+                    tracks.move_to_end(key)
+                if tx_power is not None:
+                    track.tx_power = tx_power
+                if company_id is not None:
+                    track.company_id = company_id
+                self._updates += 1
+            self._evict_locked(seen_at - self.ttl_sec)
+
+    def _evict_locked(self, cutoff):
+        tracks = self._tracks
+        while tracks:
+            key, oldest = next(iter(tracks.items()))
+            if oldest.last_seen >= cutoff and len(tracks) <= self.max_tracks:
+                break
+            del tracks[key]
+            self._evictions += 1
+            remaining = self._tracks_by_esp[key[1]] - 1
+            if remaining:
+                self._tracks_by_esp[key[1]] = remaining
+            else:
+                del self._tracks_by_esp[key[1]]
+
+    def _describe(self, mac, esp_id, track, now):
+        rssi_at_1m, tx_power_offset_db, path_loss_exponent = self._calibration.get(track.company_id, self._default_calibration)
+        if track.tx_power is not None and TX_POWER_RANGE[0] <= track.tx_power <= TX_POWER_RANGE[1]:
+            rssi_at_1m, source = track.tx_power + tx_power_offset_db, CALIBRATION_TX_POWER
+        else:
+            source = CALIBRATION_COMPANY if track.company_id in self._calibration else CALIBRATION_DEFAULT
+        # Incertidumbre actual: la del filtro más la deriva acumulada desde la última detección
+        std = math.sqrt(track.variance + self.process_noise * max(0.0, now - track.last_seen))
+        return {
+            "mac": mac,
+            "esp_id": esp_id,
+            "smoothed_rssi": round(track.estimate, 1),
+            "rssi_std": round(std, 1),
+            "last_rssi": track.last_rssi,
+            "samples": track.samples,
+            "distance_m": round(estimate_distance(track.estimate, rssi_at_1m, path_loss_exponent), 2),
+            "distance_range_m": [round(estimate_distance(track.estimate + std, rssi_at_1m, path_loss_exponent), 2),
+                                 round(estimate_distance(track.estimate - std, rssi_at_1m, path_loss_exponent), 2)],
+            "rssi_at_1m": rssi_at_1m,
+            "path_loss_exponent": path_loss_exponent,
+            "calibration": source,
+            "tx_power": track.tx_power,
+            "company_id": track.company_id,
+            "last_seen_epoch": track.last_seen,
+            "age_sec": round(max(0.0, now - track.last_seen), 1),
+        }
+
+    def device(self, mac, now=None):
+        """Estado de la MAC en cada ESP que la ve (pares no caducados), del más cercano al más lejano."""
+        now = now if now is not None else time.time()
+        cutoff = now - self.ttl_sec
+        with self._lock:
+            result = []
+            for esp_id in self._tracks_by_esp:
+                track = self._tracks.get((mac, esp_id))
+                if track is not None and track.last_seen >= cutoff:
+                    result.append(self._describe(mac, esp_id, track, now))
+        result.sort(key=lambda item: (item["distance_m"], item["esp_id"]))
+        return result
+
+    def near_esp(self, esp_id, max_distance_m=None, limit=50, now=None):
+        """(pares del ESP, MACs vistas por esp_id a como mucho max_distance_m, de la más cercana a la más lejana)."""
+        now = now if now is not None else time.time()
+        cutoff = now - self.ttl_sec
+        with self._lock:
+            total = self._tracks_by_esp.get(esp_id, 0)
+            result = []
+            if total:
+                for (mac, track_esp_id), track in self._tracks.items():
+                    if track_esp_id == esp_id and track.last_seen >= cutoff:
+                        result.append(self._describe(mac, esp_id, track, now))
+        if max_distance_m is not None:
+            result = [item for item in result if item["distance_m"] <= max_distance_m]
+        result.sort(key=lambda item: (item["distance_m"], item["mac"]))
+        return total, result[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tracks": len(self._tracks),
+                "esps": len(self._tracks_by_esp),
+                "updates": self._updates,
+                "clipped_readings": self._clipped,
+                "evicted_tracks": self._evictions,
+                "max_tracks": self.max_tracks,
+                "ttl_sec": self.ttl_sec,
+                "process_noise": self.process_noise,
+                "measurement_noise": self.measurement_noise,
+                "calibrated_companies": [f"0x{company_id:04X}" for company_id in sorted(self._calibration)],
+            }
+
+    def clear(self):
+        with self._lock:
+            self._tracks.clear()
+            self._tracks_by_esp.clear()
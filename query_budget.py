@@ -0,0 +1,169 @@
+import contextvars
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Pasos de la máquina virtual de SQLite entre dos llamadas al progress handler
+PROGRESS_HANDLER_STEPS = 10000
+# Frecuencia máxima con la que se comprueba si el cliente sigue conectado
+DISCONNECT_POLL_SEC = 0.25
+
+REASON_TIME = 'time'
+REASON_STEPS = 'steps'
+REASON_CANCELLED = 'cancelled'
+
+_current_budget = contextvars.ContextVar('query_budget', default=None)
+
+
+class QueryBudgetExceeded(sqlite3.OperationalError):
+    """Consulta interrumpida por superar su presupuesto o por cancelación."""
+
+    def __init__(self, budget):
+        super().__init__(f"Query budget exceeded ({budget.reason})")
+        self.reason = budget.reason
+        self.elapsed_ms = budget.elapsed_ms()
+
+
+class QueryBudget:
+    """
+    Presupuesto de una petición analítica: tiempo máximo y pasos de la VM de SQLite (aproximación de
+    las filas examinadas). Se comprueba desde el progress handler de cada conexión que ejecuta la
+    consulta, así que una consulta repartida entre shards se interrumpe en todos a la vez.
+    También se cancela si se desconectan todos los clientes que esperan el resultado.
+    """
+
+    def __init__(self, time_ms=None, max_steps=None):
+        self.time_ms = time_ms
+        self.max_steps = max_steps
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + time_ms / 1000.0 if time_ms else None
+        self.steps = 0
+        self.reason = None
+        self._watchers = []
+        self._next_poll = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def exceeded(self):
+        return self.reason is not None
+
+    def elapsed_ms(self):
+        return round((time.monotonic() - self.started_at) * 1000, 1)
+
+    def cancel(self, reason=REASON_CANCELLED):
+        if self.reason is None:
+            self.reason = reason
+
+    def watch(self, is_disconnected):
+        """Añade un cliente (función que indica si se ha desconectado) interesado en el resultado."""
+        with self._lock:
+            self._watchers.append(is_disconnected)
+
+    def _all_clients_gone(self):
+        with self._lock:
+            watchers = list(self._watchers)
+        return bool(watchers) and all(is_disconnected() for is_disconnected in watchers)
+
+    def progress_handler(self):
+        """Devuelve un valor distinto de 0 para que SQLite interrumpa la consulta en curso."""
+        if self.reason is not None:
+            return 1
+        self.steps += PROGRESS_HANDLER_STEPS
+        now = time.monotonic()
+        if self.deadline is not None and now > self.deadline:
+            self.cancel(REASON_TIME)
+        elif self.max_steps is not None and self.steps > self.max_steps:
+            self.cancel(REASON_STEPS)
+        elif now >= self._next_poll:
+            self._next_poll = now + DISCONNECT_POLL_SEC
+            if self._all_clients_gone():
+                self.cancel(REASON_CANCELLED)
+        return 1 if self.reason is not None else 0
+
+
+def current():
+    return _current_budget.get()
+
+
+@contextmanager
+def activate(budget):
+    """Asocia el presupuesto al contexto actual (las consultas lanzadas desde aquí lo respetan)."""
+    token = _current_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_budget.reset(token)
+
+
+@contextmanager
+def enforce(conn, budget):
+    """Aplica el presupuesto a las consultas ejecutadas en conn dentro del bloque."""
+    conn.set_progress_handler(budget.progress_handler, PROGRESS_HANDLER_STEPS)
+    try:
+        yield conn
+    except sqlite3.OperationalError as e:
+        if budget.exceeded and not isinstance(e, QueryBudgetExceeded):
+            raise QueryBudgetExceeded(budget) from e
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+class _Flight:
+    __slots__ = ('budget', 'done', 'result', 'error')
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class QueryCoalescer:
+    """
+    Agrupa peticiones idénticas simultáneas: la primera ejecuta la consulta y las demás esperan y
+    reciben su mismo resultado (o error). La ejecución compartida solo se cancela por desconexión
+    cuando se han ido todos los clientes que la esperan.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    def run(self, key, fn, make_budget, is_disconnected=None):
+        """Ejecuta fn() con el presupuesto de la ejecución compartida activo. Devuelve (resultado, presupuesto)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(make_budget())
+                self._executed += 1
+            else:
+                self._coalesced += 1
+            if is_disconnected is not None:
+                flight.budget.watch(is_disconnected)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, flight.budget
+
+        try:
+            with activate(flight.budget):
+                flight.result = fn()
+            return flight.result, flight.budget
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "executed": self._executed, "coalesced": self._coalesced}
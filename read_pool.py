@@ -0,0 +1,76 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class ReadConnectionPool:
+    """
+    Conexiones SQLite de solo lectura (mode=ro) reutilizables sobre un fichero. Cada consulta toma
+    una conexión libre en lugar de abrir una nueva, así que se ahorra la apertura del fichero, el
+    registro de funciones y la preparación de sentencias repetidas (caché de la conexión).
+    Se crean bajo demanda hasta max_size; por encima, el llamante espera a que se libere una.
+    Ninguna conexión guarda una transacción abierta al devolverse, así que siempre ven los últimos datos confirmados.
+    """
+
+    def __init__(self, database, max_size=8, setup=None):
+        self.database = database
+        self.max_size = max_size
+        self._setup = setup
+        self._idle = queue.LifoQueue()   # LIFO: se reutilizan las conexiones con la caché más caliente
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):
+        uri = Path(self.database).absolute().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        if self._setup is not None:
+            self._setup(conn)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.max_size
+            if can_create:
+                self._created += 1
+        if not can_create:
+            return self._idle.get()
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        """Cierra las conexiones libres (p.ej. tras sustituir el fichero)."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._created -= 1
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {"database": self.database, "open": self._created, "idle": self._idle.qsize(), "max_size": self.max_size}
@@ -0,0 +1,364 @@
+import json
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+
+RULE_MAC_APPEARED = 'mac_appeared'          # Una MAC vigilada aparece (o reaparece tras absent_after_sec)
+RULE_MAC_DISAPPEARED = 'mac_disappeared'    # Una MAC vigilada lleva absent_after_sec sin verse
+RULE_RSSI_ABOVE = 'rssi_above'              # El RSSI de un dispositivo en un ESP sube hasta threshold o más
+RULE_RSSI_BELOW = 'rssi_below'              # El RSSI de un dispositivo en un ESP baja de threshold
+RULE_ESP_SILENT = 'esp_silent'              # Un ESP lleva silent_after_sec sin enviar lotes (ni heartbeats)
+RULE_TYPES = (RULE_MAC_APPEARED, RULE_MAC_DISAPPEARED, RULE_RSSI_ABOVE, RULE_RSSI_BELOW, RULE_ESP_SILENT)
+
+ALL_ESPS = '*'
+
+STATE_FIRING = 'firing'
+STATE_RESOLVED = 'resolved'
+
+DEFAULT_ABSENT_AFTER_SEC = 300
+DEFAULT_SILENT_AFTER_SEC = 120
+# Estados de cruce de RSSI sin actividad durante este tiempo se olvidan en el barrido periódico
+RSSI_STATE_TTL_SEC = 3600
+
+
+class Rule:
+    __slots__ = ('rule_id', 'rule_type', 'name', 'mac', 'esp_id', 'company_id', 'threshold', 'window_sec')
+
+    def __init__(self, rule_id, rule_type, name=None, mac=None, esp_id=None, company_id=None, threshold=None, window_sec=None):
+        self.rule_id = rule_id
+        self.rule_type = rule_type
+        self.name = name or f"{rule_type} #{rule_id}"
+        self.mac = mac
+        self.esp_id = esp_id
+        self.company_id = company_id
+        self.threshold = threshold
+        self.window_sec = window_sec
+
+    @classmethod
+    def from_dict(cls, rule_id, data):
+        """Valida la definición de una regla. Lanza ValueError si no es válida."""
+        rule_type = data.get('type')
+        if rule_type not in RULE_TYPES:
+            raise ValueError(f"'type' must be one of {', '.join(RULE_TYPES)}")
+        mac = data.get('mac')
+        if mac is not None and (not isinstance(mac, str) or len(mac) != 17):
+            raise ValueError("'mac' must be a MAC address (AA:BB:CC:DD:EE:FF)")
+        mac = mac.upper() if mac else None
+        esp_id = data.get('esp_id') or None
+        company_id = data.get('company_id')
+        if company_id is not None:
+            try:
+                company_id = int(company_id, 0) if isinstance(company_id, str) else int(company_id)
+            except (ValueError, TypeError):
+                raise ValueError("'company_id' must be an integer (decimal or 0x004C)")
+
+        threshold = window_sec = None
+        if rule_type in (RULE_MAC_APPEARED, RULE_MAC_DISAPPEARED):
+            if not mac:
+                raise ValueError(f"'{rule_type}' rules require 'mac'")
+            window_sec = data.get('absent_after_sec', DEFAULT_ABSENT_AFTER_SEC)
+        elif rule_type in (RULE_RSSI_ABOVE, RULE_RSSI_BELOW):
+            if not (mac or company_id is not None or esp_id):
+                # Sin ninguna clave indexable la regla se evaluaría para cada advertisement
+                raise ValueError(f"'{rule_type}' rules require 'mac', 'company_id' or 'esp_id'")
+            threshold = data.get('threshold')
+            if isinstance(threshold, bool) or not isinstance(threshold, int):
+                raise ValueError(f"'{rule_type}' rules require an integer 'threshold' (dBm)")
+        else:
+            esp_id = esp_id or ALL_ESPS
+            window_sec = data.get('silent_after_sec', DEFAULT_SILENT_AFTER_SEC)
+        if window_sec is not None and (isinstance(window_sec, bool) or not isinstance(window_sec, (int, float)) or window_sec <= 0):
+            raise ValueError("'absent_after_sec' / 'silent_after_sec' must be a positive number")
+        return cls(rule_id, rule_type, data.get('name'), mac, esp_id, company_id, threshold, window_sec)
+
+    def to_dict(self):
+        result = {"id": self.rule_id, "type": self.rule_type, "name": self.name}
+        for key, value in (("mac", self.mac), ("esp_id", self.esp_id), ("company_id", self.company_id), ("threshold", self.threshold)):
+            if value is not None:
+                result[key] = value
+        if self.window_sec is not None:
+            result["silent_after_sec" if self.rule_type == RULE_ESP_SILENT else "absent_after_sec"] = self.window_sec
+        return result
+
+
+class AlertSink:
+    """
+    Cola local de alertas (las últimas 'capacity', consultables por id creciente) con envío opcional
+    a un webhook desde un hilo propio. Descarta una alerta si la misma (regla, MAC, ESP, estado) se
+    emitió hace menos de dedup_sec.
+    """
+
+    def __init__(self, capacity=1000, dedup_sec=300, webhook_url=None, webhook_timeout_sec=5):
+        self.dedup_sec = dedup_sec
+        self.webhook_url = webhook_url
+        self.webhook_timeout_sec = webhook_timeout_sec
+        self._lock = threading.Lock()
+        self._alerts = deque(maxlen=capacity)
+        self._last_emitted = {}
+        self._next_id = 1
+        self._suppressed = 0
+        self._webhook_queue = queue.Queue(maxsize=capacity) if webhook_url else None
+        self._webhook_thread = None
+        self._webhook_delivered = 0
+        self._webhook_failed = 0
+
+    def emit(self, alert, now):
+        key = (alert['rule_id'], alert.get('mac'), alert.get('esp_id'), alert['state'])
+        with self._lock:
+            last = self._last_emitted.get(key)
+            if last is not None and now - last < self.dedup_sec:
+                self._suppressed += 1
+                return False
+            self._last_emitted[key] = now
+            alert['id'] = self._next_id
+            self._next_id += 1
+            self._alerts.append(alert)
+        if self._webhook_queue is not None:
+            try:
+                self._webhook_queue.put_nowait(alert)
+            except queue.Full:
+                with self._lock:
+                    self._webhook_failed += 1
+        return True
+
+    def prune(self, now):
+        with self._lock:
+            for key in [k for k, ts in self._last_emitted.items() if now - ts >= self.dedup_sec]:
+                del self._last_emitted[key]
+
+    def recent(self, since_id=0, limit=100):
+        """Las últimas limit alertas con id mayor que since_id (ninguna si limit no es positivo)."""
+        if limit <= 0:
+            return []
+        with self._lock:
+            return [alert for alert in self._alerts if alert['id'] > since_id][-limit:]
+
+    def start(self):
+        if self._webhook_queue is None or self._webhook_thread is not None:
+            return
+        self._webhook_thread = threading.Thread(target=self._deliver_loop, name='alert-webhook', daemon=True)
+        self._webhook_thread.start()
+
+    def _deliver_loop(self):
+        while True:
+            alert = self._webhook_queue.get()
+            request = urllib.request.Request(
+                self.webhook_url, data=json.dumps(alert).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}, method='POST'
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=self.webhook_timeout_sec):
+                    pass
+                delivered = True
+            except Exception:
+                delivered = False
+            with self._lock:
+                if delivered:
+                    self._webhook_delivered += 1
+                else:
+                    self._webhook_failed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": len(self._alerts),
+                "last_id": self._next_id - 1,
+                "suppressed_duplicates": self._suppressed,
+                "webhook_url": self.webhook_url,
+                "webhook_delivered": self._webhook_delivered,
+                "webhook_failed": self._webhook_failed,
+            }
+
+
+class RuleEngine:
+    """
+    Evalúa reglas de alerta de forma incremental sobre cada lote ingerido. Las reglas se indexan
+    por MAC, company_id y ESP, así que el coste por advertisement depende solo de las reglas que le
+    afectan y no del total. Las condiciones por ausencia (MAC desaparecida, ESP en silencio) se
+    comprueban en un barrido periódico sobre el estado de las reglas, nunca con consultas SQL.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._rules = {}
+        self._next_rule_id = 1
+        self._by_mac = {}           # mac -> [Rule] (presencia y RSSI)
+        self._by_company = {}       # company_id -> [Rule] (RSSI)
+        self._by_esp = {}           # esp_id -> [Rule] (RSSI sin MAC ni company_id)
+        self._silent_rules = []     # [Rule] de ESPs en silencio
+        self._presence = {}         # rule_id -> [last_seen, presente?]
+        self._rssi_sides = {}       # (rule_id, mac, esp_id) -> [en el lado de alerta?, last_seen]
+        self._esp_last_contact = {}
+        self._silent = set()        # (rule_id, esp_id) con alerta de silencio activa
+        self._sweeper = None
+
+    # --- Gestión de reglas ---
+    def add_rule(self, data):
+        with self._lock:
+            rule = Rule.from_dict(self._next_rule_id, data)
+            self._next_rule_id += 1
+            self._rules[rule.rule_id] = rule
+            self._index_locked(rule)
+            return rule.to_dict()
+
+    def remove_rule(self, rule_id):
+        with self._lock:
+            rule = self._rules.pop(rule_id, None)
+            if rule is None:
+                return False
+            for index, key in ((self._by_mac, rule.mac), (self._by_company, rule.company_id), (self._by_esp, rule.esp_id)):
+                rules = index.get(key)
+                if rules and rule in rules:
+                    rules.remove(rule)
+                    if not rules:
+                        del index[key]
+            if rule in self._silent_rules:
+                self._silent_rules.remove(rule)
+            self._presence.pop(rule_id, None)
+            self._silent = {key for key in self._silent if key[0] != rule_id}
+            return True
+
+    def _index_locked(self, rule):
+        if rule.rule_type == RULE_ESP_SILENT:
+            self._silent_rules.append(rule)
+        elif rule.mac:
+            self._by_mac.setdefault(rule.mac, []).append(rule)
+        elif rule.company_id is not None:
+            self._by_company.setdefault(rule.company_id, []).append(rule)
+        else:
+            self._by_esp.setdefault(rule.esp_id, []).append(rule)
+
+    def rules(self):
+        with self._lock:
+            return [rule.to_dict() for rule in self._rules.values()]
+
+    # --- Evaluación en la ingesta ---
+    def seed_esp_contacts(self, last_contacts):
+        """{esp_id: epoch del último contacto} conocido al arrancar (heartbeats guardados)."""
+        with self._lock:
+            for esp_id, seen_at in last_contacts.items():
+                self._esp_last_contact[esp_id] = max(seen_at, self._esp_last_contact.get(esp_id, 0))
+
+    def observe_batch(self, esp_id, observations, seen_at=None):
+        """observations: iterable de tuplas (mac, rssi, company_id). Un lote vacío cuenta como heartbeat."""
+        seen_at = seen_at if seen_at is not None else time.time()
+        alerts = []
+        with self._lock:
+            self._esp_last_contact[esp_id] = seen_at
+            for rule in self._silent_rules:
+                if (rule.rule_id, esp_id) in self._silent:
+                    self._silent.discard((rule.rule_id, esp_id))
+                    alerts.append(self._alert(rule, STATE_RESOLVED, seen_at, esp_id=esp_id,
+                                              message=f"ESP {esp_id} vuelve a enviar datos"))
+            esp_rules = self._by_esp.get(esp_id, ())
+            for mac, rssi, company_id in observations:
+                mac_key = mac.upper() if mac else mac
+                for rule in self._by_mac.get(mac_key, ()):
+                    self._evaluate_locked(rule, esp_id, mac_key, rssi, seen_at, alerts)
+                if company_id is not None:
+                    for rule in self._by_company.get(company_id, ()):
+                        self._evaluate_locked(rule, esp_id, mac_key, rssi, seen_at, alerts)
+                for rule in esp_rules:
+                    self._evaluate_locked(rule, esp_id, mac_key, rssi, seen_at, alerts)
+        for alert in alerts:
+            self.sink.emit(alert, seen_at)
+
+    def _evaluate_locked(self, rule, esp_id, mac, rssi, seen_at, alerts):
+        if rule.esp_id and rule.esp_id != esp_id:
+            return
+        if rule.rule_type in (RULE_MAC_APPEARED, RULE_MAC_DISAPPEARED):
+            state = self._presence.get(rule.rule_id)
+            was_present = state is not None and state[1] and seen_at - state[0] < rule.window_sec
+            self._presence[rule.rule_id] = [seen_at, True]
+            if rule.rule_type == RULE_MAC_APPEARED and not was_present:
+                alerts.append(self._alert(rule, STATE_FIRING, seen_at, mac=mac, esp_id=esp_id, rssi=rssi,
+                                          message=f"{mac} detectada por {esp_id}"))
+            elif rule.rule_type == RULE_MAC_DISAPPEARED and state is not None and not state[1]:
+                alerts.append(self._alert(rule, STATE_RESOLVED, seen_at, mac=mac, esp_id=esp_id, rssi=rssi,
+                                          message=f"{mac} vuelve a detectarse en {esp_id}"))
+            return
+        if rssi is None:
+            return
+        on_alert_side = rssi >= rule.threshold if rule.rule_type == RULE_RSSI_ABOVE else rssi < rule.threshold
+        key = (rule.rule_id, mac, esp_id)
+        state = self._rssi_sides.get(key)
+        # Solo los cruces de umbral generan alerta; mientras el RSSI sigue del mismo lado no se repite
+        if state is None or state[0] != on_alert_side:
+            if on_alert_side or state is not None:
+                comparison = '>=' if rule.rule_type == RULE_RSSI_ABOVE else '<'
+                alerts.append(self._alert(
+                    rule, STATE_FIRING if on_alert_side else STATE_RESOLVED, seen_at, mac=mac, esp_id=esp_id, rssi=rssi,
+                    message=f"RSSI de {mac} en {esp_id}: {rssi} dBm ({'' if on_alert_side else 'ya no '}{comparison} {rule.threshold})"
+                ))
+            self._rssi_sides[key] = [on_alert_side, seen_at]
+        else:
+            state[1] = seen_at
+
+    # --- Evaluación periódica de ausencias ---
+    def sweep(self, now=None):
+        now = now if now is not None else time.time()
+        alerts = []
+        with self._lock:
+            for rule_id, state in self._presence.items():
+                rule = self._rules[rule_id]
+                if state[1] and now - state[0] >= rule.window_sec:
+                    state[1] = False
+                    if rule.rule_type == RULE_MAC_DISAPPEARED:
+                        alerts.append(self._alert(rule, STATE_FIRING, now, mac=rule.mac, esp_id=rule.esp_id,
+                                                  message=f"{rule.mac} sin detectarse desde hace {int(now - state[0])} s"))
+            for rule in self._silent_rules:
+                esps = self._esp_last_contact if rule.esp_id == ALL_ESPS else {rule.esp_id: self._esp_last_contact.get(rule.esp_id)}
+                for esp_id, last_contact in esps.items():
+                    if last_contact is None or (rule.rule_id, esp_id) in self._silent:
+                        continue
+                    if now - last_contact >= rule.window_sec:
+                        self._silent.add((rule.rule_id, esp_id))
+                        alerts.append(self._alert(rule, STATE_FIRING, now, esp_id=esp_id,
+                                                  message=f"ESP {esp_id} sin contacto desde hace {int(now - last_contact)} s"))
+            for key in [k for k, state in self._rssi_sides.items() if now - state[1] >= RSSI_STATE_TTL_SEC]:
+                del self._rssi_sides[key]
+        for alert in alerts:
+            self.sink.emit(alert, now)
+        self.sink.prune(now)
+        return len(alerts)
+
+    def start(self, interval_sec):
+        """Arranca el hilo de barrido periódico (y el de envío al webhook)."""
+        self.sink.start()
+        if self._sweeper is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(interval_sec)
+                self.sweep()
+
+        self._sweeper = threading.Thread(target=loop, name='alert-sweeper', daemon=True)
+        self._sweeper.start()
+
+    def esp_contacts(self, now=None):
+        """{esp_id: (segundos desde el último contacto, en silencio?)}."""
+        now = now if now is not None else time.time()
+        with self._lock:
+            silent_esps = {esp_id for _, esp_id in self._silent}
+            return {esp_id: (now - seen_at, esp_id in silent_esps) for esp_id, seen_at in self._esp_last_contact.items()}
+
+    def _alert(self, rule, state, now, mac=None, esp_id=None, rssi=None, message=None):
+        alert = {
+            "rule_id": rule.rule_id,
+            "rule_type": rule.rule_type,
+            "rule_name": rule.name,
+            "state": state,
+            "timestamp_utc": time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now)),
+            "message": message,
+        }
+        if mac is not None:
+            alert["mac"] = mac
+        if esp_id is not None:
+            alert["esp_id"] = esp_id
+        if rssi is not None:
+            alert["rssi"] = rssi
+        return alert
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Hueco máximo (segundos) entre dos detecciones de una MAC dentro de la misma visita
+DEFAULT_SESSION_GAP_SEC = 300
+# Las visitas más largas se parten: así cualquier sesión que cubra un instante T empieza como mucho
+# este tiempo antes de T, y las consultas por instante o intervalo son un rango acotado sobre start_time.
+DEFAULT_SESSION_MAX_DURATION_SEC = 86400
+
+SessionRecord = namedtuple('SessionRecord', [
+    'ble_mac_address', 'start_epoch', 'end_epoch', 'esps', 'peak_rssi', 'adv_count'
+])
+
+
+class OpenSession:
+    __slots__ = ('mac', 'start', 'end', 'esps', 'peak_rssi', 'adv_count')
+
+    def __init__(self, mac, seen_at):
+        self.mac = mac
+        self.start = seen_at
+        self.end = seen_at
+        self.esps = set()
+        self.peak_rssi = None
+        self.adv_count = 0
+
+    def add(self, esp_id, rssi, seen_at):
+        self.end = max(self.end, seen_at)
+        self.esps.add(esp_id)
+        self.adv_count += 1
+        if rssi is not None and (self.peak_rssi is None or rssi > self.peak_rssi):
+            self.peak_rssi = rssi
+
+    def to_record(self):
+        return SessionRecord(self.mac, self.start, self.end, sorted(self.esps), self.peak_rssi, self.adv_count)
+
+
+class Sessionizer:
+    """
+    Convierte las advertisements de cada MAC en visitas [inicio, fin]: una visita sigue abierta mientras
+    la MAC vuelva a verse antes de gap_sec. Solo las visitas abiertas viven en memoria, ordenadas por
+    última detección, así que cerrar las caducadas en cada lote recorre únicamente las que se cierran.
+    Las visitas cerradas se devuelven al llamante para que las guarde.
+    """
+
+    def __init__(self, gap_sec=DEFAULT_SESSION_GAP_SEC, max_duration_sec=DEFAULT_SESSION_MAX_DURATION_SEC):
+        self.gap_sec = gap_sec
+        self.max_duration_sec = max_duration_sec
+        self._lock = threading.Lock()
+        self._open = OrderedDict()   # mac -> OpenSession, de última detección más antigua a más reciente
+
+    def __len__(self):
+        return len(self._open)
+
+    def observe_batch(self, esp_id, observations, seen_at=None):
+        """observations: iterable de tuplas (mac, rssi). Devuelve las SessionRecord cerradas."""
+        seen_at = seen_at if seen_at is not None else time.time()
+        closed = []
+        with self._lock:
+            self._close_idle_locked(seen_at, closed)
+            for mac, rssi in observations:
+                self._observe_locked(esp_id, mac, rssi, seen_at, closed)
+        return closed
+
+    def _observe_locked(self, esp_id, mac, rssi, seen_at, closed):
+        session = self._open.get(mac)
+        if session is not None and seen_at < session.end:
+            # Observación antigua (p.ej. durante la reconstrucción): se añade sin alterar el orden
+            session.add(esp_id, rssi, seen_at)
+            return
+        if session is not None and (seen_at - session.end > self.gap_sec or seen_at - session.start >= self.max_duration_sec):
+            closed.append(self._open.pop(mac).to_record())
+            session = None
+        if session is None:
+            session = self._open[mac] = OpenSession(mac, seen_at)
+        else:
+            self._open.move_to_end(mac)
+        session.add(esp_id, rssi, seen_at)
+
+    def _close_idle_locked(self, now, closed):
+        cutoff = now - self.gap_sec
+        while self._open:
+            mac, session = next(iter(self._open.items()))
+            if session.end >= cutoff:
+                break
+            self._open.popitem(last=False)
+            closed.append(session.to_record())
+
+    def close_idle(self, now=None):
+        now = now if now is not None else time.time()
+        closed = []
+        with self._lock:
+            self._close_idle_locked(now, closed)
+        return closed
+
+    def open_sessions(self, start_epoch=None, end_epoch=None, esp_id=None, now=None):
+        """
+        Visitas abiertas que se solapan con [start_epoch, end_epoch], como SessionRecord. Una visita
+        abierta sigue en curso, así que se considera que llega hasta 'now' y no solo hasta su última detección.
+        """
+        now = now if now is not None else time.time()
+        if start_epoch is not None and start_epoch > now:
+            return []
+        with self._lock:
+            return [
+                session.to_record() for session in self._open.values()
+                # Las que ya superan el hueco se cerrarán en el próximo lote: ya no están en curso
+                if session.end >= now - self.gap_sec
+                and (end_epoch is None or session.start <= end_epoch)
+                and (esp_id is None or esp_id in session.esps)
+            ]
+
+    def clear(self):
+        with self._lock:
+            self._open.clear()
@@ -0,0 +1,60 @@
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SHARD = 'default'
+
+
+class ShardRouter:
+    """
+    Enruta cada ESP a un shard (un fichero SQLite con su propio escritor) y ejecuta
+    consultas en paralelo sobre todos los shards.
+    routes: {patrón fnmatch de esp_device_id: nombre de shard}. Se evalúan en orden;
+    los ESPs que no encajan en ningún patrón van al shard por defecto.
+    """
+
+    def __init__(self, routes=None, database_template='ble_data_{shard}.db', max_workers=8):
+        self.routes = list((routes or {}).items())
+        self.database_template = database_template
+        self.max_workers = max_workers
+        self._writer_locks = {}
+        self._locks_guard = threading.Lock()
+        self._executor = None
+
+    def shard_for_esp(self, esp_device_id):
+        for pattern, shard in self.routes:
+            if fnmatch.fnmatchcase(esp_device_id, pattern):
+                return shard
+        return DEFAULT_SHARD
+
+    def all_shards(self):
+        shards = [DEFAULT_SHARD]
+        for _, shard in self.routes:
+            if shard not in shards:
+                shards.append(shard)
+        return shards
+
+    def is_sharded(self):
+        return len(self.all_shards()) > 1
+
+    def database_path(self, shard):
+        """Ruta del fichero de un shard distinto del por defecto (el por defecto es DATABASE_NAME)."""
+        return self.database_template.format(shard=shard)
+
+    def writer_lock(self, shard):
+        """Lock de escritura por shard: los escritores de shards distintos no se bloquean entre sí."""
+        with self._locks_guard:
+            lock = self._writer_locks.get(shard)
+            if lock is None:
+                lock = self._writer_locks[shard] = threading.Lock()
+            return lock
+
+    def map(self, fn, shards=None):
+        """Ejecuta fn(shard) sobre los shards indicados (todos por defecto), en paralelo si hay varios."""
+        shards = list(shards) if shards is not None else self.all_shards()
+        if len(shards) == 1:
+            return [fn(shards[0])]
+        with self._locks_guard:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='shard')
+        return list(self._executor.map(fn, shards))
@@ -0,0 +1,197 @@
+"""
+Simulador del protocolo delta de la ingesta: compara, ciclo a ciclo, el lote completo que envía hoy el
+firmware con el lote delta (referencias 'ref' + RSSI + campos cambiados) para el mismo escaneo.
+Mide los bytes del payload JSON y el tiempo de parseo y reconstrucción en el servidor, y comprueba que
+ambos caminos producen exactamente los mismos registros.
+
+Uso: python simulate_delta_protocol.py [--cycles 500] [--devices 80] [--churn 0.05] [--restart-every 0]
+
+--restart-every N simula un reinicio del servidor (estado delta perdido) cada N ciclos: el ESP recibe
+resync_required y reenvía ese lote completo con un stateId nuevo.
+DeltaEncoder es la referencia de la parte del ESP.
+"""
+import argparse
+import json
+import logging
+import random
+import statistics
+import time
+
+import backend_server
+import ingest_control
+
+APPLE_COMPANY_PREFIX = '4C00'
+SERVICE_UUIDS = ['0000fe9f-0000-1000-8000-00805f9b34fb', '0000feaa-0000-1000-8000-00805f9b34fb',
+                 '0000180f-0000-1000-8000-00805f9b34fb', '0000fd6f-0000-1000-8000-00805f9b34fb',
+                 '6e400001-b5a3-f393-e0a9-e50e24dcca9e']
+NAMES = ['iPhone', 'Galaxy Buds2', 'Mi Smart Band 6', 'Tile', 'LE-Bose QC35', 'Forerunner 245', None, None, None]
+
+
+class DeltaEncoder:
+    """
+    Lado del ESP: recuerda el último conjunto de campos enviado por MAC y la referencia asignada. Con la
+    tabla llena reutiliza la referencia de la MAC enviada hace más tiempo (redefinida con 'macAddress').
+    """
+
+    def __init__(self, max_refs=ingest_control.DELTA_MAX_REFS_PER_ESP):
+        self.max_refs = max_refs
+        self.reset()
+
+    def reset(self):
+        """Tabla vacía con un stateId nuevo (arranque o tras resync_required)."""
+        self.state_id = random.getrandbits(31)
+        self._sent = {}   # mac -> [ref, campos, último ciclo enviado]
+        self._free_refs = list(range(self.max_refs - 1, -1, -1))
+        self._cycle = 0
+
+    def encode(self, devices):
+        self._cycle += 1
+        entries = []
+        for device in devices:
+            mac = device['macAddress']
+            fields = {key: device[key] for key in ingest_control.DELTA_FIELDS if key in device}
+            known = self._sent.get(mac)
+            if known is None:
+                known = self._sent[mac] = [self._allocate_ref(), fields, self._cycle]
+                entry = dict(fields, ref=known[0], macAddress=mac)
+            else:
+                entry = {'ref': known[0]}
+                previous = known[1]
+                for key in ingest_control.DELTA_FIELDS:
+                    if previous.get(key) != fields.get(key):
+                        entry[key] = fields.get(key)   # None -> null: el campo desaparece
+                known[1], known[2] = fields, self._cycle
+            if 'rssi' in device:
+                entry['rssi'] = device['rssi']
+            entries.append(entry)
+        return entries
+
+    def _allocate_ref(self):
+        if self._free_refs:
+            return self._free_refs.pop()
+        oldest_mac = min(self._sent, key=lambda mac: self._sent[mac][2])
+        return self._sent.pop(oldest_mac)[0]
+
+
+class Population:
+    """Dispositivos alrededor de un ESP: la mayoría estáticos, con rotación de presentes y de datos de fabricante."""
+
+    def __init__(self, size, rnd):
+        self.rnd = rnd
+        self.devices = [self._new_device(i) for i in range(size)]
+        self._next_id = size
+
+    def _new_device(self, i):
+        rnd = self.rnd
+        device = {'macAddress': ':'.join(f"{b:02X}" for b in (0xC0 | rnd.randrange(64), rnd.randrange(256), i >> 16 & 0xFF, i >> 8 & 0xFF, i & 0xFF, rnd.randrange(256)))}
+        name = rnd.choice(NAMES)
+        if name:
+            device['deviceName'] = name
+        if rnd.random() < 0.8:
+            device['manufacturerData'] = APPLE_COMPANY_PREFIX + ''.join(f"{rnd.randrange(256):02x}" for _ in range(rnd.randrange(8, 26)))
+        if rnd.random() < 0.5:
+            device['serviceUUIDs'] = rnd.sample(SERVICE_UUIDS, rnd.randrange(1, 3))
+        if rnd.random() < 0.3:
+            device['serviceData'] = {SERVICE_UUIDS[0]: ''.join(f"{rnd.randrange(256):02x}" for _ in range(12))}
+        if rnd.random() < 0.4:
+            device['txPower'] = rnd.choice([-12, -8, -4, 0, 4])
+        if rnd.random() < 0.2:
+            device['appearance'] = rnd.choice([64, 192, 961])
+        device['_base_rssi'] = rnd.randrange(-95, -45)
+        return device
+
+    def scan(self, churn):
+        rnd = self.rnd
+        for i, device in enumerate(self.devices):
+            if rnd.random() < churn:
+                self.devices[i] = self._new_device(self._next_id)
+                self._next_id += 1
+            elif 'manufacturerData' in device and rnd.random() < 0.02:
+                # Datos de fabricante que rotan (p.ej. Apple Continuity)
+                data = device['manufacturerData']
+                device['manufacturerData'] = data[:-4] + f"{rnd.randrange(65536):04x}"
+        visible = [device for device in self.devices if rnd.random() < 0.9]
+        return [{key: value for key, value in dict(device, rssi=device['_base_rssi'] + rnd.randrange(-6, 7)).items()
+                 if not key.startswith('_')} for device in visible]
+
+
+def parse_full(payload, esp_device_id):
+    data = json.loads(payload)
+    records = []
+    for device_data in data['devices']:
+        record = backend_server.parse_device_fields(device_data, esp_device_id)
+        if record is not None:
+            records.append(record._replace(ble_rssi=backend_server.parse_rssi(device_data.get('rssi'), record.ble_mac_address, esp_device_id)))
+    return records
+
+
+def parse_delta(payload, cache, esp_device_id):
+    data = json.loads(payload)
+    parsed, unknown_refs = cache.expand(esp_device_id, data['stateId'], data['devices'],
+                                        lambda fields: backend_server.parse_device_fields(fields, esp_device_id))
+    if unknown_refs:
+        return None
+    return [record._replace(ble_rssi=backend_server.parse_rssi(rssi, record.ble_mac_address, esp_device_id))
+            for record, rssi in parsed if record is not None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cycles', type=int, default=500)
+    parser.add_argument('--devices', type=int, default=80)
+    parser.add_argument('--churn', type=float, default=0.05, help='Probabilidad por ciclo de que un dispositivo sea sustituido por otro')
+    parser.add_argument('--restart-every', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    backend_server.app.logger.setLevel(logging.ERROR)
+
+    rnd = random.Random(args.seed)
+    random.seed(args.seed)
+    population = Population(args.devices, rnd)
+    encoder = DeltaEncoder()
+    cache = ingest_control.DeltaStateCache()
+    esp_device_id = 'ESP_SIM'
+    full_bytes, delta_bytes, full_ms, delta_ms = [], [], [], []
+    resyncs = 0
+    for cycle in range(1, args.cycles + 1):
+        devices = population.scan(args.churn)
+        header = {"deviceId": esp_device_id, "scanIntervalSec": 10, "bootId": 1, "batchSeq": cycle}
+        full_payload = json.dumps(dict(header, devices=devices), separators=(',', ':'))
+        if args.restart_every and cycle % args.restart_every == 0:
+            cache = ingest_control.DeltaStateCache()
+
+        delta_payload = json.dumps(dict(header, stateId=encoder.state_id, devices=encoder.encode(devices)), separators=(',', ':'))
+        started = time.perf_counter()
+        delta_records = parse_delta(delta_payload, cache, esp_device_id)
+        if delta_records is None:
+            # Estado perdido en el servidor: el ESP recibe resync_required y reenvía el lote completo
+            resyncs += 1
+            encoder.reset()
+            delta_bytes.append(len(delta_payload))
+            delta_payload = json.dumps(dict(header, stateId=encoder.state_id, devices=encoder.encode(devices)), separators=(',', ':'))
+            delta_records = parse_delta(delta_payload, cache, esp_device_id)
+            delta_bytes[-1] += len(delta_payload)
+        else:
+            delta_bytes.append(len(delta_payload))
+        delta_ms.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        full_records = parse_full(full_payload, esp_device_id)
+        full_ms.append((time.perf_counter() - started) * 1000)
+        full_bytes.append(len(full_payload))
+        if full_records != delta_records:
+            raise SystemExit(f"Ciclo {cycle}: los registros reconstruidos no coinciden con los del lote completo")
+
+    total_full, total_delta = sum(full_bytes), sum(delta_bytes)
+    print(f"\nCiclos: {args.cycles}, dispositivos por escaneo: ~{int(args.devices * 0.9)}, churn: {args.churn}, resincronizaciones: {resyncs}")
+    print(f"{'protocolo':<11}{'bytes/lote':>12}{'total KiB':>12}{'p50 parseo ms':>15}{'p95 parseo ms':>15}")
+    for name, sizes, timings in (('completo', full_bytes, full_ms), ('delta', delta_bytes, delta_ms)):
+        ordered = sorted(timings)
+        print(f"{name:<11}{statistics.mean(sizes):>12.0f}{sum(sizes) / 1024:>12.1f}"
+              f"{statistics.median(timings):>15.3f}{ordered[int(0.95 * (len(ordered) - 1))]:>15.3f}")
+    print(f"Ahorro de ancho de banda: {100 * (1 - total_delta / total_full):.1f} %. Registros idénticos en todos los ciclos.")
+    print(f"Estado del servidor: {json.dumps(cache.stats())}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Simulador de la federación multi-sede: arranca varias instancias locales del backend (una por "edificio",
+cada una en su propio proceso y con su propia base de datos), con poblaciones de MACs que se solapan
+(personas que pasan por varios edificios), y compara la vista agregada de /api/federation/overview con
+los valores exactos calculados a partir de las filas generadas.
+
+Uso: python simulate_federation.py [--sites 3] [--rows 200000] [--local-macs 3000] [--shared-macs 1500]
+
+Al final detiene una de las sedes para mostrar cómo el agregador sigue usando su último resumen
+(from_cache, staleness_sec) y marca la vista como parcial cuando no hay ninguno.
+"""
+import argparse
+import calendar
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import backend_server
+import ble_utils
+import federation
+import sketches
+
+COMPANY_IDS = [0x004C, 0x0006, 0x0075, 0x00E0, 0x0087, 0x0157]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def seed_site(database_path, rows, macs, start_epoch, end_epoch, rnd):
+    """Crea la base de datos de una sede con detecciones repartidas en [start_epoch, end_epoch) y reconstruye sus resúmenes."""
+    backend_server.DATABASE_NAME = database_path
+    backend_server.init_db()
+    company_of = {mac: rnd.choice(COMPANY_IDS) for mac in macs}
+    generated = [(start_epoch + rnd.random() * (end_epoch - start_epoch), f"ESP_{rnd.randrange(4)}", rnd.choice(macs))
+                 for _ in range(rows)]
+    conn = sqlite3.connect(database_path)
+    conn.executemany(
+        "INSERT INTO scanned_devices (timestamp, esp_device_id, ble_mac_address, ble_rssi, manufacturer_data, company_id) "
+        "VALUES (datetime(?, 'unixepoch'), ?, ?, ?, ?, ?)",
+        ((ts, esp, mac, rnd.randrange(-100, -30), f"{company_of[mac] & 0xFF:02X}{company_of[mac] >> 8:02X}0215", company_of[mac])
+         for ts, esp, mac in generated)
+    )
+    # Los resúmenes derivados (sketches, histogramas, inventario) se reconstruyen desde scanned_devices
+    for table in backend_server.DERIVED_SHARD_TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.commit()
+    conn.close()
+    backend_server.init_db()
+    return generated, company_of
+
+
+def serve_site(database_path, port, site_name):
+    """Modo interno: una sede servida por Werkzeug en este proceso."""
+    from werkzeug.serving import make_server
+    backend_server.DATABASE_NAME = database_path
+    backend_server.FEDERATION_SITE_NAME = site_name
+    backend_server.app.logger.setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    make_server('127.0.0.1', port, backend_server.app, threaded=True).serve_forever()
+
+
+def wait_until_up(url, timeout_sec=30):
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + '/api/federation/summary?startDate=2000-01-01&endDate=2000-01-01', timeout=2):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"La sede {url} no ha arrancado")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sites', type=int, default=3)
+    parser.add_argument('--rows', type=int, default=200000, help='Detecciones por sede')
+    parser.add_argument('--local-macs', type=int, default=3000, help='MACs vistas solo en cada sede')
+    parser.add_argument('--shared-macs', type=int, default=1500, help='MACs que pasan por todas las sedes')
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--serve-site', nargs=3, metavar=('DATABASE', 'PORT', 'NAME'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve_site:
+        serve_site(args.serve_site[0], int(args.serve_site[1]), args.serve_site[2])
+        return
+    backend_server.app.logger.setLevel(logging.ERROR)
+
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='ble_federation_')
+    end_date = datetime.now(backend_server.TARGET_TIMEZONE_PYTZ).date()
+    start_date = end_date - timedelta(days=args.days - 1)
+    start_utc, end_utc = backend_server.local_date_range_to_utc(start_date, end_date)
+    start_epoch = calendar.timegm(time.strptime(start_utc, '%Y-%m-%d %H:%M:%S'))
+    end_epoch = min(time.time(), calendar.timegm(time.strptime(end_utc, '%Y-%m-%d %H:%M:%S')))
+
+    shared = [f"5A:00:00:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}" for i in range(args.shared_macs)]
+    union_macs, union_advertisements = set(), 0
+    devices_by_manufacturer = defaultdict(int)
+    sites, processes = {}, []
+    for site in range(args.sites):
+        name = f"edificio_{chr(ord('a') + site)}"
+        local = [f"5A:{site + 1:02X}:00:{i >> 16 & 0xFF:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}" for i in range(args.local_macs)]
+        database_path = os.path.join(workdir, f"{name}.db")
+        started = time.perf_counter()
+        generated, company_of = seed_site(database_path, args.rows, local + shared, start_epoch, end_epoch, rnd)
+        print(f"Sede {name}: {len(generated)} filas generadas en {time.perf_counter() - started:.1f} s")
+        seen = {mac for _, _, mac in generated}
+        union_macs |= seen
+        union_advertisements += len(generated)
+        for mac in seen:
+            devices_by_manufacturer[ble_utils.COMPANY_IDENTIFIERS.get(company_of[mac], 'Desconocido/Otro')] += 1
+        port = free_port()
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve-site', database_path, str(port), name]))
+        sites[name] = f"http://127.0.0.1:{port}"
+
+    try:
+        for url in sites.values():
+            wait_until_up(url)
+        backend_server.federation_aggregator = federation.FederationAggregator(sites, cache_sec=60, timeout_sec=10)
+        client = backend_server.app.test_client()
+        url = f"/api/federation/overview?startDate={start_date.isoformat()}&endDate={end_date.isoformat()}&topN=10"
+
+        started = time.perf_counter()
+        overview = client.get(url).get_json()
+        cold_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        client.get(url)
+        cached_ms = (time.perf_counter() - started) * 1000
+
+        summary_bytes = [len(json.dumps(result["summary"])) for result in
+                         backend_server.federation_aggregator.collect({"startDate": start_date.isoformat(), "endDate": end_date.isoformat()})]
+        summed_uniques = sum(site["unique_devices"] for site in overview["sites"])
+        error = overview["unique_devices"] / len(union_macs) - 1
+        print(f"\nSedes: {args.sites}, rango {start_date} .. {end_date}")
+        print(f"Dispositivos distintos: federado {overview['unique_devices']}, exacto {len(union_macs)} "
+              f"(error {100 * error:+.2f} %, error estándar del sketch {100 * sketches.HLL_RELATIVE_STD_ERROR:.1f} %); "
+              f"sumando las sedes saldrían {summed_uniques}")
+        print(f"Advertisements: federado {overview['advertisements']}, exacto {union_advertisements}")
+        exact_manufacturers = sorted(devices_by_manufacturer.items(), key=lambda item: (-item[1], item[0]))
+        print(f"Fabricantes (dispositivos por sede, sumados): {dict(zip(overview['manufacturers']['labels'], overview['manufacturers']['data']))}")
+        print(f"  exacto: {dict(exact_manufacturers)}")
+        print(f"Hora pico (local): {max(zip(overview['peak_hours']['data'], overview['peak_hours']['labels']))[1]}, "
+              f"percentiles de RSSI: {overview['rssi_percentiles']}")
+        print(f"Tamaño de los resúmenes: {', '.join(f'{size / 1024:.1f} KiB' for size in summary_bytes)} "
+              f"(frente a {args.rows} filas por sede)")
+        print(f"Latencia del agregador: {cold_ms:.0f} ms en frío, {cached_ms:.1f} ms con caché")
+        if overview['advertisements'] != union_advertisements:
+            raise SystemExit("Los advertisements agregados no coinciden con los exactos")
+        if abs(error) > 4 * sketches.HLL_RELATIVE_STD_ERROR:
+            raise SystemExit("La estimación federada de dispositivos distintos se sale de la cota del sketch")
+
+        # Una sede cae: el agregador sirve su último resumen y después, sin caché para el rango, la deja fuera
+        processes[0].terminate()
+        processes[0].wait()
+        backend_server.federation_aggregator.cache_sec = 0
+        time.sleep(1)
+        degraded = client.get(url).get_json()
+        print(f"\nCon {list(sites)[0]} caída: partial={degraded['partial']}, sedes incluidas {degraded['sites_included']}")
+        for site in degraded['sites']:
+            print(f"  {site['site']}: ok={site['ok']} from_cache={site['from_cache']} staleness_sec={site['staleness_sec']} error={site['error']}")
+        other_range = client.get(f"/api/federation/overview?startDate={end_date.isoformat()}&endDate={end_date.isoformat()}").get_json()
+        print(f"Rango sin resumen en caché: partial={other_range['partial']}, sedes incluidas {other_range['sites_included']}")
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
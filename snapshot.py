@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class SnapshotReplica:
+    """
+    Réplica de solo lectura del fichero SQLite de un shard para las consultas analíticas. Se crea con
+    la API de backup de SQLite y después se pone al día copiando solo las filas nuevas o cambiadas,
+    así que las lecturas largas no compiten con el escritor de la ingesta por los locks del fichero original.
+    La réplica usa WAL: su refresco no espera a las lecturas en curso ni las bloquea.
+    """
+
+    def __init__(self, shard, source_path, replica_path):
+        self.shard = shard
+        self.source_path = source_path
+        self.replica_path = replica_path
+        self.ready = False
+        self.refreshed_at = None      # Epoch del inicio del último refresco completado: los datos son al menos de ese instante
+        self.last_refresh_ms = None
+        self.refreshes = 0
+        self.rows_copied = 0
+        self.errors = 0
+        self.last_error = None
+        self.state = {}               # Marcas de agua de la copia incremental (p.ej. último id copiado)
+        self.writer = None            # Conexión de escritura del refresco; abierta mantiene los ficheros WAL para los lectores
+
+    def create(self):
+        """
+        Copia completa con la API de backup (en un solo paso: copia consistente). Se hace en un fichero
+        temporal que luego sustituye a la réplica, así que debe llamarse antes de abrir lectores sobre ella.
+        """
+        started = time.time()
+        temporary_path = self.replica_path + '.tmp'
+        for path in (temporary_path, temporary_path + '-wal', temporary_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        source = sqlite3.connect(self.source_path)
+        target = sqlite3.connect(temporary_path)
+        try:
+            source.backup(target)
+            target.execute('PRAGMA journal_mode=WAL')
+        finally:
+            target.close()
+            source.close()
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.replica_path + suffix):
+                os.remove(self.replica_path + suffix)
+        if self.writer is not None:
+            self.writer.close()
+        os.replace(temporary_path, self.replica_path)
+        self.writer = sqlite3.connect(self.replica_path, check_same_thread=False)
+        self.state = {}
+        self.refreshed_at = started
+        self.last_refresh_ms = round((time.time() - started) * 1000, 1)
+        self.ready = True
+
+    def staleness_sec(self, now=None):
+        if self.refreshed_at is None:
+            return None
+        return max(0.0, (now if now is not None else time.time()) - self.refreshed_at)
+
+    def stats(self, now=None):
+        staleness = self.staleness_sec(now)
+        return {
+            "shard": self.shard,
+            "replica_path": self.replica_path,
+            "ready": self.ready,
+            "staleness_sec": round(staleness, 1) if staleness is not None else None,
+            "last_refresh_ms": self.last_refresh_ms,
+            "refreshes": self.refreshes,
+            "rows_copied": self.rows_copied,
+            "errors": self.errors,
+            "last_error": self.last_error,
+        }
+
+
+class SnapshotReplicator:
+    """
+    Mantiene las réplicas de todos los shards: un hilo llama a refresh_fn(replica) cada interval_sec.
+    refresh_fn copia los cambios y devuelve el número de filas copiadas; si falla, la réplica sigue
+    sirviendo los datos anteriores y su antigüedad (staleness) crece hasta el siguiente refresco correcto.
+    """
+
+    def __init__(self, refresh_fn, interval_sec=30):
+        self.refresh_fn = refresh_fn
+        self.interval_sec = interval_sec
+        self._replicas = {}
+        self._lock = threading.Lock()   # Un solo refresco a la vez (hilo periódico o llamada manual)
+        self._thread = None
+
+    def add(self, replica):
+        self._replicas[replica.shard] = replica
+
+    def get(self, shard):
+        replica = self._replicas.get(shard)
+        return replica if replica is not None and replica.ready else None
+
+    def replicas(self):
+        return list(self._replicas.values())
+
+    def refresh_all(self):
+        with self._lock:
+            for replica in self._replicas.values():
+                if not replica.ready:
+                    continue
+                started = time.time()
+                try:
+                    copied = self.refresh_fn(replica)
+                except sqlite3.Error as e:
+                    replica.errors += 1
+                    replica.last_error = str(e)
+                    continue
+                except Exception as e:
+                    # P.ej. disco lleno o un sketch inválido: se registra y el hilo de refresco sigue vivo
+                    replica.errors += 1
+                    replica.last_error = f"{type(e).__name__}: {e}"
+                    continue
+                replica.refreshed_at = started
+                replica.last_refresh_ms = round((time.time() - started) * 1000, 1)
+                replica.refreshes += 1
+                replica.rows_copied += copied
+
+    def max_staleness_sec(self, shards=None, now=None):
+        """Antigüedad de la réplica más atrasada (entre los shards indicados), o None si no hay réplicas listas."""
+        now = now if now is not None else time.time()
+        values = [replica.staleness_sec(now) for shard, replica in self._replicas.items()
+                  if replica.ready and (shards is None or shard in shards)]
+        return max(values) if values else None
+
+    def start(self):
+        """Arranca el hilo de refresco periódico."""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.interval_sec)
+                self.refresh_all()
+
+        self._thread = threading.Thread(target=loop, name='snapshot-refresh', daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        now = time.time()
+        max_staleness = self.max_staleness_sec(now=now)
+        return {
+            "interval_sec": self.interval_sec,
+            "max_staleness_sec": round(max_staleness, 1) if max_staleness is not None else None,
+            "replicas": [replica.stats(now) for replica in self._replicas.values()],
+        }
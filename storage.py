@@ -0,0 +1,785 @@
+"""
+Interfaz de almacenamiento usada por la ingesta y los endpoints de consulta, y motor en memoria.
+
+StorageBackend define las operaciones que necesitan las rutas; el backend SQLite (por shards) vive en
+backend_server.py y MemoryStorage guarda las filas en columnas (array) sin E/S de disco, para pruebas,
+benchmarks y despliegues efímeros. Los timestamps se intercambian como texto UTC 'YYYY-MM-DD HH:MM:SS'
+(el formato de CURRENT_TIMESTAMP en SQLite) y los rangos son semiabiertos [inicio, fin).
+"""
+import bisect
+import calendar
+import itertools
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict, namedtuple
+
+import ble_utils
+import fingerprint
+import sharding
+import sketches
+
+# Advertisement ya validada y normalizada por la ingesta
+ScanRecord = namedtuple('ScanRecord', (
+    'ble_mac_address', 'ble_device_name', 'ble_rssi', 'manufacturer_data', 'service_data',
+    'service_uuids', 'service_uuids_list', 'tx_power', 'appearance', 'company_id'
+))
+
+# Resultado de device_changes. cursor: {shard: (época, change_seq, mac)} del último cambio entregado
+DeviceChanges = namedtuple('DeviceChanges', ('devices', 'cursor', 'resync_required', 'has_more'))
+
+# Columnas de ordenación admitidas por list_devices
+DEVICE_SORT_COLUMNS = ('last_seen_timestamp', 'ble_mac_address', 'best_ble_device_name', 'manufacturer_name', 'adv_packets_count')
+
+# Rangos de los histogramas de RSSI: (umbral inferior inclusivo, etiqueta), del más fuerte al más débil
+RSSI_RANGES = (
+    (-50, '-50 a 0 dBm'),
+    (-60, '-60 a -51 dBm'),
+    (-70, '-70 a -61 dBm'),
+    (-80, '-80 a -71 dBm'),
+    (-90, '-90 a -81 dBm'),
+    (None, '< -90 dBm'),
+)
+
+# Rangos de duración de visita (límite superior exclusivo en segundos, etiqueta); el último recoge el resto
+DWELL_BUCKETS = (
+    (60, '< 1 min'),
+    (300, '1-5 min'),
+    (900, '5-15 min'),
+    (1800, '15-30 min'),
+    (3600, '30-60 min'),
+    (7200, '1-2 h'),
+    (None, '>= 2 h'),
+)
+
+UTC_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Agrupaciones de rssi_percentile_histograms
+PERCENTILE_GROUPINGS = ('none', 'esp', 'hour', 'esp_hour')
+
+
+def dwell_bucket_label(duration_sec):
+    for upper, label in DWELL_BUCKETS:
+        if upper is None or duration_sec < upper:
+            return label
+
+
+def rssi_range_label(rssi):
+    for threshold, label in RSSI_RANGES:
+        if threshold is None or rssi >= threshold:
+            return label
+
+
+def rank_manufacturers(company_counts, top_n):
+    """Top-N de fabricantes por número de dispositivos y resto agrupado en 'Otros'. company_counts: {company_id: n}."""
+    counts = defaultdict(int)
+    for company_id, count in company_counts.items():
+        counts[ble_utils.COMPANY_IDENTIFIERS.get(company_id, 'Desconocido/Otro')] += count
+    ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    result = ranked[:top_n]
+    if len(ranked) > top_n:
+        result.append(('Otros', sum(count for _, count in ranked[top_n:])))
+    return result
+
+
+def percentile_group_key(group_by, esp_id, hour_bucket):
+    """Clave de un grupo de rssi_percentile_histograms: 'total', el ESP, la hora UTC o (ESP, hora UTC)."""
+    if group_by == 'esp':
+        return esp_id
+    if group_by == 'hour':
+        return hour_bucket
+    if group_by == 'esp_hour':
+        return (esp_id, hour_bucket)
+    return 'total'
+
+
+def points_to_series(points, limit):
+    """Puntos (epoch, rssi, esp) en orden cronológico -> {esp: (epochs, rssis)} con como mucho limit puntos."""
+    series = {}
+    for epoch, rssi, esp_id in itertools.islice(points, limit):
+        columns = series.get(esp_id)
+        if columns is None:
+            columns = series[esp_id] = ([], [])
+        columns[0].append(epoch)
+        columns[1].append(rssi)
+    return series
+
+
+def utc_string_to_epoch(utc_timestamp_str):
+    return calendar.timegm(time.strptime(utc_timestamp_str[:19], UTC_TIMESTAMP_FORMAT))
+
+
+def epoch_to_utc_string(epoch):
+    return time.strftime(UTC_TIMESTAMP_FORMAT, time.gmtime(epoch))
+
+
+def session_record_to_dict(record):
+    """Una sessions.SessionRecord con el formato de sessions_overlapping."""
+    return {
+        "ble_mac_address": record.ble_mac_address,
+        "start_utc": epoch_to_utc_string(record.start_epoch),
+        "end_utc": epoch_to_utc_string(record.end_epoch),
+        "duration_sec": int(round(record.end_epoch - record.start_epoch)),
+        "esps": list(record.esps),
+        "peak_rssi": record.peak_rssi,
+        "adv_count": record.adv_count,
+    }
+
+
+def history_order_key(row):
+    """Orden total del historial de una MAC: (timestamp_utc, esp_device_id, id), único aunque haya shards."""
+    return (row['timestamp_utc'], row['esp_device_id'], row['id'])
+
+
+class StorageBackend:
+    """
+    Operaciones de datos de la ingesta y de los endpoints de consulta.
+
+    filters (list_devices / count_devices) es un dict con claves opcionales: name (subcadena),
+    name_prefix, company_id, esp_id, service_uuid, min_rssi (RSSI máximo del dispositivo) y
+    last_seen_from / last_seen_to (límites UTC de la última detección).
+    """
+
+    def init(self):
+        """Prepara el almacenamiento (esquema, índices, backfills)."""
+
+    def store_batch(self, esp_device_id, records):
+        """Guarda un lote de ScanRecord de un ESP de forma atómica."""
+        raise NotImplementedError
+
+    def recent_observations(self, since_utc):
+        """Filas (timestamp, esp_device_id, ble_mac_address, ble_device_name, ble_rssi, tx_power, company_id) desde since_utc, en orden cronológico."""
+        raise NotImplementedError
+
+    def device_history(self, mac_address, limit):
+        """Últimas advertisements de una MAC, de la más reciente a la más antigua."""
+        raise NotImplementedError
+
+    def device_history_batch(self, befores, limit):
+        """
+        {mac: filas} con hasta 'limit' advertisements por MAC, como device_history pero ordenadas por
+        history_order_key descendente. befores es {mac: clave de la última fila ya servida o None}.
+        """
+        raise NotImplementedError
+
+    def count_devices(self, filters, exact):
+        """(número de MACs que cumplen filters, aproximado?)."""
+        raise NotImplementedError
+
+    def list_devices(self, filters, sort_by, sort_order, limit, offset=0, after=None):
+        """
+        Resumen por MAC (ble_mac_address, max_timestamp_utc, adv_packets_count, best_ble_device_name,
+        last_manufacturer_data, sort_value) ordenado por sort_by y MAC. after=(sort_value, mac) pagina por cursor.
+        """
+        raise NotImplementedError
+
+    def device_changes(self, since, limit):
+        """
+        Sincronización incremental del inventario: DeviceChanges con los resúmenes (como list_devices) de
+        las MACs que cambiaron después de la posición since de cada shard, hasta 'limit' por shard en orden
+        de cambio. since=None empieza desde el principio. Si since es de otra
+        época (inventario reconstruido), de otro reparto de shards o está por delante de los datos,
+        resync_required=True, sin dispositivos y con un cursor desde el principio.
+        """
+        raise NotImplementedError
+
+    def count_clusters(self, address_type=None):
+        """(clusters, MACs asignadas) con el tipo de dirección indicado o en total."""
+        raise NotImplementedError
+
+    def list_clusters(self, address_type, limit, offset):
+        """Clusters ordenados por última detección descendente."""
+        raise NotImplementedError
+
+    def get_cluster(self, cluster_id, mac_limit):
+        """Detalle de un cluster con sus MACs ('macs'), o None si no existe."""
+        raise NotImplementedError
+
+    def activity_counts(self, mac_address, time_format, start_utc=None, end_utc=None):
+        """{strftime(time_format, hora local): nº de advertisements} de una MAC."""
+        raise NotImplementedError
+
+    def distinct_counts(self, group_by, start_utc=None, end_utc=None, esp_ids=None, exact=True):
+        """
+        ({clave: MACs distintas}, aproximado?) agrupando por 'none' (clave 'total'), 'esp' o
+        'hour_of_day' (clave 'HH' en hora local).
+        """
+        raise NotImplementedError
+
+    def distinct_sketches(self, group_by, start_utc=None, end_utc=None, esp_ids=None):
+        """
+        {clave: sketches.HyperLogLog} de las MACs vistas, con las mismas claves que distinct_counts. Son
+        mergeables con los de otros shards o instancias (p.ej. los resúmenes de la federación multi-sede).
+        """
+        raise NotImplementedError
+
+    def manufacturer_ranking(self, start_utc, end_utc, top_n):
+        """[(fabricante, dispositivos)] según el último company_id de cada MAC, Top-N más 'Otros'."""
+        raise NotImplementedError
+
+    def rssi_points(self, mac_address, start_utc=None, end_utc=None, esp_id=None, limit=1000):
+        """Filas (timestamp_utc, ble_rssi, esp_device_id) con RSSI de una MAC, en orden cronológico."""
+        raise NotImplementedError
+
+    def rssi_series(self, mac_address, start_utc=None, end_utc=None, esp_id=None, limit=1000):
+        """
+        Los mismos puntos que rssi_points en columnas: {esp_device_id: (epochs, rssis)}, listas paralelas
+        en orden cronológico y ESPs en el orden de su primer punto.
+        """
+        raise NotImplementedError
+
+    def rssi_histogram(self, esp_id=None, start_utc=None, end_utc=None):
+        """{etiqueta de RSSI_RANGES: nº de advertisements}."""
+        raise NotImplementedError
+
+    def rssi_percentile_histograms(self, group_by, start_utc=None, end_utc=None, esp_ids=None, exact=False):
+        """
+        {clave: sketches.ValueHistogram de RSSI} agrupando según PERCENTILE_GROUPINGS (claves de
+        percentile_group_key; horas UTC 'YYYY-MM-DD HH:00:00'). Con exact=False se unen los histogramas
+        guardados por (ESP, hora/día); con exact=True se recorren las filas. El resultado es el mismo.
+        """
+        raise NotImplementedError
+
+    def known_esps(self):
+        raise NotImplementedError
+
+    def esps_for_mac(self, mac_address):
+        raise NotImplementedError
+
+    def esp_heartbeats(self):
+        """[{esp_device_id, first_contact_utc, last_contact_utc, last_batch_size, batches}] ordenados por ESP."""
+        raise NotImplementedError
+
+    def store_sessions(self, session_records):
+        """Guarda visitas cerradas (sessions.SessionRecord)."""
+        raise NotImplementedError
+
+    def sessions_overlapping(self, start_utc, end_utc, max_duration_sec, esp_id=None, limit=None):
+        """
+        Visitas guardadas que se solapan con [start_utc, end_utc], por inicio ascendente: dicts con
+        ble_mac_address, start_utc, end_utc, duration_sec, esps, peak_rssi y adv_count. Ninguna visita
+        dura más de max_duration_sec, lo que acota la búsqueda por inicio.
+        """
+        raise NotImplementedError
+
+    def dwell_histogram(self, start_utc=None, end_utc=None, esp_id=None):
+        """({etiqueta de DWELL_BUCKETS: visitas}, nº de visitas, duración media) de las visitas que empiezan en el rango."""
+        raise NotImplementedError
+
+
+class _DeviceSummary:
+    """Resumen por MAC equivalente a una fila de device_inventory."""
+    __slots__ = ('mac', 'first_seen', 'last_seen', 'count', 'best_name', 'last_mfg', 'company_id',
+                 'last_rssi', 'max_rssi', 'esps', 'service_uuids', 'change_seq')
+
+    def __init__(self, mac, seen_at):
+        self.mac = mac
+        self.first_seen = seen_at
+        self.last_seen = seen_at
+        self.count = 0
+        self.best_name = None
+        self.last_mfg = None
+        self.company_id = None
+        self.last_rssi = None
+        self.max_rssi = None
+        self.esps = set()
+        self.service_uuids = set()
+        self.change_seq = 0
+
+
+class _ClusterSummary:
+    __slots__ = ('cluster_id', 'address_type', 'company_id', 'macs', 'first_seen', 'last_seen')
+
+    def __init__(self, cluster_id, address_type, company_id, seen_at):
+        self.cluster_id = cluster_id
+        self.address_type = address_type
+        self.company_id = company_id
+        self.macs = set()
+        self.first_seen = seen_at
+        self.last_seen = seen_at
+
+    def to_dict(self):
+        return {
+            "cluster_id": self.cluster_id, "address_type": self.address_type, "company_id": self.company_id,
+            "mac_count": len(self.macs), "first_seen": self.first_seen, "last_seen": self.last_seen,
+        }
+
+
+_NO_RSSI = -32768
+_NO_COMPANY = -1
+
+
+class MemoryStorage(StorageBackend):
+    """
+    Motor en memoria orientado a columnas: cada campo de scanned_devices es un array (o lista para
+    texto) indexado por número de fila, con MACs y ESPs codificados como enteros. Las filas se añaden
+    en orden cronológico, así que los rangos de tiempo se resuelven con búsqueda binaria, y se mantienen
+    los índices de filas por MAC y por ESP más los resúmenes de inventario y clusters de la ingesta.
+    utc_offset_sec: desplazamiento de la hora local usado en las agrupaciones por hora/día.
+    """
+
+    def __init__(self, utc_offset_sec=0):
+        self.utc_offset_sec = utc_offset_sec
+        self._lock = threading.Lock()
+        self._timestamps = array('d')
+        self._mac_codes = array('I')
+        self._esp_codes = array('I')
+        self._rssi = array('h')
+        self._company_ids = array('l')
+        self._names = []
+        self._manufacturer_data = []
+        self._service_data = []
+        self._service_uuids = []
+        self._tx_power = []
+        self._appearance = []
+        self._macs, self._mac_index = [], {}
+        self._esps, self._esp_index = [], {}
+        self._rows_by_mac = []   # código de MAC -> array de filas
+        self._rows_by_esp = []   # código de ESP -> array de filas
+        self._devices = {}       # mac -> _DeviceSummary
+        self._changed = OrderedDict()   # mac -> _DeviceSummary, de la menos a la más recientemente cambiada
+        self._change_seq = 0
+        self._sync_epoch = os.urandom(6).hex()
+        self._clusters = {}      # cluster_id -> _ClusterSummary
+        self._mac_clusters = {}  # mac -> (cluster_id, address_type)
+        self._heartbeats = {}    # esp_id -> [primer contacto, último contacto, tamaño del último lote, lotes]
+        self._session_starts = []  # Inicio (epoch) de cada visita guardada, ordenado
+        self._sessions = []        # SessionRecord en el mismo orden que _session_starts
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    # --- Ingesta ---
+    def _encode(self, value, values, index, rows_by_code):
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(values)
+            values.append(value)
+            rows_by_code.append(array('I'))
+        return code
+
+    def store_batch(self, esp_device_id, records):
+        with self._lock:
+            now = time.time()
+            if self._timestamps and now < self._timestamps[-1]:
+                now = self._timestamps[-1]
+            now_str = epoch_to_utc_string(now)
+            esp_code = self._encode(esp_device_id, self._esps, self._esp_index, self._rows_by_esp)
+            heartbeat = self._heartbeats.setdefault(esp_device_id, [now_str, now_str, 0, 0])
+            heartbeat[1:] = [now_str, len(records), heartbeat[3] + 1]
+            if records:
+                self._change_seq += 1
+            for record in records:
+                mac = record.ble_mac_address
+                mac_code = self._encode(mac, self._macs, self._mac_index, self._rows_by_mac)
+                row = len(self._timestamps)
+                self._timestamps.append(now)
+                self._mac_codes.append(mac_code)
+                self._esp_codes.append(esp_code)
+                self._rssi.append(_NO_RSSI if record.ble_rssi is None else max(_NO_RSSI + 1, min(32767, record.ble_rssi)))
+                self._company_ids.append(_NO_COMPANY if record.company_id is None else record.company_id)
+                self._names.append(record.ble_device_name)
+                self._manufacturer_data.append(record.manufacturer_data)
+                self._service_data.append(record.service_data)
+                self._service_uuids.append(record.service_uuids)
+                self._tx_power.append(record.tx_power)
+                self._appearance.append(record.appearance)
+                self._rows_by_mac[mac_code].append(row)
+                self._rows_by_esp[esp_code].append(row)
+                self._update_device(esp_device_id, record, now_str)
+                self._update_cluster(record, now_str)
+
+    def _update_device(self, esp_device_id, record, now_str):
+        device = self._devices.get(record.ble_mac_address)
+        if device is None:
+            device = self._devices[record.ble_mac_address] = _DeviceSummary(record.ble_mac_address, now_str)
+        device.last_seen = now_str
+        device.change_seq = self._change_seq
+        self._changed[device.mac] = device
+        self._changed.move_to_end(device.mac)
+        device.count += 1
+        if record.ble_device_name:
+            device.best_name = record.ble_device_name
+        device.last_mfg = record.manufacturer_data
+        device.company_id = record.company_id
+        if record.ble_rssi is not None:
+            device.last_rssi = record.ble_rssi
+            if device.max_rssi is None or record.ble_rssi > device.max_rssi:
+                device.max_rssi = record.ble_rssi
+        device.esps.add(esp_device_id)
+        if record.service_uuids_list:
+            device.service_uuids.update(str(uuid).lower() for uuid in record.service_uuids_list)
+
+    def _update_cluster(self, record, now_str):
+        mac = record.ble_mac_address
+        assignment = self._mac_clusters.get(mac)
+        if assignment is None:
+            cluster_id, address_type = fingerprint.compute_cluster(
+                mac, record.manufacturer_data, record.service_uuids_list, record.appearance, record.tx_power
+            )
+            self._mac_clusters[mac] = (cluster_id, address_type)
+            cluster = self._clusters.get(cluster_id)
+            if cluster is None:
+                cluster = self._clusters[cluster_id] = _ClusterSummary(cluster_id, address_type, record.company_id, now_str)
+            cluster.macs.add(mac)
+        else:
+            cluster = self._clusters[assignment[0]]
+        cluster.last_seen = now_str
+
+    # --- Helpers de lectura (llamar con el lock tomado) ---
+    def _row_range(self, start_utc, end_utc):
+        lo = 0 if start_utc is None else bisect.bisect_left(self._timestamps, utc_string_to_epoch(start_utc))
+        hi = len(self._timestamps) if end_utc is None else bisect.bisect_left(self._timestamps, utc_string_to_epoch(end_utc))
+        return lo, hi
+
+    def _rows_in_range(self, rows, start_utc, end_utc):
+        """Subconjunto (ordenado) de un índice de filas cuyas marcas de tiempo caen en [start_utc, end_utc)."""
+        lo, hi = self._row_range(start_utc, end_utc)
+        return rows[bisect.bisect_left(rows, lo):bisect.bisect_left(rows, hi)]
+
+    def _mac_rows(self, mac_address):
+        code = self._mac_index.get(mac_address)
+        return self._rows_by_mac[code] if code is not None else array('I')
+
+    def _local_strftime(self, time_format, row):
+        return time.strftime(time_format, time.gmtime(self._timestamps[row] + self.utc_offset_sec))
+
+    def _device_matches(self, device, filters):
+        name = filters.get('name')
+        if name and (not device.best_name or name.lower() not in device.best_name.lower()):
+            return False
+        prefix = filters.get('name_prefix')
+        if prefix and (not device.best_name or not device.best_name.lower().startswith(prefix.lower())):
+            return False
+        if filters.get('company_id') is not None and device.company_id != filters['company_id']:
+            return False
+        if filters.get('esp_id') and filters['esp_id'] not in device.esps:
+            return False
+        if filters.get('service_uuid') and filters['service_uuid'] not in device.service_uuids:
+            return False
+        if filters.get('min_rssi') is not None and (device.max_rssi is None or device.max_rssi < filters['min_rssi']):
+            return False
+        if filters.get('last_seen_from') and device.last_seen < filters['last_seen_from']:
+            return False
+        if filters.get('last_seen_to') and device.last_seen >= filters['last_seen_to']:
+            return False
+        return True
+
+    def _device_sort_value(self, device, sort_by):
+        if sort_by == 'ble_mac_address':
+            return device.mac
+        if sort_by == 'best_ble_device_name':
+            return device.best_name or 'N/A'
+        if sort_by == 'manufacturer_name':
+            return ble_utils.COMPANY_IDENTIFIERS.get(device.company_id, '') if device.company_id is not None else ''
+        if sort_by == 'adv_packets_count':
+            return device.count
+        return device.last_seen
+
+    # --- Consultas ---
+    def recent_observations(self, since_utc):
+        with self._lock:
+            lo, hi = self._row_range(since_utc, None)
+            return [{
+                "timestamp": epoch_to_utc_string(self._timestamps[row]),
+                "esp_device_id": self._esps[self._esp_codes[row]],
+                "ble_mac_address": self._macs[self._mac_codes[row]],
+                "ble_device_name": self._names[row],
+                "ble_rssi": None if self._rssi[row] == _NO_RSSI else self._rssi[row],
+                "tx_power": self._tx_power[row],
+                "company_id": None if self._company_ids[row] == _NO_COMPANY else self._company_ids[row],
+            } for row in range(lo, hi)]
+
+    def _history_row(self, row):
+        return {
+            "id": row + 1,
+            "timestamp_utc": epoch_to_utc_string(self._timestamps[row]),
+            "esp_device_id": self._esps[self._esp_codes[row]],
+            "ble_device_name": self._names[row],
+            "ble_rssi": None if self._rssi[row] == _NO_RSSI else self._rssi[row],
+            "manufacturer_data": self._manufacturer_data[row],
+            "service_data": self._service_data[row],
+            "service_uuids": self._service_uuids[row],
+            "tx_power": self._tx_power[row],
+            "appearance": self._appearance[row],
+        }
+
+    def device_history(self, mac_address, limit):
+        with self._lock:
+            rows = self._mac_rows(mac_address)
+            return [self._history_row(row) for row in reversed(rows[-limit:])]
+
+    def device_history_batch(self, befores, limit):
+        with self._lock:
+            result = {}
+            for mac_address, before in befores.items():
+                rows = self._mac_rows(mac_address)
+                hi = len(rows)
+                if before is not None:
+                    # Los timestamps se guardan con fracción de segundo pero la clave usa segundos enteros
+                    hi = bisect.bisect_left(rows, utc_string_to_epoch(before[0]) + 1, key=lambda row: self._timestamps[row])
+                # Se recorre hacia atrás hasta reunir 'limit' filas y completar el último segundo (empates de timestamp)
+                candidates, lo = [], hi
+                while lo > 0 and (len(candidates) < limit or
+                                  int(self._timestamps[rows[lo - 1]]) == int(self._timestamps[rows[lo]])):
+                    lo -= 1
+                    history_row = self._history_row(rows[lo])
+                    if before is None or history_order_key(history_row) < tuple(before):
+                        candidates.append(history_row)
+                candidates.sort(key=history_order_key, reverse=True)
+                result[mac_address] = candidates[:limit]
+            return result
+
+    def count_devices(self, filters, exact):
+        with self._lock:
+            if not filters:
+                return len(self._devices), False
+            return sum(1 for device in self._devices.values() if self._device_matches(device, filters)), False
+
+    def list_devices(self, filters, sort_by, sort_order, limit, offset=0, after=None):
+        descending = sort_order == 'desc'
+        with self._lock:
+            keyed = []
+            for device in self._devices.values():
+                if not self._device_matches(device, filters):
+                    continue
+                key = (self._device_sort_value(device, sort_by), device.mac)
+                if after is not None and (key >= tuple(after) if descending else key <= tuple(after)):
+                    continue
+                keyed.append((key, device))
+            keyed.sort(key=lambda item: item[0], reverse=descending)
+            return [self._device_row(device, key[0]) for key, device in keyed[offset:offset + limit]]
+
+    def _device_row(self, device, sort_value):
+        return {
+            "ble_mac_address": device.mac,
+            "max_timestamp_utc": device.last_seen,
+            "adv_packets_count": device.count,
+            "best_ble_device_name": device.best_name or 'N/A',
+            "last_manufacturer_data": device.last_mfg,
+            "sort_value": sort_value,
+        }
+
+    def device_changes(self, since, limit):
+        from_start = {sharding.DEFAULT_SHARD: (self._sync_epoch, 0, '')}
+        if since is None:
+            since = from_start
+        position = since.get(sharding.DEFAULT_SHARD)
+        with self._lock:
+            if set(since) != {sharding.DEFAULT_SHARD} or position[0] != self._sync_epoch or position[1] > self._change_seq:
+                return DeviceChanges([], from_start, True, False)
+            after = tuple(position[1:])
+            # Se recorre desde el cambio más reciente hacia atrás: el coste depende de los cambios, no del inventario
+            changed = []
+            for device in reversed(self._changed.values()):
+                if device.change_seq < after[0]:
+                    break
+                if (device.change_seq, device.mac) > after:
+                    changed.append(device)
+            changed.sort(key=lambda device: (device.change_seq, device.mac))
+            changed = changed[:limit]
+            cursor = {sharding.DEFAULT_SHARD: (self._sync_epoch, changed[-1].change_seq, changed[-1].mac)} if changed else since
+            return DeviceChanges([self._device_row(device, device.change_seq) for device in changed],
+                                 cursor, False, len(changed) == limit)
+
+    def count_clusters(self, address_type=None):
+        with self._lock:
+            clusters = [c for c in self._clusters.values() if address_type is None or c.address_type == address_type]
+            macs = sum(1 for _, mac_type in self._mac_clusters.values() if address_type is None or mac_type == address_type)
+            return len(clusters), macs
+
+    def list_clusters(self, address_type, limit, offset):
+        with self._lock:
+            clusters = [c for c in self._clusters.values() if address_type is None or c.address_type == address_type]
+            clusters.sort(key=lambda c: (c.last_seen, c.cluster_id), reverse=True)
+            return [c.to_dict() for c in clusters[offset:offset + limit]]
+
+    def get_cluster(self, cluster_id, mac_limit):
+        with self._lock:
+            cluster = self._clusters.get(cluster_id)
+            if cluster is None:
+                return None
+            result = cluster.to_dict()
+            result['macs'] = [{"ble_mac_address": mac, "address_type": self._mac_clusters[mac][1]}
+                              for mac in sorted(cluster.macs)[:mac_limit]]
+            return result
+
+    def activity_counts(self, mac_address, time_format, start_utc=None, end_utc=None):
+        with self._lock:
+            counts = defaultdict(int)
+            for row in self._rows_in_range(self._mac_rows(mac_address), start_utc, end_utc):
+                counts[self._local_strftime(time_format, row)] += 1
+            return dict(counts)
+
+    def distinct_counts(self, group_by, start_utc=None, end_utc=None, esp_ids=None, exact=True):
+        with self._lock:
+            if group_by == 'none' and start_utc is None and not esp_ids:
+                return ({'total': len(self._devices)} if self._devices else {}), False
+            if esp_ids:
+                rows = []
+                for esp_id in esp_ids:
+                    code = self._esp_index.get(esp_id)
+                    if code is not None:
+                        rows.extend(self._rows_in_range(self._rows_by_esp[code], start_utc, end_utc))
+            else:
+                rows = range(*self._row_range(start_utc, end_utc))
+            return {key: len(macs) for key, macs in self._macs_by_group_locked(group_by, rows).items()}, False
+
+    def distinct_sketches(self, group_by, start_utc=None, end_utc=None, esp_ids=None):
+        with self._lock:
+            if esp_ids:
+                rows = []
+                for esp_id in esp_ids:
+                    code = self._esp_index.get(esp_id)
+                    if code is not None:
+                        rows.extend(self._rows_in_range(self._rows_by_esp[code], start_utc, end_utc))
+            else:
+                rows = range(*self._row_range(start_utc, end_utc))
+            macs_by_group = self._macs_by_group_locked(group_by, rows)
+            result = {}
+            for key, mac_codes in macs_by_group.items():
+                sketch = result[key] = sketches.HyperLogLog()
+                for mac_code in mac_codes:
+                    sketch.add(self._macs[mac_code])
+            return result
+
+    def _macs_by_group_locked(self, group_by, rows):
+        macs_by_group = defaultdict(set)
+        for row in rows:
+            if group_by == 'esp':
+                key = self._esps[self._esp_codes[row]]
+            elif group_by == 'hour_of_day':
+                key = self._local_strftime('%H', row)
+            else:
+                key = 'total'
+            macs_by_group[key].add(self._mac_codes[row])
+        return macs_by_group
+
+    def manufacturer_ranking(self, start_utc, end_utc, top_n):
+        with self._lock:
+            latest_company = {}
+            for row in range(*self._row_range(start_utc, end_utc)):
+                if self._company_ids[row] != _NO_COMPANY:
+                    latest_company[self._mac_codes[row]] = self._company_ids[row]
+            company_counts = defaultdict(int)
+            for company_id in latest_company.values():
+                company_counts[company_id] += 1
+        return rank_manufacturers(company_counts, top_n)
+
+    def rssi_points(self, mac_address, start_utc=None, end_utc=None, esp_id=None, limit=1000):
+        with self._lock:
+            esp_code = self._esp_index.get(esp_id) if esp_id else None
+            if esp_id and esp_code is None:
+                return []
+            points = []
+            for row in self._rows_in_range(self._mac_rows(mac_address), start_utc, end_utc):
+                if self._rssi[row] == _NO_RSSI or (esp_code is not None and self._esp_codes[row] != esp_code):
+                    continue
+                points.append({
+                    "timestamp_utc": epoch_to_utc_string(self._timestamps[row]),
+                    "ble_rssi": self._rssi[row],
+                    "esp_device_id": self._esps[self._esp_codes[row]],
+                })
+                if len(points) >= limit:
+                    break
+            return points
+
+    def rssi_series(self, mac_address, start_utc=None, end_utc=None, esp_id=None, limit=1000):
+        with self._lock:
+            esp_code = self._esp_index.get(esp_id) if esp_id else None
+            if esp_id and esp_code is None:
+                return {}
+            points = ((int(self._timestamps[row]), self._rssi[row], self._esp_codes[row])
+                      for row in self._rows_in_range(self._mac_rows(mac_address), start_utc, end_utc)
+                      if self._rssi[row] != _NO_RSSI and (esp_code is None or self._esp_codes[row] == esp_code))
+            return {self._esps[code]: columns for code, columns in points_to_series(points, limit).items()}
+
+    def rssi_histogram(self, esp_id=None, start_utc=None, end_utc=None):
+        with self._lock:
+            if esp_id is not None:
+                code = self._esp_index.get(esp_id)
+                rows = self._rows_in_range(self._rows_by_esp[code], start_utc, end_utc) if code is not None else ()
+            else:
+                rows = range(*self._row_range(start_utc, end_utc))
+            counts = defaultdict(int)
+            for row in rows:
+                if self._rssi[row] != _NO_RSSI:
+                    counts[rssi_range_label(self._rssi[row])] += 1
+            return dict(counts)
+
+    def rssi_percentile_histograms(self, group_by, start_utc=None, end_utc=None, esp_ids=None, exact=False):
+        with self._lock:
+            if esp_ids:
+                rows = []
+                for esp_id in esp_ids:
+                    code = self._esp_index.get(esp_id)
+                    if code is not None:
+                        rows.extend(self._rows_in_range(self._rows_by_esp[code], start_utc, end_utc))
+            else:
+                rows = range(*self._row_range(start_utc, end_utc))
+            by_esp_hour = defaultdict(sketches.ValueHistogram)
+            for row in rows:
+                if self._rssi[row] != _NO_RSSI:
+                    by_esp_hour[(self._esp_codes[row], int(self._timestamps[row] // 3600))].add(self._rssi[row])
+            histograms = {}
+            for (esp_code, hour), histogram in by_esp_hour.items():
+                key = percentile_group_key(group_by, self._esps[esp_code], epoch_to_utc_string(hour * 3600))
+                if key in histograms:
+                    histograms[key].merge(histogram)
+                else:
+                    histograms[key] = histogram
+            return histograms
+
+    def known_esps(self):
+        with self._lock:
+            return sorted(self._esps)
+
+    def esp_heartbeats(self):
+        with self._lock:
+            return [{
+                "esp_device_id": esp_id,
+                "first_contact_utc": first_contact,
+                "last_contact_utc": last_contact,
+                "last_batch_size": last_batch_size,
+                "batches": batches,
+            } for esp_id, (first_contact, last_contact, last_batch_size, batches) in sorted(self._heartbeats.items())]
+
+    def store_sessions(self, session_records):
+        with self._lock:
+            for record in session_records:
+                position = bisect.bisect_right(self._session_starts, record.start_epoch)
+                self._session_starts.insert(position, record.start_epoch)
+                self._sessions.insert(position, record)
+
+    def sessions_overlapping(self, start_utc, end_utc, max_duration_sec, esp_id=None, limit=None):
+        start_epoch, end_epoch = utc_string_to_epoch(start_utc), utc_string_to_epoch(end_utc)
+        with self._lock:
+            lo = bisect.bisect_left(self._session_starts, start_epoch - max_duration_sec)
+            hi = bisect.bisect_left(self._session_starts, end_epoch + 1)
+            result = []
+            for record in self._sessions[lo:hi]:
+                if record.end_epoch < start_epoch or (esp_id and esp_id not in record.esps):
+                    continue
+                result.append(session_record_to_dict(record))
+                if limit is not None and len(result) >= limit:
+                    break
+            return result
+
+    def dwell_histogram(self, start_utc=None, end_utc=None, esp_id=None):
+        with self._lock:
+            lo = 0 if start_utc is None else bisect.bisect_left(self._session_starts, utc_string_to_epoch(start_utc))
+            hi = len(self._sessions) if end_utc is None else bisect.bisect_left(self._session_starts, utc_string_to_epoch(end_utc))
+            counts, total, duration_sum = defaultdict(int), 0, 0
+            for record in self._sessions[lo:hi]:
+                if esp_id and esp_id not in record.esps:
+                    continue
+                duration = int(round(record.end_epoch - record.start_epoch))
+                counts[dwell_bucket_label(duration)] += 1
+                total += 1
+                duration_sum += duration
+            return dict(counts), total, (duration_sum / total if total else None)
+
+    def esps_for_mac(self, mac_address):
+        with self._lock:
+            return sorted({self._esps[self._esp_codes[row]] for row in self._mac_rows(mac_address)})
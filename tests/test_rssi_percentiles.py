@@ -0,0 +1,215 @@
+"""
+Precisión de los percentiles de RSSI: se guardan distribuciones conocidas (distintas por ESP) repartidas en
+varios días y horas, y los p10/p50/p90 que salen de unir los histogramas guardados por (ESP, hora/día) se
+comparan con el percentil por rango más cercano calculado sobre las filas y con exact=true, en rangos de
+fechas arbitrarios y subconjuntos de ESPs, tanto en rssi_percentile_histograms como en /api/rssi-percentiles.
+
+sketches.ValueHistogram es exacto para enteros dentro de [min_value, max_value] (los de fuera se acotan a
+los extremos): el error admitido es cero tras acotar.
+"""
+import logging
+import math
+import random
+import sqlite3
+from collections import defaultdict
+from datetime import date, timedelta
+from unittest import mock
+
+import pytest
+
+import backend_server
+import fingerprint
+import sharding
+import sketches
+import storage
+
+ESPS = ['ESP_A', 'ESP_B', 'ESP_C', 'ESP_D']
+PERCENTS = [10, 50, 90]
+FIRST_DAY = date(2024, 3, 9)
+DAYS = 3
+ROWS = 6000
+SEED = 11
+ESP_SUBSETS = [None, ['ESP_A'], ['ESP_B', 'ESP_D'], ['ESP_C', 'ESP_X']]
+
+
+def sample_rssi(rnd, esp_id):
+    """Distribución conocida de cada ESP: normal, uniforme, bimodal y casi constante (muchos empates)."""
+    if esp_id == 'ESP_A':
+        return round(rnd.gauss(-62, 6))
+    if esp_id == 'ESP_B':
+        return rnd.randrange(-98, -34)
+    if esp_id == 'ESP_C':
+        return round(rnd.gauss(-50, 3)) if rnd.random() < 0.7 else round(rnd.gauss(-88, 4))
+    return -70 if rnd.random() < 0.9 else rnd.choice([-45, -95])
+
+
+def make_observations():
+    """[(epoch, esp_id, mac, rssi)] por orden de tiempo; cada ESP solo emite en algunas horas y hay RSSI nulos."""
+    rnd = random.Random(SEED)
+    start = storage.utc_string_to_epoch(f"{FIRST_DAY} 00:00:00")
+    macs = [f"5A:00:{i >> 8:02X}:{i & 0xFF:02X}:10:20" for i in range(300)]
+    active_hours = {esp_id: set(rnd.sample(range(24), 16)) for esp_id in ESPS}
+    observations = []
+    while len(observations) < ROWS:
+        epoch = start + rnd.randrange(DAYS * 86400)
+        esp_id = rnd.choice(ESPS)
+        if (epoch // 3600) % 24 not in active_hours[esp_id]:
+            continue
+        rssi = None if rnd.random() < 0.03 else sample_rssi(rnd, esp_id)
+        observations.append((epoch, esp_id, rnd.choice(macs), rssi))
+    return sorted(observations)
+
+
+def nearest_rank(values, percent):
+    """Percentil por rango más cercano: el valor en la posición ceil(p / 100 · n) de los n ordenados."""
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(percent / 100.0 * len(ordered))) - 1]
+
+
+def reference_groups(observations, group_by, start_utc, end_utc, esp_ids):
+    """{clave de percentile_group_key: [rssi]} directamente de las filas."""
+    start = storage.utc_string_to_epoch(start_utc) if start_utc else float('-inf')
+    end = storage.utc_string_to_epoch(end_utc) if end_utc else float('inf')
+    groups = defaultdict(list)
+    for epoch, esp_id, _, rssi in observations:
+        if rssi is None or not start <= epoch < end or (esp_ids and esp_id not in esp_ids):
+            continue
+        hour_bucket = storage.epoch_to_utc_string(epoch - epoch % 3600)
+        groups[storage.percentile_group_key(group_by, esp_id, hour_bucket)].append(rssi)
+    return groups
+
+
+def store_sqlite(observations):
+    """Filas con su marca de tiempo en scanned_devices y reconstrucción de los resúmenes (como simulate_federation)."""
+    sqlite_engine = backend_server.SQLiteStorage()
+    sqlite_engine.init()
+    conn = sqlite3.connect(backend_server.DATABASE_NAME)
+    conn.executemany(
+        "INSERT INTO scanned_devices (timestamp, esp_device_id, ble_mac_address, ble_rssi) VALUES (datetime(?, 'unixepoch'), ?, ?, ?)",
+        observations
+    )
+    for table in backend_server.DERIVED_SHARD_TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.commit()
+    conn.close()
+    sqlite_engine.init()
+    return sqlite_engine
+
+
+def store_memory(observations):
+    """Las mismas filas por store_batch, con el reloj fijado a la marca de tiempo de cada una."""
+    memory_engine = storage.MemoryStorage(utc_offset_sec=backend_server.analytics_offset_hours() * 3600)
+    memory_engine.init()
+    for epoch, esp_id, mac, rssi in observations:
+        record = backend_server.parse_device_fields({'macAddress': mac}, esp_id)._replace(ble_rssi=rssi)
+        with mock.patch('time.time', return_value=float(epoch)):
+            memory_engine.store_batch(esp_id, [record])
+    return memory_engine
+
+
+@pytest.fixture(scope='module')
+def observations():
+    return make_observations()
+
+
+@pytest.fixture(scope='module', params=('sqlite', 'memory'))
+def engine(request, observations, tmp_path_factory):
+    patcher = pytest.MonkeyPatch()
+    backend_server.app.logger.setLevel(logging.ERROR)
+    if request.param == 'sqlite':
+        patcher.setattr(backend_server, 'DATABASE_NAME', str(tmp_path_factory.mktemp('percentiles') / 'ble.db'))
+        patcher.setattr(backend_server, 'shard_router', sharding.ShardRouter({}, backend_server.SHARD_DATABASE_TEMPLATE))
+        patcher.setattr(backend_server, 'fingerprint_indexes', {sharding.DEFAULT_SHARD: fingerprint.FingerprintIndex()})
+        yield store_sqlite(observations)
+    else:
+        yield store_memory(observations)
+    patcher.undo()
+
+
+def random_ranges(count=12):
+    """Rangos UTC alineados a horas (los que resuelven los histogramas guardados), algunos cruzando días."""
+    rnd = random.Random(SEED)
+    start = storage.utc_string_to_epoch(f"{FIRST_DAY} 00:00:00")
+    ranges = [(None, None),
+              (storage.epoch_to_utc_string(start), storage.epoch_to_utc_string(start + DAYS * 86400)),
+              (storage.epoch_to_utc_string(start + 86400), storage.epoch_to_utc_string(start + 2 * 86400))]
+    for _ in range(count):
+        first_hour = rnd.randrange(-3, DAYS * 24)
+        ranges.append((storage.epoch_to_utc_string(start + first_hour * 3600),
+                       storage.epoch_to_utc_string(start + (first_hour + rnd.randrange(1, 60)) * 3600)))
+    return ranges
+
+
+# --- sketches.ValueHistogram ---
+def test_value_histogram_nearest_rank():
+    rnd = random.Random(SEED)
+    percents = [0, 0.1, 1, 10, 25, 50, 75, 90, 99, 99.9, 100]
+    for size in (1, 2, 3, 10, 101, 5000):
+        values = [rnd.randrange(-140, 140) for _ in range(size)]
+        histogram = sketches.ValueHistogram()
+        for value in values:
+            histogram.add(value)
+        clamped = [min(max(value, sketches.RSSI_HISTOGRAM_MIN), sketches.RSSI_HISTOGRAM_MAX) for value in values]
+        assert histogram.total() == size
+        assert histogram.percentiles(percents) == [nearest_rank(clamped, percent) for percent in percents]
+        assert histogram.mean() == pytest.approx(sum(clamped) / size)
+    assert sketches.ValueHistogram().percentiles(PERCENTS) == [None, None, None]
+
+
+def test_value_histogram_merge_is_exact():
+    rnd = random.Random(SEED)
+    parts = [[rnd.randrange(-100, -30) for _ in range(rnd.randrange(0, 200))] for _ in range(24)]
+    merged = sketches.ValueHistogram()
+    for part in parts:
+        histogram = sketches.ValueHistogram()
+        for value in part:
+            histogram.add(value)
+        # Como en la base de datos: serializado por (ESP, hora) y unido al consultar
+        merged.merge_bytes(histogram.to_bytes())
+    values = [value for part in parts for value in part]
+    assert merged.percentiles(PERCENTS) == [nearest_rank(values, percent) for percent in PERCENTS]
+
+
+# --- Motores de almacenamiento ---
+@pytest.mark.parametrize('group_by', storage.PERCENTILE_GROUPINGS)
+def test_merged_percentiles_match_rows(engine, observations, group_by):
+    for start_utc, end_utc in random_ranges():
+        for esp_ids in ESP_SUBSETS:
+            expected = reference_groups(observations, group_by, start_utc, end_utc, esp_ids)
+            merged = engine.rssi_percentile_histograms(group_by, start_utc, end_utc, esp_ids, exact=False)
+            exact = engine.rssi_percentile_histograms(group_by, start_utc, end_utc, esp_ids, exact=True)
+            assert set(merged) == set(exact) == set(expected)
+            for key, values in expected.items():
+                reference = [nearest_rank(values, percent) for percent in PERCENTS]
+                assert merged[key].total() == exact[key].total() == len(values)
+                assert merged[key].percentiles(PERCENTS) == exact[key].percentiles(PERCENTS) == reference, (key, start_utc, end_utc)
+
+
+# --- /api/rssi-percentiles ---
+@pytest.mark.parametrize('group_by', storage.PERCENTILE_GROUPINGS)
+def test_rssi_percentiles_endpoint(engine, observations, monkeypatch, group_by):
+    monkeypatch.setattr(backend_server, 'storage_backend', engine)
+    client = backend_server.app.test_client()
+    percents = [10, 50, 90, 99.5]
+    date_ranges = [(FIRST_DAY, FIRST_DAY), (FIRST_DAY + timedelta(days=1), FIRST_DAY + timedelta(days=DAYS)),
+                   (FIRST_DAY - timedelta(days=1), FIRST_DAY + timedelta(days=1))]
+    for start_date, end_date in date_ranges:
+        start_utc, end_utc = backend_server.local_date_range_to_utc(start_date, end_date)
+        for esp_ids in ESP_SUBSETS:
+            expected = reference_groups(observations, group_by, start_utc, end_utc, esp_ids)
+            params = {'group_by': group_by, 'startDate': start_date.isoformat(), 'endDate': end_date.isoformat(),
+                      'percentiles': ','.join(map(str, percents))}
+            if esp_ids:
+                params['esp_ids'] = ','.join(esp_ids)
+            responses = [client.get('/api/rssi-percentiles', query_string=dict(params, exact=exact)) for exact in ('false', 'true')]
+            assert [response.status_code for response in responses] == [200, 200]
+            merged, exact = (response.get_json() for response in responses)
+            assert merged['groups'] == exact['groups']
+            received = {}
+            for group in merged['groups']:
+                hour_bucket = storage.epoch_to_utc_string(group['t']) if 't' in group else None
+                received[storage.percentile_group_key(group_by, group.get('esp_id'), hour_bucket)] = group
+            assert set(received) == set(expected)
+            for key, values in expected.items():
+                assert received[key]['count'] == len(values)
+                assert received[key]['values'] == [nearest_rank(values, percent) for percent in percents]
@@ -0,0 +1,357 @@
+"""
+Conformidad de los motores de almacenamiento: la misma secuencia de store_batch se reproduce en
+SQLiteStorage (base de datos temporal) y en MemoryStorage, y cada método de la interfaz que usan la
+ingesta, el inventario (filtros, cursor, sincronización delta), el historial, las visitas y las analíticas
+debe devolver lo mismo en ambos. Incluye una comprobación de tiempos de los dos motores.
+
+SQLite marca las filas con CURRENT_TIMESTAMP: tras cada lote, el reloj de MemoryStorage se fija al
+last_contact que SQLite ha guardado para ese ESP, así los dos motores ven las mismas marcas de tiempo.
+"""
+import logging
+import random
+import time
+from unittest import mock
+
+import pytest
+
+import backend_server
+import fingerprint
+import sessions
+import sharding
+import storage
+
+ESPS = ['ESP_A', 'ESP_B', 'ESP_C', 'ESP_D']
+COMPANY_PREFIXES = {0x004C: '4C00', 0x0006: '0600', 0x0075: '7500', 0x00E0: 'E000', 0x0157: '5701'}
+SERVICE_UUIDS = ['0000fe9f-0000-1000-8000-00805f9b34fb', '0000feaa-0000-1000-8000-00805f9b34fb',
+                 '0000180f-0000-1000-8000-00805f9b34fb']
+NAMES = ['iPhone', 'Galaxy Buds2', 'Mi Smart Band 6', 'Tile', None, None]
+BATCHES = 40
+SEED = 7
+
+
+def make_population(rnd, size):
+    """Dispositivos con MACs públicas y aleatorias, nombres, fabricantes y servicios variados."""
+    devices = []
+    for i in range(size):
+        first_octet = rnd.choice([0x00, 0x5A, 0x7A, 0xC4])
+        device = {'macAddress': f"{first_octet:02X}:{i >> 8 & 0xFF:02X}:{i & 0xFF:02X}:10:20:{rnd.randrange(256):02X}"}
+        name = rnd.choice(NAMES)
+        if name:
+            device['deviceName'] = f"{name} {i % 7}"
+        if rnd.random() < 0.8:
+            company_id = rnd.choice(list(COMPANY_PREFIXES))
+            device['manufacturerData'] = COMPANY_PREFIXES[company_id] + ''.join(f"{rnd.randrange(256):02x}" for _ in range(6))
+        if rnd.random() < 0.5:
+            device['serviceUUIDs'] = rnd.sample(SERVICE_UUIDS, rnd.randrange(1, 3))
+        if rnd.random() < 0.3:
+            device['txPower'] = rnd.choice([-12, -8, 0, 4])
+        devices.append(device)
+    return devices
+
+
+def make_batches(seed=SEED, batches=BATCHES, population=150, batch_size=40):
+    """[(esp_id, [ScanRecord])] deterministas; algunos lotes vacíos (heartbeat) y algunos RSSI nulos."""
+    rnd = random.Random(seed)
+    devices = make_population(rnd, population)
+    result = []
+    for i in range(batches):
+        esp_id = rnd.choice(ESPS)
+        if i % 9 == 8:
+            result.append((esp_id, []))
+            continue
+        records = []
+        for device in rnd.sample(devices, rnd.randrange(1, batch_size)):
+            record = backend_server.parse_device_fields(device, esp_id)
+            rssi = None if rnd.random() < 0.05 else rnd.randrange(-100, -30)
+            records.append(record._replace(ble_rssi=rssi))
+        result.append((esp_id, records))
+    return result
+
+
+def store_in_lockstep(sqlite_engine, memory_engine, batches):
+    """Guarda cada lote en los dos motores con la misma marca de tiempo (la que SQLite ha asignado)."""
+    for esp_id, records in batches:
+        # El lote entero debe caer en el mismo segundo de CURRENT_TIMESTAMP
+        fraction = time.time() % 1
+        if fraction > 0.8:
+            time.sleep(1.01 - fraction)
+        sqlite_engine.store_batch(esp_id, records)
+        heartbeat = next(item for item in sqlite_engine.esp_heartbeats() if item['esp_device_id'] == esp_id)
+        with mock.patch('time.time', return_value=float(storage.utc_string_to_epoch(heartbeat['last_contact_utc']))):
+            memory_engine.store_batch(esp_id, records)
+
+
+def as_dicts(rows):
+    return [dict(row) for row in rows]
+
+
+# Columnas de list_devices según StorageBackend (SQLite añade otras auxiliares para fusionar shards)
+DEVICE_ROW_KEYS = ('ble_mac_address', 'max_timestamp_utc', 'adv_packets_count', 'best_ble_device_name',
+                   'last_manufacturer_data', 'sort_value')
+
+
+def device_rows(rows):
+    return [{key: row[key] for key in DEVICE_ROW_KEYS} for row in rows]
+
+
+@pytest.fixture(scope='module')
+def engines(tmp_path_factory):
+    patcher = pytest.MonkeyPatch()
+    backend_server.app.logger.setLevel(logging.ERROR)
+    patcher.setattr(backend_server, 'DATABASE_NAME', str(tmp_path_factory.mktemp('conformance') / 'ble.db'))
+    patcher.setattr(backend_server, 'shard_router', sharding.ShardRouter({}, backend_server.SHARD_DATABASE_TEMPLATE))
+    patcher.setattr(backend_server, 'fingerprint_indexes', {sharding.DEFAULT_SHARD: fingerprint.FingerprintIndex()})
+    sqlite_engine = backend_server.SQLiteStorage()
+    memory_engine = storage.MemoryStorage(utc_offset_sec=backend_server.analytics_offset_hours() * 3600)
+    sqlite_engine.init()
+    memory_engine.init()
+    batches = make_batches()
+    store_in_lockstep(sqlite_engine, memory_engine, batches)
+    yield sqlite_engine, memory_engine, batches
+    patcher.undo()
+
+
+@pytest.fixture(scope='module')
+def time_range(engines):
+    """Rango [inicio, fin) al segundo que cubre todas las filas guardadas y uno que solo cubre una parte."""
+    sqlite_engine = engines[0]
+    rows = sqlite_engine.recent_observations('1970-01-01 00:00:00')
+    first, last = storage.utc_string_to_epoch(rows[0]['timestamp']), storage.utc_string_to_epoch(rows[-1]['timestamp'])
+    full = (storage.epoch_to_utc_string(first), storage.epoch_to_utc_string(last + 1))
+    partial = (storage.epoch_to_utc_string(first + (last - first) // 2), storage.epoch_to_utc_string(last + 1))
+    return full, partial
+
+
+@pytest.fixture(scope='module')
+def aligned_ranges(time_range):
+    """
+    Rangos alineados a horas y días, como los que construyen los endpoints: los caminos por sketches
+    (sketches HLL e histogramas de RSSI por hora/día) resuelven con esa granularidad. Incluye uno vacío.
+    """
+    first = storage.utc_string_to_epoch(time_range[0][0])
+    last = storage.utc_string_to_epoch(time_range[0][1]) - 1
+    hour_start, day_start = first - first % 3600, first - first % 86400
+    return (
+        (storage.epoch_to_utc_string(hour_start), storage.epoch_to_utc_string(last - last % 3600 + 3600)),
+        (storage.epoch_to_utc_string(day_start), storage.epoch_to_utc_string(last - last % 86400 + 86400)),
+        (storage.epoch_to_utc_string(day_start - 86400), storage.epoch_to_utc_string(day_start)),
+    )
+
+
+def sample_macs(batches, count=12):
+    macs = sorted({record.ble_mac_address for _, records in batches for record in records})
+    return random.Random(SEED).sample(macs, count)
+
+
+# --- Ingesta ---
+def test_recent_observations(engines, time_range):
+    sqlite_engine, memory_engine, _ = engines
+    for since in ('1970-01-01 00:00:00', time_range[1][0]):
+        assert as_dicts(sqlite_engine.recent_observations(since)) == memory_engine.recent_observations(since)
+
+
+def test_heartbeats_and_esps(engines):
+    sqlite_engine, memory_engine, batches = engines
+    assert as_dicts(sqlite_engine.esp_heartbeats()) == memory_engine.esp_heartbeats()
+    assert sqlite_engine.known_esps() == memory_engine.known_esps() == sorted({esp_id for esp_id, _ in batches})
+    for mac in sample_macs(batches):
+        assert sqlite_engine.esps_for_mac(mac) == memory_engine.esps_for_mac(mac)
+
+
+def test_clusters(engines):
+    sqlite_engine, memory_engine, _ = engines
+    for address_type in (None, fingerprint.ADDRESS_TYPE_PUBLIC, fingerprint.ADDRESS_TYPE_RANDOM_RESOLVABLE):
+        assert sqlite_engine.count_clusters(address_type) == memory_engine.count_clusters(address_type)
+    sqlite_clusters = as_dicts(sqlite_engine.list_clusters(None, 500, 0))
+    assert sqlite_clusters == memory_engine.list_clusters(None, 500, 0)
+    assert as_dicts(sqlite_engine.list_clusters(None, 5, 3)) == memory_engine.list_clusters(None, 5, 3)
+    for cluster in sqlite_clusters[:10]:
+        assert sqlite_engine.get_cluster(cluster['cluster_id'], 50) == memory_engine.get_cluster(cluster['cluster_id'], 50)
+    assert sqlite_engine.get_cluster(1, 50) is None and memory_engine.get_cluster(1, 50) is None
+
+
+# --- Inventario: filtros, orden, cursor y sincronización delta ---
+DEVICE_FILTERS = [
+    {},
+    {'name': 'band'},
+    {'name_prefix': 'gal'},
+    {'company_id': 0x004C},
+    {'esp_id': 'ESP_B'},
+    {'service_uuid': SERVICE_UUIDS[0]},
+    {'min_rssi': -50},
+    {'company_id': 0x0006, 'esp_id': 'ESP_A', 'min_rssi': -80},
+]
+
+
+@pytest.mark.parametrize('filters', DEVICE_FILTERS)
+def test_count_devices(engines, filters):
+    sqlite_engine, memory_engine, _ = engines
+    assert sqlite_engine.count_devices(filters, True) == memory_engine.count_devices(filters, True)
+
+
+def test_count_devices_estimate(engines):
+    sqlite_engine, memory_engine, _ = engines
+    estimate, approximate = sqlite_engine.count_devices({}, False)
+    exact, _ = memory_engine.count_devices({}, False)
+    # SQLite estima con los sketches; el motor en memoria cuenta exacto
+    assert approximate and abs(estimate - exact) <= max(2, 0.05 * exact)
+
+
+@pytest.mark.parametrize('sort_by', storage.DEVICE_SORT_COLUMNS)
+@pytest.mark.parametrize('sort_order', ('asc', 'desc'))
+def test_list_devices_pages_and_cursor(engines, time_range, sort_by, sort_order):
+    sqlite_engine, memory_engine, _ = engines
+    for filters in (DEVICE_FILTERS[0], DEVICE_FILTERS[3], {'last_seen_from': time_range[1][0]}):
+        full = device_rows(sqlite_engine.list_devices(filters, sort_by, sort_order, 1000))
+        assert full and full == device_rows(memory_engine.list_devices(filters, sort_by, sort_order, 1000))
+        assert device_rows(sqlite_engine.list_devices(filters, sort_by, sort_order, 7, offset=5)) == \
+            device_rows(memory_engine.list_devices(filters, sort_by, sort_order, 7, offset=5))
+        # Recorrido completo por cursor en los dos motores
+        after, walked = None, []
+        while True:
+            page = device_rows(sqlite_engine.list_devices(filters, sort_by, sort_order, 9, after=after))
+            assert page == device_rows(memory_engine.list_devices(filters, sort_by, sort_order, 9, after=after))
+            walked += page
+            if len(page) < 9:
+                break
+            after = (page[-1]['sort_value'], page[-1]['ble_mac_address'])
+        assert walked == full
+
+
+def test_device_changes(engines):
+    sqlite_engine, memory_engine, _ = engines
+    cursors = {}
+    for name, engine in (('sqlite', sqlite_engine), ('memory', memory_engine)):
+        since, delivered = None, []
+        while True:
+            changes = engine.device_changes(since, 25)
+            assert not changes.resync_required
+            delivered += [(row['ble_mac_address'], row['adv_packets_count'], row['max_timestamp_utc']) for row in changes.devices]
+            since = changes.cursor
+            if not changes.has_more:
+                break
+        cursors[name] = (since, delivered)
+    # La época del cursor es propia de cada motor; lo entregado y su orden, no
+    assert cursors['sqlite'][1] == cursors['memory'][1]
+    for name, engine in (('sqlite', sqlite_engine), ('memory', memory_engine)):
+        caught_up = engine.device_changes(cursors[name][0], 25)
+        assert caught_up.devices == [] and not caught_up.resync_required
+        stale = {shard: ('otra-epoca', position[1], position[2]) for shard, position in cursors[name][0].items()}
+        assert engine.device_changes(stale, 25).resync_required
+
+
+# --- Historial ---
+def test_device_history(engines):
+    sqlite_engine, memory_engine, batches = engines
+    macs = sample_macs(batches)
+    for mac in macs:
+        assert as_dicts(sqlite_engine.device_history(mac, 5)) == memory_engine.device_history(mac, 5)
+    befores = {mac: None for mac in macs}
+    while befores:
+        sqlite_pages = sqlite_engine.device_history_batch(befores, 2)
+        memory_pages = memory_engine.device_history_batch(befores, 2)
+        assert {mac: as_dicts(rows) for mac, rows in sqlite_pages.items()} == memory_pages
+        befores = {mac: storage.history_order_key(rows[-1]) for mac, rows in memory_pages.items() if len(rows) == 2}
+
+
+# --- Visitas ---
+def test_sessions(engines, time_range):
+    sqlite_engine, memory_engine, batches = engines
+    start = storage.utc_string_to_epoch(time_range[0][0])
+    rnd = random.Random(SEED)
+    records = [sessions.SessionRecord(mac, start + offset, start + offset + duration, sorted(rnd.sample(ESPS, 2)),
+                                      rnd.randrange(-90, -40), rnd.randrange(1, 50))
+               for mac in sample_macs(batches, 10)
+               for offset, duration in ((rnd.randrange(-7200, 0), rnd.randrange(0, 4000)), (rnd.randrange(0, 3600), rnd.randrange(0, 600)))]
+    sqlite_engine.store_sessions(records)
+    memory_engine.store_sessions(records)
+    window = (storage.epoch_to_utc_string(start - 1800), storage.epoch_to_utc_string(start + 1800))
+    for esp_id in (None, 'ESP_C'):
+        assert sqlite_engine.sessions_overlapping(*window, 86400, esp_id=esp_id) == \
+            memory_engine.sessions_overlapping(*window, 86400, esp_id=esp_id)
+        assert sqlite_engine.dwell_histogram(*window, esp_id=esp_id) == memory_engine.dwell_histogram(*window, esp_id=esp_id)
+    assert sqlite_engine.sessions_overlapping(*window, 86400, limit=3) == memory_engine.sessions_overlapping(*window, 86400, limit=3)
+    assert sqlite_engine.dwell_histogram() == memory_engine.dwell_histogram()
+
+
+# --- Analíticas ---
+@pytest.mark.parametrize('group_by', ('none', 'esp', 'hour_of_day'))
+def test_distinct_counts(engines, time_range, aligned_ranges, group_by):
+    sqlite_engine, memory_engine, _ = engines
+    for start_utc, end_utc in time_range + aligned_ranges:
+        for esp_ids in (None, ['ESP_A', 'ESP_C']):
+            assert sqlite_engine.distinct_counts(group_by, start_utc, end_utc, esp_ids, exact=True) == \
+                memory_engine.distinct_counts(group_by, start_utc, end_utc, esp_ids, exact=True)
+    for start_utc, end_utc in aligned_ranges + ((None, None),):
+        for esp_ids in (None, ['ESP_A', 'ESP_C']):
+            # La unión de HyperLogLog es exacta: SQLite combina los de cada (ESP, hora) y llega a los mismos registros
+            memory_estimates = {key: sketch.estimate() for key, sketch in
+                                memory_engine.distinct_sketches(group_by, start_utc, end_utc, esp_ids).items()}
+            assert {key: sketch.estimate() for key, sketch in
+                    sqlite_engine.distinct_sketches(group_by, start_utc, end_utc, esp_ids).items()} == memory_estimates
+            if start_utc is not None:
+                estimated, approximate = sqlite_engine.distinct_counts(group_by, start_utc, end_utc, esp_ids, exact=False)
+                assert approximate and estimated == memory_estimates
+
+
+def test_activity_and_rssi_series(engines, time_range):
+    sqlite_engine, memory_engine, batches = engines
+    for mac in sample_macs(batches):
+        for start_utc, end_utc in ((None, None),) + time_range:
+            for time_format in ('%Y-%m-%d %H:00', '%H'):
+                assert sqlite_engine.activity_counts(mac, time_format, start_utc, end_utc) == \
+                    memory_engine.activity_counts(mac, time_format, start_utc, end_utc)
+            for esp_id in (None, 'ESP_B'):
+                assert as_dicts(sqlite_engine.rssi_points(mac, start_utc, end_utc, esp_id)) == \
+                    memory_engine.rssi_points(mac, start_utc, end_utc, esp_id)
+                assert sqlite_engine.rssi_series(mac, start_utc, end_utc, esp_id, limit=5) == \
+                    memory_engine.rssi_series(mac, start_utc, end_utc, esp_id, limit=5)
+
+
+def test_rssi_histograms_and_manufacturers(engines, time_range, aligned_ranges):
+    sqlite_engine, memory_engine, _ = engines
+    for start_utc, end_utc in ((None, None),) + time_range + aligned_ranges:
+        for esp_id in (None, 'ESP_D'):
+            assert sqlite_engine.rssi_histogram(esp_id, start_utc, end_utc) == memory_engine.rssi_histogram(esp_id, start_utc, end_utc)
+        if start_utc is not None:
+            for top_n in (2, 10):
+                assert sqlite_engine.manufacturer_ranking(start_utc, end_utc, top_n) == \
+                    memory_engine.manufacturer_ranking(start_utc, end_utc, top_n)
+    for start_utc, end_utc in time_range + aligned_ranges + ((None, None),):
+        for group_by in storage.PERCENTILE_GROUPINGS:
+            # Los histogramas guardados por (ESP, hora/día) solo se comparan en rangos alineados
+            for exact in ((True,) if (start_utc, end_utc) in time_range else (False, True)):
+                for esp_ids in (None, ['ESP_A', 'ESP_B']):
+                    expected = memory_engine.rssi_percentile_histograms(group_by, start_utc, end_utc, esp_ids, exact)
+                    result = sqlite_engine.rssi_percentile_histograms(group_by, start_utc, end_utc, esp_ids, exact)
+                    assert {key: histogram.to_bytes() for key, histogram in result.items()} == \
+                        {key: histogram.to_bytes() for key, histogram in expected.items()}
+
+
+# --- Rendimiento ---
+def test_engine_timings(tmp_path, monkeypatch):
+    """
+    Cota holgada de tiempo para los dos motores con el mismo volumen: detecta regresiones de orden de
+    magnitud (p.ej. un recorrido completo por lote o una consulta sin índice), no compara máquinas.
+    """
+    monkeypatch.setattr(backend_server, 'DATABASE_NAME', str(tmp_path / 'timing.db'))
+    monkeypatch.setattr(backend_server, 'shard_router', sharding.ShardRouter({}, backend_server.SHARD_DATABASE_TEMPLATE))
+    monkeypatch.setattr(backend_server, 'fingerprint_indexes', {sharding.DEFAULT_SHARD: fingerprint.FingerprintIndex()})
+    batches = make_batches(seed=SEED + 1, batches=200, population=2000, batch_size=100)
+    records = sum(len(batch_records) for _, batch_records in batches)
+    for engine in (backend_server.SQLiteStorage(), storage.MemoryStorage()):
+        engine.init()
+        started = time.perf_counter()
+        for esp_id, batch_records in batches:
+            engine.store_batch(esp_id, batch_records)
+        ingest_sec = time.perf_counter() - started
+        started = time.perf_counter()
+        engine.count_devices({'company_id': 0x004C}, True)
+        engine.list_devices({}, 'last_seen_timestamp', 'desc', 50)
+        engine.list_devices({'esp_id': 'ESP_A', 'min_rssi': -70}, 'adv_packets_count', 'desc', 50)
+        engine.distinct_counts('esp', exact=True)
+        engine.rssi_percentile_histograms('esp')
+        query_sec = time.perf_counter() - started
+        name = type(engine).__name__
+        assert ingest_sec / records < 0.002, f"{name}: {1e6 * ingest_sec / records:.0f} us por advertisement"
+        assert query_sec < 2.0, f"{name}: consultas en {query_sec:.2f} s"